@@ -10,6 +10,7 @@ import numpy as np
 from astropy.io import fits
 import glob
 import copy
+from scipy import ndimage
 from pyDANDIA import logs
 from pyDANDIA import pixelmasks
 import matplotlib as mpl
@@ -503,7 +504,8 @@ def construct_the_pixel_mask(setup, reduction_metadata,
     :rtype: array_like
     '''
 
-    log.info('Constructing the image bad pixel mask')
+    if log != None:
+        log.info('Constructing the image bad pixel mask')
 
     try:
         bpm = BadPixelMask()
@@ -523,7 +525,8 @@ def construct_the_pixel_mask(setup, reduction_metadata,
             else:
                 bpm.instrument_mask = np.zeros(image_dims).astype(int)
 
-            log.info('Included instrumental bad pixel mask data')
+            if log != None:
+                log.info('Included instrumental bad pixel mask data')
 
         if type(banzai_bpm) == type(fits.hdu.image.ImageHDU()):
 
@@ -572,10 +575,10 @@ def construct_the_pixel_mask(setup, reduction_metadata,
 def find_clusters_saturated_pixels(setup,saturated_pixel_mask,image_shape,log):
     """Function to find clusters in the pixels of a saturated pixel mask.
 
-    This applies a varient of the Density-Based Spatial Cluster of Applications
-    with Noise (DBSCAN) approach developed by Ester, M, et al. (1996), Proc.
-    2nd Intl. Conf. Knowledge Discovery and Data Mining (KDD-96), E.Simmouds,
-    J.Han & U.M.Fayyad eds., AAAI Press, p.226-231.
+    Saturated pixels are grouped into clusters of 8-connected pixels using
+    connected-component labelling of the mask, so the cost scales linearly
+    with the number of pixels in the image and the result does not depend on
+    the order in which the pixels are visited.
 
     :param array saturated_pixel_mask: Binary mask of saturated pixels
     :param tuple image_shape: Shape of the full image, represented as a np.array
@@ -584,117 +587,78 @@ def find_clusters_saturated_pixels(setup,saturated_pixel_mask,image_shape,log):
     logs.ifverbose(log,setup,'\n')
     logs.ifverbose(log,setup,'\nAnalysing saturated pixels to look for clusters around bright objects')
 
-    # Initially, every saturated pixel is considered to be in a
-    # unique cluster of 1 pixel.
-    clusters = []
-
-    j = -1
-
-    idx = np.where(saturated_pixel_mask == 1)
-
-    logs.ifverbose(log,setup,'Image has a total of '+str(len(idx[0]))+' saturated pixels')
-
-    for i in range(0,len(idx[0]),1):
-
-        x = idx[1][i]
-        y = idx[0][i]
-
-        j += 1
-
-        clusters.append( PixelCluster(index=j, xc=x, yc=y) )
-
-    # Iteratively merge clusters if they have neighbouring saturated pixels
-    n_iter = 0
-    max_iter = 5
-
-    iterate = True
-
-    while iterate:
-
-        n_iter += 1
-        mergers = []
-        remaining_clusters = {}
-
-        logs.ifverbose(log,setup,'Iteration '+str(n_iter))
-
-        for ic,c in enumerate(clusters):
-
-            if ic not in mergers:
-
-                logs.ifverbose(log,setup,'\nCluster '+str(c.index)+' at '+str(c.xc)+', '+str(c.yc))
-
-                c.id_neighbouring_pixels(image_shape)
-
-                logs.ifverbose(log,setup,' -> Found '+str(len(c.neighbours))+' neighbouring pixels')
-                logs.ifverbose(log,setup,c.neighbours)
-
-                n_mask_neighbours = 0
-
-                for n in c.neighbours:
-
-                    for ik,k in enumerate(clusters):
-
-                        if ic != ik and ik not in mergers and \
-                            k.check_pixel_in_cluster(n[0],n[1]):
-
-                            n_mask_neighbours += 1
-
-                            logs.ifverbose(log,setup,' -> Neighbouring pixel '+\
-                                            repr(n)+ ' in cluster '+str(ik)+' '+\
-                                            repr(k.check_pixel_in_cluster(n[0],n[1])))
-
-                            logs.ifverbose(log,setup,'Merging '+str(ik)+' with '+str(ic))
-
-                            mergers.append(ik)
-
-                            c.merge_cluster(k,log=log)
+    mask = (np.asarray(saturated_pixel_mask) == 1)[0:image_shape[0],0:image_shape[1]]
 
-                            if c.index not in remaining_clusters.keys():
-                                remaining_clusters[c.index] = c
+    logs.ifverbose(log,setup,'Image has a total of '+str(mask.sum())+' saturated pixels')
 
-                            logs.ifverbose(log,setup,'Remaining clusters: '+repr(remaining_clusters.keys()))
-                            logs.ifverbose(log,setup,'Mergers: '+repr(mergers))
+    (labels, nclusters) = ndimage.label(mask,
+                                        structure=ndimage.generate_binary_structure(2,2))
 
-                if n_mask_neighbours == 0:
+    (yp, xp) = np.nonzero(labels)
 
-                     remaining_clusters[c.index] = c
+    clusters = build_pixel_clusters(xp, yp, labels[yp,xp], nclusters)
 
-                     logs.ifverbose(log,setup,'Remaining clusters: '+repr(remaining_clusters.keys()))
-                     logs.ifverbose(log,setup,'Mergers: '+repr(mergers))
+    logs.ifverbose(log,setup,'N clusters = '+str(len(clusters)))
 
-        logs.ifverbose(log,setup,'N mergers = '+str(len(mergers)))
-
-        logs.ifverbose(log,setup,'\nChecking for duplicated clusters:')
+    return clusters
 
-        clusters = []
+def build_pixel_clusters(xp, yp, labels, nclusters):
+    """Function to build the PixelCluster objects for a set of labelled pixels.
 
-        for c in remaining_clusters.values():
+    The centroid (median pixel position), bounding box and pixel range of
+    every cluster are calculated in a single pass over the sorted pixel lists.
 
-            new = True
+    :param array xp: x-positions of the pixels
+    :param array yp: y-positions of the pixels
+    :param array labels: Cluster label of each pixel, numbered from 1
+    :param int nclusters: Number of clusters
 
-            for k in clusters:
+    :return: list of PixelCluster objects ordered by label
+    :rtype: list
+    """
 
-                if k.check_for_identical_cluster(c):
+    clusters = []
 
-                    new = False
+    if nclusters == 0:
+        return clusters
 
-                    logs.ifverbose(log,setup,'Clusters '+str(k.index)+\
-                    ' and '+str(c.index)+\
-                    ' have the same pixel list, eliminating the duplicate')
+    order = np.lexsort((yp, xp, labels))
+    xp = np.asarray(xp)[order]
+    yp = np.asarray(yp)[order]
+    labels = np.asarray(labels)[order]
 
-            if new:
+    npix = np.bincount(labels, minlength=nclusters+1)[1:]
+    starts = np.concatenate(([0], np.cumsum(npix)[:-1]))
+    ends = starts + npix
 
-                clusters.append(c)
+    xmin = np.minimum.reduceat(xp, starts)
+    xmax = np.maximum.reduceat(xp, starts)
+    ymin = np.minimum.reduceat(yp, starts)
+    ymax = np.maximum.reduceat(yp, starts)
 
-        logs.ifverbose(log,setup,'N remaining clusters = '+str(len(clusters)))
+    xc = 0.5 * (xp[starts + (npix-1)//2] + xp[starts + npix//2])
+    ysorted = yp[np.lexsort((yp, labels))]
+    yc = 0.5 * (ysorted[starts + (npix-1)//2] + ysorted[starts + npix//2])
 
-        logs.ifverbose(log,setup,'Iteration '+str(n_iter))
+    for i in range(0,nclusters,1):
 
-        if len(mergers) == 0 or n_iter >= max_iter or len(clusters) == 1:
+        c = PixelCluster(index=i)
+        c.xc = xc[i]
+        c.yc = yc[i]
+        c.pixels = np.column_stack((xp[starts[i]:ends[i]],
+                                    yp[starts[i]:ends[i]])).tolist()
 
-            iterate = False
+        if npix[i] > 1:
+            c.range = [xmin[i], xmax[i], ymin[i], ymax[i]]
+            if ymax[i] > ymin[i]:
+                c.xyratio = float(xmax[i]-xmin[i])/float(ymax[i]-ymin[i])
+            else:
+                c.xyratio = np.inf
+        else:
+            c.range = [0.0, 0.0, 0.0, 0.0]
+            c.xyratio = 1.0
 
-        logs.ifverbose(log,setup,'\nContinue? '+repr(iterate)+'\n')
+        clusters.append(c)
 
     return clusters
 
@@ -792,69 +756,19 @@ def find_rows_with_blooming(saturated_pixel_mask, diagnostic_plots=False):
 def find_clusters_in_vector(vector,verbose=False):
     """Function to identify clusters of contiguous values in an integer vector"""
 
-    clusters = []
-
-    for i in range(0,len(vector),1):
-        clusters.append( PixelCluster(index=i, xc=vector[i], yc=0) )
-
-    n_iter = 0
-    max_iter = 3
-
-    iterate = True
-
-    while iterate:
-
-        n_iter += 1
-
-        mergers = []
-        remaining_clusters = {}
-
-        if verbose: print('Iteration: '+str(n_iter))
-
-        for ic,c in enumerate(clusters):
-
-            if verbose: print('Cluster '+str(c.index)+' '+repr(c.pixels))
-
-            if c.index not in mergers:
-
-                n_c_mergers = 0
-
-                for ik,k in enumerate(clusters):
-
-                    min_sep = c.calc_min_separation(k)
-
-                    if verbose:
-                        print(' -> kluster '+str(k.index)+\
-                                ' separation='+str(min_sep))
-
-                    if ic != ik and abs(min_sep) <= 1:
-
-                        if verbose:
-                            print(' --> Merged kluster '+str(k.index)+\
-                                    ' with '+str(c.index))
-
-                        n_c_mergers += 1
-
-                        c.merge_cluster(k)
-
-                        mergers.append(ik)
-
-                        if c.index not in remaining_clusters.keys():
-                            remaining_clusters[c.index] = c
+    vector = np.sort(np.asarray(vector, dtype=int))
 
-                if n_c_mergers == 0:
-                    remaining_clusters[c.index] = c
+    if len(vector) == 0:
+        return []
 
-            if verbose:
-                print('Mergers: '+repr(mergers))
-                print('Remaining clusters: '+repr(remaining_clusters))
+    labels = np.cumsum(np.concatenate(([1], (np.diff(vector) > 1).astype(int))))
 
-        clusters = []
-        for c in remaining_clusters.values():
-            clusters.append(c)
+    clusters = build_pixel_clusters(vector, np.zeros(len(vector), dtype=int),
+                                    labels, labels[-1])
 
-        if len(mergers) == 0 or n_iter >= max_iter or len(clusters) == 1:
-            iterate = False
+    if verbose:
+        for c in clusters:
+            print('Cluster '+c.summary())
 
     return clusters
 
@@ -1,10 +1,12 @@
 from astropy.io import fits
 from astropy.table import Table
 from astropy.table import Column
+from astropy.table import vstack
 from astropy.coordinates import SkyCoord
 from astropy import units
 from pyDANDIA import match_utils
 import numpy as np
+from scipy.spatial import cKDTree
 from os import path
 import copy
 
@@ -22,6 +24,7 @@ class CrossMatchTable():
         self.stars = Table()
         self.images = Table()
         self.stamps = Table()
+        self.field_tree = None
 
     def create(self, params):
         xmatch = fits.HDUList()
@@ -62,6 +65,7 @@ class CrossMatchTable():
 
         self.datasets = Table(dataset_columns)
         self.field_index = Table(field_index_columns)
+        self.field_tree = None
         self.create_stars_table()
         self.create_images_table()
         self.create_stamps_table()
@@ -245,14 +249,8 @@ class CrossMatchTable():
 
         # Cross-match all entries in the field catalog with those stars
         # detected in the current dataset:
-        dataset_stars = SkyCoord( dataset_metadata.star_catalog[1]['ra'],
-                                    dataset_metadata.star_catalog[1]['dec'],
-                                    frame='icrs', unit=(units.deg, units.deg) )
-
-        field_stars = SkyCoord(self.field_index['ra'], self.field_index['dec'],
-                            frame='icrs', unit=(units.deg, units.deg) )
-
-        (field_idx, separations2D, separations3D) = dataset_stars.match_to_catalog_3d(field_stars)
+        (field_idx, separations2D) = self.nearest_field_stars(dataset_metadata.star_catalog[1]['ra'],
+                                                              dataset_metadata.star_catalog[1]['dec'])
 
         # Add stars with matches within the separation_threshold to the
         # matched_stars index
@@ -260,22 +258,41 @@ class CrossMatchTable():
         matching_dataset_index = np.arange(0,len(dataset_metadata.star_catalog[1]),1)[constraint]
         matching_field_index = field_idx[constraint]
 
-        for j,jdataset in enumerate(matching_dataset_index):
-            jfield = matching_field_index[j]
-            field_star_row = self.field_index[jfield]
-            dataset_star_row = dataset_metadata.star_catalog[1][jdataset]
-            (star_added,matched_stars) = self.add_to_match_index(field_star_row, dataset_star_row,
-                                    separations2D[jdataset], matched_stars, log,
-                                    verbose=verbose)
+        dataset_catalog = dataset_metadata.star_catalog[1]
+        nmatches = len(matching_dataset_index)
+        p = {'cat1_index': self.field_index['field_id'][matching_field_index],
+             'cat1_ra': self.field_index['ra'][matching_field_index],
+             'cat1_dec': self.field_index['dec'][matching_field_index],
+             'cat1_x': np.zeros(nmatches),
+             'cat1_y': np.zeros(nmatches),
+             'cat2_index': dataset_catalog['index'][matching_dataset_index],
+             'cat2_ra': dataset_catalog['ra'][matching_dataset_index],
+             'cat2_dec': dataset_catalog['dec'][matching_dataset_index],
+             'cat2_x': np.zeros(nmatches),
+             'cat2_y': np.zeros(nmatches),
+             'separation': separations2D[constraint].value}
+        matched_stars.add_matches(p, log=log)
 
         # Add all other stars to the orphan's list:
-        unmatched_dataset_index = np.arange(0,len(dataset_metadata.star_catalog[1]),1)
-        matched_star_indices = np.array(matched_stars.cat2_index) - 1
+        unmatched_dataset_index = np.arange(0,len(dataset_catalog),1)
+        matched_star_indices = np.array(matched_stars.cat2_index, dtype='int') - 1
         unmatched_dataset_index = np.delete(unmatched_dataset_index,matched_star_indices)
-        for jdataset in unmatched_dataset_index:
-            dataset_star_row = dataset_metadata.star_catalog[1][jdataset]
-            (star_added, orphans) = self.add_to_orphans(dataset_star_row, orphans,
-                                                    log, verbose=verbose)
+        norphans = len(unmatched_dataset_index)
+        p = {'cat1_index': [None]*norphans,
+             'cat1_ra': np.zeros(norphans),
+             'cat1_dec': np.zeros(norphans),
+             'cat1_x': np.zeros(norphans),
+             'cat1_y': np.zeros(norphans),
+             'cat2_index': dataset_catalog['index'][unmatched_dataset_index],
+             'cat2_ra': dataset_catalog['ra'][unmatched_dataset_index],
+             'cat2_dec': dataset_catalog['dec'][unmatched_dataset_index],
+             'cat2_x': np.zeros(norphans),
+             'cat2_y': np.zeros(norphans),
+             'separation': np.zeros(norphans) - 1.0}
+
+        # Orphans are appended without checking for duplication, since no
+        # cat1 index is given
+        orphans.add_matches(p, log=log, replace_worse_matches=False)
 
         return matched_stars, orphans
 
@@ -286,15 +303,10 @@ class CrossMatchTable():
 
         matched_stars = match_utils.StarMatchIndex()
 
-        field_stars = SkyCoord(self.field_index['ra'], self.field_index['dec'],
-                            frame='icrs', unit=(units.deg, units.deg) )
-        gaia_stars = SkyCoord(gaia_data['ra'], gaia_data['dec'],
-                            frame='icrs', unit=(units.deg, units.deg) )
-
-        log.info('Matching '+str(len(field_stars))+' field stars against '+\
-                str(len(gaia_stars))+' stars in the Gaia catalog')
+        log.info('Matching '+str(len(self.field_index))+' field stars against '+\
+                str(len(gaia_data))+' stars in the Gaia catalog')
 
-        (field_idx, separations2D, separations3D) = gaia_stars.match_to_catalog_3d(field_stars)
+        (field_idx, separations2D) = self.nearest_field_stars(gaia_data['ra'], gaia_data['dec'])
 
         constraint = separations2D < params['separation_threshold']
         matching_gaia_index = np.arange(0,len(gaia_data),1)[constraint]
@@ -403,26 +415,28 @@ class CrossMatchTable():
 
         # Update field index with matched stars
         log.info('Updating field index with matched stars:')
-        for j in range(0,len(matched_stars.cat1_index),1):
-            jfield = np.where(self.field_index['field_id'] == matched_stars.cat1_index[j])
-            row = self.field_index[jfield]
-            row[dataset_code+'_index'] = matched_stars.cat2_index[j]    # Cat 2 star ID NOT index
-            self.field_index[jfield] = row
-            #log.info(repr(row))
+        jfield = self.field_index_rows(matched_stars.cat1_index)
+        present = jfield >= 0
+        self.field_index[dataset_code+'_index'][jfield[present]] = \
+                np.array(matched_stars.cat2_index)[present]    # Cat 2 star ID NOT index
 
         # Append orphans to the end of the field index
         log.info('Updating field index with orphans:')
         log.info(repr(orphans.cat2_index))
-        ncol = len(self.field_index.colnames)
-        dataset_col = self.field_index.colnames.index(dataset_code+'_index')
-        for j in range(0,len(orphans.cat2_index),1):
-            jfield = len(self.field_index) + 1      # Becomes new star ID NOT index
-            jdataset = orphans.cat2_index[j] - 1    # Converts cat 2 star ID to index
-            gaia_id =  dataset_metadata.star_catalog[1][int(jdataset)]['gaia_source_id']
-            row = [jfield, orphans.cat2_ra[j], orphans.cat2_dec[j], 0, 0, gaia_id] + [0]*(ncol-6)
-            row[dataset_col] = orphans.cat2_index[j]    # Star ID in dataset
-            self.field_index.add_row(row)
-            #log.info(repr(row)+' dataset star '+str(j))
+        norphans = len(orphans.cat2_index)
+        if norphans > 0:
+            nstars = len(self.field_index)
+            jdataset = np.array(orphans.cat2_index, dtype='int') - 1    # Converts cat 2 star ID to index
+
+            new_rows = Table( [Column(name=col, data=np.zeros(norphans, dtype=self.field_index[col].dtype))
+                                for col in self.field_index.colnames] )
+            new_rows['field_id'] = np.arange(nstars+1, nstars+norphans+1, 1)     # Becomes new star ID NOT index
+            new_rows['ra'] = orphans.cat2_ra
+            new_rows['dec'] = orphans.cat2_dec
+            new_rows['gaia_source_id'][:] = dataset_metadata.star_catalog[1]['gaia_source_id'][jdataset]
+            new_rows[dataset_code+'_index'] = orphans.cat2_index    # Star ID in dataset
+
+            self.field_index = vstack([self.field_index, new_rows], join_type='exact')
 
     def dataset_index(self, red_dir):
         """Method to search the header index of matched data directories and
@@ -458,18 +472,13 @@ class CrossMatchTable():
                      3: [ra_range[0]+dra, ra_range[1], dec_range[0]+ddec, dec_range[1]],
                      4: [ra_range[0], ra_range[0]+dra, dec_range[0]+ddec, dec_range[1]]}
 
-        nstars_quadrants = [0,0,0,0]
-
-        for j in range(0,len(self.field_index),1):
-            star = self.field_index[j]
-
-            for q, quad_data in quadrants.items():
-                if field_stars[j].ra >= quad_data[0] and field_stars[j].ra <= quad_data[1] \
-                    and field_stars[j].dec >= quad_data[2] and field_stars[j].dec <= quad_data[3]:
-                    nstars_quadrants[q-1] += 1
-                    star['quadrant'] = q
-                    star['quadrant_id'] = nstars_quadrants[q-1]
-                    self.field_index[j] = star
+        # Stars on the boundary between quadrants are counted in each of
+        # them but assigned to the last
+        for q, quad_data in quadrants.items():
+            in_quadrant = (field_stars.ra >= quad_data[0]) & (field_stars.ra <= quad_data[1]) \
+                        & (field_stars.dec >= quad_data[2]) & (field_stars.dec <= quad_data[3])
+            self.field_index['quadrant'][in_quadrant] = q
+            self.field_index['quadrant_id'][in_quadrant] = np.arange(1,in_quadrant.sum()+1,1)
 
     def init_stars_table(self):
 
@@ -589,6 +598,7 @@ class CrossMatchTable():
         hdu_list = fits.open(file_path, mmap=True)
         self.gaia_dr = hdu_list[0].header['GAIA_DR']
         self.field_index = load_binary_table(hdu_list, 1)
+        self.field_tree = None
         self.datasets = load_binary_table(hdu_list, 2)
         self.stars = load_binary_table(hdu_list, 3)
         self.images = load_binary_table(hdu_list, 4)
@@ -601,42 +611,137 @@ class CrossMatchTable():
         """Method to return the field_index indices of a set of stars based on
         an input list of field_index identifiers"""
 
-        field_index = []
-        for star_id in field_ids:
-            idx = np.where(self.field_index['field_id'] == star_id)[0]
-            if len(idx) == 1:
-                field_index.append(idx[0])
-            else:
-                field_index.append(None)
+        field_index = [ int(idx) if idx >= 0 else None
+                        for idx in self.field_index_rows(field_ids) ]
+
         return field_index
 
+    def field_index_rows(self, field_ids):
+        """Method to return the array indices in the field_index of a set of
+        stars, based on their field_index identifiers.  Returns -1 for stars
+        which are not present, or not unique, in the field_index"""
+
+        field_ids = np.array(field_ids, dtype='int')
+        index_ids = np.array(self.field_index['field_id'], dtype='int')
+
+        order = np.argsort(index_ids, kind='stable')
+        sorted_ids = index_ids[order]
+        first = np.searchsorted(sorted_ids, field_ids, side='left')
+        last = np.searchsorted(sorted_ids, field_ids, side='right')
+
+        rows = np.full(len(field_ids), -1, dtype='int')
+        unique = (last - first) == 1
+        rows[unique] = order[first[unique]]
+
+        return rows
+
+    def field_index_tree(self):
+        """Method to return a KD-tree of the unit vectors of the positions of
+        the stars in the field_index.  The tree is built on first use and
+        rebuilt only if the field_index is reloaded or changes length"""
+
+        if self.field_tree is None or self.field_tree.n != len(self.field_index):
+            self.field_tree = cKDTree( radec_to_unit_vectors(self.field_index['ra'],
+                                                             self.field_index['dec']) )
+
+        return self.field_tree
+
+    def nearest_field_stars(self, ra, dec):
+        """Method to identify the nearest star in the field_index to each of a
+        set of positions
+
+        Inputs:
+        :param array ra: RA of positions in decimal degrees
+        :param array dec: Dec of positions in decimal degrees
+
+        Outputs:
+        :param array field_idx: Array index in the field_index of the nearest star
+        :param Quantity separations: Separation to the nearest star in degrees
+        """
+
+        (chord, field_idx) = self.field_index_tree().query( radec_to_unit_vectors(ra, dec) )
+
+        return field_idx, chord_to_separation(chord)*units.deg
+
+    def cone_search_on_positions(self, ra_centres, dec_centres, radius):
+        """Method to perform cone searches of the field_index around a set of
+        positions in a single query
+
+        Inputs:
+        :param array ra_centres: RA of search centres in decimal degrees
+        :param array dec_centres: Dec of search centres in decimal degrees
+        :param float radius: Search radius in decimal degrees
+
+        Outputs:
+        :param Table results: One row per star within the radius of each
+                              centre, giving the target_index of the centre,
+                              the field_idx array index and field_id of the
+                              star, its position and its separation in degrees
+        """
+
+        targets = radec_to_unit_vectors(ra_centres, dec_centres)
+        chord = 2.0 * np.sin(np.deg2rad(radius)/2.0)
+
+        matches = self.field_index_tree().query_ball_point(targets, chord)
+
+        target_index = np.repeat(np.arange(0,len(targets),1),
+                                 [len(m) for m in matches])
+        field_idx = np.array([j for m in matches for j in m], dtype='int')
+
+        separations = chord_to_separation(np.linalg.norm(
+                        self.field_tree.data[field_idx] - targets[target_index], axis=1))
+        keep = separations <= radius
+
+        order = np.lexsort( (field_idx[keep], target_index[keep]) )
+        target_index = target_index[keep][order]
+        field_idx = field_idx[keep][order]
+
+        results = Table( [Column(name='target_index', data=target_index, dtype='int'),
+                          Column(name='field_idx', data=field_idx, dtype='int'),
+                          Column(name='field_id', data=np.array(self.field_index['field_id'])[field_idx], dtype='int'),
+                          Column(name='ra', data=np.array(self.field_index['ra'])[field_idx], dtype='float'),
+                          Column(name='dec', data=np.array(self.field_index['dec'])[field_idx], dtype='float'),
+                          Column(name='separation', data=separations[keep][order], dtype='float')] )
+
+        return results
+
     def cone_search(self, params, log=None, debug=False):
         """Method to perform a cone search on the field index for all objects
         within the search radius (in decimal degrees) of the (ra_center, dec_centre)
         given"""
 
-        starlist = SkyCoord(self.field_index['ra'], self.field_index['dec'],
-                            frame='icrs', unit=(units.deg,units.deg))
-
-        target = SkyCoord(params['ra_centre'], params['dec_centre'],
-                            frame='icrs', unit=(units.deg,units.deg))
+        matches = self.cone_search_on_positions([params['ra_centre']], [params['dec_centre']],
+                                                params['radius'])
 
-        separations = target.separation(starlist)
+        results = self.field_index[matches['field_idx']]
+        results.add_column(matches['separation']*units.deg, name='separation')
 
-        idx = np.where(separations.value <= params['radius'])[0]
-        results = self.field_index[idx]
-        results.add_column(separations[idx], name='separation')
-
-        log.info('Identified '+str(len(results))+' candidates within '+str(params['radius'])+\
+        if log!=None:
+            log.info('Identified '+str(len(results))+' candidates within '+str(params['radius'])+\
                     ' of ('+str(params['ra_centre'])+', '+str(params['dec_centre'])+')')
-        log.info(' '.join(results.colnames))
-        for star in results:
-            log.info(' '.join(str(star[col]) for col in results.colnames))
+            log.info(' '.join(results.colnames))
+            for star in results:
+                log.info(' '.join(str(star[col]) for col in results.colnames))
 
-        if debug and len(idx[0]) == 0:
-            idx = np.where(separations.value == separations.value.min())
-            if log!=None:
-                log.info('Nearest closest star: ')
-                log.info(self.field_index['field_id'][idx], self.field_index['ra'][idx], self.field_index['dec'][idx], separations[idx])
+        if debug and len(results) == 0 and log!=None:
+            (idx, separation) = self.nearest_field_stars([params['ra_centre']], [params['dec_centre']])
+            log.info('Nearest closest star: ')
+            log.info(str(self.field_index['field_id'][idx[0]])+' '+str(self.field_index['ra'][idx[0]])+\
+                     ' '+str(self.field_index['dec'][idx[0]])+' '+str(separation[0]))
 
         return results
+
+def radec_to_unit_vectors(ra, dec):
+    """Function to convert sky positions in decimal degrees into an array of
+    cartesian unit vectors"""
+
+    ra = np.deg2rad(np.array(ra, dtype='float'))
+    dec = np.deg2rad(np.array(dec, dtype='float'))
+
+    return np.column_stack( (np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)) )
+
+def chord_to_separation(chord):
+    """Function to convert the chord length between unit vectors into the
+    angular separation between them in decimal degrees"""
+
+    return np.rad2deg( 2.0 * np.arcsin( np.clip(np.array(chord)/2.0, 0.0, 1.0) ) )
@@ -178,7 +178,7 @@ def remove_table(red_dir):
     # does not remove a table - it can only update the contents of an existing
     # table
     hdulist = [fits.PrimaryHDU()]
-    all_layers = meta2.__dict__.keys()
+    all_layers = meta2.layer_names()
     for key_layer in all_layers:
         layer = getattr(meta2, key_layer)
         if layer != [None, None]:
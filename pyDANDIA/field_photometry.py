@@ -8,8 +8,23 @@ from pyDANDIA import crossmatch_datasets
 from pyDANDIA import hd5_utils
 from pyDANDIA import pipeline_setup
 from astropy.table import Table, Column
+import h5py
 import pdb
 
+# Columns of the dataset photometry arrays transferred to the field photometry
+# arrays, as (field column, dataset column) pairs:
+# hjd, inst_mag, inst_mag_err, cal_mag, cal_mag_err, corr_mag, corr_mag_err,
+# norm_mag, norm_mag_err, ps, ps_err, bkgd, bkgd_err, res_x, res_y, qc_flag
+FIELD_PHOT_COLUMNS = [(0,9),(1,11),(2,12),(3,13),(4,14),(5,23),(6,24),(7,26),(8,27),\
+                      (9,19),(10,20),(12,21),(13,22),(14,7),(15,8),(16,25)]
+FIELD_PHOT_NCOLUMNS = 17
+FIELD_PHOT_STAMP_COLUMN = 11
+
+# Number of stars of each field quadrant populated and written to disk at
+# once.  A multiple of the chunk length of the HDF5 files keeps each write
+# aligned with whole chunks
+FIELD_PHOT_BLOCK_STARS = 8*hd5_utils.PHOT_CHUNK_STARS
+
 def combine_photometry_from_all_datasets():
 
     params = get_args()
@@ -34,25 +49,31 @@ def combine_photometry_from_all_datasets():
         xmatch = populate_stamps_table(xmatch, dataset['dataset_code'], dataset_metadata, log)
 
     # These loops are deliberately separated because it makes it easier to
-    # initialize the photometry array for the whole field to the correct size
-    photometry = init_field_data_table(xmatch,log)
+    # initialize the photometry files for the whole field to the correct size.
+    # The field photometry is written to the HDF5 files of each quadrant
+    # dataset by dataset, so that only a block of stars is held in memory
+    quad_files = init_field_photometry_files(params, xmatch, log)
     for dataset in xmatch.datasets:
         log.info('Populating timeseries photometry with data from '+dataset['dataset_code'])
         setup = pipeline_setup.PipelineSetup()
         setup.red_dir = dataset['dataset_red_dir']
         dataset_metadata = metadata.MetaData()
         dataset_metadata.load_all_metadata(setup.red_dir, 'pyDANDIA_metadata.fits')
-        phot_data = hd5_utils.read_phot_hd5(setup, log=log, return_type='array')
-        if len(phot_data) > 0:
-            (field_star_index, dataset_stars_index) = get_dataset_star_indices(dataset, xmatch)
-            dataset_image_index = get_dataset_image_index(dataset, xmatch)
-            (xmatch,photometry) = populate_photometry_array(field_star_index, dataset_stars_index,
-                                            dataset_image_index, photometry, phot_data, xmatch, log,
-                                            dataset_metadata)
-
-    # Output tables to field HDF5 files in quadrants and update the xmatch table
+        phot_data = hd5_utils.read_phot_hd5(setup, log=log)
+        try:
+            if len(phot_data) > 0:
+                (field_star_index, dataset_stars_index) = get_dataset_star_indices(dataset, xmatch)
+                dataset_image_index = get_dataset_image_index(dataset, xmatch)
+                xmatch = populate_field_photometry_files(field_star_index, dataset_stars_index,
+                                                dataset_image_index, quad_files, phot_data, xmatch, log,
+                                                dataset_metadata)
+        finally:
+            # Datasets without a photometry file return an empty array
+            if isinstance(phot_data, h5py.Dataset):
+                phot_data.file.close()
+
+    # Update the xmatch table
     xmatch.save(params['crossmatch_file'])
-    output_field_photometry(params, xmatch, photometry, log)
 
     log.info('Field photometry: complete')
 
@@ -93,41 +114,16 @@ def build_array_index(array_indices, verbose=False):
     array_indices  list of np.arrays or list of lists
     """
 
-    # Total number of entries in all of the output selection index elements
-    nentries = len(array_indices[0])
-    for array in array_indices[1:]:
-        nentries *= len(array)
+    grids = np.meshgrid(*[np.asarray(array, dtype='int') for array in array_indices],
+                        indexing='ij')
+    index = tuple( [grid.ravel() for grid in grids] )
 
     if verbose:
-        print('Nentries = ',nentries,' based on input array indices of length:')
+        print('Nentries = ',len(index[0]),' based on input array indices of length:')
         [print(len(array)) for array in array_indices]
+        print(index)
 
-    index = []
-
-    for axis in range(0,len(array_indices),1):
-        index.append(np.zeros(nentries, dtype='int'))
-
-        if axis+1 < len(array_indices):
-            nrepeat = len(array_indices[axis+1])
-            for i in range(axis+2,len(array_indices),1):
-                nrepeat *= len(array_indices[i])
-                if verbose: print('nrepeat*= ',nrepeat, i, len(array_indices[i]))
-            if verbose: print('Axis: ',axis,' nrepeat: ',nrepeat)
-
-        else:
-            nrepeat = 1
-
-        istart = 0
-        iend = istart + nrepeat
-        while iend <= nentries:
-            for entry in array_indices[axis]:
-                index[axis][istart:iend].fill(entry)
-                if verbose: print('Loop: ',istart, iend, entry,' axis: ',axis)
-                istart = iend
-                iend = istart + nrepeat
-
-    if verbose: print(index)
-    return tuple(index)
+    return index
 
 def update_array_col_index(index3d, new_col):
     """Function to substitute a new array column number into the 3rd index in a
@@ -163,53 +159,192 @@ def populate_photometry_array(field_star_index, dataset_star_index,
     # combined photometry array:
     phot_index = build_array_index([field_star_index, dataset_image_index,[0]])
     data_index = build_array_index([dataset_star_index, np.arange(0,ndata,1), [9]])
-    photometry[phot_index] = dataset_photometry[data_index]
-
-    # Update the array indices to refer to the photometry columns, and
-    # transfer those data as well.  Tuples listed below give the array indices
-    # of the following columns in the (main, dataset) photometry arrays.
-    # inst_mag, inst_mag_err, cal_mag, cal_mag_err, corr_mag, corr_mag_err,
-    # norm_mag, norm_mag_err, ps, ps_err, bkgd, bkgd_err, res_x, res_y, qc_flag
-    column_index = [(1,11),(2,12),(3,13),(4,14),(5,23),(6,24),(7,26),(8,27),\
-                    (9,19),(10,20),(12,21),(13,22),(14,7),(15,8),(16,25)]
-    for column in column_index:
+
+    # Update the array indices to refer to each of the photometry columns in
+    # turn, and transfer those data
+    for column in FIELD_PHOT_COLUMNS:
         phot_index = update_array_col_index(phot_index, column[0])
         data_index = update_array_col_index(data_index, column[1])
         photometry[phot_index] = dataset_photometry[data_index]
 
     # Populate the stamp index:
-    list_of_stamps = dataset_metadata.stamps[1]['PIXEL_INDEX'].tolist()
-    for stamp in list_of_stamps:
-        stamp_row = np.where(dataset_metadata.stamps[1]['PIXEL_INDEX'] == stamp)[0][0]
-        xmin = int(dataset_metadata.stamps[1][stamp_row]['X_MIN'])
-        xmax = int(dataset_metadata.stamps[1][stamp_row]['X_MAX'])
-        ymin = int(dataset_metadata.stamps[1][stamp_row]['Y_MIN'])
-        ymax = int(dataset_metadata.stamps[1][stamp_row]['Y_MAX'])
+    star_stamps = get_dataset_star_stamps(dataset_metadata)[dataset_star_index]
+    in_stamp = star_stamps >= 0
+    phot_index = build_array_index([np.asarray(field_star_index)[in_stamp], dataset_image_index,
+                                    [FIELD_PHOT_STAMP_COLUMN]])
+    photometry[phot_index] = np.repeat(star_stamps[in_stamp], len(dataset_image_index))
+
+    # Also update the images table with the timestamp data:
+    xmatch = update_images_hjd(xmatch, dataset_image_index,
+                               get_dataset_image_hjds(dataset_photometry))
+
+    log.info('-> Populated photometry array with dataset timeseries photometry')
+    return xmatch, photometry
 
-        stamp_stars = (dataset_metadata.star_catalog[1]['x'] < xmax) & (dataset_metadata.star_catalog[1]['x'] > xmin) & \
-                     (dataset_metadata.star_catalog[1]['y'] < ymax) & (dataset_metadata.star_catalog[1]['y'] > ymin)
+def init_field_photometry_files(params, xmatch, log,
+                                compression=None, compression_opts=None):
+    """Function to create the HDF5 photometry files for each quadrant of the
+    field, with zero-filled, chunked photometry arrays of
+    [Nstars in quadrant, Nimages, Ncolumns].  The stars of each quadrant are
+    stored in the row given by their quadrant_id.
 
-        stamp_star_idx = dataset_metadata.star_catalog[1]['index'][stamp_stars] - 1
+    Returns a dictionary of the file paths of each quadrant
+    """
 
-        field_stamp_star_idx = []
-        for dataset_idx in stamp_star_idx:
-            idx = np.where(dataset_star_index == dataset_idx)[0]
-            if len(idx) > 0:
-                field_stamp_star_idx.append(field_star_index[idx[0]])
+    setup = pipeline_setup.PipelineSetup()
+    setup.red_dir = path.join(path.dirname(params['crossmatch_file']))
 
-        phot_index = build_array_index([field_stamp_star_idx, dataset_image_index,[0]])
-        phot_index = update_array_col_index(phot_index, 11)
+    quad_files = {}
+    for q in range(1,5,1):
+        idx = np.where(xmatch.field_index['quadrant'] == q)[0]
+        nstars = int(xmatch.field_index['quadrant_id'][idx].max()) if len(idx) > 0 else 0
+        shape = (nstars, len(xmatch.images), FIELD_PHOT_NCOLUMNS)
 
-        photometry[phot_index] = stamp
+        filename = params['field_name']+'_quad'+str(q)+'_photometry.hdf5'
+        quad_files[q] = hd5_utils.phot_file_path(setup, filename)
+
+        with h5py.File(quad_files[q], "w") as f:
+            hd5_utils.create_empty_phot_dataset(f, shape,
+                                                compression=compression,
+                                                compression_opts=compression_opts)
+
+        log.info('Initialized timeseries photometry array '+repr(shape)+\
+                 ' for quadrant '+str(q)+' in '+quad_files[q])
+
+    return quad_files
+
+def populate_field_photometry_files(field_star_index, dataset_star_index,
+                                    dataset_image_index, quad_files, dataset_photometry,
+                                    xmatch, log, dataset_metadata,
+                                    block_stars=FIELD_PHOT_BLOCK_STARS):
+    """Function to transfer the timeseries photometry of a single dataset to
+    the HDF5 photometry files of the field quadrants.
+
+    The stars of each quadrant are processed in blocks of block_stars rows;
+    the photometry of the dataset's images for each block is assembled in
+    memory and written to the file before the next block is read.  Since
+    the images of each dataset occupy their own columns of the image axis,
+    the blocks can be written without reading back data from other datasets.
+
+    :param array field_star_index: Field index array indices of the dataset's stars
+    :param array dataset_star_index: Corresponding array indices in the dataset
+    :param array dataset_image_index: Images table indices of the dataset's images
+    :param dict quad_files: Paths to the photometry files of each quadrant
+    :param array dataset_photometry: Dataset photometry array or HDF5 dataset
+    :param CrossMatchTable xmatch: Field crossmatch table
+    :param logging log: Open log
+    :param MetaData dataset_metadata: Metadata of the dataset's reduction
+    :param int block_stars: Number of quadrant stars written at once
+    """
 
-    # Also update the images table with the timestamp data:
-    for i in range(0,ndata,1):
-        jdx = np.where(dataset_photometry[:,i,9] > 0)[0]
-        if len(jdx) > 0:
-            xmatch.images['hjd'][dataset_image_index[i]] = dataset_photometry[jdx[0],i,9]
+    field_star_index = np.asarray(field_star_index, dtype='int')
+    dataset_star_index = np.asarray(dataset_star_index, dtype='int')
+    dataset_image_index = np.asarray(dataset_image_index, dtype='int')
 
-    log.info('-> Populated photometry array with dataset timeseries photometry')
-    return xmatch, photometry
+    ndata = dataset_photometry.shape[1]
+    log.info('N datapoints in image data: '+str(ndata)+', len dataset_image_index: '+str(len(dataset_image_index)))
+    log.info('Len field_star_index: '+str(len(field_star_index))+' len dataset_star_index: '+str(len(dataset_star_index)))
+
+    star_stamps = get_dataset_star_stamps(dataset_metadata)
+
+    # Contiguous runs of the dataset's images in the field images table are
+    # written as single slices
+    image_order = np.argsort(dataset_image_index)
+    runs = np.split(image_order, np.where(np.diff(dataset_image_index[image_order]) != 1)[0] + 1)
+
+    star_quadrants = np.array(xmatch.field_index['quadrant'])[field_star_index]
+    star_rows = np.array(xmatch.field_index['quadrant_id'])[field_star_index] - 1
+
+    for q, file_path in quad_files.items():
+        in_quad = np.where(star_quadrants == q)[0]
+        if len(in_quad) == 0:
+            continue
+
+        with h5py.File(file_path, "a") as f:
+            dset = f['dataset_photometry']
+
+            for row0 in range(0, dset.shape[0], block_stars):
+                row1 = min(row0+block_stars, dset.shape[0])
+                jdx = in_quad[(star_rows[in_quad] >= row0) & (star_rows[in_quad] < row1)]
+                if len(jdx) == 0:
+                    continue
+
+                # HDF5 selections must be in increasing order
+                jdx = jdx[np.argsort(dataset_star_index[jdx])]
+                data = dataset_photometry[dataset_star_index[jdx],:,:]
+
+                block = np.zeros((row1-row0, ndata, FIELD_PHOT_NCOLUMNS))
+                phot_index = build_array_index([star_rows[jdx]-row0, np.arange(0,ndata,1), [0]])
+                data_index = build_array_index([np.arange(0,len(jdx),1), np.arange(0,ndata,1), [9]])
+                for column in FIELD_PHOT_COLUMNS:
+                    phot_index = update_array_col_index(phot_index, column[0])
+                    data_index = update_array_col_index(data_index, column[1])
+                    block[phot_index] = data[data_index]
+
+                stamps = star_stamps[dataset_star_index[jdx]]
+                in_stamp = stamps >= 0
+                block[star_rows[jdx][in_stamp]-row0,:,FIELD_PHOT_STAMP_COLUMN] = stamps[in_stamp][:,np.newaxis]
+
+                for run in runs:
+                    if len(run) > 0:
+                        i0 = dataset_image_index[run[0]]
+                        dset[row0:row1, i0:i0+len(run), :] = block[:,run,:]
+
+        log.info('-> Wrote photometry for '+str(len(in_quad))+' stars to quadrant '+str(q))
+
+    xmatch = update_images_hjd(xmatch, dataset_image_index,
+                               get_dataset_image_hjds(dataset_photometry, block_stars=block_stars))
+
+    log.info('-> Populated field photometry with dataset timeseries photometry')
+
+    return xmatch
+
+def get_dataset_star_stamps(dataset_metadata):
+    """Function to return the PIXEL_INDEX of the stamp containing each star in
+    a dataset's star_catalog, or -1 for stars outside all stamps.  Where
+    stamps overlap, stars are assigned to the last stamp in the table"""
+
+    x = np.array(dataset_metadata.star_catalog[1]['x'])
+    y = np.array(dataset_metadata.star_catalog[1]['y'])
+    star_idx = np.array(dataset_metadata.star_catalog[1]['index'], dtype='int') - 1
+
+    star_stamps = np.full(star_idx.max()+1 if len(star_idx) > 0 else 0, -1, dtype='int')
+
+    for stamp in dataset_metadata.stamps[1]:
+        stamp_stars = (x < int(stamp['X_MAX'])) & (x > int(stamp['X_MIN'])) & \
+                      (y < int(stamp['Y_MAX'])) & (y > int(stamp['Y_MIN']))
+        star_stamps[star_idx[stamp_stars]] = int(stamp['PIXEL_INDEX'])
+
+    return star_stamps
+
+def get_dataset_image_hjds(dataset_photometry, block_stars=FIELD_PHOT_BLOCK_STARS):
+    """Function to return the HJD of each image in a dataset's photometry,
+    taken from the first star with a measured HJD, or zero if there is none.
+    The photometry is read in blocks of stars"""
+
+    ndata = dataset_photometry.shape[1]
+    hjds = np.zeros(ndata)
+    found = np.zeros(ndata, dtype='bool')
+
+    for j0 in range(0, dataset_photometry.shape[0], block_stars):
+        if found.all():
+            break
+        block = np.array(dataset_photometry[j0:j0+block_stars,:,9])
+        measured = block > 0
+        first = np.argmax(measured, axis=0)
+        new = ~found & measured.any(axis=0)
+        hjds[new] = block[first[new], np.where(new)[0]]
+        found |= new
+
+    return hjds
+
+def update_images_hjd(xmatch, dataset_image_index, hjds):
+    """Function to record the HJDs of a dataset's images in the images table"""
+
+    measured = hjds > 0
+    xmatch.images['hjd'][np.asarray(dataset_image_index)[measured]] = hjds[measured]
+
+    return xmatch
 
 def get_dataset_star_indices(dataset, xmatch):
 
@@ -346,7 +481,7 @@ def init_field_data_table(xmatch,log):
     # qc_flag
     # Note: corrected_mag columns included to allow for likely future expansion;
     # not yet populated
-    photometry = np.zeros( (len(xmatch.stars), len(xmatch.images), 17) )
+    photometry = np.zeros( (len(xmatch.stars), len(xmatch.images), FIELD_PHOT_NCOLUMNS) )
     log.info('Initialized timeseries photometry array')
 
     return photometry
@@ -1,36 +1,169 @@
 import os
 import h5py
+import collections
 import numpy as np
 
+# Default chunk shape of the photometry datasets, in stars and images.  Square
+# chunks of ~1MB keep both the per-star reads of the lightcurves and the
+# per-image writes of stage6 to a small multiple of the data requested.
+PHOT_CHUNK_STARS = 64
+PHOT_CHUNK_IMAGES = 64
+
+def phot_chunk_shape(shape, chunk_stars=PHOT_CHUNK_STARS,
+                     chunk_images=PHOT_CHUNK_IMAGES):
+    """Function to return the chunk shape of a photometry dataset of the
+    given (nstars, nimages, ncolumns) shape.  The image axis is resizable,
+    so its chunk length does not depend on the current number of images"""
+
+    maxshape = phot_maxshape(shape)
+
+    chunks = [max(1, chunk_stars), max(1, chunk_images), max(1, shape[2])]
+
+    # Chunks must not exceed the data shape along axes of fixed length
+    for axis in range(0,3,1):
+        if maxshape[axis] is not None:
+            chunks[axis] = min(chunks[axis], maxshape[axis])
+
+    return tuple(chunks)
+
+def phot_maxshape(shape):
+    """Function to return the maximum shape of a photometry dataset of the
+    given (nstars, nimages, ncolumns) shape.  The image axis is resizable,
+    as are the star and column axes of empty datasets, since HDF5 does not
+    allow chunks of a fixed-length axis of zero length"""
+
+    return (shape[0] if shape[0] > 0 else None, None,
+            shape[2] if shape[2] > 0 else None)
+
 def write_phot_hd5(setup, dataset_phot_data, log=None,
-                    filename=None):
-    """Function to output a dataset photometry table to an HD5 file"""
+                    filename=None, compression=None, compression_opts=None):
+    """Function to output a dataset photometry table to an HD5 file.
 
-    if not filename:
-        output_path = os.path.join(setup.red_dir,'photometry.hdf5')
-    else:
-        output_path = os.path.join(setup.red_dir,filename)
+    The photometry is stored chunked, with a resizable image axis, so that
+    the photometry of new images can be added in place by update_phot_hd5.
+
+    :param object setup: Pipeline setup instance
+    :param array dataset_phot_data: Photometry array (nstars, nimages, ncolumns)
+    :param logging log: Open reduction log, optional
+    :param str filename: Name of the file in setup.red_dir, optional
+    :param str compression: Lossless HDF5 compression filter, e.g. 'gzip'
+                            or 'lzf', optional
+    :param int compression_opts: Compression level, optional
+    """
+
+    output_path = phot_file_path(setup, filename)
 
     with h5py.File(output_path, "w") as f:
-        dset = f.create_dataset('dataset_photometry',
-                                    dataset_phot_data.shape,
-                                    dtype='float64',
-                                    data=dataset_phot_data)
-    f.close()
+        create_phot_dataset(f, dataset_phot_data,
+                            compression=compression,
+                            compression_opts=compression_opts)
 
     if log:
         log.info('Output photometry dataset for '+str(setup.red_dir)+\
                 ' with '+repr(dataset_phot_data.shape)+\
                 ' datapoints')
 
+def create_phot_dataset(f, dataset_phot_data, compression=None,
+                        compression_opts=None):
+    """Function to create the dataset_photometry dataset in an open HD5 file"""
+
+    dataset_phot_data = np.asarray(dataset_phot_data)
+
+    dset = create_empty_phot_dataset(f, dataset_phot_data.shape,
+                                     compression=compression,
+                                     compression_opts=compression_opts)
+    if dataset_phot_data.size > 0:
+        dset[...] = dataset_phot_data
+
+    return dset
+
+def create_empty_phot_dataset(f, shape, compression=None,
+                              compression_opts=None):
+    """Function to create a zero-filled dataset_photometry dataset of the
+    given (nstars, nimages, ncolumns) shape in an open HD5 file.  Chunks are
+    only allocated on disk as they are written, so the dataset can be
+    populated piecewise without holding the whole array in memory"""
+
+    if compression:
+        filters = {'compression': compression,
+                   'compression_opts': compression_opts,
+                   'shuffle': True}
+    else:
+        filters = {}
+
+    dset = f.create_dataset('dataset_photometry',
+                            shape,
+                            dtype='float64',
+                            chunks=phot_chunk_shape(shape),
+                            maxshape=phot_maxshape(shape),
+                            fillvalue=0.0,
+                            **filters)
+
+    return dset
+
+def update_phot_hd5(setup, dataset_phot_data, image_index, log=None,
+                    filename=None, compression=None, compression_opts=None):
+    """Function to write the photometry of a set of images to an existing
+    HD5 photometry file, in place.  The image axis of the file is extended
+    to the number of images of the dataset_phot_data array if need be.
+
+    Files which do not exist yet, or which were written with a contiguous
+    layout or a different number of stars or columns, are rewritten in full.
+
+    :param object setup: Pipeline setup instance
+    :param array dataset_phot_data: Photometry array (nstars, nimages, ncolumns)
+    :param list image_index: Indices of the images to write on the image axis
+    :param logging log: Open reduction log, optional
+    :param str filename: Name of the file in setup.red_dir, optional
+    :param str compression: Lossless HDF5 compression filter of new files
+    :param int compression_opts: Compression level of new files
+    """
+
+    output_path = phot_file_path(setup, filename)
+
+    if os.path.isfile(output_path):
+        with h5py.File(output_path, "a") as f:
+            dset = f.get('dataset_photometry')
+            appendable = (dset is not None
+                          and dset.maxshape[1] is None
+                          and dset.shape[0] == dataset_phot_data.shape[0]
+                          and dset.shape[2] == dataset_phot_data.shape[2])
+
+            if appendable:
+                if dset.shape[1] < dataset_phot_data.shape[1]:
+                    dset.resize(dataset_phot_data.shape[1], axis=1)
+
+                # Write contiguous runs of images as single slices
+                image_index = np.unique(np.asarray(image_index, dtype=int))
+                runs = np.split(image_index,
+                                np.where(np.diff(image_index) != 1)[0] + 1)
+                for run in runs:
+                    if len(run) > 0:
+                        dset[:, run[0]:run[-1]+1, :] = dataset_phot_data[:, run[0]:run[-1]+1, :]
+
+        if appendable:
+            if log:
+                log.info('Updated the photometry of '+str(len(image_index))+\
+                        ' images in '+output_path)
+            return
+
+    write_phot_hd5(setup, dataset_phot_data, log=log, filename=filename,
+                   compression=compression, compression_opts=compression_opts)
+
+def phot_file_path(setup, filename=None):
+    """Function to return the path to a photometry HD5 file in a reduction
+    directory"""
+
+    if not filename:
+        return os.path.join(setup.red_dir,'photometry.hdf5')
+    else:
+        return os.path.join(setup.red_dir,filename)
+
 def read_phot_hd5(setup,log=None, filename=None, return_type='hdf5'):
     """Function to read an existing dataset photometry table in HD5 format
     Function returns two zero-length arrays if none is available"""
 
-    if not filename:
-        input_path = os.path.join(setup.red_dir,'photometry.hdf5')
-    else:
-        input_path = os.path.join(setup.red_dir,filename)
+    input_path = phot_file_path(setup, filename)
 
     if os.path.isfile(input_path):
         f = h5py.File(input_path, "r")
@@ -65,3 +198,189 @@ def read_phot_from_hd5_file(file_path, return_type='hdf5'):
         return dset
     else:
         return np.array(dset[:])
+
+# Default number of chunks of photometry held in memory by a PhotometryReader
+PHOT_READER_CACHE_CHUNKS = 32
+
+class PhotometryReader(object):
+    """Class providing lazy access to the photometry array of an HD5 file.
+
+    The file is opened once.  The photometry of individual stars is read
+    by chunks of (stars, images), of which the most recently used are kept
+    in memory, so that the lightcurves of a star and its neighbours are
+    extracted without loading the whole array.  Files written with a
+    contiguous layout are read in blocks of the default chunk shape.
+
+    :param str file_path: Path to the photometry HD5 file
+    :param int cache_chunks: Maximum number of chunks held in memory.  At
+                             least the chunks of one row of stars across
+                             all images are held, so that the chunks read
+                             for a star are not evicted before its
+                             neighbours are requested
+    """
+
+    def __init__(self, file_path, cache_chunks=PHOT_READER_CACHE_CHUNKS):
+
+        if not os.path.isfile(file_path):
+            raise IOError('Cannot find input photometry file '+file_path)
+
+        self.file_path = file_path
+        self.file = h5py.File(file_path, "r")
+        self.dset = self.file['dataset_photometry']
+        self.shape = self.dset.shape
+
+        if self.dset.chunks:
+            self.block_shape = self.dset.chunks[0:2]
+        else:
+            self.block_shape = phot_chunk_shape(self.shape)[0:2]
+
+        self.n_image_blocks = int(np.ceil(self.nimages / float(self.block_shape[1])))
+        self.cache_chunks = max(cache_chunks, self.n_image_blocks)
+        self.blocks = collections.OrderedDict()
+
+    @property
+    def nstars(self):
+        return self.shape[0]
+
+    @property
+    def nimages(self):
+        return self.shape[1]
+
+    @property
+    def ncolumns(self):
+        return self.shape[2]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.blocks.clear()
+        self.file.close()
+
+    def read_block(self, star_block, image_block):
+        """Method to return a block of the photometry array, from the cache
+        if it has been read recently"""
+
+        key = (star_block, image_block)
+
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+
+        (bstars, bimages) = self.block_shape
+        block = self.dset[star_block*bstars:(star_block+1)*bstars,
+                          image_block*bimages:(image_block+1)*bimages, :]
+
+        self.blocks[key] = block
+        while len(self.blocks) > self.cache_chunks:
+            self.blocks.popitem(last=False)
+
+        return block
+
+    def get_star(self, star_index, columns=None):
+        """Method to return the photometry of a single star
+
+        :param int star_index: Index of the star in the photometry array
+        :param list columns: Indices of the columns to return, optional
+        :return: array (nimages, ncolumns)
+        """
+
+        star_index = int(star_index)
+        if star_index < 0:
+            star_index += self.nstars
+        if star_index < 0 or star_index >= self.nstars:
+            raise IndexError('Star index '+str(star_index)+' is outside the photometry array of '+\
+                                str(self.nstars)+' stars')
+
+        (bstars, bimages) = self.block_shape
+        star_data = np.zeros((self.nimages, self.ncolumns))
+        for image_block in range(0,self.n_image_blocks,1):
+            block = self.read_block(star_index // bstars, image_block)
+            star_data[image_block*bimages:image_block*bimages+block.shape[1],:] = block[star_index % bstars,:,:]
+
+        if columns is not None:
+            return star_data[:,columns]
+
+        return star_data
+
+    def get_stars(self, star_indices, columns=None):
+        """Method to return the photometry of a set of stars
+
+        :param list star_indices: Indices of the stars in the photometry array
+        :param list columns: Indices of the columns to return, optional
+        :return: array (nstars selected, nimages, ncolumns)
+        """
+
+        star_indices = np.array(star_indices, dtype=int).ravel()
+        star_indices[star_indices < 0] += self.nstars
+        if ((star_indices < 0) | (star_indices >= self.nstars)).any():
+            raise IndexError('Star indices are outside the photometry array of '+\
+                                str(self.nstars)+' stars')
+
+        # Stars are grouped by the row of chunks they fall in, so that each
+        # chunk is read only once however the stars are ordered
+        (bstars, bimages) = self.block_shape
+        star_data = np.zeros((len(star_indices), self.nimages, self.ncolumns))
+        star_blocks = star_indices // bstars
+        order = np.argsort(star_blocks, kind='stable')
+        bounds = np.where(np.diff(star_blocks[order]) != 0)[0] + 1
+
+        for jdx in np.split(order, bounds):
+            if len(jdx) == 0:
+                continue
+            for image_block in range(0,self.n_image_blocks,1):
+                block = self.read_block(star_blocks[jdx[0]], image_block)
+                star_data[jdx,image_block*bimages:image_block*bimages+block.shape[1],:] = \
+                        block[star_indices[jdx] % bstars,:,:]
+
+        if columns is not None:
+            return star_data[:,:,columns]
+
+        return star_data
+
+    def get_images(self, image_indices, columns=None):
+        """Method to return the photometry of all stars in a set of images.
+        Images are read directly from the file rather than through the
+        cache, since an image spans all of the chunks of the star axis.
+
+        :param list image_indices: Indices of the images in the photometry array
+        :param list columns: Indices of the columns to return, optional
+        :return: array (nstars, nimages selected, ncolumns)
+        """
+
+        image_indices = np.asarray(image_indices, dtype=int)
+        (unique_indices, order) = np.unique(image_indices, return_inverse=True)
+
+        data = self.dset[:, unique_indices.tolist(), :][:, order, :]
+
+        if columns is not None:
+            return data[:,:,columns]
+
+        return data
+
+    def get_image(self, image_index, columns=None):
+        """Method to return the photometry of all stars in a single image
+
+        :param int image_index: Index of the image in the photometry array
+        :param list columns: Indices of the columns to return, optional
+        :return: array (nstars, ncolumns)
+        """
+
+        return self.get_images([image_index], columns=columns)[:,0,:]
+
+def open_phot_hd5(setup, filename=None, log=None,
+                  cache_chunks=PHOT_READER_CACHE_CHUNKS):
+    """Function to open a photometry HD5 file in a reduction directory for
+    lazy reading, returning a PhotometryReader"""
+
+    reader = PhotometryReader(phot_file_path(setup, filename),
+                              cache_chunks=cache_chunks)
+
+    if log:
+        log.info('Opened photometry data with '+repr(reader.shape)+\
+                ' datapoints')
+
+    return reader
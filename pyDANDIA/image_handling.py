@@ -10,19 +10,9 @@ def determine_image_struture(file_path, log=None):
     if path.isfile(file_path) == False:
         raise IOError('Cannot find file '+file_path)
 
-    image_structure = {'sci': None, 'bpm': None, 'pyDANDIA_pixel_mask': None}
-
     hdu = fits.open(file_path)
 
-    for i in range(0,len(hdu),1):
-        if hdu[i].name == 'SCI':
-            image_structure['sci'] = i
-        elif hdu[i].name == 'PRIMARY':
-            image_structure['sci'] = i
-        elif hdu[i].name == 'BPM':
-            image_structure['bpm'] = i
-        elif hdu[i].name == 'PYDANDIA_PIXEL_MASK':
-            image_structure['pyDANDIA_pixel_mask'] = i
+    image_structure = identify_image_extensions(hdu)
 
     if image_structure['sci'] == None:
         raise IOError('Cannot find any science data in image '+file_path)
@@ -37,6 +27,24 @@ def determine_image_struture(file_path, log=None):
 
     return image_structure
 
+def identify_image_extensions(hdu):
+    """Function to identify the list indices of the science image, the
+    Bad Pixel Mask and the pyDANDIA pixel mask within an open FITS HDUList"""
+
+    image_structure = {'sci': None, 'bpm': None, 'pyDANDIA_pixel_mask': None}
+
+    for i in range(0,len(hdu),1):
+        if hdu[i].name == 'SCI':
+            image_structure['sci'] = i
+        elif hdu[i].name == 'PRIMARY':
+            image_structure['sci'] = i
+        elif hdu[i].name == 'BPM':
+            image_structure['bpm'] = i
+        elif hdu[i].name == 'PYDANDIA_PIXEL_MASK':
+            image_structure['pyDANDIA_pixel_mask'] = i
+
+    return image_structure
+
 def get_science_header(file_path, image_structure={}):
 
     if len(image_structure) == 0:
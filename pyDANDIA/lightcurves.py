@@ -20,6 +20,7 @@ from pyDANDIA import  pipeline_setup
 from pyDANDIA import  metadata
 from pyDANDIA import  logs
 import csv
+import h5py
 from datetime import datetime
 
 
@@ -49,13 +50,16 @@ def extract_star_lightcurves_on_cone_to_list(params):
 
 	results = phot_db.box_search_on_position(conn, c.ra.deg, c.dec.deg, radius, radius)
 	lcs = []
-	for star_field_id in results['star_id']:
+	if len(results['star_id']) > 0:
+		with hd5_utils.open_phot_hd5(pipeline_setup.pipeline_setup({'red_dir': params['red_dir']})) as phot_reader:
+			for star_field_id in results['star_id']:
 
 
 
-		photometry_data = fetch_photometry_for_dataset(params, star_field_id, matched_stars, log)
+				photometry_data = fetch_photometry_for_dataset(params, star_field_id, matched_stars, log,
+															   phot_reader=phot_reader)
 
-		lcs.append(np.c_[photometry_data['hjd'],photometry_data['calibrated_mag'],photometry_data['calibrated_mag_err']])
+				lcs.append(np.c_[photometry_data['hjd'],photometry_data['calibrated_mag'],photometry_data['calibrated_mag_err']])
 
 	logs.close_log(log)
 
@@ -96,33 +100,167 @@ def extract_star_lightcurves_on_cone(params, log=None):
 	if log != None and len(results['star_id']) > 0:
 		log.info('Extracting lightcurves for the following matching objects')
 
-	for star_field_id in results['star_id']:
+	if len(results['star_id']) > 0:
+		with hd5_utils.open_phot_hd5(pipeline_setup.pipeline_setup({'red_dir': params['red_dir']})) as phot_reader:
 
-		if log!=None:
-			log.info('-> Star field ID: '+str(star_field_id))
+			for star_field_id in results['star_id']:
 
-		photometry_data = fetch_photometry_for_dataset(params, star_field_id, matched_stars, log)
+				if log!=None:
+					log.info('-> Star field ID: '+str(star_field_id))
 
-		#setname = path.basename(params['red_dir']).split('_')[1]
-		setname = path.basename("_".join((params['red_dir']).split('_')[1:]))
+				photometry_data = fetch_photometry_for_dataset(params, star_field_id, matched_stars, log,
+															   phot_reader=phot_reader)
 
-		datafile = open(path.join(params['output_dir'],'star_'+str(star_field_id)+'_'+setname+'.dat'),'w')
+				#setname = path.basename(params['red_dir']).split('_')[1]
+				setname = path.basename("_".join((params['red_dir']).split('_')[1:]))
 
-		for i in range(0,len(photometry_data),1):
+				datafile = open(path.join(params['output_dir'],'star_'+str(star_field_id)+'_'+setname+'.dat'),'w')
 
-		    datafile.write(str(photometry_data['hjd'][i])+'  '+\
-				    str(photometry_data['instrumental_mag'][i])+'  '+str(photometry_data['instrumental_mag_err'][i])+'  '+\
-				    str(photometry_data['calibrated_mag'][i])+'  '+str(photometry_data['calibrated_mag_err'][i])+'\n')
+				for i in range(0,len(photometry_data),1):
 
-		datafile.close()
-		if log!=None:
-			log.info('-> Output dataset '+setname)
+				    datafile.write(str(photometry_data['hjd'][i])+'  '+\
+						    str(photometry_data['instrumental_mag'][i])+'  '+str(photometry_data['instrumental_mag_err'][i])+'  '+\
+						    str(photometry_data['calibrated_mag'][i])+'  '+str(photometry_data['calibrated_mag_err'][i])+'\n')
+
+				datafile.close()
+				if log!=None:
+					log.info('-> Output dataset '+setname)
 
 	message = 'OK'
 	logs.close_log(log)
 
 	return message
 
+# Columns of the dataset photometry output for each star in batch extraction:
+# hjd, instrumental_mag, instrumental_mag_err, calibrated_mag, calibrated_mag_err
+BATCH_LC_COLUMNS = [9, 11, 12, 13, 14]
+BATCH_LC_NAMES = ['hjd', 'instrumental_mag', 'instrumental_mag_err',
+					'calibrated_mag', 'calibrated_mag_err']
+
+def extract_star_lightcurves_in_batch(params, log=None, format='dat'):
+	"""Function to extract the lightcurves of a list of stars from a single
+	dataset's reduction in one pass.
+
+	Stars may be given either by their field star IDs in the phot_db, as
+	params['star_ids'], or by position, as lists of params['ra'] and
+	params['dec'] in sexigesimal format.  Positions are resolved in a single
+	query of the phot_db to the nearest star within params['radius']
+	(decimal degrees, default 2 arcsec).  The photometry of all stars is then
+	read from the dataset's photometry file in one pass.
+
+	:param dict params: red_dir, output_dir and either star_ids, or ra, dec,
+						db_file_path and optionally radius
+	:param logging log: Open log, optional.  If not given, a log is started
+						in the red_dir
+	:param str format: 'dat' for one file per star, 'hdf5' for a single
+					   lightcurves_<setname>.hdf5 file of all stars
+	:return str message, list lc_files: Status and the files written
+	"""
+
+	close_log = False
+	if log == None:
+		log = logs.start_stage_log( params['red_dir'], 'lightcurves' )
+		close_log = True
+
+	reduction_metadata = metadata.MetaData()
+	reduction_metadata.load_a_layer_from_file( params['red_dir'],
+		                                      'pyDANDIA_metadata.fits',
+		                                      'matched_stars' )
+	matched_stars = reduction_metadata.load_matched_stars()
+
+	if 'star_ids' in params.keys():
+		star_field_ids = np.unique(np.array(params['star_ids'], dtype='int'))
+	else:
+		star_field_ids = resolve_star_positions(params, log)
+
+	log.info('Extracting lightcurves for '+str(len(star_field_ids))+' stars')
+
+	lc_files = []
+	if len(star_field_ids) == 0:
+		message = 'No stars within search region'
+		if close_log:
+			logs.close_log(log)
+		return message, lc_files
+
+	(star_field_ids, star_dataset_ids) = matched_stars.find_starlist_match_ids('cat1_index',
+																			star_field_ids, log)
+	present = star_dataset_ids > 0
+	if not present.all():
+		log.info('No photometry available for stars '+repr(star_field_ids[~present].tolist()))
+	star_field_ids = star_field_ids[present]
+	star_dataset_ids = star_dataset_ids[present]
+
+	with hd5_utils.open_phot_hd5(pipeline_setup.pipeline_setup({'red_dir': params['red_dir']}),
+								   log=log) as phot_reader:
+		photometry = phot_reader.get_stars(star_dataset_ids - 1, columns=BATCH_LC_COLUMNS)
+
+	if not path.isdir(params['output_dir']):
+		mkdir(params['output_dir'])
+	setname = get_setname(params)
+
+	if 'hdf5' in format:
+		lc_file = path.join(params['output_dir'], 'lightcurves_'+setname+'.hdf5')
+		output_lightcurve_bundle(lc_file, star_field_ids, star_dataset_ids, photometry)
+		lc_files.append(lc_file)
+
+	if 'dat' in format:
+		for j,star_field_id in enumerate(star_field_ids):
+			lc_file = path.join(params['output_dir'],'star_'+str(star_field_id)+'_'+setname+'.dat')
+			np.savetxt(lc_file, photometry[j], fmt='%s', delimiter='  ')
+			lc_files.append(lc_file)
+
+	if 'dat' not in format and 'hdf5' not in format:
+		log.info('Unrecognized lightcurve format requested ('+str(format)+') no output possible')
+
+	log.info('-> Output '+str(len(lc_files))+' lightcurve files for dataset '+setname)
+
+	message = 'OK'
+	if close_log:
+		logs.close_log(log)
+
+	return message, lc_files
+
+def resolve_star_positions(params, log):
+	"""Function to identify the field star IDs of the nearest stars in the
+	phot_db to a list of positions, using a single query.  Positions with no
+	star within the search radius are logged and omitted"""
+
+	conn = phot_db.get_connection(dsn=params['db_file_path'])
+
+	c = SkyCoord(params['ra'], params['dec'], frame='icrs', unit=(units.hourangle, units.deg))
+	ra = np.atleast_1d(c.ra.deg)
+	dec = np.atleast_1d(c.dec.deg)
+
+	if 'radius' in params.keys():
+		radius = float(params['radius'])
+	else:
+		radius = 2.0 / 3600.0
+
+	results = phot_db.cone_search_on_positions(conn, ra, dec, radius)
+	conn.close()
+
+	# Select the closest star to each position
+	order = np.lexsort( (results['separation'].data, results['target_index'].data) )
+	results = results[order]
+	(targets, first) = np.unique(results['target_index'].data, return_index=True)
+
+	missing = np.setdiff1d(np.arange(0,len(ra),1), targets)
+	if len(missing) > 0:
+		log.info('No stars found within '+str(radius)+' deg of positions '+repr(missing.tolist()))
+
+	return np.unique(np.array(results['star_id'][first], dtype='int'))
+
+def output_lightcurve_bundle(file_path, star_field_ids, star_dataset_ids, photometry):
+	"""Function to output the lightcurves of a set of stars to a single HDF5
+	file.  The photometry dataset has shape [Nstars, Nimages, Ncolumns], with
+	columns listed in its 'columns' attribute"""
+
+	with h5py.File(file_path, "w") as f:
+		f.create_dataset('star_field_id', data=np.array(star_field_ids, dtype='int'))
+		f.create_dataset('star_dataset_id', data=np.array(star_dataset_ids, dtype='int'))
+		dset = f.create_dataset('photometry', data=photometry, dtype='float64')
+		dset.attrs['columns'] = BATCH_LC_NAMES
+
 def extract_star_lightcurve_isolated_reduction(params, log=None, format='dat',
 											valid_data_only=True,phot_error_threshold=10.0,
 											output_neighbours=False,psfactor_threshold=0.8):
@@ -177,17 +315,21 @@ def extract_star_lightcurve_isolated_reduction(params, log=None, format='dat',
 		else:
 			star_order = [ order_by_proximity[0] ]
 
-		for j in star_order:
+		with hd5_utils.open_phot_hd5(pipeline_setup.pipeline_setup({'red_dir': params['red_dir']}),
+									   log=log) as phot_reader:
+
+			for j in star_order:
 
-			star_dataset_id = results['star_id'][j]
+				star_dataset_id = results['star_id'][j]
 
-			if log!=None:
-				log.info('-> Star dataset ID: '+str(star_dataset_id)+' separation: '+str(results['separation'][j])+' deg')
+				if log!=None:
+					log.info('-> Star dataset ID: '+str(star_dataset_id)+' separation: '+str(results['separation'][j])+' deg')
 
-			photometry_data = fetch_photometry_for_isolated_dataset(params, star_dataset_id, log)
+				photometry_data = fetch_photometry_for_isolated_dataset(params, star_dataset_id, log,
+																		phot_reader=phot_reader)
 
-			lc_files = output_lightcurve(params, reduction_metadata, photometry_data, star_dataset_id, format,
-								  			valid_data_only, phot_error_threshold, psfactor_threshold, log)
+				lc_files = output_lightcurve(params, reduction_metadata, photometry_data, star_dataset_id, format,
+									  			valid_data_only, phot_error_threshold, psfactor_threshold, log)
 
 
 	message = 'OK'
@@ -420,11 +562,15 @@ def identify_unique_datasets(phot_table,facilities,filters):
 
     return datasets
 
-def fetch_photometry_for_dataset(params, star_field_id, matched_stars, log):
+def fetch_photometry_for_dataset(params, star_field_id, matched_stars, log,
+                                 phot_reader=None):
 
     setup = pipeline_setup.pipeline_setup({'red_dir': params['red_dir']})
 
-    dataset_photometry = hd5_utils.read_phot_hd5(setup)
+    if phot_reader is None:
+        dataset_photometry = hd5_utils.open_phot_hd5(setup)
+    else:
+        dataset_photometry = phot_reader
 
     (star_field_ids, star_dataset_ids) = matched_stars.find_starlist_match_ids('cat1_index', np.array([star_field_id]), log,
                                                                                 verbose=True)
@@ -437,22 +583,30 @@ def fetch_photometry_for_dataset(params, star_field_id, matched_stars, log):
 
     log.info('Star array index: '+str(star_dataset_index))
 
-    photometry_data = dataset_photometry[star_dataset_index,:,:]
-
-    photometry_data = table.Table( [ table.Column(name='hjd', data=dataset_photometry[star_dataset_index,:,9]),
-                                     table.Column(name='instrumental_mag', data=dataset_photometry[star_dataset_index,:,11]),
-                                     table.Column(name='instrumental_mag_err', data=dataset_photometry[star_dataset_index,:,12]),
-                                      table.Column(name='calibrated_mag', data=dataset_photometry[star_dataset_index,:,13]),
-                                      table.Column(name='calibrated_mag_err', data=dataset_photometry[star_dataset_index,:,14]),
+    try:
+        star_photometry = dataset_photometry.get_star(star_dataset_index)
+    finally:
+        if phot_reader is None:
+            dataset_photometry.close()
+
+    photometry_data = table.Table( [ table.Column(name='hjd', data=star_photometry[:,9]),
+                                     table.Column(name='instrumental_mag', data=star_photometry[:,11]),
+                                     table.Column(name='instrumental_mag_err', data=star_photometry[:,12]),
+                                      table.Column(name='calibrated_mag', data=star_photometry[:,13]),
+                                      table.Column(name='calibrated_mag_err', data=star_photometry[:,14]),
                                       ] )
 
     return photometry_data
 
-def fetch_photometry_for_isolated_dataset(params, star_dataset_id, log):
+def fetch_photometry_for_isolated_dataset(params, star_dataset_id, log,
+										  phot_reader=None):
 
 	setup = pipeline_setup.pipeline_setup({'red_dir': params['red_dir']})
 
-	dataset_photometry = hd5_utils.read_phot_hd5(setup, log=log)
+	if phot_reader is None:
+		dataset_photometry = hd5_utils.open_phot_hd5(setup, log=log)
+	else:
+		dataset_photometry = phot_reader
 
 	log.info('Star dataset ID = '+str(star_dataset_id))
 
@@ -460,23 +614,29 @@ def fetch_photometry_for_isolated_dataset(params, star_dataset_id, log):
 
 	log.info('Star array index: '+str(star_dataset_index))
 
-	if dataset_photometry.shape[2] > 25:
-		corr_mags = table.Column(name='corrected_mag', data=dataset_photometry[star_dataset_index,:,23])
-		corr_merr = table.Column(name='corrected_mag_err', data=dataset_photometry[star_dataset_index,:,24])
-		qc_flag = table.Column(name='qc_flag', data=dataset_photometry[star_dataset_index,:,25])
+	try:
+		star_photometry = dataset_photometry.get_star(star_dataset_index)
+	finally:
+		if phot_reader is None:
+			dataset_photometry.close()
+
+	if star_photometry.shape[1] > 25:
+		corr_mags = table.Column(name='corrected_mag', data=star_photometry[:,23])
+		corr_merr = table.Column(name='corrected_mag_err', data=star_photometry[:,24])
+		qc_flag = table.Column(name='qc_flag', data=star_photometry[:,25])
 	else:
-		nimages = len(dataset_photometry[star_dataset_index,:,0])
+		nimages = len(star_photometry[:,0])
 		corr_mags = table.Column(name='corrected_mag', data=np.zeros(nimages))
 		corr_merr = table.Column(name='corrected_mag_err', data=np.zeros(nimages))
 		qc_flag = table.Column(name='qc_flag', data=np.zeros(nimages))
 
-	photometry_data = table.Table( [ table.Column(name='hjd', data=dataset_photometry[star_dataset_index,:,9]),
-									 table.Column(name='instrumental_mag', data=dataset_photometry[star_dataset_index,:,11]),
-									 table.Column(name='instrumental_mag_err', data=dataset_photometry[star_dataset_index,:,12]),
-									  table.Column(name='calibrated_mag', data=dataset_photometry[star_dataset_index,:,13]),
-									  table.Column(name='calibrated_mag_err', data=dataset_photometry[star_dataset_index,:,14]),
- 									  table.Column(name='pscale', data=dataset_photometry[star_dataset_index,:,19]),
- 									  table.Column(name='pscale_err', data=dataset_photometry[star_dataset_index,:,20]),
+	photometry_data = table.Table( [ table.Column(name='hjd', data=star_photometry[:,9]),
+									 table.Column(name='instrumental_mag', data=star_photometry[:,11]),
+									 table.Column(name='instrumental_mag_err', data=star_photometry[:,12]),
+									  table.Column(name='calibrated_mag', data=star_photometry[:,13]),
+									  table.Column(name='calibrated_mag_err', data=star_photometry[:,14]),
+ 									  table.Column(name='pscale', data=star_photometry[:,19]),
+ 									  table.Column(name='pscale_err', data=star_photometry[:,20]),
 									  corr_mags, corr_merr, qc_flag] )
 
 	return photometry_data
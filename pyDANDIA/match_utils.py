@@ -9,8 +9,13 @@ from astropy.table import Table, Column
 
 class StarMatchIndex:
 
+    COLUMNS = ['cat1_index', 'cat1_ra', 'cat1_dec', 'cat1_x', 'cat1_y',
+               'cat2_index', 'cat2_ra', 'cat2_dec', 'cat2_x', 'cat2_y',
+               'separation']
+
     def __init__(self):
 
+        self._positions = {'cat1_index': None, 'cat2_index': None}
         self.cat1_index = []
         self.cat1_ra = []
         self.cat1_dec = []
@@ -24,6 +29,50 @@ class StarMatchIndex:
         self.separation = []
         self.n_match = 0
 
+    @property
+    def cat1_index(self):
+        return self._cat1_index
+
+    @cat1_index.setter
+    def cat1_index(self, values):
+        self._cat1_index = list(values)
+        self._positions['cat1_index'] = None
+
+    @property
+    def cat2_index(self):
+        return self._cat2_index
+
+    @cat2_index.setter
+    def cat2_index(self, values):
+        self._cat2_index = list(values)
+        self._positions['cat2_index'] = None
+
+    def star_positions(self, catalog_index):
+        """Method to return a dictionary mapping the star IDs in either
+        catalog's index to the array entry of their first occurance in the
+        matched stars list.  The dictionary is rebuilt only when the index
+        has been reassigned or entries have been removed.
+
+        Inputs:
+        :param str catalog_index: Name of catalog index attribute,
+                                    one of {cat1_index, cat2_index}
+
+        Outputs:
+        :param dict positions: Star ID: array entry
+        """
+
+        star_ids = getattr(self, catalog_index)
+        positions = self._positions[catalog_index]
+
+        if positions is None or positions[1] != len(star_ids):
+            lookup = {}
+            for i,star_id in enumerate(star_ids):
+                lookup.setdefault(star_id, i)
+            positions = [lookup, len(star_ids)]
+            self._positions[catalog_index] = positions
+
+        return positions[0]
+
     def add_match(self,params, log=None, verbose=False, replace_worse_matches=True):
 
         add_star = True
@@ -32,13 +81,14 @@ class StarMatchIndex:
             add_star = self.remove_worse_matches(params,log=log)
 
         if add_star:
-            for key, value in params.items():
-
-                l = getattr(self,key)
-
-                l.append(value)
+            for catalog_index in ['cat1_index', 'cat2_index']:
+                star_ids = getattr(self, catalog_index)
+                self.star_positions(catalog_index).setdefault(params[catalog_index],
+                                                              len(star_ids))
+                self._positions[catalog_index][1] += 1
 
-                setattr(self,key,l)
+            for key, value in params.items():
+                getattr(self,key).append(value)
 
             self.n_match += 1
 
@@ -47,17 +97,66 @@ class StarMatchIndex:
 
         return add_star
 
+    def add_matches(self, params, log=None, replace_worse_matches=True):
+        """Method to add a set of matches to the index in a single operation.
+
+        If replace_worse_matches is True, the new matches are combined with
+        those already in the index and, where a star from either catalog
+        appears in more than one match, only the closest match is retained.
+        Matches are accepted in order of increasing separation, as would
+        result from adding them one at a time.
+
+        Inputs:
+        :param dict params: Dictionary or Table of arrays, one for each of
+                            the index's COLUMNS
+        :param logger log: Open log, optional
+        :param bool replace_worse_matches: Remove duplicated matches
+
+        Outputs:
+        :param array accepted: Boolean array indicating which of the new
+                               matches were retained in the index
+        """
+
+        nnew = len(params['cat1_index'])
+
+        if not replace_worse_matches:
+            for key in self.COLUMNS:
+                getattr(self,key).extend(list(params[key]))
+            self.n_match += nnew
+            accepted = np.ones(nnew, dtype='bool')
+
+        else:
+            columns = {}
+            for key in self.COLUMNS:
+                columns[key] = list(getattr(self,key)) + list(params[key])
+
+            keep = select_closest_matches(np.array(columns['cat1_index']),
+                                          np.array(columns['cat2_index']),
+                                          np.array(columns['separation'], dtype='float'))
+            entries = np.where(keep)[0]
+
+            for key in self.COLUMNS:
+                values = columns[key]
+                setattr(self, key, [values[i] for i in entries])
+            self.n_match = len(entries)
+
+            accepted = keep[len(keep)-nnew:]
+
+        if log!=None:
+            log.info('Added '+str(accepted.sum())+' of '+str(nnew)+\
+                     ' proposed matches to the matched stars index, which now contains '+\
+                     str(self.n_match)+' stars')
+
+        return accepted
+
     def check_for_duplicates(self,params, log=None):
 
         duplicates = {'cat1_index': [], 'cat2_index': []}
 
-        if params['cat1_index'] in self.cat1_index:
-            idx = self.cat1_index.index(params['cat1_index'])
-            duplicates['cat1_index'].append(idx)
-
-        if params['cat2_index'] in self.cat2_index:
-            idx = self.cat2_index.index(params['cat2_index'])
-            duplicates['cat2_index'].append(idx)
+        for catalog_index in ['cat1_index', 'cat2_index']:
+            idx = self.star_positions(catalog_index).get(params[catalog_index], -1)
+            if idx >= 0:
+                duplicates[catalog_index].append(idx)
 
         if log!=None:
             log.info('Found '+str(len(duplicates['cat1_index']))+' duplicates in the cat1_index with the input star already in the match index at array entries: ')
@@ -80,8 +179,8 @@ class StarMatchIndex:
         matches are found, this method returns add_star = False"""
 
         add_star = True
-        if params['cat1_index'] in self.cat1_index:
-            idx = self.cat1_index.index(params['cat1_index'])
+        idx = self.star_positions('cat1_index').get(params['cat1_index'], -1)
+        if idx >= 0:
 
             if params['separation'] < self.separation[idx]:
                 self.remove_match(idx,log=log)
@@ -92,8 +191,8 @@ class StarMatchIndex:
                     log.info('Star proposed for match index duplicates a closer-matching star already in the index.  Match rejected.')
 
         if add_star:
-            if params['cat2_index'] in self.cat2_index:
-                idx = self.cat2_index.index(params['cat2_index'])
+            idx = self.star_positions('cat2_index').get(params['cat2_index'], -1)
+            if idx >= 0:
 
                 if params['separation'] < self.separation[idx]:
                     self.remove_match(idx,log=log)
@@ -213,12 +312,7 @@ class StarMatchIndex:
         :param int idx: Array index of star or -1 if not found
         """
 
-        catalog_star_index = getattr(self,catalog_index)
-
-        try:
-            idx = catalog_star_index.index(cat2_star_id)
-        except ValueError:
-            idx = -1
+        idx = self.star_positions(catalog_index).get(cat2_star_id, -1)
 
         return idx
 
@@ -330,6 +424,59 @@ class StarMatchIndex:
         #self.separation = np.array(self.separation)[inliers].tolist()
         self.n_match = len(self.cat2_x)
 
+def select_closest_matches(cat1_index, cat2_index, separation):
+    """Function to select a set of unique matches from a list of proposed
+    matches, in which stars from either catalog may appear more than once.
+
+    Matches are accepted in order of increasing separation, provided that
+    neither star has already been accepted in a closer match.  This is
+    evaluated in rounds; in each round, all proposed matches which are
+    the closest remaining match for both of their stars are accepted, and
+    any remaining matches involving those stars are rejected.
+
+    Inputs:
+    :param array cat1_index: Star IDs from catalog 1
+    :param array cat2_index: Star IDs from catalog 2
+    :param array separation: Separation of each proposed match
+
+    Outputs:
+    :param array accepted: Boolean array indicating accepted matches
+    """
+
+    nmatch = len(separation)
+    accepted = np.zeros(nmatch, dtype='bool')
+    if nmatch == 0:
+        return accepted
+
+    # Rank the matches by separation, with ties resolved in list order
+    order = np.lexsort( (np.arange(0,nmatch,1), separation) )
+    rank = np.zeros(nmatch, dtype='int')
+    rank[order] = np.arange(0,nmatch,1)
+
+    (ids1, star1) = np.unique(cat1_index, return_inverse=True)
+    (ids2, star2) = np.unique(cat2_index, return_inverse=True)
+
+    remaining = np.ones(nmatch, dtype='bool')
+    while remaining.any():
+        idx = np.where(remaining)[0]
+
+        closest1 = np.full(len(ids1), nmatch, dtype='int')
+        np.minimum.at(closest1, star1[idx], rank[idx])
+        closest2 = np.full(len(ids2), nmatch, dtype='int')
+        np.minimum.at(closest2, star2[idx], rank[idx])
+
+        best = idx[ (closest1[star1[idx]] == rank[idx]) & \
+                    (closest2[star2[idx]] == rank[idx]) ]
+        accepted[best] = True
+
+        taken1 = np.zeros(len(ids1), dtype='bool')
+        taken1[star1[best]] = True
+        taken2 = np.zeros(len(ids2), dtype='bool')
+        taken2[star2[best]] = True
+        remaining &= ~(taken1[star1] | taken2[star2])
+
+    return accepted
+
 def transfer_main_catalog_indices(matched_stars, sub_detected_sources, sub_catalog_sources,
                                 full_detected_sources, full_catalog_sources, log):
 
@@ -8,6 +8,7 @@ from os import path
 from astropy.io import fits
 from astropy.table import Table
 from astropy.table import Column
+from astropy.table import vstack
 from astropy.coordinates import SkyCoord
 from astropy.utils.exceptions import AstropyWarning
 from astropy import units as u
@@ -21,6 +22,7 @@ from pyDANDIA import match_utils
 from pyDANDIA import image_handling
 
 import os
+import hashlib
 import pathlib
 
 def update_a_dictionary(dictionary, new_key, new_value):
@@ -48,6 +50,42 @@ def update_a_dictionary(dictionary, new_key, new_value):
     return new_dictionary
 
 
+def row_key(entry):
+    '''
+    Key of an entry of the first column of a layer in the layer row index,
+    so that bytes and str entries match
+
+    :param entry: the entry, e.g. an image name
+    '''
+
+    if isinstance(entry, bytes):
+        return entry.decode()
+
+    return str(entry)
+
+
+def layer_checksum(layer):
+    '''
+    Checksum of the contents of a metadata layer, used to identify the layers
+    which have changed since they were loaded or saved
+
+    :param list layer: [astropy.header, astropy.Table]
+
+    :return checksum: hex digest
+    '''
+
+    checksum = hashlib.sha1(layer[0].tostring().encode())
+
+    table_data = layer[1].as_array()
+    checksum.update(repr(table_data.dtype).encode())
+    checksum.update(repr([layer[1][column].unit for column in layer[1].colnames]).encode())
+    checksum.update(np.ascontiguousarray(table_data).tobytes())
+    if np.ma.is_masked(table_data):
+        checksum.update(np.ascontiguousarray(np.ma.getmaskarray(table_data)).tobytes())
+
+    return checksum.hexdigest()
+
+
 class MetaData:
     """Class defining the data structure produced by the pyDANDIA pipeline
     to hold metadata regarding the reduction of a single dataset, including
@@ -67,6 +105,26 @@ class MetaData:
 
         self.stamps = [None, None]
 
+        # Checksums of the layers as last loaded from or saved to each
+        # metadata file, keyed by file path and layer name
+        self._layer_checksums = {}
+
+        # Index of the rows of each layer by the entries in its first
+        # column, e.g. the image names
+        self._row_indices = {}
+
+    def layer_names(self):
+        '''
+        Names of all the layers of the metadata object
+        '''
+
+        return [key for key in self.__dict__.keys() if not key.startswith('_')]
+
+    def record_layer_checksum(self, metadata_path, key_layer):
+
+        checksums = self._layer_checksums.setdefault(path.abspath(metadata_path), {})
+        checksums[key_layer] = layer_checksum(getattr(self, key_layer))
+
     def create_metadata_file(self, metadata_directory, metadata_name):
         '''
         Create a metadata fits file from scratch
@@ -513,18 +571,32 @@ class MetaData:
 
         '''
 
-        metadata = fits.open(path.join(metadata_directory,metadata_name), mmap=True)
+        metadata_path = path.join(metadata_directory,metadata_name)
+
+        with fits.open(metadata_path, mmap=True) as metadata:
+
+            self.load_layer_from_hdu(metadata_path, key_layer, metadata[key_layer])
+
+    def load_layer_from_hdu(self, metadata_path, key_layer, layer):
+        '''
+        Load into the metadata object a layer from an HDU of the metadata file.
 
-        layer = metadata[key_layer]
+        :param string metadata_path: the path to the metadata file
+        :param string key_layer: the name of the layer
+        :param BinTableHDU layer: the HDU of the layer
+        '''
 
         header = layer.header
         table = Table(layer.data)
 
         setattr(self, key_layer, [header, table])
 
+        self.record_layer_checksum(metadata_path, key_layer)
+
     def load_all_metadata(self, metadata_directory, metadata_name):
         '''
-        Load into the metadata object all layers contains in the metadata file.
+        Load into the metadata object all layers contains in the metadata file,
+        reading the file once.
 
         :param string metadata_directory: the metadata directory where this file will be saved
         :param string metadata_name: the name of the metadata file
@@ -532,17 +604,19 @@ class MetaData:
 
         '''
 
-        metadata = fits.open(path.join(metadata_directory, metadata_name), mmap=True)
+        metadata_path = path.join(metadata_directory, metadata_name)
 
-        all_layers = [i.header['NAME'] for i in metadata[1:]]
+        with fits.open(metadata_path, mmap=True) as metadata:
 
-        for key_layer in all_layers:
+            for layer in metadata[1:]:
 
-            try:
-                self.load_a_layer_from_file(metadata_directory, metadata_name, key_layer)
-            except:
+                key_layer = layer.header['NAME']
 
-                print('No Layer with key name :' + key_layer)
+                try:
+                    self.load_layer_from_hdu(metadata_path, key_layer, layer)
+                except:
+
+                    print('No Layer with key name :' + key_layer)
 
     def load_matched_stars(self):
         """Method to load the matched_stars list"""
@@ -579,20 +653,26 @@ class MetaData:
     def save_updated_metadata(self, metadata_directory, metadata_name, log=None):
         '''
         Save in the metadata file the updated metadata object (i.e all layers).
+        Only the layers which have changed since they were loaded from or
+        last saved to this file are written.
 
         :param string metadata_directory: the metadata directory where this file will be saved
         :param string metadata_name: the name of the metadata file
 
 
         '''
-        all_layers = self.__dict__.keys()
+        checksums = self._layer_checksums.get(path.abspath(path.join(metadata_directory, metadata_name)), {})
 
-        for key_layer in all_layers:
+        updated_layers = []
+        for key_layer in self.layer_names():
             layer = getattr(self, key_layer)
-            if layer != [None, None]:
+            if layer != [None, None] and checksums.get(key_layer) != layer_checksum(layer):
                 if log != None:
                     log.info('Writing meta data layer ' + key_layer)
-                self.save_a_layer_to_file(metadata_directory, metadata_name, key_layer, log=log)
+                updated_layers.append(key_layer)
+
+        if len(updated_layers) > 0:
+            self.save_layers_to_file(metadata_directory, metadata_name, updated_layers, log=log)
 
         if log != None:
             log.info('Stored updated metadata')
@@ -608,31 +688,64 @@ class MetaData:
 
         '''
 
-        layer = getattr(self, key_layer)
+        self.save_layers_to_file(metadata_directory, metadata_name, [key_layer], log=log)
+
+    def save_layers_to_file(self, metadata_directory, metadata_name,
+                            key_layers, log=None):
+        '''
+        Save in the metadata file a set of updated layers in a single pass.
+        The other layers are copied unchanged from the existing file.  The
+        updated file is written alongside the original and then renamed over
+        it, so that processes reading the metadata never see a partially
+        written file.
+
+        :param string metadata_directory: the metadata directory where this file will be saved
+        :param string metadata_name: the name of the metadata file
+        :param list key_layers: the names of the layers to be saved
+
+        '''
+
+        metadata_path = path.join(metadata_directory, metadata_name)
+
+        update_layers = collections.OrderedDict()
+        for key_layer in key_layers:
+            layer = getattr(self, key_layer)
+
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', AstropyWarning)
+                update_layer = fits.BinTableHDU(layer[1], header=layer[0])
+                update_layer.name = update_layer.header['name']
 
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore', AstropyWarning)
-            update_layer = fits.BinTableHDU(layer[1], header=layer[0])
-            update_layer.name = update_layer.header['name']
+            update_layers[update_layer.name.upper()] = update_layer
+
+        temp_path = metadata_path + '.' + str(os.getpid()) + '.tmp'
 
         try:
-            metadata = fits.open(path.join(metadata_directory, metadata_name),
-                                 mmap=True)
-            try:
+            with fits.open(metadata_path, mmap=True) as metadata:
+
+                hdu_list = fits.HDUList([metadata[0]])
 
-                metadata[key_layer] = update_layer
+                for hdu in metadata[1:]:
+                    hdu_list.append(update_layers.pop(hdu.name.upper(), hdu))
 
-            except:
+                for update_layer in update_layers.values():
+                    hdu_list.append(update_layer)
 
-                metadata.append(update_layer)
+                hdu_list.writeto(temp_path, overwrite=True)
 
-            metadata.writeto(path.join(metadata_directory, metadata_name),
-                             overwrite=True)
+            os.replace(temp_path, metadata_path)
 
         except IOError:
             if log != None:
                 log.info('ERROR: Cannot output metadata to file ' + \
-                         path.join(metadata_directory, metadata_name))
+                         metadata_path)
+            if path.isfile(temp_path):
+                os.remove(temp_path)
+
+            return
+
+        for key_layer in key_layers:
+            self.record_layer_checksum(metadata_path, key_layer)
 
     def transform_2D_table_to_dictionary(self, key_layer):
         '''
@@ -678,6 +791,66 @@ class MetaData:
 
                 layer[1].add_column(Column([value], name=key, dtype=type(value)))
 
+    def layer_row_index(self, key_layer):
+        '''
+        Index of the rows of a layer by the entries in its first column, e.g.
+        the image names.  The index is built when first needed and kept in
+        sync by the methods which add rows to or update the layer; it is
+        rebuilt if the table is replaced or changes length by other means.
+
+        :param string key_layer: the name of the layer
+
+        :return dict: {entry: index of the first row with this entry}
+        '''
+
+        table = getattr(self, key_layer)[1]
+
+        cached = self._row_indices.get(key_layer)
+        if cached is not None and cached[0] is table and cached[1] == len(table):
+            return cached[2]
+
+        entries = np.asarray(table.columns[0]).astype(str)
+        row_index = dict(zip(entries[::-1], range(len(entries)-1, -1, -1)))
+
+        self._row_indices[key_layer] = [table, len(table), row_index]
+
+        return row_index
+
+    def find_rows(self, key_layer, entries):
+        '''
+        Find the rows of a layer for a list of entries of its first column
+
+        :param string key_layer: the name of the layer
+        :param list entries: the entries to look for, e.g. image names
+
+        :return array: the row indices, -1 for entries not in the layer
+        '''
+
+        row_index = self.layer_row_index(key_layer)
+
+        return np.array([row_index.get(row_key(entry), -1) for entry in entries], dtype=int)
+
+    def find_row(self, key_layer, entry):
+        '''
+        Find the row of a layer for an entry of its first column
+
+        :param string key_layer: the name of the layer
+        :param entry: the entry to look for, e.g. an image name
+
+        :return int: the row index, raises IndexError if the entry is not in the layer
+        '''
+
+        row = self.layer_row_index(key_layer).get(row_key(entry), None)
+
+        if row is None:
+            raise IndexError(str(entry) + ' not found in the ' + key_layer + ' layer')
+
+        return row
+
+    def invalidate_row_index(self, key_layer):
+
+        self._row_indices.pop(key_layer, None)
+
     def add_row_to_layer(self, key_layer, new_row):
         '''
         Add a row to a specific layer
@@ -688,19 +861,46 @@ class MetaData:
         '''
 
         layer = getattr(self, key_layer)
-        layer_keys = layer[1].keys()
-
-        first_column = layer[1][layer_keys[0]]
+        row_index = self.layer_row_index(key_layer)
 
-        if new_row[0] in first_column:
+        if row_key(new_row[0]) in row_index:
             #update the row, not creating a new one
-            row_index = np.where(new_row[0]==first_column)[0]
-            self.update_row_to_layer(key_layer, row_index, new_row)
+            layer[1][row_index[row_key(new_row[0])]] = new_row
 
         else:
 
             layer[1].add_row(new_row)
 
+            row_index[row_key(new_row[0])] = len(layer[1]) - 1
+            self._row_indices[key_layer] = [layer[1], len(layer[1]), row_index]
+
+    def add_rows_to_layer(self, key_layer, new_rows):
+        '''
+        Add a set of rows to a specific layer in a single operation.  Rows whose
+        first entry is already in the layer update the existing row instead.
+
+        :param string key_layer: the name of the layer to be saved
+        :param list new_rows: the list of rows, each a list of values
+
+        '''
+
+        layer = getattr(self, key_layer)
+        row_index = self.layer_row_index(key_layer)
+
+        appended_rows = []
+        appended_keys = set()
+        for new_row in new_rows:
+            if row_key(new_row[0]) in row_index:
+                layer[1][row_index[row_key(new_row[0])]] = new_row
+            elif row_key(new_row[0]) not in appended_keys:
+                appended_rows.append(new_row)
+                appended_keys.add(row_key(new_row[0]))
+
+        if len(appended_rows) > 0:
+            new_table = Table(rows=appended_rows, names=layer[1].colnames,
+                              dtype=[layer[1][column].dtype for column in layer[1].colnames])
+            layer[1] = vstack([layer[1], new_table], metadata_conflicts='silent')
+
     def add_column_to_layer(self, key_layer, new_column_name, new_column_data, new_column_format=None,
                             new_column_unit=None):
         '''
@@ -741,6 +941,8 @@ class MetaData:
         layer = getattr(self, key_layer)
         layer[1][row_index] = new_row
 
+        self.invalidate_row_index(key_layer)
+
     def update_column_to_layer(self, key_layer, key_column, new_column):
         '''
         Modify an entire column of the layer
@@ -753,6 +955,9 @@ class MetaData:
         layer = getattr(self, key_layer)
         layer[1][key_column] = new_column
 
+        if key_column == layer[1].colnames[0]:
+            self.invalidate_row_index(key_layer)
+
     def find_all_images(self, setup, reduction_metadata, images_directory_path=None, log=None,):
         '''
         Find all the images.
@@ -821,10 +1026,8 @@ class MetaData:
 
         column_name = 'STAGE_'+str(stage_number)
         if rerun_all:
-            for name in list_of_images:
-
-                image_row = np.where(layer[1]['IMAGES'] == name)[0]
-                self.update_a_cell_to_layer('reduction_status', image_row,column_name,0)
+            image_rows = self.find_rows('reduction_status', list_of_images)
+            self.update_a_cell_to_layer('reduction_status', image_rows[image_rows >= 0], column_name, 0)
 
 
         try:
@@ -837,13 +1040,14 @@ class MetaData:
 
                 new_images = []
 
-                for name in list_of_images:
+                image_rows = self.find_rows('reduction_status', list_of_images)
+                pending = np.asarray(layer[1][column_name]).astype(str) == '0'
 
-                    image_row = np.where(layer[1]['IMAGES'] == name)[0]
+                for name, image_row in zip(list_of_images, image_rows):
 
-                    if len(image_row) != 0:
+                    if image_row >= 0:
 
-                        if layer[1][image_row[0]][column_name] == '0':
+                        if pending[image_row]:
                             logs.ifverbose(log, setup,
                                            name + ' is a new image to process by stage number: ' + str(stage_number))
                             new_images.append(name)
@@ -896,6 +1100,9 @@ class MetaData:
         layer = getattr(self, key_layer)
         layer[1][column_name][row_index] = new_value
 
+        if column_name == layer[1].colnames[0]:
+            self.invalidate_row_index(key_layer)
+
     def update_reduction_metadata_reduction_status(self, new_images, stage_number=0,
         status = '0', log = None):
         '''
@@ -911,20 +1118,18 @@ class MetaData:
         layer = self.reduction_status
         number_of_columns = len(layer[1].keys())-1
         if len(layer[1])==0:
-            for image in new_images:
-
-                    self.add_row_to_layer('reduction_status',[image]+number_of_columns*['0'])
+            self.add_rows_to_layer('reduction_status',
+                                   [[image]+number_of_columns*['0'] for image in new_images])
 
         else:
             column_name = 'STAGE_'+str(stage_number)
-            for image in new_images:
+            image_rows = self.find_rows('reduction_status', new_images)
 
-                if image in layer[1]['IMAGES'] :
-                    index_image = np.where(layer[1]['IMAGES'] == image)[0][0]
-                    self.update_a_cell_to_layer('reduction_status', index_image, column_name, status)
-                else:
+            self.update_a_cell_to_layer('reduction_status', image_rows[image_rows >= 0], column_name, status)
 
-                    self.add_row_to_layer('reduction_status',[image]+number_of_columns*['0'])
+            self.add_rows_to_layer('reduction_status',
+                                   [[image]+number_of_columns*['0'] for image, image_row in zip(new_images, image_rows)
+                                    if image_row < 0])
 
         if log != None:
             log.info('Updated the reduction status layer')
@@ -945,24 +1150,20 @@ class MetaData:
         layer = self.reduction_status
         number_of_columns = len(layer[1].keys())-1
         if len(layer[1])==0:
-            for image in new_images:
-
-                    self.add_row_to_layer('reduction_status',[image]+number_of_columns*[0])
+            self.add_rows_to_layer('reduction_status',
+                                   [[image]+number_of_columns*[0] for image in new_images])
 
         else:
-            column_name = 'STAGE_'+str(stage_number)
-            for i,image in enumerate(new_images):
+            image_rows = self.find_rows('reduction_status', new_images)
+            known = image_rows >= 0
+            status = np.array(status, dtype=object)
 
-                if image in layer[1]['IMAGES'] :
-                    index_image = np.where(layer[1]['IMAGES'] == image)[0][0]
-                    self.update_a_cell_to_layer('reduction_status', index_image, column_name, status[i])
+            self.set_reduction_status_rows(image_rows[known], status[known], stage_number,
+                                           rejected=np.array([s == -1 for s in status[known]], dtype=bool))
 
-                    if status[i] == -1:
-                        for c in range(stage_number,8,1):
-                            self.update_a_cell_to_layer('reduction_status', index_image, 'STAGE_'+str(c), status[i])
-                else:
-
-                    self.add_row_to_layer('reduction_status',[image]+number_of_columns*[0])
+            self.add_rows_to_layer('reduction_status',
+                                   [[image]+number_of_columns*[0] for image, image_row in zip(new_images, image_rows)
+                                    if image_row < 0])
 
         if log != None:
             log.info('Updated the reduction status layer')
@@ -978,28 +1179,61 @@ class MetaData:
         :param log object: Open log
         '''
 
-        layer = self.reduction_status
-        column_name = 'STAGE_'+str(stage_number)
+        images = list(image_status.keys())
+        image_rows = self.find_rows('reduction_status', images)
 
-        for image, stat in image_status.items():
-                if image in layer[1]['IMAGES'] :
-                    index_image = np.where(layer[1]['IMAGES'] == image)[0][0]
-                    self.update_a_cell_to_layer('reduction_status', index_image,
-                                                column_name, stat)
+        if (image_rows < 0).any():
+            raise IOError('Attempt to update the status of an image unknown to the metadata reduction status table: '+\
+                          images[np.where(image_rows < 0)[0][0]])
 
-                    if '-1' in str(stat):
-                        for c in range(stage_number,8,1):
-                            self.update_a_cell_to_layer('reduction_status',
-                                                        index_image,
-                                                        'STAGE_'+str(c),
-                                                        stat)
+        status = np.array([image_status[image] for image in images], dtype=object)
 
-                else:
-                    raise IOError('Attempt to update the status of an image unknown to the metadata reduction status table: '+image)
+        self.set_reduction_status_rows(image_rows, status, stage_number,
+                                       rejected=np.array(['-1' in str(s) for s in status], dtype=bool))
 
         if log != None:
             log.info('Updated the reduction status layer')
 
+    def set_reduction_status_rows(self, image_rows, status, stage_number, rejected=None):
+        '''
+        Set the reduction status of a set of rows of the reduction_status layer
+        for one stage.  Rejected images have their status set for this and all
+        later stages.
+
+        :param array image_rows: the row indices of the images
+        :param array status: the status of each image
+        :param int stage_number: the stage number
+        :param array rejected: boolean flags of the rejected images, optional
+        '''
+
+        layer = self.reduction_status
+
+        if len(image_rows) == 0:
+            return
+
+        column = layer[1]['STAGE_'+str(stage_number)]
+        column[image_rows] = np.array(status).astype(column.dtype)
+
+        if rejected is not None and rejected.any():
+            for c in range(stage_number+1,8,1):
+                column = layer[1]['STAGE_'+str(c)]
+                column[image_rows[rejected]] = np.array(status[rejected]).astype(column.dtype)
+
+    def pending_images(self, stage_number):
+        '''
+        List the images which have not yet been processed by a stage, according to
+        the reduction_status layer
+
+        :param int stage_number: the stage number
+
+        :return list: the names of the images with status 0 for this stage
+        '''
+
+        layer = self.reduction_status
+        pending = np.asarray(layer[1]['STAGE_'+str(stage_number)]).astype(str) == '0'
+
+        return np.asarray(layer[1]['IMAGES']).astype(str)[pending].tolist()
+
     def set_all_reduction_status_to_0(self, log=None):
         '''
             Update the reduction_status layer with all images of the stage set to status
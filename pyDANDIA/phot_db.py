@@ -235,6 +235,23 @@ class Stars(TableDef):
     pc_010_decindex = (
         'CREATE INDEX IF NOT EXISTS stars_dec ON stars (dec)')
 
+    # R*Tree spatial index of the star positions, kept in sync by triggers
+    pc_020_spatialindex = (
+        'CREATE VIRTUAL TABLE IF NOT EXISTS stars_spatial USING rtree('
+        'star_id, ra_min, ra_max, dec_min, dec_max)')
+    pc_030_spatialinsert = (
+        'CREATE TRIGGER IF NOT EXISTS stars_spatial_insert AFTER INSERT ON stars '
+        'WHEN new.ra IS NOT NULL AND new.dec IS NOT NULL BEGIN '
+        'INSERT OR REPLACE INTO stars_spatial VALUES (new.star_id, new.ra, new.ra, new.dec, new.dec); END')
+    pc_040_spatialupdate = (
+        'CREATE TRIGGER IF NOT EXISTS stars_spatial_update AFTER UPDATE OF star_id, ra, dec ON stars BEGIN '
+        'DELETE FROM stars_spatial WHERE star_id = old.star_id; '
+        'INSERT OR REPLACE INTO stars_spatial SELECT new.star_id, new.ra, new.ra, new.dec, new.dec '
+        'WHERE new.ra IS NOT NULL AND new.dec IS NOT NULL; END')
+    pc_050_spatialdelete = (
+        'CREATE TRIGGER IF NOT EXISTS stars_spatial_delete AFTER DELETE ON stars BEGIN '
+        'DELETE FROM stars_spatial WHERE star_id = old.star_id; END')
+
 class PhotometryPoints(TableDef):
     """Photometry database table describing the primary photometric quantities
     measured from image data.
@@ -425,10 +442,27 @@ def get_connection(dsn=database_file_path):
                   PHOTOMETRY_TD,
                   STAMPS_TD)
 
+    ensure_spatial_index(conn)
+
     populate_db_defaults(conn)
 
     return conn
 
+def ensure_spatial_index(conn):
+    """Function to (re)build the spatial index of the stars table if it is
+    out of step with the table, as for databases created before the index
+    was introduced"""
+
+    n_stars = conn.execute('SELECT COUNT(*) FROM stars WHERE ra IS NOT NULL AND dec IS NOT NULL').fetchone()[0]
+    n_indexed = conn.execute('SELECT COUNT(*) FROM stars_spatial').fetchone()[0]
+
+    if n_stars != n_indexed:
+        conn.execute('BEGIN')
+        conn.execute('DELETE FROM stars_spatial')
+        conn.execute('INSERT INTO stars_spatial SELECT star_id, ra, ra, dec, dec FROM stars '+\
+                     'WHERE ra IS NOT NULL AND dec IS NOT NULL')
+        conn.commit()
+
 def populate_db_defaults(conn):
     """Function to pre-populate the photometric database tables for the filters
     and facilities used in the survey."""
@@ -505,7 +539,7 @@ def update_table_entry(conn,table_name,key_name,search_key,entry_id,value):
 
         cursor.close()
 
-def feed_to_table(conn, table_name, names, values):
+def feed_to_table(conn, table_name, names, values, commit=True):
     """makes a row out of names and values and inserts it into table_name.
 
     This returns the value of last_insert_rowid(), whether or not that
@@ -515,6 +549,8 @@ def feed_to_table(conn, table_name, names, values):
     :param string table_name: Name of the DB table to insert into
     :param list names: List of entry keywords in the DB table
     :param list values: List of values corresponding to the keywords
+    :param boolean commit: Commit after the insert; callers inserting many rows
+                           within their own transaction should set this False
     """
     cursor = conn.cursor()
     try:
@@ -529,7 +565,8 @@ def feed_to_table(conn, table_name, names, values):
 
     finally:
 
-        conn.commit()
+        if commit:
+            conn.commit()
 
         cursor.close()
 
@@ -547,10 +584,70 @@ def feed_to_table_many(conn, table_name, names, tuples):
                                         ' VALUES ('+\
                                          ','.join("?"*len(names)) + ')'
 
+    # Connections in autocommit mode would otherwise commit every row
+    if not conn.in_transaction:
+        conn.execute('BEGIN')
+
     conn.executemany(command, tuples)
 
     conn.commit()
 
+def feed_to_table_many_returning_ids(conn, table_name, names, tuples,
+                                     primary_key):
+    """Function to insert a sequence of new rows into table_name in a single
+    transaction, returning the primary keys assigned to them, in the order
+    of the tuples.
+
+    SQLite assigns each new row of a table with an INTEGER PRIMARY KEY the
+    key following the largest in the table, so the keys of the rows inserted
+    are those greater than the largest key before the insert.
+
+    :param Connection conn: Open DB connection object
+    :param string table_name: Name of the DB table to insert into
+    :param list names: List of entry keywords in the DB table, excluding
+                       the primary key
+    :param list tuples: List of tuples of values corresponding to the keywords
+    :param string primary_key: Name of the INTEGER PRIMARY KEY column
+
+    :return array: primary keys of the new rows
+    """
+
+    command = 'INSERT INTO ' + str(table_name) + ' (' +\
+                                        ','.join(names) + ') ' +\
+                                        ' VALUES ('+\
+                                         ','.join("?"*len(names)) + ')'
+
+    if conn.in_transaction:
+        conn.commit()
+
+    # The write lock is taken at the start of the transaction, so that no
+    # other connection can insert rows between the query and the insert
+    conn.execute('BEGIN IMMEDIATE')
+
+    try:
+        last_key = conn.execute('SELECT MAX('+primary_key+') FROM '+\
+                                str(table_name)).fetchone()[0]
+        if last_key is None:
+            last_key = 0
+
+        conn.executemany(command, tuples)
+
+        new_keys = [ row[0] for row in conn.execute('SELECT '+primary_key+\
+                                ' FROM '+str(table_name)+' WHERE '+primary_key+\
+                                ' > ? ORDER BY '+primary_key, (last_key,)) ]
+
+        if len(new_keys) != len(tuples):
+            raise IOError('Expected '+str(len(tuples))+' new rows in table '+\
+                            str(table_name)+' but found '+str(len(new_keys)))
+
+    except:
+        conn.rollback()
+        raise
+
+    conn.commit()
+
+    return np.array(new_keys, dtype=int)
+
 
 def update_stars_ref_image_id(conn, ref_image_name, star_ids):
     """Dumps a sequence of tuples into table_name, where foreign keys
@@ -777,6 +874,59 @@ def query_to_astropy_table(conn, query, args=()):
 
     return table.Table(data=data)
 
+class PrimaryKeyCache(object):
+    """Cache of the primary keys of the entries in the facilities, filters,
+    software, reference_images, images and stamps tables, resolved by the
+    value of their identifying column.  Keys are looked up with parameterised
+    queries the first time they are needed, or loaded in bulk with preload,
+    and then served from memory for the rest of the reduction.
+    """
+
+    # Table, primary key and identifying column of each kind of key
+    key_columns = {'facility': ('facilities', 'facility_id', 'facility_code'),
+                   'filter': ('filters', 'filter_id', 'filter_name'),
+                   'code': ('software', 'code_id', 'version'),
+                   'refimage': ('reference_images', 'refimg_id', 'filename'),
+                   'image': ('images', 'img_id', 'filename'),
+                   'stamp': ('stamps', 'stamp_id', 'stamp_index')}
+
+    # Maximum number of values per bulk query, below the SQLite limit
+    # on the number of query parameters
+    max_query_values = 500
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.keys = {key: {} for key in self.key_columns.keys()}
+
+    def preload(self, key, values):
+        """Method to resolve the primary keys of a list of entries with as
+        few queries as possible.  Values with no entry in the table are
+        not cached, so that they are queried again if they are requested."""
+
+        (table_name, pk_column, search_column) = self.key_columns[key]
+
+        values = [str(v) for v in values if str(v) not in self.keys[key]]
+
+        for i in range(0, len(values), self.max_query_values):
+            subset = values[i:i+self.max_query_values]
+            query = 'SELECT ' + pk_column + ', ' + search_column + ' FROM ' + table_name + \
+                    ' WHERE ' + search_column + ' IN (' + ','.join(['?']*len(subset)) + ')'
+
+            for (pk, value) in self.conn.execute(query, subset):
+                if str(value) not in self.keys[key]:
+                    self.keys[key][str(value)] = pk
+
+    def get(self, key, value):
+        """Method to return the primary key of the entry with the given value
+        of its identifying column, or None if there is no such entry"""
+
+        value = str(value)
+
+        if value not in self.keys[key]:
+            self.preload(key, [value])
+
+        return self.keys[key].get(value, None)
+
 def box_search_on_position(conn, ra_centre, dec_centre, dra, ddec):
     """Function to search the database for stars within (d(ra),d(dec)) of the
     (ra_centre, dec_centre) given.
@@ -793,12 +943,17 @@ def box_search_on_position(conn, ra_centre, dec_centre, dra, ddec):
     dec_min = dec_centre - ddec
     dec_max = dec_centre + ddec
 
-    query = 'SELECT star_id,ra,dec FROM stars WHERE ra BETWEEN '+\
-            str(ra_min)+' AND '+str(ra_max)+\
-            ' AND dec BETWEEN '+\
-            str(dec_min)+' AND '+str(dec_max)
+    # The spatial index selects the candidates, the stars table the exact box
+    query = 'SELECT stars.star_id,stars.ra,stars.dec FROM stars_spatial '+\
+            'CROSS JOIN stars ON stars.star_id = stars_spatial.star_id '+\
+            'WHERE stars_spatial.ra_max >= ? AND stars_spatial.ra_min <= ? '+\
+            'AND stars_spatial.dec_max >= ? AND stars_spatial.dec_min <= ? '+\
+            'AND stars.ra BETWEEN ? AND ? AND stars.dec BETWEEN ? AND ? '+\
+            'ORDER BY stars.star_id'
 
-    t = query_to_astropy_table(conn, query, args=())
+    t = query_to_astropy_table(conn, query,
+                               args=(ra_min, ra_max, dec_min, dec_max,
+                                     ra_min, ra_max, dec_min, dec_max))
 
     c = SkyCoord(ra_centre, dec_centre, frame='icrs', unit=(units.deg,units.deg))
 
@@ -810,6 +965,94 @@ def box_search_on_position(conn, ra_centre, dec_centre, dra, ddec):
 
     return t
 
+def cone_search_on_positions(conn, ra_centres, dec_centres, radius):
+    """Function to search the database for the stars within a radius of each
+    of a set of positions, in a single query against the spatial index of
+    the stars table.
+
+    :param connection conn: SQlite3 open connection object
+    :param array ra_centres: Central RAs in decimal degrees
+    :param array dec_centres: Central Decs in decimal degrees
+    :param float radius: Search radius in decimal degrees, or an array of
+                         radii for each position
+
+    :return Table: target_index, star_id, ra, dec and separation (deg) of
+                   each star found, where target_index refers to the position
+                   searched.  Stars found within the radius of several
+                   positions are listed once for each.
+    """
+
+    ra_centres = np.atleast_1d(np.array(ra_centres, dtype=float))
+    dec_centres = np.atleast_1d(np.array(dec_centres, dtype=float))
+    radius = np.broadcast_to(np.array(radius, dtype=float), ra_centres.shape)
+
+    # RA half-widths of the boxes enclosing each cone, covering all RAs for
+    # cones which include a pole
+    dec_extreme = np.minimum(abs(dec_centres) + radius, 90.0)
+    polar = dec_extreme >= 90.0
+    dra = np.full(ra_centres.shape, 180.0)
+    dra[~polar] = radius[~polar] / np.cos(np.radians(dec_extreme[~polar]))
+    dra = np.minimum(dra, 180.0)
+
+    boxes = []
+    for j in range(0,len(ra_centres),1):
+        box_dec = (dec_centres[j] - radius[j], dec_centres[j] + radius[j])
+
+        if dra[j] >= 180.0:
+            boxes.append( (j, 0.0, 360.0) + box_dec )
+            continue
+
+        ra_min = ra_centres[j] - dra[j]
+        ra_max = ra_centres[j] + dra[j]
+        boxes.append( (j, ra_min, ra_max) + box_dec )
+
+        # Boxes crossing RA=0 are searched on both sides
+        if ra_min < 0.0:
+            boxes.append( (j, ra_min + 360.0, 360.0) + box_dec )
+        if ra_max > 360.0:
+            boxes.append( (j, 0.0, ra_max - 360.0) + box_dec )
+
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS cone_search_targets '+\
+                 '(target_index INTEGER, ra_min REAL, ra_max REAL, dec_min REAL, dec_max REAL)')
+    conn.execute('DELETE FROM cone_search_targets')
+    conn.executemany('INSERT INTO cone_search_targets VALUES (?,?,?,?,?)', boxes)
+
+    # CROSS JOIN fixes the order of the loops of the query, so that each
+    # target is a lookup in the spatial index
+    query = 'SELECT DISTINCT cone_search_targets.target_index,stars.star_id,stars.ra,stars.dec '+\
+            'FROM cone_search_targets '+\
+            'CROSS JOIN stars_spatial ON stars_spatial.ra_max >= cone_search_targets.ra_min '+\
+            'AND stars_spatial.ra_min <= cone_search_targets.ra_max '+\
+            'AND stars_spatial.dec_max >= cone_search_targets.dec_min '+\
+            'AND stars_spatial.dec_min <= cone_search_targets.dec_max '+\
+            'JOIN stars ON stars.star_id = stars_spatial.star_id '+\
+            'ORDER BY cone_search_targets.target_index, stars.star_id'
+
+    rows = conn.execute(query).fetchall()
+
+    conn.execute('DELETE FROM cone_search_targets')
+
+    if len(rows) > 0:
+        (target_index, star_id, ra, dec) = [ np.array(col) for col in zip(*rows) ]
+        ra = ra.astype(float)
+        dec = dec.astype(float)
+    else:
+        (target_index, star_id) = (np.array([], dtype=int), np.array([], dtype=int))
+        (ra, dec) = (np.array([]), np.array([]))
+
+    c = SkyCoord(ra_centres[target_index], dec_centres[target_index],
+                 frame='icrs', unit=(units.deg,units.deg))
+    s = SkyCoord(ra, dec, frame='icrs', unit=(units.deg,units.deg))
+    separations = c.separation(s).deg
+
+    within = separations <= radius[target_index]
+
+    return table.Table([ table.Column(name='target_index', data=target_index[within]),
+                         table.Column(name='star_id', data=star_id[within]),
+                         table.Column(name='ra', data=ra[within]),
+                         table.Column(name='dec', data=dec[within]),
+                         table.Column(name='separation', data=separations[within]) ])
+
 def cascade_delete_reference_images(conn, refimg_id_list,log):
     """Function to remove all database entries corresponding to a given
     reference image, including both the entries for the image itself and
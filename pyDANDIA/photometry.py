@@ -29,6 +29,7 @@ from pyDANDIA import image_handling
 from scipy.odr import *
 import scipy.optimize as so
 import scipy.ndimage as sndi
+from multiprocessing import Pool
 
 
 def linear_func(p, x):
@@ -36,12 +37,27 @@ def linear_func(p, x):
     return a * x + b
 
 
+# Size in pixels of the square tiles used to partition the reference catalog
+REF_PHOT_TILE_SIZE = 512
+
+# Read-only data shared by the reference photometry work units of a process
+ref_phot_worker_data = {}
+
 def run_psf_photometry(setup,reduction_metadata,log,ref_star_catalog,
                        image_path,psf_model,sky_model,
-                       centroiding=True, diagnostics=True, psf_diameter=None):
+                       centroiding=True, diagnostics=True, psf_diameter=None,
+                       n_workers=1, tile_size=REF_PHOT_TILE_SIZE, grouped=False):
     """Function to perform PSF fitting photometry on all stars for a single
     image.
 
+    The catalog is partitioned spatially into square tiles, and the stars of
+    each tile are fitted as one work unit, optionally distributed over a pool
+    of worker processes which share the image data read-only.  Where the star
+    positions are fixed (centroiding=False), only the PSF intensity is fitted,
+    which is a linear, weighted least-squares fit calculated for all stars of
+    a tile at once.  In grouped mode, stars whose PSF stamps overlap are
+    fitted simultaneously with psf.fit_star_group_existing_model.
+
     :param SetUp object setup: Essential reduction parameters
     :param MetaData reduction_metadata: pipeline metadata for this dataset
     :param logging log: Open reduction log object
@@ -49,9 +65,13 @@ def run_psf_photometry(setup,reduction_metadata,log,ref_star_catalog,
     :param str image_path: Path to image to be photometered
     :param PSFModel object psf_model: PSF to be fitted to each star
     :param BackgroundModel object sky_model: Model for the image sky background
-    :param float ref_flux: Reference flux value for optimized PSF measurement
     :param boolean centroiding: Switch to (dis)-allow re-fitting of each star's
                                 x, y centroid.  Default=allowed (True)
+    :param boolean diagnostics: Switch for per-star logging
+    :param float psf_diameter: Diameter of the PSF stamp fitted to each star
+    :param int n_workers: Number of worker processes, default=1 (serial)
+    :param int tile_size: Width in pixels of the tiles of the catalog
+    :param boolean grouped: Switch to fit blended stars simultaneously
 
     Returns:
 
@@ -78,187 +98,417 @@ def run_psf_photometry(setup,reduction_metadata,log,ref_star_catalog,
                     ' PSF of diameter='+str(psf_diameter))
     logs.ifverbose(log,setup,'Scaling fluxes by exposure time '+str(exp_time)+'s')
 
-    Y_data, X_data = np.indices((int(psf_diameter),int(psf_diameter)))
-
     Y_image, X_image = np.indices(data.shape)
 
     sky_bkgd = sky_model.background_model(Y_image,X_image,sky_model.get_parameters())
 
-    residuals = np.copy(data)
+    if grouped:
+        (groups, group_size) = psf.group_blended_stars(ref_star_catalog[:,1],
+                                                       ref_star_catalog[:,2],
+                                                       psf_diameter)
+        log.info('Found '+str((group_size > 1).sum())+' groups of blended stars, including '+\
+                 str(group_size[group_size > 1].sum())+' stars, to be fitted simultaneously')
+    else:
+        groups = None
+
+    work_units = build_photometry_tiles(ref_star_catalog[:,1], ref_star_catalog[:,2],
+                                        tile_size, groups=groups)
+
+    shared_data = {'image': data, 'sky_bkgd': sky_bkgd,
+                   'xstars': np.array(ref_star_catalog[:,1], dtype=float),
+                   'ystars': np.array(ref_star_catalog[:,2], dtype=float),
+                   'psf_type': psf_model.psf_type(),
+                   'psf_parameters': psf_model.get_parameters(),
+                   'psf_diameter': psf_diameter, 'centroiding': centroiding,
+                   'groups': groups, 'setup': setup}
+
+    fit = run_photometry_work_units(work_units, shared_data, n_workers,
+                                    len(ref_star_catalog), log)
+
+    # Photometric uncertainties.  The uncertainty of the star flux is
+    # the Poisson noise on the fitted PSF flux.
+    flux = fit['flux']
+    sigma_star = np.zeros(len(flux))
+    sigma_star.fill(-99.999)
+    positive = flux > 0
+    sigma_star[positive] = np.sqrt(flux[positive] * gain)
+    sigma_ron = np.sqrt(ron*ron * psf_npixels)
+    median_sky = fit['median_sky']
+    sigma_sky = np.sqrt(median_sky * gain * psf_npixels)
+
+    flux_err = np.sqrt( (sigma_star*sigma_star) + (sigma_ron*sigma_ron) + (sigma_sky*sigma_sky) )
+
+    (mag, mag_err, flux_scaled, flux_err_scaled) = convert_flux_to_mag_array(flux, flux_err,
+                                                                            exp_time=exp_time)
+
+    good_fit = fit['good_fit']
+    bad_fit = np.invert(good_fit)
+
+    ref_star_catalog[good_fit,5] = flux_scaled[good_fit]
+    ref_star_catalog[good_fit,6] = flux_err_scaled[good_fit]
+    ref_star_catalog[good_fit,7] = mag[good_fit]
+    ref_star_catalog[good_fit,8] = mag_err[good_fit]
+    ref_star_catalog[good_fit,12] = sky_model.get_local_background(ref_star_catalog[good_fit,1],
+                                                                   ref_star_catalog[good_fit,2])
+    ref_star_catalog[good_fit,13] = np.sqrt(sky_model.varience)
+
+    ref_star_catalog[bad_fit,5:11] = 0.0
+    ref_star_catalog[bad_fit,11] = 1e10
+    ref_star_catalog[bad_fit,12:14] = 0.0
+
+    if diagnostics:
+        logs.ifverbose(log, setup, ' -> PSF radius='+str(half_psf)+\
+                        'pix, N pixels PSF='+str(psf_npixels)+'pix, gain='+str(gain)+\
+                        ' e-/ADU, read noise='+str(sigma_ron)+'e- (RON='+str(ron)+'e-/pix)')
+
+        for j in range(0,len(ref_star_catalog),1):
+            if good_fit[j]:
+                logs.ifverbose(log,setup,' -> Star '+str(j)+' at position ('+\
+                                str(ref_star_catalog[j,1])+', '+str(ref_star_catalog[j,2])+') '+
+                                'raw flux='+str(flux[j])+'e- '+
+                                'star noise='+str(sigma_star[j])+'e- '+
+                                'sky noise='+str(sigma_sky[j])+'e- (median sky='+str(median_sky[j])+'ADU) '+
+                                'flux='+str(flux_scaled[j])+' +/- '+\
+                                str(flux_err_scaled[j])+' ADU, '
+                                'mag='+str(mag[j])+' +/- '+str(mag_err[j])+' mag')
+            else:
+                logs.ifverbose(log,setup,' -> Star '+str(j)+
+                                ' No photometry possible from poor PSF fit')
 
-    jincr = int(float(len(ref_star_catalog))*0.01)
-    psf_params = []
-    for j in range(0,len(ref_star_catalog),1):
+    log.info('Fitted '+str(good_fit.sum())+' out of '+str(len(ref_star_catalog))+' stars')
 
-        xstar = ref_star_catalog[j,1]
-        ystar = ref_star_catalog[j,2]
+    residuals = subtract_psf_models(data, psf_model, ref_star_catalog[:,1],
+                                    ref_star_catalog[:,2], fit['intensity'],
+                                    psf_diameter, good_fit, work_units)
 
-        X_grid = X_data + (int(xstar) - half_psf)
-        Y_grid = Y_data + (int(ystar) - half_psf)
+    res_image_path = os.path.join(setup.red_dir,'ref',os.path.basename(image_path).replace('.fits','_res.fits'))
 
-        corners = psf.calc_stamp_corners(xstar, ystar, psf_diameter, psf_diameter,
-                                         data.shape[1], data.shape[0],
-                                         over_edge=True)
+    hdu = fits.PrimaryHDU(residuals-np.median(sky_bkgd))
+    hdulist = fits.HDUList([hdu])
+    hdulist.writeto(res_image_path, overwrite=True)
 
-        if diagnostics:
-            logs.ifverbose(log,setup,' -> Star '+str(j)+' at position ('+\
-                            str(xstar)+', '+str(ystar)+')')
+    logs.ifverbose(log, setup, 'Output residuals image '+res_image_path)
 
-            logs.ifverbose(log,setup,' -> Corners of PSF stamp '+repr(corners))
+    plot_ref_mag_errors(setup,ref_star_catalog)
 
-        (data_section, sec_xstar, sec_ystar) = psf.extract_image_section(data,
-                                                            xstar,ystar,corners)
+    log.info('Completed photometry')
 
-        (sky_section, sky_x, sky_y) = psf.extract_image_section(sky_bkgd,
-                                                            xstar,ystar,corners)
+    return ref_star_catalog
 
-        (fitted_model,fitted_cov,good_fit) = psf.fit_star_existing_model(setup, data_section,
-                                               sec_xstar, sec_ystar,
-                                               psf_diameter, psf_model,
-                                               sky_section,
-                                               centroiding=centroiding,
-                                               diagnostics=False)
+def build_photometry_tiles(xstars, ystars, tile_size, groups=None):
+    """Function to partition a catalog of stars into square tiles of the image.
+    If groups of blended stars are given, all stars of a group are assigned to
+    the tile containing the mean position of the group.
 
-        if diagnostics:
-            logs.ifverbose(log, setup,' -> Star '+str(j)+
-                            ' fitted model parameters = '+
-                            repr(fitted_model.get_parameters()))
+    :param array xstars: x-pixel positions of the stars
+    :param array ystars: y-pixel positions of the stars
+    :param int tile_size: Width of the tiles in pixels
+    :param array groups: Index of the blend group of each star [optional]
 
-        fitted_pars = fitted_model.get_parameters()
-        fitted_pars[1] = ystar
-        fitted_pars[2] = xstar
-        fitted_model.update_psf_parameters(fitted_pars)
+    Returns:
 
-        if diagnostics:
-            logs.ifverbose(log, setup,' -> Star '+str(j)+
-                            ' updated centroid parameters = '+\
-                            repr(fitted_model.get_parameters())+
-                            ' good fit? '+repr(good_fit))
+    :param list work_units: Entries of [tile_index, star_index] for each
+                            occupied tile, where star_index is the array of
+                            the catalog indices of the stars in the tile
+    """
 
+    tile_size = max(int(tile_size), 1)
+    xstars = np.asarray(xstars, dtype=float)
+    ystars = np.asarray(ystars, dtype=float)
 
-        if good_fit == True:
+    if groups is not None:
+        group_size = np.bincount(groups)
+        xstars = (np.bincount(groups, weights=xstars) / group_size)[groups]
+        ystars = (np.bincount(groups, weights=ystars) / group_size)[groups]
 
-            sub_psf_model = psf.get_psf_object('Moffat2D')
+    xtile = np.floor(xstars / tile_size).astype(int)
+    ytile = np.floor(ystars / tile_size).astype(int)
 
-            pars = fitted_model.get_parameters()
-            #pars[1] = (psf_diameter/2.0) + (sec_ystar-np.round(sec_ystar))
-            #pars[2] = (psf_diameter/2.0) + (sec_xstar-np.round(sec_xstar))
+    tiles = np.stack((ytile, xtile), axis=1)
+    (tile_ids, tile_index) = np.unique(tiles, axis=0, return_inverse=True)
+    tile_index = tile_index.ravel()
 
+    order = np.argsort(tile_index, kind='stable')
+    boundaries = np.searchsorted(tile_index[order], np.arange(0,len(tile_ids)+1,1))
 
+    work_units = []
+    for t in range(0,len(tile_ids),1):
+        work_units.append([tuple(tile_ids[t]), order[boundaries[t]:boundaries[t+1]]])
 
-            pars[1] = sec_ystar
-            pars[2] = sec_xstar
+    return work_units
 
-            sub_psf_model.update_psf_parameters(pars)
+def run_photometry_work_units(work_units, shared_data, n_workers, nstars, log):
+    """Function to fit the stars of a list of tile work units, either serially
+    or distributed over a pool of worker processes
 
-            sub_corners = psf.calc_stamp_corners(sec_xstar, sec_ystar,
-                                                 psf_diameter, psf_diameter,
-                                                 data_section.shape[1],
-                                                 data_section.shape[0],
-                                                 over_edge=True)
+    :param list work_units: Entries of [tile_index, star_index]
+    :param dict shared_data: Read-only data required by every work unit
+    :param int n_workers: Number of worker processes
+    :param int nstars: Total number of stars in the catalog
+    :param logger log: Open reduction log
 
-            psf_image = psf.model_psf_in_image(data_section,sub_psf_model,
-                                                    [sec_ystar,sec_xstar],
-                                                    sub_corners)
+    Returns:
 
-            residuals[corners[2]:corners[3],corners[0]:corners[1]] -= psf_image
+    :param dict fit: Arrays of the fitted intensity, flux, median_sky and
+                     good_fit for every star in the catalog
+    """
 
+    n_workers = max(1, min(int(n_workers), len(work_units)))
 
-            if diagnostics:
-                logs.ifverbose(log, setup,' -> Star '+str(j)+
-                                ' subtracted PSF from the residuals')
+    if n_workers == 1:
+        log.info('Fitting the PSFs of '+str(nstars)+' stars in '+
+                 str(len(work_units))+' tiles serially')
+        init_photometry_worker(shared_data)
+        tile_results = map(fit_tile_photometry, work_units)
+        pool = None
+    else:
+        log.info('Fitting the PSFs of '+str(nstars)+' stars in '+
+                 str(len(work_units))+' tiles with '+str(n_workers)+' worker processes')
+        pool = Pool(processes=n_workers, initializer=init_photometry_worker,
+                    initargs=(shared_data,))
+        tile_results = pool.imap(fit_tile_photometry, work_units)
+
+    fit = {'intensity': np.zeros(nstars), 'flux': np.zeros(nstars),
+           'median_sky': np.zeros(nstars), 'good_fit': np.zeros(nstars, dtype='bool')}
+
+    try:
+        nfitted = 0
+        jincr = max(int(float(nstars)*0.1), 1)
+        for unit, result in zip(work_units, tile_results):
+            star_index = unit[1]
+            for key in fit.keys():
+                fit[key][star_index] = result[key]
+
+            if (nfitted + len(star_index))//jincr > nfitted//jincr:
+                percentage = round((float(nfitted+len(star_index))/float(nstars))*100.0,0)
+                log.info(' -> Photometry '+str(percentage)+\
+                            '% complete ('+str(nfitted+len(star_index))+' stars out of '+\
+                            str(nstars)+')')
+            nfitted += len(star_index)
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+
+    return fit
+
+def init_photometry_worker(shared_data):
+    """Function to initialize a process to fit reference image photometry,
+    storing the data shared between work units.
+
+    :param dict shared_data: Read-only data required by every work unit
+    """
 
-            (flux, sigma_star) = fitted_model.calc_flux(Y_grid, X_grid, gain)
+    ref_phot_worker_data.clear()
+    ref_phot_worker_data.update(shared_data)
 
-            try:
-                error_psf_model = psf.get_psf_object('Moffat2D')
-                ppp = np.copy(pars)
-                y,x = np.indices(psf_image.shape)
-                
-                jacobians = aa.psf_model_deriv1(y,x,ppp)+[np.ones(psf_image.shape)] #Adding background jacs
-                jacobians_per_pixel = [[jacobians[0][i,j],jacobians [1][i,j],jacobians [2][i,j],jacobians [3][i,j],jacobians [4][i,j],jacobians [5][i,j]] for i in range(psf_image.shape[0]) for j in range(psf_image.shape[1])]
-                variance_per_pixel = [np.dot(jacobians_per_pixel[i],np.dot(fitted_cov,jacobians_per_pixel[i])) for i in range(len(jacobians_per_pixel))]
+    psf_model = psf.get_psf_object(shared_data['psf_type'])
+    psf_model.update_psf_parameters(shared_data['psf_parameters'])
+    ref_phot_worker_data['psf_model'] = psf_model
 
-                sigma_star2 = np.sum(variance_per_pixel)**0.5
-            except:
-                sigma_star2 = sigma_star
-                
-            sigma_ron = np.sqrt(ron*ron * psf_npixels)
-            median_sky = np.median(sky_section)
-            sigma_sky = np.sqrt(median_sky * gain * psf_npixels)
+def fit_tile_photometry(work_unit):
+    """Function to fit the PSF of all stars in a tile work unit, using the
+    data stored by init_photometry_worker
 
+    :param list work_unit: Entry of [tile_index, star_index]
 
+    Returns:
 
-            total_flux = (sigma_star2*sigma_star2) + (sigma_ron*sigma_ron) + (sigma_sky*sigma_sky)
-            flux_err = np.sqrt(total_flux)
+    :param dict result: Arrays of the fitted intensity, flux, median_sky and
+                        good_fit for the stars in the tile
+    """
 
-            total_flux = (sigma_star2*sigma_star2) + (sigma_ron*sigma_ron) + (sigma_sky*sigma_sky)
-            flux_err = np.sqrt(total_flux)
+    star_index = work_unit[1]
+    image = ref_phot_worker_data['image']
+    sky_bkgd = ref_phot_worker_data['sky_bkgd']
+    psf_model = ref_phot_worker_data['psf_model']
+    psf_diameter = ref_phot_worker_data['psf_diameter']
+    xstars = ref_phot_worker_data['xstars'][star_index]
+    ystars = ref_phot_worker_data['ystars'][star_index]
+
+    if ref_phot_worker_data['groups'] is not None:
+        (intensity, good_fit) = fit_star_group_intensities(image, sky_bkgd, psf_model,
+                                                        xstars, ystars, psf_diameter,
+                                                        ref_phot_worker_data['groups'][star_index],
+                                                        ref_phot_worker_data['centroiding'])
+    elif ref_phot_worker_data['centroiding']:
+        (intensity, good_fit) = fit_star_intensities_with_centroiding(ref_phot_worker_data['setup'],
+                                                        image, sky_bkgd, psf_model,
+                                                        xstars, ystars, psf_diameter)
+    else:
+        (intensity, good_fit) = fit_star_intensities(image, sky_bkgd, psf_model,
+                                                     xstars, ystars, psf_diameter)
+
+    (Y_stamps, X_stamps, inside) = psf.calc_stamp_pixels(xstars, ystars,
+                                                         psf_diameter, psf_diameter,
+                                                         image.shape[1], image.shape[0])
+    sky_stamps = np.where(inside, sky_bkgd[np.clip(Y_stamps, 0, image.shape[0]-1),
+                                           np.clip(X_stamps, 0, image.shape[1]-1)], np.nan)
+    median_sky = np.zeros(len(star_index))
+    has_pixels = inside.any(axis=(1,2))
+    median_sky[has_pixels] = np.nanmedian(sky_stamps[has_pixels], axis=(1,2))
+
+    # Flux of the fitted PSF, summed over a box of the PSF diameter
+    half_psf = int(float(psf_diameter)/2.0)
+    Y_data, X_data = np.indices((int(psf_diameter),int(psf_diameter)))
+    X_grid = X_data[np.newaxis,:,:] + (xstars.astype(int) - half_psf)[:,np.newaxis,np.newaxis]
+    Y_grid = Y_data[np.newaxis,:,:] + (ystars.astype(int) - half_psf)[:,np.newaxis,np.newaxis]
+    flux = intensity * psf.model_unit_psfs(psf_model, Y_grid, X_grid, xstars, ystars).sum(axis=(1,2))
+
+    return {'intensity': intensity, 'flux': flux, 'median_sky': median_sky,
+            'good_fit': good_fit}
+
+def fit_star_intensities(image, sky_bkgd, psf_model, xstars, ystars, psf_diameter):
+    """Function to fit the intensity of an existing PSF model to a set of
+    stars at fixed positions.  As the model is linear in the intensity, the
+    weighted least-squares solution is calculated directly for all stars at
+    once, using the same stamps and weights as psf.fit_star_existing_model.
+
+    :param array image: Image data
+    :param array sky_bkgd: Model sky background for the image
+    :param PSFModel psf_model: PSF model to be fitted
+    :param array xstars: x-pixel positions of the stars
+    :param array ystars: y-pixel positions of the stars
+    :param float psf_diameter: Width of the stamp fitted around each star
 
+    Returns:
 
+    :param array intensity: Fitted intensity of the PSF for each star
+    :param array good_fit: Boolean array indicating a valid fit
+    """
 
-            if diagnostics:
-                logs.ifverbose(log, setup, ' -> Star '+str(j)+' raw flux='+str(flux)+'e- '+
-                                'star noise='+str(sigma_star)+'e- '+
-                                'read noise='+str(sigma_ron)+'e- (RON='+str(ron)+'e-/pix) '+
-                                'sky noise='+str(sigma_sky)+'e- (median sky='+str(median_sky)+'ADU) '+
-                                'total flux uncertainty='+str(flux_err)+
-                                ' before scaling by exposure time')
-                logs.ifverbose(log, setup, ' -> PSF radius='+str(half_psf)+\
-                                'pix, N pixels PSF='+str(psf_npixels)+'pix, gain='+str(gain)+' e-/ADU')
+    (Y_stamps, X_stamps, inside) = psf.calc_stamp_pixels(xstars, ystars,
+                                                         psf_diameter, psf_diameter,
+                                                         image.shape[1], image.shape[0])
+    Y_pix = np.clip(Y_stamps, 0, image.shape[0]-1)
+    X_pix = np.clip(X_stamps, 0, image.shape[1]-1)
 
-            (mag, mag_err, flux_scaled, flux_err_scaled) = convert_flux_to_mag(flux, flux_err, exp_time=exp_time)
+    data = image[Y_pix, X_pix]
+    sky_subtracted_data = data - sky_bkgd[Y_pix, X_pix]
 
+    # Design matrix of each star: the unit-intensity PSF in its stamp
+    design = psf.model_unit_psfs(psf_model, Y_stamps, X_stamps, xstars, ystars)
 
-            ref_star_catalog[j,5] = flux_scaled
-            ref_star_catalog[j,6] = flux_err_scaled
-            ref_star_catalog[j,7] = mag
-            ref_star_catalog[j,8] = mag_err
-            ref_star_catalog[j,12] = sky_model.get_local_background(xstar, ystar)
-            ref_star_catalog[j,13] = np.sqrt(sky_model.varience)
+    valid = inside & np.isfinite(data) & (data != 0)
+    weights = np.zeros(data.shape)
+    weights[valid] = 1.0 / np.abs(data[valid])
 
-            if diagnostics:
-                logs.ifverbose(log,setup,' -> Star '+str(j)+
-                                ' flux='+str(flux_scaled)+' +/- '+\
-                                str(flux_err_scaled)+' ADU, '
-                                'mag='+str(mag)+' +/- '+str(mag_err)+' mag')
+    normal = (weights * design * design).sum(axis=(1,2))
+    projection = (weights * design * np.where(valid, sky_subtracted_data, 0.0)).sum(axis=(1,2))
 
-        else:
+    intensity = np.zeros(len(normal))
+    fitted = normal > 0.0
+    intensity[fitted] = projection[fitted] / normal[fitted]
 
-            if diagnostics:
-                logs.ifverbose(log,setup,' -> Star '+str(j)+
-                                ' No photometry possible from poor PSF fit')
+    good_fit = fitted & (intensity > 0.0)
 
-            ref_star_catalog[j,5] = 0.0
-            ref_star_catalog[j,6] = 0.0
-            ref_star_catalog[j,7] = 0.0
-            ref_star_catalog[j,8] = 0.0
-            ref_star_catalog[j,9] = 0.0
-            ref_star_catalog[j,10] = 0.0
-            ref_star_catalog[j,11] = 1e10
-            ref_star_catalog[j,12] = 0.0
-            ref_star_catalog[j,12] = 0.0
-            ref_star_catalog[j,13] = 0.0
-
-        if j%jincr == 0:
-            percentage = round((float(j)/float(len(ref_star_catalog)))*100.0,0)
-            logs.ifverbose(log,setup,' -> Photometry '+str(percentage)+\
-                            '% complete ('+str(j)+' stars out of '+\
-                            str(len(ref_star_catalog))+')')
+    return intensity, good_fit
 
-    res_image_path = os.path.join(setup.red_dir,'ref',os.path.basename(image_path).replace('.fits','_res.fits'))
+def fit_star_group_intensities(image, sky_bkgd, psf_model, xstars, ystars,
+                               psf_diameter, groups, centroiding):
+    """Function to fit the intensities of a set of stars, fitting the stars
+    of each group of blended stars simultaneously.  Isolated stars are fitted
+    together with fit_star_intensities.
 
-    hdu = fits.PrimaryHDU(residuals-np.median(sky_bkgd))
-    hdulist = fits.HDUList([hdu])
-    hdulist.writeto(res_image_path, overwrite=True)
+    :param array groups: Index of the blend group of each star
 
-    logs.ifverbose(log, setup, 'Output residuals image '+res_image_path)
+    Returns:
 
-    plot_ref_mag_errors(setup,ref_star_catalog)
+    :param array intensity: Fitted intensity of the PSF for each star
+    :param array good_fit: Boolean array indicating a valid fit
+    """
 
-    log.info('Completed photometry')
+    intensity = np.zeros(len(xstars))
+    good_fit = np.zeros(len(xstars), dtype='bool')
 
-    return ref_star_catalog
+    (group_ids, group_index, group_size) = np.unique(groups, return_inverse=True,
+                                                     return_counts=True)
+    group_index = group_index.ravel()
+    blended = group_size[group_index] > 1
+
+    isolated = np.where(np.invert(blended))[0]
+    if len(isolated) > 0:
+        (intensity[isolated], good_fit[isolated]) = fit_star_intensities(image, sky_bkgd,
+                                                        psf_model, xstars[isolated],
+                                                        ystars[isolated], psf_diameter)
+
+    order = np.argsort(group_index, kind='stable')
+    boundaries = np.searchsorted(group_index[order], np.arange(0,len(group_ids)+1,1))
+    for g in np.where(group_size > 1)[0]:
+        jdx = order[boundaries[g]:boundaries[g+1]]
+
+        (intensity[jdx], x_fit, y_fit, good_fit[jdx]) = psf.fit_star_group_existing_model(image,
+                                                        sky_bkgd, psf_model,
+                                                        xstars[jdx], ystars[jdx],
+                                                        psf_diameter,
+                                                        centroiding=centroiding)
+
+    return intensity, good_fit
+
+def fit_star_intensities_with_centroiding(setup, image, sky_bkgd, psf_model,
+                                          xstars, ystars, psf_diameter):
+    """Function to fit the intensity and centroid of an existing PSF model to
+    each of a set of stars in turn
+
+    Returns:
+
+    :param array intensity: Fitted intensity of the PSF for each star
+    :param array good_fit: Boolean array indicating a valid fit
+    """
+
+    intensity = np.zeros(len(xstars))
+    good_fit = np.zeros(len(xstars), dtype='bool')
+
+    for j in range(0,len(xstars),1):
+
+        corners = psf.calc_stamp_corners(xstars[j], ystars[j], psf_diameter, psf_diameter,
+                                         image.shape[1], image.shape[0],
+                                         over_edge=True)
+
+        (data_section, sec_xstar, sec_ystar) = psf.extract_image_section(image,
+                                                            xstars[j],ystars[j],corners)
+
+        (sky_section, sky_x, sky_y) = psf.extract_image_section(sky_bkgd,
+                                                            xstars[j],ystars[j],corners)
+
+        if data_section.size == 0:
+            continue
+
+        (fitted_model,fitted_cov,fit_ok) = psf.fit_star_existing_model(setup, data_section,
+                                               sec_xstar, sec_ystar,
+                                               psf_diameter, psf_model,
+                                               sky_section,
+                                               centroiding=True,
+                                               diagnostics=False)
+
+        intensity[j] = fitted_model.get_parameters()[0]
+        good_fit[j] = fit_ok
+
+    return intensity, good_fit
+
+def subtract_psf_models(data, psf_model, xstars, ystars, intensity, psf_diameter,
+                        good_fit, work_units):
+    """Function to subtract the fitted PSF models of all stars from an image,
+    returning the residuals image.  The models are built for the stars of
+    each tile in turn, to limit the memory required."""
+
+    residuals = np.copy(data)
+
+    for unit in work_units:
+        jdx = unit[1][good_fit[unit[1]]]
+        if len(jdx) == 0:
+            continue
+
+        (Y_stamps, X_stamps, inside) = psf.calc_stamp_pixels(xstars[jdx], ystars[jdx],
+                                                            psf_diameter, psf_diameter,
+                                                            data.shape[1], data.shape[0])
+
+        psf_images = psf.model_unit_psfs(psf_model, Y_stamps, X_stamps, xstars[jdx], ystars[jdx]) * \
+                        intensity[jdx,np.newaxis,np.newaxis]
+
+        np.subtract.at(residuals, (Y_stamps[inside], X_stamps[inside]), psf_images[inside])
+
+    return residuals
 
 def run_psf_photometry_naylor(setup,reduction_metadata,log,ref_star_catalog,
                        image_path,psf_model,sky_model,ref_flux,
@@ -517,24 +767,61 @@ def calc_calib_mags(fit_params, covar_fit, mag, mag_err):
 
     return cal_ref_mag, cal_ref_mag_err
 
+def calc_calib_mags_array(fit_params, covar_fit, mag, mag_err):
+    """Array equivalent of calc_calib_mags, returning zero calibrated
+    magnitudes and uncertainties for stars with mag < 7"""
+
+    mag = np.asarray(mag, dtype=float)
+    mag_err = np.asarray(mag_err, dtype=float)
+
+    ccalib = np.eye(3)
+    ccalib[:2,:2] = covar_fit
+    ccalib[2,2] = fit_params[0]**2
+    jac = np.c_[mag, np.ones(len(mag)), mag_err]
+
+    cal_mag = np.zeros(len(mag))
+    cal_mag_err = np.zeros(len(mag))
+
+    calibrated = mag >= 7.0
+    cal_mag[calibrated] = calibrate_photometry.phot_func(fit_params, mag[calibrated])
+    cal_mag_err[calibrated] = np.einsum('ij,jk,ik->i', jac[calibrated], ccalib, jac[calibrated])**0.5
+
+    return cal_mag, cal_mag_err
+
+# Columns of the difference image photometry, in the order they are output
+DIFFERENCE_PHOTOMETRY_COLUMNS = ['star_id',
+                                 'diff_flux', 'diff_flux_err',
+                                 'magnitude', 'magnitude_err',
+                                 'cal_magnitude', 'cal_magnitude_err',
+                                 'flux', 'flux_err',
+                                 'cal_flux', 'cal_flux_err',
+                                 'phot_scale_factor', 'phot_scale_factor_err',
+                                 'local_background', 'local_background_err',
+                                 'residual_x', 'residual_y',
+                                 'radius']
+
 def run_psf_photometry_on_difference_image(setup, reduction_metadata, log, ref_star_catalog, sky_model,
                                            difference_image, psf_model, kernel, kernel_error, background_difference_image,ref_exposure_time,image_id,
                                            per_star_logging=False):
-    """Function to perform PSF fitting photometry on all stars for a single difference image.
+    """Function to perform photometry on all stars for a single difference image.
+    The measurements are calculated for all stars at once; stars which fail
+    quality control are given null values of -9999.99.
 
     :param SetUp object setup: Essential reduction parameters
     :param MetaData reduction_metadata: pipeline metadata for this dataset
     :param logging log: Open reduction log object
-    :param array ref_star_catalog: catalog of objects detected in the image
+    :param structured array ref_star_catalog: catalog of objects detected in the image, with
+                                fields star_id, x, y, ref_flux and ref_flux_err
     :param array_like difference_image: the array of data on which performs photometry
     :param array_like psf_model: PSF to be fitted to each star
 
 
     Returns:
 
-    :param array ref_star_catalog: catalog of objects detected in the image
+    :param structured array difference_image_photometry: photometry for all stars
+                                with fields DIFFERENCE_PHOTOMETRY_COLUMNS
     """
-    
+
     def check_fwhm(reduction_metadata, image_id, log):
 
         use_image = True
@@ -566,23 +853,12 @@ def run_psf_photometry_on_difference_image(setup, reduction_metadata, log, ref_s
 
         return use_image
 
-    def null_background(x,axis=None):
-        return 0
-
-
     #psf_diameter = reduction_metadata.psf_dimensions[1]['psf_radius'][0]*2.0
     psf_diameter = reduction_metadata.get_psf_radius()*2.0
-    half_psf = int(psf_diameter/2)
     gain = reduction_metadata.get_gain()
     ron = reduction_metadata.reduction_parameters[1]['RON']
     log.info('Performing PSF photometry on difference stamp with PSF diameter = '+str(psf_diameter))
 
-    size_stamp = int(2 * half_psf) + 1
-    if size_stamp % 2 == 0:
-        size_stamp += 1
-
-    Y_data, X_data = np.indices((size_stamp, size_stamp))
-
     fit_params = [reduction_metadata.phot_calib[1]['a0'][0],
                   reduction_metadata.phot_calib[1]['a1'][0]]
     covar_fit = np.array( [ [reduction_metadata.phot_calib[1]['c0'][0],reduction_metadata.phot_calib[1]['c1'][0]],
@@ -591,53 +867,26 @@ def run_psf_photometry_on_difference_image(setup, reduction_metadata, log, ref_s
     log.info('Calculating calibrated photometry using fit parameters: '+repr(fit_params))
     log.info('and covarience matrix: '+repr(covar_fit))
 
-    list_star_id = []
-
-    list_radius = []
-
-    list_delta_flux = []
-    list_delta_flux_error = []
-
-    list_flux = []
-    list_flux_error = []
-    list_cal_flux = []
-    list_cal_flux_error = []
-
-    list_mag = []
-    list_mag_error = []
-    list_cal_mag = []
-    list_cal_mag_error = []
-
-    list_phot_scale_factor = []
-    list_phot_scale_factor_error = []
-    list_background = []
-    list_background_error = []
-
-    list_align_x = []
-    list_align_y = []
-
     phot_scale_factor = np.sum(kernel)
     error_phot_scale_factor = np.sum(kernel_error**2)**0.5
 
-    control_size = 50
-    control_count = 0
-    #psf_parameters = psf_model.get_parameters()
-
-    #radius = half_psf + 1
+    nstars = len(ref_star_catalog)
+    dtype = [('star_id', ref_star_catalog['star_id'].dtype)] + \
+            [(column, 'float64') for column in DIFFERENCE_PHOTOMETRY_COLUMNS[1:]]
+    difference_image_photometry = np.zeros(nstars, dtype=dtype)
+    difference_image_photometry['star_id'] = ref_star_catalog['star_id']
+    for column in DIFFERENCE_PHOTOMETRY_COLUMNS[1:]:
+        difference_image_photometry[column] = -9999.99
 
-    positions = np.array(ref_star_catalog[:, [1, 2]]).astype(np.float)
-    pixscale = reduction_metadata.reduction_parameters[1]['PIX_SCALE'].data[0]
+    positions = np.c_[ref_star_catalog['x'], ref_star_catalog['y']]
     use_image = check_fwhm(reduction_metadata, image_id, log)
 
-
     if use_image:
 
         mask = difference_image == 0
-        radius = psf_diameter/2.0
 
         radius = reduction_metadata.images_stats[1]['FWHM'][image_id]*1
         apertures = CircularAperture(positions, r=radius)
-        #apertures = RectangularAperture(positions, w=radius*2,h=radius*2)
 
         sigma_clip = SigmaClip(sigma=3.)
         bkg_estimator = MedianBackground()
@@ -654,227 +903,83 @@ def run_psf_photometry_on_difference_image(setup, reduction_metadata, log, ref_s
         error = calc_total_error(np.abs(difference_image), (bkg.background_rms**2)**0.5, gain)
         error = (error**2+ron**2/gain**2)**0.5
 
-        #import pdb ; pdb.set_trace()
-
-        try:
-            phot_table = aperture_photometry(difference_image-bkg.background, apertures, method='subpixel',
-                         error=error)
-
-        except ValueError:
-            import pdb;
-            pdb.set_trace()
-
-        log.info('Performing difference image photometry for '+str(len(ref_star_catalog))+' stars')
-
-        for j in range(0, len(ref_star_catalog), 1):
-
-            good_fit = True
-
-            list_star_id.append(ref_star_catalog[j, 0])
-
-            xstar = float(ref_star_catalog[j, 1])
-            ystar = float(ref_star_catalog[j, 2])
-            ref_flux = float(ref_star_catalog[j, 5])
-            error_ref_flux = float(ref_star_catalog[j, 6])
-            cal_ref_flux = float(ref_star_catalog[j, 11])
-            error_cal_ref_flux = float(ref_star_catalog[j, 12])
-
-            if ref_flux <= 0.0 or error_ref_flux <= 0.0:
-                good_fit = False
-
-            use_psf_photometry = False
-
-            if use_psf_photometry and good_fit:
-
-                X_grid = X_data + (int(np.round(xstar)) - half_psf)
-                Y_grid = Y_data + (int(np.round(ystar)) - half_psf)
-
-                logs.ifverbose(log, setup, ' -> Star ' + str(j) + ' at position (' + \
-                               str(xstar) + ', ' + str(ystar) + ')')
-
-                psf_parameters[1] = xstar
-                psf_parameters[2] = ystar
-
-                psf_image = psf_model.psf_model(X_grid, Y_grid, psf_parameters)
-
-                psf_convolve = sndi.filters.convolve(psf_image, kernel,mode='constant')
-
-                try:
-
-                    max_x = int(np.min([difference_image.shape[0], np.max(X_data + (int(np.round(xstar)) - half_psf)) + 1]))
-                    min_x = int(np.max([0, np.min(X_data + (int(np.round(xstar)) - half_psf))]))
-                    max_y = int(np.min([difference_image.shape[1], np.max(Y_data + (int(np.round(ystar)) - half_psf)) + 1]))
-                    min_y = int(np.max([0, np.min(Y_data + (int(np.round(ystar)) - half_psf))]))
-
-                    data = difference_image[min_y:max_y, min_x:max_x]
-
-                    max_x = int(max_x - (int(np.round(xstar)) - half_psf))
-                    min_x = int(min_x - (int(np.round(xstar)) - half_psf))
-                    max_y = int(max_y - (int(np.round(ystar)) - half_psf))
-                    min_y = int(min_y - (int(np.round(ystar)) - half_psf))
-
-                    PSF = psf_convolve[min_y:max_y, min_x:max_x]
-
-
-                    psf_fit = PSF
-
-                    good_fit = True
-
-
-                except:
-                    good_fit = False
-
-            else:
-                good_fit = True
-            if (positions[j][0]<0) | (positions[j][1]<0) | (positions[j][0]>difference_image.shape[1]) | \
-                    (positions[j][1]>difference_image.shape[0]):
-
-                good_fit = False
-           
-            if good_fit == True:
-
-                if ref_flux >= 0.0 and error_ref_flux > 0.0:
-
-
-                    flux = phot_table[j][3]/phot_scale_factor
-                    flux_err = phot_table[j][4]
-
-                    flux_tot = ref_flux*ref_exposure_time - flux
-                    flux_err_tot = (error_ref_flux ** 2*ref_exposure_time**2 + flux_err**2/phot_scale_factor**2+
-                                    (phot_table[j][3]*error_phot_scale_factor/phot_scale_factor**2)**2) ** 0.5
-
-                    if per_star_logging:
-                        log.info(' -> Star ' + str(j) + ' at position (' + \
-                                   str(xstar) + ', ' + str(ystar) + ') flux='+str(flux)+', flux_err='+str(flux_err)+\
-                                   ', flux_tot='+str(flux_tot)+', flux_err_tot='+str(flux_err_tot)+\
-                                   ', ref_flux='+str(ref_flux)+', ref_flux_err='+str(error_ref_flux)+\
-                                   ', phot_table entry='+str(phot_table[j][3])+'+/-'+str(phot_table[j][4])+', phot scale factor='+str(phot_scale_factor)+\
-                                   ', diff image at position='+str(difference_image[int(positions[j][1]),int(positions[j][0])])+\
-                                   ', bkgd at position='+str(bkg.background[int(positions[j][1]),int(positions[j][0])]))
-
-                    if (flux_tot > 0.0) and (flux_err_tot > 0.0) and (difference_image[int(positions[j][1]),int(positions[j][0])] != 0) \
-                                and (bkg.background[int(positions[j][1]),int(positions[j][0])]!=0) and (flux!=0) and (flux_err!=0):
-
-                        list_delta_flux.append(flux)
-                        list_delta_flux_error.append(flux_err)
-
-                        (mag, mag_err, flux_tot, flux_err_tot) = convert_flux_to_mag(flux_tot, flux_err_tot, ref_exposure_time)
-                        #(mag, mag_err, flux_tot, flux_err_tot) = convert_flux_to_mag(flux_tot2, flux_err_tot2, ref_exposure_time)
-
-                        #cal_mag = calibrate_photometry.phot_func(fit_params,mag)
-                        #cal_mag_err = mag_err
-                        (cal_mag, cal_mag_err) = calc_calib_mags(fit_params, covar_fit, mag, mag_err)
-
-                        (cal_flux, cal_flux_err) = convert_mag_to_flux(cal_mag, cal_mag_err)
-
-                        list_radius.append(radius)
-
-                        list_flux.append(flux_tot)
-                        list_flux_error.append(flux_err_tot)
-                        list_cal_flux.append(cal_flux)
-                        list_cal_flux_error.append(cal_flux_err)
-
-                        list_mag.append(mag)
-                        list_mag_error.append(mag_err)
-                        list_cal_mag.append(cal_mag)
-                        list_cal_mag_error.append(cal_mag_err)
-
-                        list_phot_scale_factor.append(phot_scale_factor)
-                        list_phot_scale_factor_error.append(error_phot_scale_factor)
-                        #list_background.append(back)
-                        #list_background_error.append(back_err)
-
-                        #list_align_x.append(xstar)
-                        #list_align_y.append(ystar)
+        phot_table = aperture_photometry(difference_image-bkg.background, apertures, method='subpixel',
+                     error=error)
+
+        log.info('Performing difference image photometry for '+str(nstars)+' stars')
+
+        aperture_sum = np.array(phot_table['aperture_sum'], dtype=float)
+        aperture_sum_err = np.array(phot_table['aperture_sum_err'], dtype=float)
+        ref_flux = ref_star_catalog['ref_flux']
+        error_ref_flux = ref_star_catalog['ref_flux_err']
+
+        # Stars outside the image are not measured; the pixel indices of
+        # these stars are clipped only so that the arrays can be indexed
+        (ny, nx) = difference_image.shape
+        ix = positions[:,0].astype(int)
+        iy = positions[:,1].astype(int)
+        inside = (positions[:,0] >= 0) & (positions[:,1] >= 0) & (ix < nx) & (iy < ny)
+        ix = np.clip(ix, 0, nx - 1)
+        iy = np.clip(iy, 0, ny - 1)
+
+        flux = aperture_sum/phot_scale_factor
+        flux_err = aperture_sum_err
+
+        flux_tot = ref_flux*ref_exposure_time - flux
+        flux_err_tot = (error_ref_flux ** 2*ref_exposure_time**2 + flux_err**2/phot_scale_factor**2+
+                        (aperture_sum*error_phot_scale_factor/phot_scale_factor**2)**2) ** 0.5
+
+        good_fit = inside & (ref_flux >= 0.0) & (error_ref_flux > 0.0) & \
+                    (flux_tot > 0.0) & (flux_err_tot > 0.0) & \
+                    (difference_image[iy,ix] != 0) & (bkg.background[iy,ix] != 0) & \
+                    (flux != 0) & (flux_err != 0)
+
+        if per_star_logging:
+            for j in range(nstars):
+                log.info(' -> Star ' + str(j) + ' at position (' + \
+                           str(positions[j,0]) + ', ' + str(positions[j,1]) + ') flux='+str(flux[j])+', flux_err='+str(flux_err[j])+\
+                           ', flux_tot='+str(flux_tot[j])+', flux_err_tot='+str(flux_err_tot[j])+\
+                           ', ref_flux='+str(ref_flux[j])+', ref_flux_err='+str(error_ref_flux[j])+\
+                           ', phot_table entry='+str(aperture_sum[j])+'+/-'+str(aperture_sum_err[j])+', phot scale factor='+str(phot_scale_factor)+\
+                           ', diff image at position='+str(difference_image[iy[j],ix[j]])+\
+                           ', bkgd at position='+str(bkg.background[iy[j],ix[j]]))
+                if good_fit[j]:
+                    log.info(' --> Photometry OK')
+                else:
+                    log.info(' --> Photometry failed quality control')
 
-                        #back = bkg.background[int(positions[j][1]),int(positions[j][0])]
-                        back = background_of_image[int(positions[j][1]),int(positions[j][0])]
-                        back_err = bkg.background_rms[int(positions[j][1]),int(positions[j][0])]
+        (mag, mag_err, flux_tot, flux_err_tot) = convert_flux_to_mag_array(flux_tot[good_fit], flux_err_tot[good_fit],
+                                                                           ref_exposure_time)
 
-                        list_background.append(back)
-                        list_background_error.append(back_err)
+        (cal_mag, cal_mag_err) = calc_calib_mags_array(fit_params, covar_fit, mag, mag_err)
 
-                        list_align_x.append(positions[j][0])
-                        list_align_y.append(positions[j][1])
-                       
-                        if per_star_logging:
-                            log.info(' --> Photometry OK')
+        (cal_flux, cal_flux_err) = convert_mag_to_flux(cal_mag, cal_mag_err)
 
-                    else:
-                        good_fit = False
+        measurements = {'diff_flux': flux[good_fit], 'diff_flux_err': flux_err[good_fit],
+                        'magnitude': mag, 'magnitude_err': mag_err,
+                        'cal_magnitude': cal_mag, 'cal_magnitude_err': cal_mag_err,
+                        'flux': flux_tot, 'flux_err': flux_err_tot,
+                        'cal_flux': cal_flux, 'cal_flux_err': cal_flux_err,
+                        'phot_scale_factor': phot_scale_factor,
+                        'phot_scale_factor_err': error_phot_scale_factor,
+                        'local_background': background_of_image[iy[good_fit],ix[good_fit]],
+                        'local_background_err': bkg.background_rms[iy[good_fit],ix[good_fit]],
+                        'residual_x': positions[good_fit,0], 'residual_y': positions[good_fit,1],
+                        'radius': radius}
 
-                        if per_star_logging:
-                            log.info(' --> Photometry failed quality control')
+        for column, values in measurements.items():
+            difference_image_photometry[column][good_fit] = values
 
-                else:
-                    #logs.ifverbose(log, setup, ' -> Star ' + str(j) +
-                    #           ' No photometry possible due to poor reference frame measurement')
-
-                    good_fit = False
-
-            if good_fit == False:
-
-                #logs.ifverbose(log, setup, ' -> Star ' + str(j) +
-                #               ' No photometry possible from poor fit')
-
-                list_radius.append(-9999.99)
-                list_delta_flux.append(-9999.99)
-                list_delta_flux_error.append(-9999.99)
-                list_flux.append(-9999.99)
-                list_flux_error.append(-9999.99)
-                list_cal_flux.append(-9999.99)
-                list_cal_flux_error.append(-9999.99)
-                list_mag.append(-9999.99)
-                list_mag_error.append(-9999.99)
-                list_cal_mag.append(-9999.99)
-                list_cal_mag_error.append(-9999.99)
-                list_phot_scale_factor.append(np.sum(kernel))
-                list_phot_scale_factor_error.append(-9999.99)
-                list_background.append(-9999.99)
-                list_background_error.append(-9999.99)
-
-                list_align_x.append(-9999.99)
-                list_align_y.append(-9999.99)
-                # import pdb; pdb.set_trace()
+        difference_image_photometry['phot_scale_factor'][~good_fit] = phot_scale_factor
 
     else:
 
         log.info('Invalid FWHM data for image - no photometry can be produced')
 
-        list_star_id = ref_star_catalog[:, 0].tolist()
-        list_radius = [-9999.99]*len(ref_star_catalog)
-        list_delta_flux = [-9999.99]*len(ref_star_catalog)
-        list_delta_flux_error = [-9999.99]*len(ref_star_catalog)
-        list_flux = [-9999.99]*len(ref_star_catalog)
-        list_flux_error = [-9999.99]*len(ref_star_catalog)
-        list_cal_flux = [-9999.99]*len(ref_star_catalog)
-        list_cal_flux_error = [-9999.99]*len(ref_star_catalog)
-        list_mag = [-9999.99]*len(ref_star_catalog)
-        list_mag_error = [-9999.99]*len(ref_star_catalog)
-        list_cal_mag = [-9999.99]*len(ref_star_catalog)
-        list_cal_mag_error = [-9999.99]*len(ref_star_catalog)
-        list_phot_scale_factor = [-9999.99]*len(ref_star_catalog)
-        list_phot_scale_factor_error = [-9999.99]*len(ref_star_catalog)
-        list_background = [-9999.99]*len(ref_star_catalog)
-        list_background_error = [-9999.99]*len(ref_star_catalog)
-        list_align_x = [-9999.99]*len(ref_star_catalog)
-        list_align_y = [-9999.99]*len(ref_star_catalog)
-
-
-    difference_image_photometry = [list_star_id,
-                                       list_delta_flux, list_delta_flux_error,
-                                       list_mag, list_mag_error,
-                                       list_cal_mag, list_cal_mag_error,
-                                       list_flux, list_flux_error,
-                                       list_cal_flux, list_cal_flux_error,
-                                       list_phot_scale_factor, list_phot_scale_factor_error,
-                                       list_background, list_background_error,
-                                       list_align_x, list_align_y,
-                                       list_radius]
     log.info('Completed photometry on difference image')
 
     # return  difference_image_photometry, control_zone
-    return np.array(difference_image_photometry), 1
+    return difference_image_photometry, 1
 
 
 
@@ -923,6 +1028,34 @@ run
 
     return mag, mag_err, flux, flux_err
 
+def convert_flux_to_mag_array(flux, flux_err, exp_time=None):
+    """Array equivalent of convert_flux_to_mag, returning zero magnitudes
+    and uncertainties for negative fluxes"""
+
+    flux = np.asarray(flux, dtype=float)
+    flux_err = np.asarray(flux_err, dtype=float)
+
+    if exp_time != None:
+
+        frac_err = flux_err / flux
+
+        flux = flux / exp_time
+
+        flux_err = flux * frac_err
+
+    mag = np.zeros(len(flux))
+    mag_err = np.zeros(len(flux))
+
+    valid = (flux >= 0.0) & (flux_err >= 0.0)
+
+    ZP = 25.0
+
+    mag[valid] = ZP - 2.5 * np.log10(flux[valid])
+
+    mag_err[valid] = (2.5 / np.log(10.0)) * flux_err[valid] / flux[valid]
+
+    return mag, mag_err, flux, flux_err
+
 def convert_mag_to_flux(mag, mag_err):
     """Function to convert the flux of a star from its fitted PSF model
     and its uncertainty onto the magnitude scale.
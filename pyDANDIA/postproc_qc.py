@@ -33,69 +33,52 @@ def run_postproc(setup, **params):
     # Grow photometry array to allow additional columns for corrected mags
     photometry = grow_photometry_array(photometry,log)
     photometry = mask_photometry_array(photometry, 1, log)
+    star_chunk = params['star_chunk_size']
 
-    # Calculate mean_mag, RMS for all stars
-    phot_stats = plot_rms.calc_mean_rms_mag(photometry,log,'calibrated')
+    # Calculate mean_mag, RMS for all stars and the mean photometric residual
+    # per image in a single pass over the photometry array
+    (phot_stats, image_residuals) = calc_qc_statistics(photometry, log,
+                                                'calibrated', star_chunk=star_chunk)
     plot_rms.plot_rms(phot_stats, params, log,
                     plot_file=path.join(setup.red_dir,'init_rms_mag.png'))
     plot_rms.output_phot_statistics(phot_stats,
                                     path.join(setup.red_dir,'init_rms_mag.txt'),
                                     log)
-
-    # Calculate photometric residuals
-    phot_residuals = calc_phot_residuals(photometry, phot_stats, log, 'calibrated')
-    plot_phot_residuals(params, reduction_metadata, phot_residuals, log)
-
-    # Calculate mean residual per image
-    image_residuals = calc_image_residuals(reduction_metadata, photometry, phot_residuals,log)
+    log_image_residuals(reduction_metadata, image_residuals, log)
     plot_image_residuals(params, image_residuals, log)
 
-    # Mask photometry from images with excessive average photometric residuals
-    photometry = mask_phot_from_bad_images(params, photometry, image_residuals, 2, log)
-
-    # Mask photometry from datapoints which fail the ps/exptime criterion
-    photometry = mask_phot_with_bad_psexpt(params, reduction_metadata, photometry, 4, log)
-
-    # Mask photometry from images with unreliable resampling coefficients:
-    photometry = mask_phot_from_bad_warp_matrix(params, setup, photometry, 8, log)
-
-    # Mask photometry from images with poor quality difference images
-    photometry = mask_phot_from_bad_diff_images(params,setup,reduction_metadata,photometry,16,log)
+    if params['diagnostic_plots']:
+        phot_residuals = calc_phot_residuals(photometry, phot_stats, log, 'calibrated')
+        plot_phot_residuals(params, reduction_metadata, phot_residuals, log)
+        del phot_residuals
+
+    # Evaluate all of the quality control criteria, then apply the combined
+    # bitmask to the photometry in one pass:
+    # 2: images with excessive average photometric residuals
+    # 4: datapoints which fail the ps/exptime criterion
+    # 8: images with unreliable resampling coefficients
+    # 16: poor quality difference image stamps
+    qc_criteria = [ (2, select_images_with_bad_residuals(params, image_residuals, log)),
+                    (4, select_datapoints_with_bad_psexpt(params, reduction_metadata, photometry, log)),
+                    (8, select_images_with_bad_warp_matrix(params, setup, reduction_metadata, log)),
+                    (16, select_bad_diff_image_stamps(params, setup, reduction_metadata,
+                                                      photometry.shape[0], log)) ]
+    photometry = apply_qc_flags(photometry, qc_criteria, log, star_chunk=star_chunk)
 
     # Mirror calibrated photometry to corrected columns ready for processing:
     photometry = mirror_mag_columns(photometry, 'calibrated', log)
 
-    # Compensate for mean residual per image and output to photometry array
-    #photometry = apply_image_mag_correction(params, image_residuals, photometry, log, 'calibrated')
-
-    # Re-calculate mean_mag, RMS for all stars, using corrected magnitudes
-    phot_stats = plot_rms.calc_mean_rms_mag(photometry,log,'corrected')
-    phot_stats = mask_photometry_stats(phot_stats, log)
-
-    # Re-calculate photometric residuals
-    phot_residuals = calc_phot_residuals(photometry, phot_stats, log, 'corrected')
-    image_residuals = calc_image_residuals(reduction_metadata, photometry, phot_residuals,log)
-
-    # Calculate photometric scatter per image
-    image_rms = calc_image_rms(phot_residuals, log)
-
-    # Factor photometric scatter into photometric residuals - DEACTIVATED, masking only
-    #photometry = apply_image_merr_correction(photometry, image_residuals, log, 'corrected')
-    phot_stats = plot_rms.calc_mean_rms_mag(photometry,log,'corrected')
+    # Re-calculate mean_mag, RMS for all stars and the per-image residuals,
+    # using corrected magnitudes and excluding all masked datapoints
+    (phot_stats, image_residuals) = calc_qc_statistics(photometry, log,
+                                                'corrected', star_chunk=star_chunk)
+    log_image_residuals(reduction_metadata, image_residuals, log)
     plot_rms.plot_rms(phot_stats, params, log,
                     plot_file=path.join(setup.red_dir,'postproc_rms_mag.png'))
     plot_rms.output_phot_statistics(phot_stats,
                 path.join(setup.red_dir,'postproc_rms_mag.txt'),
                 log)
 
-    # Set quality control flags to indicate suspect data points in photometry array
-    # Replaced with a bitmask
-    #photometry = set_image_photometry_qc_flags(photometry, log)
-
-    # Set quality control flags to indicate datapoints with large uncertainties:
-    # Replaced with bitmask, may review
-    #photometry = set_star_photometry_qc_flags(photometry, phot_stats, log)
-
     # Ouput updated photometry
     output_revised_photometry(setup, photometry, log)
 
@@ -148,6 +131,9 @@ def sanity_check(setup, params, log):
     if 'diagnostic_plots' not in params.keys():
         params['diagnostic_plots'] = False
 
+    if 'star_chunk_size' not in params.keys():
+        params['star_chunk_size'] = 0
+
     log.info('Configuration parameters:')
     for key, value in params.items():
         log.info(key+': '+str(value))
@@ -177,9 +163,7 @@ def mask_photometry_array(photometry, error_code, log):
 
     mask = np.invert(photometry[:,:,mag_col] > 0.0)
 
-    expand_mask = np.empty((mask.shape[0], mask.shape[1], photometry.shape[2]))
-    for col in range(0,expand_mask.shape[2],1):
-        expand_mask[:,:,col] = mask
+    expand_mask = np.repeat(mask[:,:,np.newaxis], photometry.shape[2], axis=2)
 
     photometry[mask,25] = error_code
 
@@ -192,15 +176,112 @@ def mask_photometry_stats(phot_stats, log):
 
     mask = np.invert(phot_stats[:,0] > 0.0)
 
-    expand_mask = np.empty((mask.shape[0],phot_stats.shape[1]))
-    for col in range(0,phot_stats.shape[1],1):
-        expand_mask[:,col] = mask
+    expand_mask = np.repeat(mask[:,np.newaxis], phot_stats.shape[1], axis=1)
 
     phot_stats = np.ma.masked_array(phot_stats, mask=expand_mask)
     log.info('Masked invalid data in photometric statistics for each star')
 
     return phot_stats
 
+def calc_qc_statistics(photometry, log, phot_columns, star_chunk=None):
+    """Function to calculate the photometric statistics of each star together
+    with the weighted mean photometric residual per image in a single pass over
+    the photometry array.
+
+    Only datapoints with positive magnitudes and uncertainties which are not
+    masked contribute.  The array can optionally be processed in chunks of
+    stars, which limits the size of the temporary arrays required, since the
+    per-image residuals are accumulated from weighted sums.
+
+    :param array photometry: [Masked] photometry array (nstars, nimages, ncols)
+    :param logger log: Log for the reduction
+    :param str phot_columns: Photometry columns to use, e.g. 'calibrated'
+    :param int star_chunk: Number of stars per chunk, or None/0 for all stars
+
+    Returns:
+    :param array phot_stats: Per-star weighted mean mag, weighted RMS,
+                            percentile RMS and error on the weighted mean mag,
+                            in the format of plot_rms.calc_mean_rms_mag
+    :param masked_array image_residuals: Per-image weighted mean photometric
+                            residual, weighted RMS residual and mean HJD
+    """
+
+    (mag_col, merr_col) = plot_rms.get_photometry_columns(phot_columns)
+
+    nstars = photometry.shape[0]
+    nimages = photometry.shape[1]
+    if star_chunk is None or int(star_chunk) <= 0:
+        star_chunk = max(nstars, 1)
+    star_chunk = int(star_chunk)
+
+    data = np.ma.getdata(photometry)
+    mask = np.ma.getmask(photometry)
+
+    phot_stats = np.zeros((nstars,4))
+
+    # Weighted sums of the residuals and HJDs accumulated per image
+    sum_weights = np.zeros(nimages)
+    sum_residuals = np.zeros(nimages)
+    sum_residuals_sq = np.zeros(nimages)
+    sum_hjd = np.zeros(nimages)
+    nvalid = np.zeros(nimages, dtype='int')
+
+    for j0 in range(0, nstars, star_chunk):
+        j1 = min(j0+star_chunk, nstars)
+
+        mags = data[j0:j1,:,mag_col]
+        errs = data[j0:j1,:,merr_col]
+        valid = np.logical_and(mags > 0.0, errs > 0.0)
+        if mask is not np.ma.nomask:
+            valid &= np.invert(mask[j0:j1,:,mag_col])
+        mags = np.where(valid, mags, 0.0)
+        errs_sq = np.where(valid, errs*errs, 1.0)
+
+        # Per-star statistics
+        weights = np.where(valid, 1.0/errs_sq, 0.0)
+        star_weights = weights.sum(axis=1)
+        has_data = star_weights > 0.0
+        wmean = np.zeros(j1-j0)
+        wmean[has_data] = (mags*weights).sum(axis=1)[has_data] / star_weights[has_data]
+        werror = np.zeros(j1-j0)
+        werror[has_data] = np.sqrt(1.0 / star_weights[has_data])
+
+        dmags = np.where(valid, mags - wmean[:,np.newaxis], 0.0)
+        wrms = np.zeros(j1-j0)
+        wrms[has_data] = np.sqrt( (dmags*dmags*weights).sum(axis=1)[has_data] / star_weights[has_data] )
+
+        pmags = np.where(valid, mags, np.nan)
+        pmags[np.invert(has_data),:] = 0.0
+        prms = (np.nanpercentile(pmags, 84, axis=1) - np.nanpercentile(pmags, 16, axis=1))/2.0
+
+        phot_stats[j0:j1,0] = wmean
+        phot_stats[j0:j1,1] = wrms
+        phot_stats[j0:j1,2] = prms
+        phot_stats[j0:j1,3] = werror
+
+        # Per-image residuals, weighted by the combined uncertainty of the
+        # datapoint and the star's weighted mean magnitude
+        res_weights = np.where(valid, 1.0/(errs_sq + werror[:,np.newaxis]**2), 0.0)
+        sum_weights += res_weights.sum(axis=0)
+        sum_residuals += (dmags*res_weights).sum(axis=0)
+        sum_residuals_sq += (dmags*dmags*res_weights).sum(axis=0)
+        sum_hjd += np.where(valid, data[j0:j1,:,9], 0.0).sum(axis=0)
+        nvalid += valid.sum(axis=0)
+
+    log.info('Calculated stellar weighted mean magnitudes, weighted and percentile RMS')
+
+    image_residuals = np.zeros((nimages,3))
+    has_data = np.logical_and(nvalid > 0, sum_weights > 0.0)
+    image_residuals[has_data,0] = sum_residuals[has_data] / sum_weights[has_data]
+    image_residuals[has_data,1] = np.sqrt( sum_residuals_sq[has_data] / sum_weights[has_data] )
+    image_residuals[has_data,2] = sum_hjd[has_data] / nvalid[has_data]
+
+    extend_mask = np.repeat(np.invert(has_data)[:,np.newaxis], 3, axis=1)
+    image_residuals = np.ma.masked_array(image_residuals, mask=extend_mask)
+    log.info('Calculated weighted mean photometric residual per image')
+
+    return phot_stats, image_residuals
+
 def calc_phot_residuals(photometry, phot_stats, log, phot_columns):
 
     (mag_col, merr_col) = plot_rms.get_photometry_columns(phot_columns)
@@ -283,19 +364,21 @@ def calc_image_residuals(reduction_metadata, photometry, phot_residuals, log):
     mask = np.ma.getmask(phot_residuals)
     nvalid = np.sum(np.invert(mask[:,:,0]), axis=0)
     mask = (nvalid == 0)
-    extend_mask = np.empty(image_residuals.shape, dtype=bool)
-    for col in range(0,3,1):
-        extend_mask[:,col] = mask
+    extend_mask = np.repeat(mask[:,np.newaxis], image_residuals.shape[1], axis=1)
     image_residuals = np.ma.masked_array(image_residuals, mask=extend_mask)
     log.info('Masked image entries where no stars had valid photometric residuals')
 
+    log_image_residuals(reduction_metadata, image_residuals, log)
+
+    return image_residuals
+
+def log_image_residuals(reduction_metadata, image_residuals, log):
+
     log.info('Image weighted mean photometric residual and RMS:')
     for i, image_name in enumerate(reduction_metadata.headers_summary[1]['IMAGES']):
         log.info(str(i)+' '+image_name+' '+str(image_residuals[i,0])+' '+\
                 str(image_residuals[i,1])+' '+str(image_residuals[i,2]))
 
-    return image_residuals
-
 def plot_image_residuals(params, image_residuals, log):
 
     fig = plt.figure(1,(10,10))
@@ -435,15 +518,68 @@ def output_revised_photometry(setup, photometry, log):
 
 def mask_all_datapoints_by_image_index(photometry, bad_data_index, error_code):
 
-    expand_mask = np.ma.getmask(photometry)
-    expand_data = np.ma.getdata(photometry)
-    for i in bad_data_index:
-        mask = np.empty((photometry.shape[0],photometry.shape[2]), dtype='bool')
-        mask.fill(True)
-        expand_mask[:,i,:] = mask
-        expand_data[:,i,25] += error_code
+    bad_images = np.zeros(photometry.shape[1], dtype='bool')
+    bad_images[bad_data_index] = True
+
+    return flag_datapoints(photometry, bad_images, error_code)
+
+def flag_datapoints(photometry, bad_data, error_code):
+    """Function to add an error_code to the QC bitmask column of the
+    photometry array and mask all columns for the selected datapoints.
+
+    :param array photometry: [Masked] photometry array (nstars, nimages, ncols)
+    :param array bad_data: Boolean array of datapoints to flag, either per
+                            image (nimages) or per datapoint (nstars, nimages)
+    :param int error_code: Bitmask value for this QC criterion
+    """
+
+    return apply_qc_flags(photometry, [(error_code, bad_data)])
+
+def apply_qc_flags(photometry, qc_criteria, log=None, star_chunk=None):
+    """Function to apply a set of quality control criteria to the photometry
+    array in a single pass.  The error codes of all criteria failed by each
+    datapoint are combined and added to the QC bitmask column 25, and all
+    columns of these datapoints are masked.
+
+    :param array photometry: [Masked] photometry array (nstars, nimages, ncols)
+    :param list qc_criteria: List of (error_code, bad_data) tuples, where
+                            bad_data is a boolean array per image (nimages)
+                            or per datapoint (nstars, nimages)
+    :param logger log: Log for the reduction [optional]
+    :param int star_chunk: Number of stars per chunk, or None/0 for all stars
+    """
+
+    nstars = photometry.shape[0]
+    if star_chunk is None or int(star_chunk) <= 0:
+        star_chunk = max(nstars, 1)
+    star_chunk = int(star_chunk)
+
+    data = np.ma.getdata(photometry)
+    mask = np.ma.getmaskarray(photometry)
+
+    nflagged = 0
+    for j0 in range(0, nstars, star_chunk):
+        j1 = min(j0+star_chunk, nstars)
 
-    photometry = np.ma.masked_array(expand_data, mask=expand_mask)
+        flags = np.zeros((j1-j0, photometry.shape[1]), dtype='int')
+        for (error_code, bad_data) in qc_criteria:
+            bad_data = np.asarray(bad_data, dtype='bool')
+            if bad_data.ndim == 2:
+                bad_data = bad_data[j0:j1,:]
+            flags += error_code * bad_data
+
+        flagged = flags > 0
+        data[j0:j1,:,25] += flags
+        mask[j0:j1,:,:] |= flagged[:,:,np.newaxis]
+        nflagged += flagged.sum()
+
+    photometry = np.ma.masked_array(data, mask=mask)
+
+    if log != None:
+        for (error_code, bad_data) in qc_criteria:
+            log.info('QC criterion '+str(error_code)+' flagged '+\
+                    str(np.broadcast_to(bad_data, photometry.shape[0:2]).sum())+' datapoints')
+        log.info('Masked '+str(nflagged)+' datapoints failing one or more QC criteria')
 
     return photometry
 
@@ -477,98 +613,94 @@ def repeat_array_entries(a, nrepeat, order, verbose=False):
 def mask_datapoints_by_image_stamp(photometry, reduction_metadata, bad_data_index, error_code):
     """Accepts an index of the images,stamps to be flagged as bad data"""
 
-    expand_mask = np.ma.getmask(photometry)
-    expand_data = np.ma.getdata(photometry)
+    bad_data = select_image_stamp_datapoints(reduction_metadata, bad_data_index,
+                                             photometry.shape[0:2])
 
-    stamps = np.unique(bad_data_index[1])
-    for s in stamps:
-        stamp_dims = reduction_metadata.stamps[1][s]
+    photometry = flag_datapoints(photometry, bad_data, error_code)
 
-        affected_stars = np.where( (reduction_metadata.star_catalog[1]['x'].data >= float(stamp_dims['X_MIN'])) & \
-                        (reduction_metadata.star_catalog[1]['x'].data < float(stamp_dims['X_MAX'])) & \
-                        (reduction_metadata.star_catalog[1]['y'].data >= float(stamp_dims['Y_MIN'])) & \
-                        (reduction_metadata.star_catalog[1]['y'].data < float(stamp_dims['Y_MAX'])) )[0]
+    return photometry
 
-        #print('AFFECTED STARS: ',reduction_metadata.star_catalog[1][affected_stars])
+def select_image_stamp_datapoints(reduction_metadata, bad_data_index, shape):
+    """Function to convert an index of (images, stamps) into a boolean array
+    of the (stars, images) datapoints affected, using the stamp boundaries
 
-        # This is a more robust way to identify which images are affected, since
-        # not all images produce photometry
-        idx = np.where(bad_data_index[1] == s)[0]
-        affected_images = bad_data_index[0][idx]
-        #print('AFFECTED IMAGES: ',affected_images)
+    :param MetaData reduction_metadata: Metadata with star_catalog and stamps tables
+    :param tuple bad_data_index: Arrays of image and stamp indices
+    :param tuple shape: Dimensions (nstars, nimages) of the output array
+    """
 
-        mask = np.empty((len(affected_stars)*len(affected_images)*photometry.shape[2]), dtype='bool')
-        mask.fill(True)
+    bad_data = np.zeros(shape, dtype='bool')
+    if len(bad_data_index[0]) == 0:
+        return bad_data
 
-        dim2 = repeat_array_entries( np.arange(0,photometry.shape[2],1),
-                                    (len(affected_images)*len(affected_stars)),
-                                    order='F')
-        dim1 = repeat_array_entries(affected_images, photometry.shape[2], 'C')
-        dim1 = repeat_array_entries(dim1, len(affected_stars), 'F')
-        dim0 = repeat_array_entries(affected_stars, len(affected_images)*photometry.shape[2], 'C')
-        array_loc = (dim0, dim1, dim2)
+    x = reduction_metadata.star_catalog[1]['x'].data[0:shape[0]]
+    y = reduction_metadata.star_catalog[1]['y'].data[0:shape[0]]
 
-        #print('Masking data at ',array_loc)
-        expand_mask[array_loc] = mask
+    # This is a more robust way to identify which images are affected, since
+    # not all images produce photometry
+    bad_images = np.asarray(bad_data_index[0], dtype='int')
+    bad_stamps = np.asarray(bad_data_index[1], dtype='int')
+    for s in np.unique(bad_stamps):
+        stamp_dims = reduction_metadata.stamps[1][s]
 
-        dim2 = np.zeros(len(affected_stars)*len(affected_images), dtype='int')
-        dim2.fill(25)
-        dim1 = repeat_array_entries(affected_images, len(affected_stars), 'F')
-        dim0 = repeat_array_entries(affected_stars, len(affected_images), 'C')
-        array_loc = (dim0, dim1, dim2)
+        in_stamp = (x >= float(stamp_dims['X_MIN'])) & \
+                    (x < float(stamp_dims['X_MAX'])) & \
+                    (y >= float(stamp_dims['Y_MIN'])) & \
+                    (y < float(stamp_dims['Y_MAX']))
 
-        #print('Flagging data at ',array_loc)
-        expand_data[array_loc] += error_code
-        #print(expand_data[array_loc])
+        affected_images = np.zeros(shape[1], dtype='bool')
+        affected_images[bad_images[bad_stamps == s]] = True
 
-    photometry = np.ma.masked_array(expand_data, mask=expand_mask)
+        bad_data |= np.logical_and(in_stamp[:,np.newaxis], affected_images[np.newaxis,:])
 
-    return photometry
+    return bad_data
 
 def mask_phot_from_bad_images(params, photometry, image_residuals, error_code, log):
 
-    idx = np.where(abs(image_residuals[:,0]) > params['residuals_threshold'])[0]
+    bad_images = select_images_with_bad_residuals(params, image_residuals, log)
 
-    photometry = mask_all_datapoints_by_image_index(photometry, idx, error_code)
+    photometry = flag_datapoints(photometry, bad_images, error_code)
 
     log.info('Masked photometric data for images with excessive average residuals')
 
     return photometry
 
-def mask_phot_with_bad_psexpt(params, reduction_metadata, photometry, error_code, log):
+def select_images_with_bad_residuals(params, image_residuals, log):
 
-    ps_expt = calc_ps_exptime(reduction_metadata, photometry, log)
+    bad_images = np.ma.filled(abs(image_residuals[:,0]) > params['residuals_threshold'], False)
 
-    idx = np.where(ps_expt < params['psexpt_threshold'])
+    log.info('Identified '+str(bad_images.sum())+\
+            ' images with mean photometric residuals above the threshold '+\
+            str(params['residuals_threshold']))
 
-    mask = np.ma.getmask(photometry)
-    data = np.ma.getdata(photometry)
-    for col in range(0,mask.shape[2],1):
-        mask[idx[0],idx[1],col] = True
-    data[idx[0],idx[1],25] += error_code
+    return bad_images
 
-    photometry = np.ma.masked_array(data, mask=mask)
+def mask_phot_with_bad_psexpt(params, reduction_metadata, photometry, error_code, log):
+
+    bad_data = select_datapoints_with_bad_psexpt(params, reduction_metadata, photometry, log)
+
+    photometry = flag_datapoints(photometry, bad_data, error_code)
 
     log.info('Masked photometric data for datapoints with ps/expt < '+str(params['psexpt_threshold']))
 
     return photometry
 
+def select_datapoints_with_bad_psexpt(params, reduction_metadata, photometry, log):
+
+    ps_expt = calc_ps_exptime(reduction_metadata, photometry, log)
+
+    return np.ma.getdata(ps_expt) < params['psexpt_threshold']
+
 def calc_ps_exptime(reduction_metadata, photometry, log):
 
-    ps_data = photometry[:,:,19]
-    mask = np.empty(ps_data.shape)
-    mask.fill(False)
+    ps_data = np.ma.masked_array(photometry[:,:,19])
 
-    exptimes = reduction_metadata.headers_summary[1]['EXPKEY'].data
-    expt_data = np.zeros(ps_data.shape, dtype='float')
-    for i in range(0,expt_data.shape[1],1):
-        expt_data[:,i].fill(float(exptimes[i]))
+    exptimes = reduction_metadata.headers_summary[1]['EXPKEY'].data.astype('float')
     reference_image_name = reduction_metadata.data_architecture[1]['REF_IMAGE'].data[0]
-    iref = np.where(reduction_metadata.headers_summary[1]['IMAGES'] == reference_image_name)
-    ref_expt = float(exptimes[iref])
+    iref = np.where(reduction_metadata.headers_summary[1]['IMAGES'] == reference_image_name)[0]
+    ref_expt = float(exptimes[iref[0]])
 
-    ps_data = np.ma.masked_array(ps_data, mask=mask)
-    ps_expt = ps_data*ref_expt/expt_data
+    ps_expt = ps_data*ref_expt/exptimes[np.newaxis,:]
 
     log.info('Calculated the pscale/exptime quality control metric')
 
@@ -604,31 +736,71 @@ def load_resampled_data(setup,log):
 
     return frames, coefficients
 
-def mask_phot_from_bad_warp_matrix(params,setup,photometry,error_code,log):
+def mask_phot_from_bad_warp_matrix(params,setup,reduction_metadata,photometry,error_code,log):
 
-    (frames, coefficients) = load_resampled_data(setup,log)
+    bad_images = select_images_with_bad_warp_matrix(params, setup, reduction_metadata, log)
 
-    idx = np.where(coefficients > params['warp_matrix_threshold'])[0]
-
-    photometry = mask_all_datapoints_by_image_index(photometry, idx, error_code)
+    photometry = flag_datapoints(photometry, bad_images, error_code)
 
     log.info('Masked photometric data for difference images with excessive residuals')
 
     return photometry
 
+def select_images_with_bad_warp_matrix(params, setup, reduction_metadata, log):
+    """Function to identify the images where any of the resampling
+    coefficients exceed the warp_matrix_threshold"""
+
+    image_list = reduction_metadata.headers_summary[1]['IMAGES'].data
+    bad_images = np.zeros(len(image_list), dtype='bool')
+
+    (frames, coefficients) = load_resampled_data(setup,log)
+    if len(frames) == 0:
+        return bad_images
+
+    bad_frames = (coefficients > params['warp_matrix_threshold']).any(axis=0)
+    bad_images[:] = np.isin(image_list, np.array(frames)[bad_frames])
+
+    log.info('Identified '+str(bad_images.sum())+\
+             ' images with warp matrix coefficients above the threshold '+\
+             str(params['warp_matrix_threshold']))
+
+    return bad_images
+
 def mask_phot_from_bad_diff_images(params,setup,reduction_metadata,photometry,error_code,log):
 
+    bad_data = select_bad_diff_image_stamps(params, setup, reduction_metadata,
+                                            photometry.shape[0], log)
+
+    photometry = flag_datapoints(photometry, bad_data, error_code)
+
+    log.info('Masked '+str(bad_data.sum())+' datapoints from difference images with std dev > '+\
+                str(params['diff_std_threshold']))
+
+    return photometry
+
+def select_bad_diff_image_stamps(params, setup, reduction_metadata, nstars, log):
+    """Function to identify the (stars, images) datapoints which lie within
+    difference image stamps with a standard deviation above the
+    diff_std_threshold"""
+
+    image_list = reduction_metadata.headers_summary[1]['IMAGES'].data
+    shape = (nstars, len(image_list))
+
     diff_dir = path.join(setup.red_dir,'diffim')
     diff_images = glob.glob(path.join(diff_dir, '*'))
     diff_images.sort()
 
     dimage_stats = []
     for dimage_path in diff_images:
-        dimage_idx = np.where(path.basename(dimage_path) == reduction_metadata.headers_summary[1]['IMAGES'].data)[0][0]
+        dimage_idx = np.where(path.basename(dimage_path) == image_list)[0][0]
         stats = calc_stamp_statistics(params,dimage_path,dimage_idx,log)
         dimage_stats.append(stats)
     dimage_stats = np.array(dimage_stats)
 
+    if len(dimage_stats) == 0:
+        log.info('No difference images available to assess')
+        return np.zeros(shape, dtype='bool')
+
     plot_dimage_statistics(params, dimage_stats, diff_images)
 
     # Use only first dimension of this array, which is images,stamps
@@ -640,12 +812,12 @@ def mask_phot_from_bad_diff_images(params,setup,reduction_metadata,photometry,er
     if len(idx[0]) > 0:
         log.info(repr(idx))
 
-    photometry = mask_datapoints_by_image_stamp(photometry, reduction_metadata, idx, error_code)
+    # Convert the index of difference images into the index of images and
+    # the stamp index used by the statistics
+    bad_data_index = (dimage_stats[idx[0],idx[1],0].astype('int'),
+                      dimage_stats[idx[0],idx[1],1].astype('int'))
 
-    log.info('Masked '+str(len(idx))+' datapoints from difference images with std dev > '+\
-                str(params['diff_std_threshold']))
-
-    return photometry
+    return select_image_stamp_datapoints(reduction_metadata, bad_data_index, shape)
 
 def calc_stamp_statistics(params,dimage_path,dimage_idx,log):
     statistics = []
@@ -744,11 +916,7 @@ def set_star_photometry_qc_flags(photometry, phot_stats, log):
 
     max_uncertainty = 10**(a0 * phot_stats[:,0] + a1 + rms)
 
-    error_threshold = np.zeros((photometry.shape[0], photometry.shape[1]))
-    for i in range(0,photometry.shape[1],1):
-        error_threshold[:,i] = max_uncertainty
-
-    idx = np.where(photometry[:,:,24] > error_threshold)
+    idx = np.where(photometry[:,:,24] > max_uncertainty[:,np.newaxis])
     photometry[idx[0],idx[1],25] -= 1
 
     log.info('Set quality control flag for datapoints with photometric uncertainties exceeding mag-dependend threshold')
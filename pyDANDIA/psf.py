@@ -12,6 +12,10 @@ import abc
 import collections
 import numpy as np
 from scipy import optimize, integrate
+from scipy import sparse
+from scipy.sparse import linalg as sparse_linalg
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
@@ -26,6 +30,9 @@ from pyDANDIA import convolution
 import copy
 
 
+# Maximum number of blended stars fitted simultaneously as a group
+MAX_BLEND_GROUP_SIZE = 50
+
 class PSFModel(object):
     __metaclass__ = abc.ABCMeta
 
@@ -1270,6 +1277,197 @@ def fit_star_existing_model(setup, data, x_cen, y_cen, psf_radius,
 
     return fitted_model, fitted_cov, good_fit
 
+def model_unit_psfs(psf_model, Y_stamps, X_stamps, xstars, ystars):
+    """Function to evaluate a PSF model of unit intensity centred on each star,
+    over the pixel coordinates (nstars, ny, nx) of a stamp per star"""
+
+    unit_model = get_psf_object(psf_model.psf_type())
+
+    pars = psf_model.get_parameters()
+    pars[0] = 1.0
+    pars[1] = np.asarray(ystars, dtype=float)[:,np.newaxis,np.newaxis]
+    pars[2] = np.asarray(xstars, dtype=float)[:,np.newaxis,np.newaxis]
+
+    return unit_model.psf_model(Y_stamps, X_stamps, pars)
+
+def group_blended_stars(xstars, ystars, psf_diameter, max_group_size=None):
+    """Function to cluster stars whose PSF stamps overlap into groups to be
+    fitted simultaneously.  Stars are linked if their separation is less than
+    the PSF diameter along both axes, and groups are the connected sets of
+    linked stars.  In crowded fields, groups with more than max_group_size
+    stars are split by reducing the critical separation for those stars
+    until the groups are small enough.
+
+    :param array xstars: x-pixel positions of the stars
+    :param array ystars: y-pixel positions of the stars
+    :param float psf_diameter: Width of the PSF stamp of each star
+    :param int max_group_size: Maximum number of stars in a group
+
+    Returns:
+
+    :param array groups: Index of the group of each star
+    :param array group_size: Number of stars in each group
+    """
+
+    if max_group_size == None:
+        max_group_size = MAX_BLEND_GROUP_SIZE
+
+    positions = np.stack((np.asarray(xstars, dtype=float),
+                          np.asarray(ystars, dtype=float)), axis=1)
+    nstars = len(positions)
+
+    groups = np.zeros(nstars, dtype='int')
+    ngroups = 0
+    pending = [ (np.arange(0,nstars,1), float(psf_diameter)) ]
+    while len(pending) > 0:
+        (members, separation) = pending.pop()
+        labels = link_overlapping_stars(positions[members], separation)
+        sizes = np.bincount(labels)
+
+        for label in np.where(sizes > 0)[0]:
+            submembers = members[labels == label]
+            if sizes[label] > max_group_size and separation > 0.01:
+                pending.append( (submembers, separation*0.8) )
+            else:
+                groups[submembers] = ngroups
+                ngroups += 1
+
+    group_size = np.bincount(groups, minlength=ngroups)
+
+    return groups, group_size
+
+def link_overlapping_stars(positions, separation):
+    """Function to label the connected sets of stars separated by less than
+    the given separation along both axes"""
+
+    nstars = len(positions)
+    if nstars == 0:
+        return np.zeros(0, dtype='int')
+
+    tree = cKDTree(positions)
+    pairs = tree.query_pairs(separation, p=np.inf, output_type='ndarray')
+    if len(pairs) > 0:
+        overlap = np.abs(positions[pairs[:,0]] - positions[pairs[:,1]]).max(axis=1) < separation
+        pairs = pairs[overlap]
+
+    links = sparse.coo_matrix((np.ones(len(pairs), dtype='int8'), (pairs[:,0], pairs[:,1])),
+                              shape=(nstars, nstars))
+    (ngroups, labels) = connected_components(links, directed=False)
+
+    return labels
+
+def fit_star_group_existing_model(data, sky_bkgd, psf_model, xstars, ystars,
+                                  psf_diameter, centroiding=False):
+    """Function to fit an existing PSF model simultaneously to a group of
+    blended stars in an image.
+
+    Each star is modeled over the same stamp and with the same weighting as
+    in fit_star_existing_model, but the models of all stars in the group are
+    summed in the pixels where their stamps overlap.  The intensities are the
+    solution of a sparse, weighted linear least-squares problem.  If
+    centroiding is enabled, the intensities and positions of all stars in the
+    group are then refined together in a single non-linear fit, with the
+    position of each star allowed to move by up to 1 pixel.
+
+    :param array data: Image data
+    :param array sky_bkgd: Sky background model for the image
+    :param PSFModel psf_model: Existing PSF model
+    :param array xstars: x-pixel positions of the stars in image coordinates
+    :param array ystars: y-pixel positions of the stars in image coordinates
+    :param float psf_diameter: Width of the stamp fitted around each star
+    :param boolean centroiding: Switch to refine the star positions
+
+    Returns:
+
+    :param array intensity: Fitted PSF intensity of each star
+    :param array x_fit: Fitted x-pixel position of each star
+    :param array y_fit: Fitted y-pixel position of each star
+    :param array good_fit: Boolean array indicating a valid fit
+    """
+
+    xstars = np.asarray(xstars, dtype=float)
+    ystars = np.asarray(ystars, dtype=float)
+    nstars = len(xstars)
+
+    (Y_stamps, X_stamps, inside) = calc_stamp_pixels(xstars, ystars,
+                                                     psf_diameter, psf_diameter,
+                                                     data.shape[1], data.shape[0])
+
+    # Each row of the design matrix is a pixel in the union of the stamps
+    star_index = np.repeat(np.arange(0,nstars,1), inside[0].size).reshape(inside.shape)[inside]
+    pixels = Y_stamps[inside] * data.shape[1] + X_stamps[inside]
+    (pixel_index, rows) = np.unique(pixels, return_inverse=True)
+    rows = rows.ravel()
+    y_pix = pixel_index // data.shape[1]
+    x_pix = pixel_index % data.shape[1]
+
+    image_data = data[y_pix, x_pix]
+    sky_subtracted_data = image_data - sky_bkgd[y_pix, x_pix]
+    weight = np.zeros(len(image_data))
+    valid = np.isfinite(image_data) & (image_data != 0)
+    weight[valid] = 1.0 / np.abs(image_data[valid]) ** 0.5
+    sky_subtracted_data[np.invert(valid)] = 0.0
+
+    def design_matrix(x, y):
+        design = model_unit_psfs(psf_model, Y_stamps, X_stamps, x, y)[inside]
+        return sparse.csr_matrix((design * weight[rows], (rows, star_index)),
+                                 shape=(len(pixel_index), nstars))
+
+    weighted_data = sky_subtracted_data * weight
+
+    fit = sparse_linalg.lsqr(design_matrix(xstars, ystars), weighted_data,
+                             atol=1e-12, btol=1e-12)
+    intensity = fit[0]
+    x_fit = np.copy(xstars)
+    y_fit = np.copy(ystars)
+
+    if centroiding:
+
+        def residuals(params):
+            model = design_matrix(params[nstars:2*nstars], params[2*nstars:]).dot(params[0:nstars])
+            return model - weighted_data
+
+        def sparse_columns(values):
+            return sparse.csr_matrix((values * weight[rows], (rows, star_index)),
+                                     shape=(len(pixel_index), nstars))
+
+        def jacobian(params):
+            pars = psf_model.get_parameters()
+            pars[0] = params[0:nstars][:,np.newaxis,np.newaxis]
+            pars[1] = params[2*nstars:][:,np.newaxis,np.newaxis]
+            pars[2] = params[nstars:2*nstars][:,np.newaxis,np.newaxis]
+            derivs = get_psf_object(psf_model.psf_type()).psf_model_deriv1(Y_stamps, X_stamps, pars)
+            return sparse.hstack([sparse_columns(derivs[0][inside]),
+                                  sparse_columns(derivs[2][inside]),
+                                  sparse_columns(derivs[1][inside])]).tocsr()
+
+        init_par = np.concatenate((intensity, xstars, ystars))
+        lower = np.concatenate((np.zeros(nstars) - np.inf, xstars - 1.0, ystars - 1.0))
+        upper = np.concatenate((np.zeros(nstars) + np.inf, xstars + 1.0, ystars + 1.0))
+        init_par = np.clip(init_par, lower, upper)
+
+        # Use the analytic derivatives of the PSF model where available,
+        # otherwise difference only the parameters of the stars whose stamps
+        # contain each pixel
+        if hasattr(psf_model, 'psf_model_deriv1'):
+            fit = optimize.least_squares(residuals, init_par, jac=jacobian,
+                                         bounds=(lower, upper), method='trf',
+                                         tr_solver='lsmr', x_scale='jac')
+        else:
+            structure = sparse.csr_matrix((np.ones(len(rows)), (rows, star_index)),
+                                          shape=(len(pixel_index), nstars))
+            fit = optimize.least_squares(residuals, init_par, bounds=(lower, upper),
+                                         jac_sparsity=sparse.hstack([structure, structure, structure]),
+                                         method='trf', tr_solver='lsmr', x_scale='jac')
+        if fit.success:
+            intensity = fit.x[0:nstars]
+            x_fit = fit.x[nstars:2*nstars]
+            y_fit = fit.x[2*nstars:]
+
+    good_fit = np.isfinite(intensity) & (intensity > 0.0)
+
+    return intensity, x_fit, y_fit, good_fit
+
 def extract_image_section(data,x_cen,y_cen,corners):
     """Function to extract an image section and return the section array
     and the centroid coordinates adjusted for the image section
@@ -1750,6 +1948,46 @@ def calc_stamp_corners(xcen, ycen, dx, dy, maxx, maxy, over_edge=False,
 
             return np.array([xmin, xmax, ymin, ymax]).astype(int)
 
+def calc_stamp_pixels(xcen, ycen, dx, dy, maxx, maxy):
+    """Function to calculate the pixel coordinates of the boxes around a set
+    of positions on a common grid.  This is the array equivalent of
+    calc_stamp_corners with over_edge=True: the pixels within each box that
+    lie inside the image are those spanned by the corners it returns.
+
+    :param array xcen: x-pixel locations of the box centres
+    :param array ycen: y-pixel locations of the box centres
+    :param int dx: full width of the box in the x-direction
+    :param int dy: full width of the box in the y-direction
+    :param int maxx: x-dimension of the original image
+    :param int maxy: y-dimension of the original image
+
+    Return:
+
+    :param array Y_stamps: y-pixel coordinates of each box (nstars, ny, nx)
+    :param array X_stamps: x-pixel coordinates of each box (nstars, ny, nx)
+    :param array inside: Boolean array, True for pixels inside the image
+    """
+
+    def box_axis(cen, d):
+        # Half-width as calculated by calc_stamp_corners for odd and even d
+        halfd = int(d)/2
+        nd = int(np.floor(halfd) + np.ceil(halfd))
+
+        origin = np.floor(np.round(np.asarray(cen, dtype=float)) - halfd).astype(int)
+
+        return origin, nd
+
+    (x0, nx) = box_axis(xcen, dx)
+    (y0, ny) = box_axis(ycen, dy)
+
+    (Y_box, X_box) = np.indices((ny, nx))
+    Y_stamps = Y_box[np.newaxis,:,:] + y0[:,np.newaxis,np.newaxis]
+    X_stamps = X_box[np.newaxis,:,:] + x0[:,np.newaxis,np.newaxis]
+
+    inside = (X_stamps >= 0) & (X_stamps < maxx) & (Y_stamps >= 0) & (Y_stamps < maxy)
+
+    return Y_stamps, X_stamps, inside
+
 
 def coadd_stamps(setup, stamps, log, diagnostics=True):
     """Function to combine a set of identically-sized image cutout2D objects,
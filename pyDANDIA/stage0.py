@@ -15,6 +15,8 @@ from astropy.io import fits
 import astropy.units as u
 import sys
 import json
+import multiprocessing as mp
+from multiprocessing import Pool
 
 from pyDANDIA import config_utils
 from astropy.nddata import Cutout2D
@@ -112,9 +114,6 @@ def run_stage0(setup):
 
     if len(new_images) > 0:
 
-        update_reduction_metadata_headers_summary_with_new_images(setup,
-                                                                  reduction_metadata, new_images, log=log)
-
         set_bad_pixel_mask_directory(setup, reduction_metadata,
                                      bpm_directory_path=os.path.join(setup.red_dir, 'data'),
                                      log=log)
@@ -125,22 +124,13 @@ def run_stage0(setup):
 
         logs.ifverbose(log, setup, 'Updating metadata with info on new images...')
 
-        for new_image in new_images:
-            image_structure = image_handling.determine_image_struture(os.path.join(setup.red_dir, 'data',new_image), log)
-
-            open_image = open_an_image(setup, reduction_metadata.data_architecture[1]['IMAGES_PATH'][0],
-                                       new_image, log, image_index=image_structure['sci'])
-
-            image_bpm = open_an_image(setup, reduction_metadata.data_architecture[1]['BPM_PATH'][0],
-                                           new_image, log, image_index=image_structure['bpm'])
+        n_workers = get_n_workers(reduction_metadata, log)
 
-            bpm = bad_pixel_mask.construct_the_pixel_mask(setup, reduction_metadata,
-                                                  open_image, image_bpm, [1,3], log,
-                                                  low_level=0,
-                                                  instrument_bpm=instrument_bpm)
+        header_infos = prepare_new_images(setup, reduction_metadata, new_images,
+                                          instrument_bpm, n_workers, log)
 
-            save_the_pixel_mask_in_image(reduction_metadata, new_image, bpm)
-            logs.ifverbose(log, setup, ' -> ' + new_image)
+        add_new_images_to_headers_summary(reduction_metadata, new_images,
+                                          header_infos, log=log)
 
     reduction_metadata.update_reduction_metadata_reduction_status(new_images, stage_number=0, status=1, log=log)
 
@@ -358,6 +348,130 @@ def set_bad_pixel_mask_directory(setup, reduction_metadata,
                                 bpm_directory_path)
 
 
+def get_n_workers(reduction_metadata,log):
+    """Function to return the number of processes to use to prepare the
+    new images, from the stage0_workers reduction parameter"""
+
+    if 'STAGE0_WORKERS' in reduction_metadata.reduction_parameters[1].keys():
+        n_workers = int(reduction_metadata.reduction_parameters[1]['STAGE0_WORKERS'][0])
+    else:
+        n_workers = 1
+    if n_workers < 1:
+        n_workers = mp.cpu_count()
+
+    log.info('Using '+str(n_workers)+' processes to prepare the new images')
+
+    return n_workers
+
+def prepare_new_images(setup, reduction_metadata, new_images, instrument_bpm,
+                       n_workers, log):
+    '''
+    Prepare a list of new images, either serially or distributed over a pool
+    of worker processes.  For each image the header information is extracted
+    and the pixel mask is constructed and stored in the image file.
+
+    :param object setup: the pipeline setup object
+    :param object reduction_metadata: the metadata object
+    :param list new_images: list of strings
+    :param BadPixelMask instrument_bpm: the instrumental bad pixel mask
+    :param int n_workers: number of worker processes
+    :param logger log: open reduction log
+
+    :return: the header information of each image, in the order of new_images
+    :rtype: list
+    '''
+
+    # The metadata and instrumental mask are shared read-only by all workers
+    shared_data = {'setup': setup,
+                   'reduction_metadata': reduction_metadata,
+                   'instrument_bpm': instrument_bpm,
+                   'images_path': reduction_metadata.data_architecture[1]['IMAGES_PATH'][0]}
+
+    n_workers = max(1, min(int(n_workers), len(new_images)))
+
+    if n_workers == 1:
+        log.info('Preparing '+str(len(new_images))+' new images serially')
+        init_stage0_worker(shared_data)
+        results = [prepare_new_image(image_name) for image_name in new_images]
+
+    else:
+        log.info('Preparing '+str(len(new_images))+' new images with '
+                 +str(n_workers)+' worker processes')
+        pool = Pool(processes=n_workers, initializer=init_stage0_worker, initargs=(shared_data,))
+        try:
+            results = pool.map(prepare_new_image, new_images)
+        finally:
+            pool.close()
+            pool.join()
+
+    header_infos = []
+    for image_name, (image_structure, image_header_infos) in zip(new_images, results):
+        log.info('Determined that image '+image_name+\
+                 ' has the following structure: '+repr(image_structure))
+        log.info('HEADER INFO: '+repr(image_header_infos))
+        logs.ifverbose(log, setup, ' -> ' + image_name)
+
+        header_infos.append(image_header_infos)
+
+    return header_infos
+
+# Read-only data shared by the image preparation work units of a process
+stage0_worker_data = {}
+
+def init_stage0_worker(shared_data):
+    '''
+    Initialize a process to prepare new images, storing the data shared
+    between work units.
+
+    :param dict shared_data: read-only data required by every work unit
+    '''
+
+    stage0_worker_data.clear()
+    stage0_worker_data.update(shared_data)
+
+def prepare_new_image(image_name):
+    '''
+    Prepare a single new image.  The image file is opened once, its header
+    information is extracted, and the pixel mask is constructed from the
+    science and BPM extensions and written back to the same file.
+
+    :param string image_name: the name of the image
+
+    :return: the image structure and the array of header information
+    :rtype: tuple
+    '''
+
+    setup = stage0_worker_data['setup']
+    reduction_metadata = stage0_worker_data['reduction_metadata']
+    image_path = os.path.join(stage0_worker_data['images_path'], image_name)
+
+    with fits.open(image_path, memmap=False) as open_hdulist:
+
+        # Read all extensions before the file is overwritten
+        open_hdulist.readall()
+
+        image_structure = image_handling.identify_image_extensions(open_hdulist)
+
+        if image_structure['sci'] == None:
+            raise IOError('Cannot find any science data in image '+image_path)
+        if image_structure['bpm'] == None:
+            raise IOError('Cannot find a BPM for image '+image_path)
+
+        open_image = open_hdulist[image_structure['sci']]
+
+        header_infos = parse_the_image_header(reduction_metadata, open_image)
+
+        bpm = bad_pixel_mask.construct_the_pixel_mask(setup, reduction_metadata,
+                                            open_image, open_hdulist[image_structure['bpm']],
+                                            [1,3], None, low_level=0,
+                                            instrument_bpm=stage0_worker_data['instrument_bpm'])
+
+        add_pixel_mask_to_image(open_hdulist, bpm)
+
+        open_hdulist.writeto(image_path, overwrite=True)
+
+    return image_structure, header_infos
+
 def open_an_image(setup, image_directory, image_name, log,
                   image_index=0):
     '''
@@ -439,20 +553,32 @@ def save_the_pixel_mask_in_image(reduction_metadata, image_name, bpm):
     :param array_like master_mask: the master mask which needs to be kept
 
     '''
+    open_image = fits.open(os.path.join(reduction_metadata.data_architecture[1]['IMAGES_PATH'][0], image_name))
+
+    add_pixel_mask_to_image(open_image, bpm)
+
+    open_image.writeto(os.path.join(reduction_metadata.data_architecture[1]['IMAGES_PATH'][0], image_name),
+                       overwrite=True)
+
+
+def add_pixel_mask_to_image(open_image, bpm):
+    '''
+    Add the master pixel mask to an open image as the pyDANDIA_PIXEL_MASK
+    extension, replacing any existing pixel mask.
+
+    :param astropy.HDUList open_image: the opened image file
+    :param BadPixelMask bpm: the bad pixel mask of the image
+    '''
+
     master_pixels_mask = fits.ImageHDU(bpm.master_mask)
     master_pixels_mask.name = 'pyDANDIA_PIXEL_MASK'
 
-    open_image = fits.open(os.path.join(reduction_metadata.data_architecture[1]['IMAGES_PATH'][0], image_name))
-
     try:
         open_image['pyDANDIA_PIXEL_MASK'] = master_pixels_mask
     except:
 
         open_image.append(master_pixels_mask)
 
-    open_image.writeto(os.path.join(reduction_metadata.data_architecture[1]['IMAGES_PATH'][0], image_name),
-                       overwrite=True)
-
 
 def update_reduction_metadata_with_config_file(reduction_metadata,
                                                config_dictionnary, log=None):
@@ -577,36 +703,59 @@ def update_reduction_metadata_headers_summary_with_new_images(setup,
     :rtype array_like
     '''
 
+    header_infos = []
+
     for image_name in new_images:
-        layer = reduction_metadata.headers_summary[1]
 
         image_structure = image_handling.determine_image_struture(os.path.join(setup.red_dir, 'data', image_name), log=log)
 
         open_image = open_an_image(setup, reduction_metadata.data_architecture[1]['IMAGES_PATH'][0],
                                    image_name, log, image_index=image_structure['sci'])
 
-        header_infos = parse_the_image_header(reduction_metadata, open_image)
+        header_infos.append(parse_the_image_header(reduction_metadata, open_image))
+
+        if log != None:
+            log.info('HEADER INFO: '+repr(header_infos[-1]))
+
+    add_new_images_to_headers_summary(reduction_metadata, new_images,
+                                      header_infos, log=log)
+
 
-        log.info('HEADER INFO: '+repr(header_infos))
-        log.info(str(len(header_infos)))
+def add_new_images_to_headers_summary(reduction_metadata, new_images,
+                                      header_infos, log=None):
+    '''
+    Add the header information of a set of new images to the headers_summary
+    layer of the metadata in a single update
 
-        names = np.append('IMAGES', header_infos[:, 0])
-        values = np.append(image_name, header_infos[:, 1])
-        formats = np.append('S200', header_infos[:, 2])
+    :param object reduction_metadata: the metadata object
+    :param list new_images: list of strings
+    :param list header_infos: the header information array of each image
+    '''
 
-        log.info(str(values))
-        log.info(str(len(values)))
+    rows = []
 
-        if layer:
+    for image_name, image_header_infos in zip(new_images, header_infos):
 
-            reduction_metadata.add_row_to_layer('headers_summary',  values.astype(str))
+        values = np.append(image_name, image_header_infos[:, 1])
 
+        rows.append(list(values.astype(str)))
 
-        else:
+    if len(rows) > 0:
+
+        if not reduction_metadata.headers_summary[1]:
+
+            names = np.append('IMAGES', header_infos[0][:, 0])
+            formats = np.append('S200', header_infos[0][:, 2])
 
             reduction_metadata.create_headers_summary_layer(names, formats,
                                                             units=None,
-                                                            data=values)
+                                                            data=np.array(rows[0]))
+
+            rows = rows[1:]
+
+        if len(rows) > 0:
+
+            reduction_metadata.add_rows_to_layer('headers_summary', rows)
 
     if log != None:
         log.info('Added data on new images to the metadata')
@@ -9,6 +9,7 @@ import sys
 from astropy.io import fits
 from astropy import table
 import numpy as np
+import multiprocessing as mp
 from pyDANDIA import  logs
 from pyDANDIA import  metadata
 from pyDANDIA import  starfind
@@ -110,7 +111,9 @@ def run_stage3(setup, **kwargs):
                                              sky_model,
                                              psf_diameter=psf_diameter,
                                              centroiding=False,
-                                             diagnostics=True)
+                                             diagnostics=True,
+                                             n_workers=get_n_workers(reduction_metadata,log),
+                                             grouped=use_grouped_photometry(reduction_metadata,log))
 
 
         reduction_metadata = store_photometry_in_metadata(reduction_metadata, ref_star_catalog)
@@ -158,6 +161,34 @@ def get_default_config(kwargs,log):
 
     return kwargs
 
+def get_n_workers(reduction_metadata,log):
+    """Function to return the number of processes to use for the reference
+    image photometry, from the stage3_workers reduction parameter"""
+
+    if 'STAGE3_WORKERS' in reduction_metadata.reduction_parameters[1].keys():
+        n_workers = int(reduction_metadata.reduction_parameters[1]['STAGE3_WORKERS'][0])
+    else:
+        n_workers = 1
+    if n_workers < 1:
+        n_workers = mp.cpu_count()
+
+    log.info('Using '+str(n_workers)+' processes for the reference image photometry')
+
+    return n_workers
+
+def use_grouped_photometry(reduction_metadata,log):
+    """Function to return whether blended stars should be fitted
+    simultaneously, from the stage3_grouped_photometry reduction parameter"""
+
+    grouped = False
+    if 'STAGE3_GROUPED_PHOTOMETRY' in reduction_metadata.reduction_parameters[1].keys():
+        if 'true' in str(reduction_metadata.reduction_parameters[1]['STAGE3_GROUPED_PHOTOMETRY'][0]).lower():
+            grouped = True
+
+    log.info('Fitting blended stars simultaneously? '+repr(grouped))
+
+    return grouped
+
 def check_metadata(reduction_metadata,log):
     """Function to verify sufficient information has been extracted from
     the metadata
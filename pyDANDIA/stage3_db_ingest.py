@@ -517,83 +517,134 @@ def commit_stars(conn, params, reduction_metadata, log,
 
     log.info('Starting commit of '+str(n_stars)+' stars')
 
-    for j in range(0,n_stars,1):
+    catalog = reduction_metadata.star_catalog[1]
+    catalog_columns = ['gaia_source_id', 'gaia_ra', 'gaia_ra_error', 'gaia_dec', 'gaia_dec_error',
+                       'phot_g_mean_flux', 'phot_g_mean_flux_error',
+                       'phot_bp_mean_flux', 'phot_bp_mean_flux_error',
+                       'phot_rp_mean_flux', 'phot_rp_mean_flux_error',
+                       'vphas_source_id', 'vphas_ra', 'vphas_dec',
+                       'gmag', 'gmag_error', 'rmag', 'rmag_error', 'imag', 'imag_error']
+
+    if search_for_match:
+        query = 'SELECT star_id,ra,dec FROM stars'
+        existing_stars = phot_db.query_to_astropy_table(conn, query, args=())
+
+        star_ids = match_stars_on_position(existing_stars,
+                                           np.array(catalog['ra'], dtype=float),
+                                           np.array(catalog['dec'], dtype=float),
+                                           tol)
+
+        for j in np.where(star_ids > 0)[0]:
+            log.info('Catalog star at RA, Dec '+str(catalog['ra'][j])+','+str(catalog['dec'][j])+\
+                 ' matches a star already in the phot_db with star_id '+str(int(star_ids[j])))
+
+        # Catalog stars are also matched against the new stars which precede
+        # them in the catalog, as each is committed in turn
+        new_stars = np.where(star_ids == 0)[0]
+        duplicates = match_duplicate_positions(np.array(catalog['ra'], dtype=float)[new_stars],
+                                               np.array(catalog['dec'], dtype=float)[new_stars],
+                                               tol)
+        duplicate_of = np.full(n_stars, -1)
+        duplicate_of[new_stars] = np.where(duplicates >= 0, new_stars[duplicates], -1)
+
+        for j in np.where(duplicate_of >= 0)[0]:
+            log.info('Catalog star at RA, Dec '+str(catalog['ra'][j])+','+str(catalog['dec'][j])+\
+                 ' matches catalog star '+str(catalog['index'][duplicate_of[j]])+' committed to the phot_db')
 
-        idx = reduction_metadata.star_catalog[1]['index'][j]
-        ra = reduction_metadata.star_catalog[1]['ra'][j]
-        dec = reduction_metadata.star_catalog[1]['dec'][j]
+    else:
+        duplicate_of = np.full(n_stars, -1)
 
-        star_pars = [ str(idx), str(ra), str(dec), str(refimage['refimg_id'][0]),
-                    str(reduction_metadata.star_catalog[1]['gaia_source_id'][j]),
-                    str(reduction_metadata.star_catalog[1]['gaia_ra'][j]),
-                    str(reduction_metadata.star_catalog[1]['gaia_ra_error'][j]),
-                    str(reduction_metadata.star_catalog[1]['gaia_dec'][j]),
-                    str(reduction_metadata.star_catalog[1]['gaia_dec_error'][j]),
-                    str(reduction_metadata.star_catalog[1]['phot_g_mean_flux'][j]),
-                    str(reduction_metadata.star_catalog[1]['phot_g_mean_flux_error'][j]),
-                    str(reduction_metadata.star_catalog[1]['phot_bp_mean_flux'][j]),
-                    str(reduction_metadata.star_catalog[1]['phot_bp_mean_flux_error'][j]),
-                    str(reduction_metadata.star_catalog[1]['phot_rp_mean_flux'][j]),
-                    str(reduction_metadata.star_catalog[1]['phot_rp_mean_flux_error'][j]),
-                    str(reduction_metadata.star_catalog[1]['vphas_source_id'][j]),
-                    str(reduction_metadata.star_catalog[1]['vphas_ra'][j]),
-                    str(reduction_metadata.star_catalog[1]['vphas_dec'][j]),
-                    str(reduction_metadata.star_catalog[1]['gmag'][j]),
-                    str(reduction_metadata.star_catalog[1]['gmag_error'][j]),
-                    str(reduction_metadata.star_catalog[1]['rmag'][j]),
-                    str(reduction_metadata.star_catalog[1]['rmag_error'][j]),
-                    str(reduction_metadata.star_catalog[1]['imag'][j]),
-                    str(reduction_metadata.star_catalog[1]['imag_error'][j]),
-                    str((int(reduction_metadata.star_catalog[1]['clean'][j]))) ]
+    submit = np.where((star_ids == 0) & (duplicate_of < 0))[0]
 
-        if search_for_match:
+    columns = [ catalog['index'], catalog['ra'], catalog['dec'] ] + \
+                [ catalog[col] for col in catalog_columns ]
+    columns = [ np.array(col).astype(str)[submit] for col in columns ]
 
-            results = phot_db.box_search_on_position(conn, ra, dec, tol, tol)
+    refimg_id = str(refimage['refimg_id'][0])
+    vphas_clean = np.array(catalog['clean']).astype(int).astype(str)[submit]
 
-            if len(results) > 0:
+    star_rows = [ tuple(values[0:3]) + (refimg_id,) + tuple(values[3:]) + (clean,)
+                    for values, clean in zip(zip(*columns), vphas_clean) ]
 
-                log.info('Catalog star at RA, Dec '+str(ra)+','+str(dec)+\
-                     ' matches a star already in the phot_db with RA, Dec '+\
-                     str(results['ra'][0])+','+str(results['dec'][0]))
+    if len(star_rows) > 0:
+        star_ids[submit] = phot_db.feed_to_table_many_returning_ids(conn, 'stars',
+                                                                    star_keys, star_rows,
+                                                                    'star_id')
 
-                star_ids[j] = int(results['star_id'][0])
+    duplicates = np.where(duplicate_of >= 0)[0]
+    star_ids[duplicates] = star_ids[duplicate_of[duplicates]]
 
-                submit = False
+    log.info('Completed the ingest of '+str(n_stars)+' to the photometric database')
 
-            else:
+    return star_ids
 
-                submit = True
+def match_stars_on_position(stars, ra, dec, tol):
+    """Function to identify the entries of a starlist within a box of
+    half-width tol of each of a set of positions, using an index of the
+    starlist sorted by declination.  Where several stars are in the box, the
+    first in the starlist is returned.
 
-        else:
+    :param Table stars: Starlist with star_id, ra, dec columns
+    :param array ra: RAs of the positions in decimal degrees
+    :param array dec: Decs of the positions in decimal degrees
+    :param float tol: Box half-width in decimal degrees
 
-            submit = True
+    :return array: star_id of the matching star for each position, 0 if none
+    """
 
-        if submit:
+    star_ids = np.zeros(len(ra))
 
-            command = 'INSERT OR REPLACE INTO stars ('+','.join(star_keys)+') VALUES ("'
-            command += '","'.join(star_pars) + '")'
+    if len(stars) == 0:
+        return star_ids
 
-            cursor = conn.cursor()
+    order = np.argsort(np.array(stars['dec'], dtype=float), kind='stable')
+    star_ra = np.array(stars['ra'], dtype=float)[order]
+    star_dec = np.array(stars['dec'], dtype=float)[order]
+    star_id = np.array(stars['star_id'])[order]
 
-            cursor.execute(command)
+    jmin = np.searchsorted(star_dec, dec - tol, side='left')
+    jmax = np.searchsorted(star_dec, dec + tol, side='right')
 
-            conn.commit()
+    for j in np.where(jmax > jmin)[0]:
+        candidates = np.arange(jmin[j], jmax[j], 1)
+        candidates = candidates[abs(star_ra[candidates] - ra[j]) <= tol]
 
-            results = phot_db.box_search_on_position(conn, ra, dec, tol, tol)
+        if len(candidates) > 0:
+            star_ids[j] = star_id[candidates[order[candidates].argmin()]]
 
-            if len(results) > 1:
-                idx = np.where(results['separation'] == results['separation'].min())[0][0]
-            else:
-                idx = 0
+    return star_ids
 
-            #log.info('Commited catalog star at RA, Dec '+str(ra)+','+str(dec)+\
-            #         ' to the phot_db as star_id='+str(results['star_id'][idx]))
+def match_duplicate_positions(ra, dec, tol):
+    """Function to identify the entries of a list of positions which fall
+    within a box of half-width tol of an earlier entry of the list.  Each
+    entry is matched to the first earlier entry in its box which is not
+    itself a duplicate, as if the entries were committed to a database one
+    at a time, each after searching for a match among those committed.
 
-            star_ids[j] = int(results['star_id'][idx])
+    :param array ra: RAs of the positions in decimal degrees
+    :param array dec: Decs of the positions in decimal degrees
+    :param float tol: Box half-width in decimal degrees
 
-    log.info('Completed the ingest of '+str(n_stars)+' to the photometric database')
+    :return array: index of the entry matched by each entry, -1 if none
+    """
 
-    return star_ids
+    duplicate_of = np.full(len(ra), -1)
+
+    order = np.argsort(dec, kind='stable')
+    sorted_dec = dec[order]
+
+    jmin = np.searchsorted(sorted_dec, dec - tol, side='left')
+    jmax = np.searchsorted(sorted_dec, dec + tol, side='right')
+
+    for j in np.where(jmax - jmin > 1)[0]:
+        candidates = order[jmin[j]:jmax[j]]
+        candidates = candidates[(candidates < j) & (abs(ra[candidates] - ra[j]) <= tol)]
+        candidates = candidates[duplicate_of[candidates] < 0]
+
+        if len(candidates) > 0:
+            duplicate_of[j] = candidates.min()
+
+    return duplicate_of
 
 def commit_photometry(conn, params, reduction_metadata, star_ids, log):
 
@@ -177,7 +177,7 @@ def run_stage4(setup, **kwargs):
                 target_image = data[index][0]
                 x_shift = data[index][1]
                 y_shift = data[index][2]
-                row_index = np.where(reduction_metadata.images_stats[1]['IM_NAME'].data == target_image)[0][0]
+                row_index = reduction_metadata.find_row('images_stats', target_image)
                 reduction_metadata.update_a_cell_to_layer('images_stats', row_index, 'SHIFT_X', x_shift)
                 reduction_metadata.update_a_cell_to_layer('images_stats', row_index, 'SHIFT_Y', y_shift)
                 logs.ifverbose(log, setup,
@@ -193,7 +193,7 @@ def run_stage4(setup, **kwargs):
             for index in range(len(data)):
                 target_image = data[index][0]
                 try:
-                    row_index = np.where(reduction_metadata.images_stats[1]['IM_NAME'].data == target_image)[0][0]
+                    row_index = reduction_metadata.find_row('images_stats', target_image)
                     sorted_data[row_index] = data[index]
                 except IndexError:
                     log.info('ERROR: Cannot find an entry for '+target_image+' in the IMAGES STATS table.  Re-run stages 0 & 1?')
@@ -616,7 +616,7 @@ def resample_image(new_images, reference_image_name, reference_image_directory,
         if log != None:
             log.info('Calculating translation of '+new_image+' from the reference')
 
-        row_index = np.where(reduction_metadata.images_stats[1]['IM_NAME'] == new_image)[0][0]
+        row_index = reduction_metadata.find_row('images_stats', new_image)
         x_shift, y_shift = -reduction_metadata.images_stats[1][row_index]['SHIFT_X'], - \
             reduction_metadata.images_stats[1][row_index]['SHIFT_Y']
 
@@ -802,7 +802,7 @@ def resample_image_stamps(new_images, reference_image_name, reference_image_dire
     for new_image in new_images:
         log.info('Resampling image '+new_image)
 
-        row_index = np.where(reduction_metadata.images_stats[1]['IM_NAME'] == new_image)[0][0]
+        row_index = reduction_metadata.find_row('images_stats', new_image)
         x_shift, y_shift = -reduction_metadata.images_stats[1][row_index]['SHIFT_X'], - \
             reduction_metadata.images_stats[1][row_index]['SHIFT_Y']
 
@@ -11,6 +11,7 @@
 ######################################################################
 import os, sys
 import copy
+import functools
 import numpy as np
 from astropy.io import fits
 from scipy.signal import convolve2d
@@ -22,6 +23,7 @@ from pyDANDIA.subtract_subimages import subtract_images, subtract_subimage
 from multiprocessing import Pool
 import multiprocessing as mp
 import scipy.optimize as so
+from scipy.linalg import cho_factor, cho_solve, LinAlgError
 from astropy.wcs import WCS
 
 from astropy.stats import sigma_clipped_stats
@@ -33,12 +35,17 @@ from pyDANDIA import logs
 from pyDANDIA import psf
 from pyDANDIA import stage4
 from pyDANDIA import image_handling
+from pyDANDIA import umatrix_numpy
+from pyDANDIA import umatrix_store
 import matplotlib as mpl
 mpl.use('Agg')
 import scipy.ndimage as sn
 from skimage import transform as tf
 import matplotlib.pyplot as plt
 
+UMATRIX_ENGINES = ['cython', 'numpy', 'fft']
+KERNEL_UNCERTAINTY_MODES = ['analytic', 'bootstrap']
+
 
 def run_stage5(setup, **kwargs):
     """Main driver function to run stage 5: kernel_solution
@@ -55,10 +62,45 @@ def run_stage5(setup, **kwargs):
 
     log = logs.start_stage_log(setup.red_dir, 'stage5', version=stage5_version)
     log.info('Setup:\n' + setup.summary() + '\n')
+
+    # find the metadata
+    reduction_metadata = metadata.MetaData()
+    reduction_metadata.load_all_metadata(setup.red_dir, 'pyDANDIA_metadata.fits')
+
+    # Reductions configured before the engine option existed use the cython routines
+    if 'UMATRIX_ENGINE' in reduction_metadata.reduction_parameters[1].keys():
+        umatrix_engine = str(reduction_metadata.reduction_parameters[1]['UMATRIX_ENGINE'][0]).lower()
+    else:
+        umatrix_engine = 'cython'
+    log.info('Using the ' + umatrix_engine + ' u-matrix engine')
+
+    if 'STAGE5_WORKERS' in reduction_metadata.reduction_parameters[1].keys():
+        n_workers = int(reduction_metadata.reduction_parameters[1]['STAGE5_WORKERS'][0])
+    else:
+        n_workers = 1
+    if n_workers < 1:
+        n_workers = mp.cpu_count()
+
+    if 'KERNEL_UNCERTAINTY' in reduction_metadata.reduction_parameters[1].keys():
+        uncertainty_mode = str(reduction_metadata.reduction_parameters[1]['KERNEL_UNCERTAINTY'][0]).lower()
+    else:
+        uncertainty_mode = 'bootstrap'
+    log.info('Estimating kernel uncertainties using the ' + uncertainty_mode + ' method')
+
+    if umatrix_engine not in UMATRIX_ENGINES:
+        status = 'KO'
+        report = 'Unknown u-matrix engine ' + umatrix_engine + ', expected one of ' + repr(UMATRIX_ENGINES)
+        log.info(report)
+        return status, report
+
+    if uncertainty_mode not in KERNEL_UNCERTAINTY_MODES:
+        status = 'KO'
+        report = 'Unknown kernel uncertainty method ' + uncertainty_mode + ', expected one of ' + repr(KERNEL_UNCERTAINTY_MODES)
+        log.info(report)
+        return status, report
+
     try:
-        from umatrix_routine import umatrix_construction, umatrix_bvector_construction, bvector_construction
-        from umatrix_routine import umatrix_construction_nobkg, bvector_construction_nobkg
-        #from umatrix_routine import umatrix_construction_clean, bvector_construction_clean
+        load_umatrix_routines(umatrix_engine)
 
     except ImportError:
         log.info('Uncompiled cython code, please run setup.py: e.g.\n python setup.py build_ext --inplace')
@@ -66,10 +108,6 @@ def run_stage5(setup, **kwargs):
         report = 'Uncompiled cython code, please run setup.py: e.g.\n python setup.py build_ext --inplace'
         return status, report
 
-    # find the metadata
-    reduction_metadata = metadata.MetaData()
-    reduction_metadata.load_all_metadata(setup.red_dir, 'pyDANDIA_metadata.fits')
-
     image_red_status = reduction_metadata.fetch_image_status(5)
 
     log.info('Determining the kernel size for all images based on their FWHM')
@@ -232,7 +270,8 @@ def run_stage5(setup, **kwargs):
     quality_metrics = subtract_with_constant_kernel_on_stamps(new_images, reference_image_name, reference_image_directory,
                                                     reduction_metadata, setup, data_image_directory, kernel_size_array,
                                                     max_adu, ref_stats, maxshift, kernel_directory_path,
-                                                    diffim_directory_path, log)
+                                                    diffim_directory_path, log, engine=umatrix_engine,
+                                                    n_workers=n_workers, uncertainty_mode=uncertainty_mode)
     data = np.copy(quality_metrics)
     if ('PSCALE' in reduction_metadata.images_stats[1].keys()):
 
@@ -246,7 +285,7 @@ def run_stage5(setup, **kwargs):
             ngood = float(data[idx][5])
             kurtosis_quality = data[idx][6]
             skew_quality = data[idx][7]
-            row_index = np.where(reduction_metadata.images_stats[1]['IM_NAME'].data == target_image)[0][0]
+            row_index = reduction_metadata.find_row('images_stats', target_image)
 
             try:
                 reduction_metadata.update_a_cell_to_layer('images_stats', row_index, 'PSCALE', pscale)
@@ -400,7 +439,7 @@ def resampled_median_stack(setup, reduction_metadata, new_images, log):
 
     for new_image in new_images:
 
-        row_index = np.where(reduction_metadata.images_stats[1]['IM_NAME'] == new_image)[0][0]
+        row_index = reduction_metadata.find_row('images_stats', new_image)
 
         if image_sum == []:
             image_sum = open_an_image(setup, data_image_directory, new_image, log).data
@@ -498,7 +537,7 @@ def subtract_with_constant_kernel(new_images, reference_image_name, reference_im
     for new_image in new_images:
         log.info(new_image + ' quality metrics:')
 
-        row_index = np.where(reduction_metadata.images_stats[1]['IM_NAME'] == new_image)[0][0]
+        row_index = reduction_metadata.find_row('images_stats', new_image)
         ref_fwhm_x, ref_fwhm_y, ref_sigma_x, ref_sigma_y = ref_stats
         x_shift, y_shift = -reduction_metadata.images_stats[1][row_index]['SHIFT_X'], - \
         reduction_metadata.images_stats[1][row_index]['SHIFT_Y']
@@ -607,11 +646,15 @@ def subtract_with_constant_kernel_on_stamps(new_images, reference_image_name, re
                                             reduction_metadata,
                                             setup, data_image_directory, kernel_size_array, max_adu, ref_stats,
                                             maxshift,
-                                            kernel_directory_path, diffim_directory_path, log):
+                                            kernel_directory_path, diffim_directory_path, log, engine='cython',
+                                            n_workers=1, uncertainty_mode='bootstrap'):
     """subtracting image with a single kernel individual stamps
     This routine calculates the umatrix of the least squares problem defining the kernel
     and subtracts the model
     :param object new images : list of unprocessed images
+    :param string engine : u-matrix and b-vector construction engine
+    :param int n_workers : number of processes solving (image, stamp) work units
+    :param string uncertainty_mode : kernel uncertainty estimate, 'analytic' or 'bootstrap'
 
     :return: None
     :rtype: None
@@ -640,305 +683,395 @@ def subtract_with_constant_kernel_on_stamps(new_images, reference_image_name, re
         ref_structure = image_handling.determine_image_struture(ref_file_path, log=log)
         reference_image = fits.open( ref_file_path)[ref_structure['sci']].data.astype(float)
 
-        kernel_size_max = max(kernel_size_array)
-        reference_images = []
+        umatrices_grid, factors_grid = load_umatrix_grid(reference_image, master_mask, reduction_metadata.stamps[1],
+                                                         kernel_size_array, max_adu, kernel_directory_path,
+                                                         log, engine=engine)
+
+    log.info('Performing image subtraction')
 
-        ref_structure = image_handling.determine_image_struture(os.path.join(reference_image_directory, reference_image_name),log=log)
+    # Each (image, stamp) pair is an independent work unit; the reference
+    # image, master mask and u-matrices are shared read-only by all workers
+    work_units = []
+    image_bins = {}
+    for new_image in new_images:
+
+        kernel_directory = os.path.join(kernel_directory_path, new_image)
+        diffim_directory = os.path.join(diffim_directory_path, new_image)
 
         try:
+            os.mkdir(kernel_directory)
 
-            umatrices_grid, kernel_sizes, max_adu_restored = np.load(os.path.join(kernel_directory_path, 'unweighted_u_matrix.npy'), allow_pickle=True)
-            log.info('Loading pre-existing u-matrices')
+            os.mkdir(diffim_directory)
 
-            if (kernel_sizes != kernel_size_array) or (max_adu_restored != max_adu):
-                # calculate and store unweighted umatrices
-                umatrices_grid = []
-                for idx in range(len(kernel_size_array)):
-                    umatrices = []
+        except:
+            pass
 
-                    for stamp in list_of_stamps:
-                        stamp_row = np.where(reduction_metadata.stamps[1]['PIXEL_INDEX'] == stamp)[0][0]
-                        xmin = reduction_metadata.stamps[1]['PIXEL_INDEX'][stamp_row]['X_MIN'][0]
-                        xmax = reduction_metadata.stamps[1]['PIXEL_INDEX'][stamp_row]['X_MAX'][0]
-                        ymin = reduction_metadata.stamps[1]['PIXEL_INDEX'][stamp_row]['Y_MIN'][0]
-                        ymax = reduction_metadata.stamps[1]['PIXEL_INDEX'][stamp_row]['Y_MAX'][0]
+        row_index = reduction_metadata.find_row('images_stats', new_image)
+        fwhm_val = reduction_metadata.images_stats[1][row_index]['FWHM'] * grow_kernel
 
-                        #reference_image, bright_reference_mask, reference_image_unmasked, noise_image = open_reference(setup, reference_image_directory, reference_image_name, kernel_size_array[idx], max_adu,
-                        #       ref_extension=ref_structure['sci'], log=log, central_crop=maxshift, master_mask=master_mask,
-                        #       external_weight=None,subset=[ymin,ymax, xmin,xmax])
+        umatrix_index = int(np.digitize(fwhm_val, np.array(kernel_size_array)))
+        umatrix_index = min(umatrix_index, len(kernel_size_array) - 1)
+        image_bins[new_image] = umatrix_index
+
+        for stamp in list_of_stamps:
+            stamp_row = np.where(reduction_metadata.stamps[1]['PIXEL_INDEX'] == stamp)[0][0]
+            xmin = int(reduction_metadata.stamps[1][stamp_row]['X_MIN'])
+            xmax = int(reduction_metadata.stamps[1][stamp_row]['X_MAX'])
+            ymin = int(reduction_metadata.stamps[1][stamp_row]['Y_MIN'])
+            ymax = int(reduction_metadata.stamps[1][stamp_row]['Y_MAX'])
+
+            work_units.append([new_image, stamp, stamp_row, [ymin, ymax, xmin, xmax], umatrix_index])
+
+    if len(work_units) > 0:
+        shared_data = {'reference_image': reference_image,
+                       'master_mask': master_mask,
+                       'umatrices_grid': umatrices_grid,
+                       'factors_grid': factors_grid,
+                       'kernel_size_array': kernel_size_array,
+                       'max_adu': max_adu,
+                       'image_directory': reduction_metadata.data_architecture[1]['IMAGES_PATH'][0],
+                       'data_image_directory': data_image_directory,
+                       'kernel_directory_path': kernel_directory_path,
+                       'diffim_directory_path': diffim_directory_path,
+                       'engine': engine,
+                       'uncertainty_mode': uncertainty_mode}
+
+        stamp_results = run_stamp_work_units(work_units, shared_data, n_workers, len(list_of_stamps), log)
+    else:
+        stamp_results = []
 
-                        ref,ref_unmasked,ref_mask,bkg_ref,noise =  mask_the_reference(reference_image[ymin:ymax, xmin:xmax],master_mask[ymin:ymax, xmin:xmax],kernel_size_array[idx],max_adu)
+    quality_metrics = gather_stamp_quality_metrics(new_images, work_units, stamp_results, image_bins,
+                                                   setup, log)
 
+    return quality_metrics
 
-                        #reference_images.append([ref,ref_unmasked,ref_mask,bkg_ref,noise])
-                        umatrices.append(
-                            umatrix_constant(ref, kernel_size_array[idx],
-                                             noise))
-                    umatrices_grid.append(umatrices)
 
-                np.save(os.path.join(kernel_directory_path, 'unweighted_u_matrix.npy'),
-                        [umatrices_grid, kernel_size_array, max_adu])
+def run_stamp_work_units(work_units, shared_data, n_workers, n_stamps, log):
+    """Function to compute the kernel solution and difference image for a
+    list of (image, stamp) work units, either serially or distributed over
+    a pool of worker processes.
 
-        except:
+    Inputs:
+        :param list work_units: Entries of [image, stamp, stamp_row, stamp_slice, umatrix_index]
+        :param dict shared_data: Read-only data required by every work unit
+        :param int n_workers: Number of worker processes
+        :param int n_stamps: Number of stamps per image
+        :param logger log: Open reduction log
 
-            log.info('Calculating and storing unweighted umatrices')
+    Output:
+        :param list stamp_results: Per-unit results, in the order of work_units
+    """
 
-            umatrices_grid = []
-            for idx in range(len(kernel_size_array)):
-                log.info(' -> Starting image ' + str(idx) + ', kernel size ' + str(kernel_size_array[idx]))
-                umatrices = []
+    n_workers = max(1, min(int(n_workers), len(work_units)))
 
-                for stamp in list_of_stamps:
-                    stamp_row = np.where(reduction_metadata.stamps[1]['PIXEL_INDEX'] == stamp)[0][0]
-                    xmin = int( reduction_metadata.stamps[1][stamp_row]['X_MIN'])
-                    xmax = int( reduction_metadata.stamps[1][stamp_row]['X_MAX'])
-                    ymin = int( reduction_metadata.stamps[1][stamp_row]['Y_MIN'])
-                    ymax = int( reduction_metadata.stamps[1][stamp_row]['Y_MAX'])
+    if n_workers == 1:
+        log.info('Solving for the kernels of ' + str(len(work_units)) + ' stamps serially')
+        init_stamp_worker(shared_data)
+        stamp_results = [stamp_kernel_solution_pool(unit) for unit in work_units]
 
+    else:
+        # Keep the stamps of an image with the same worker whenever there are
+        # enough images to occupy the pool, so that each image is read and
+        # resampled once
+        n_images = len(work_units) / float(n_stamps)
+        if n_images >= n_workers:
+            chunksize = n_stamps
+        else:
+            chunksize = 1
 
+        log.info('Solving for the kernels of ' + str(len(work_units)) + ' stamps with '
+                 + str(n_workers) + ' worker processes')
+        pool = Pool(processes=n_workers, initializer=init_stamp_worker, initargs=(shared_data,))
+        try:
+            stamp_results = pool.map(stamp_kernel_solution_pool, work_units, chunksize=chunksize)
+        finally:
+            pool.close()
+            pool.join()
 
-                   # reference_image, bright_reference_mask, reference_image_unmasked, noise_image = open_reference(setup, reference_image_directory, reference_image_name, kernel_size_array[idx], max_adu,
-                   #            ref_extension=ref_structure['sci'], log=log, central_crop=maxshift, master_mask=master_mask,
-                   #            external_weight=None,subset=[ymin,ymax, xmin,xmax])
-                    ref,ref_unmasked,ref_mask,bkg_ref,noise =  mask_the_reference(reference_image[ymin:ymax, xmin:xmax],master_mask[ymin:ymax, xmin:xmax],kernel_size_array[idx],max_adu)
+    return stamp_results
 
 
-                   # reference_images.append([ref,ref_unmasked,ref_mask,bkg_ref,noise])
-                    umatrices.append(
-                        umatrix_constant(ref, kernel_size_array[idx],
-                                         noise))
+def gather_stamp_quality_metrics(new_images, work_units, stamp_results, image_bins, setup, log):
+    """Function to combine the per-stamp results into the per-image quality
+    metrics, in the order of the new_images list.  An image is flagged as
+    failed if the solution for any of its stamps failed.
 
-                    log.info(' -> Completed u-matrix calculation on stamp '+str(stamp))
-                umatrices_grid.append(umatrices)
+    Inputs:
+        :param list new_images: Images processed
+        :param list work_units: Entries of [image, stamp, stamp_row, stamp_slice, umatrix_index]
+        :param list stamp_results: Per-unit results, in the order of work_units
+        :param dict image_bins: Kernel size bin used for each image
+        :param object setup: Reduction setup
+        :param logger log: Open reduction log
 
-            np.save(os.path.join(kernel_directory_path, 'unweighted_u_matrix.npy'),
-                    [umatrices_grid, kernel_size_array, max_adu])
-            log.info('Stored u-matrix')
+    Output:
+        :param list quality_metrics: QC indices per new image
+    """
+
+    image_results = {}
+    for new_image in new_images:
+        image_results[new_image] = []
+
+    for unit, result in zip(work_units, stamp_results):
+        image_results[unit[0]].append([unit[1]] + list(result))
 
-    log.info('Performing image subtraction')
     quality_metrics = []
-    #import pdb; pdb.set_trace()
     for new_image in new_images:
+        log.info(new_image + ' quality metrics:')
 
-        kernel_directory = os.path.join(kernel_directory_path, new_image)
-        diffim_directory = os.path.join(diffim_directory_path, new_image)
+        errors = [str(entry[0]) + ': ' + entry[2] for entry in image_results[new_image] if entry[1] != 'OK']
 
-        try:
-            os.mkdir(kernel_directory)
+        if len(errors) == 0 and len(image_results[new_image]) > 0:
+            stamp_metrics = np.array([entry[3] for entry in image_results[new_image]], dtype=float)
+            (pscale, pscale_err, median_sky, variance_per_pixel, ngood, kurtosis_quality,
+             skew_quality) = np.median(stamp_metrics, axis=0)
 
-            os.mkdir(diffim_directory)
+            if log is not None:
+                logs.ifverbose(log, setup,
+                               'b_vector calculated for:' + new_image + ' and scale factor ' + str(pscale)
+                               + ' +/- '+str(pscale_err) +' variance per pixel ' + str(
+                                   np.round(variance_per_pixel, 4)) + ' in kernel bin ' + str(image_bins[new_image]))
+            quality_metrics.append(
+                [new_image, pscale, pscale_err, median_sky, variance_per_pixel, ngood, kurtosis_quality,
+                 skew_quality])
 
-        except:
-            pass
-        log.info(new_image + ' quality metrics:')
+        else:
+            quality_metrics.append([new_image, -1.0, -1.0, -1.0, -1.0, 0, -1.0, -1.0])
 
-        row_index = np.where(reduction_metadata.images_stats[1]['IM_NAME'] == new_image)[0][0]
-        fwhm_val = reduction_metadata.images_stats[1][row_index]['FWHM'] * grow_kernel
-        ref_fwhm_x, ref_fwhm_y, ref_sigma_x, ref_sigma_y = ref_stats
+            if log is not None:
+                logs.ifverbose(log, setup,
+                               'kernel matrix computation or shift failed:' + new_image + '. skipping! '
+                               + ' '.join(errors))
 
-        umatrix_index = int(np.digitize(fwhm_val, np.array(kernel_size_array)))
-        umatrix_index = min(umatrix_index, len(kernel_size_array) - 1)
-       # umatrix_index = -1
-        umatrix_grid = umatrices_grid[umatrix_index]
-        kernel_size = kernel_size_array[umatrix_index]
+        log.info(' -> ' + repr(quality_metrics[-1]))
 
+    return quality_metrics
 
 
-        x_shift, y_shift = 0, 0
+# Read-only data shared by the stamp work units of a process
+stamp_worker_data = {}
 
-        log.info('Smoothing the data if the reference is not as sharp as a data image')
-        smoothing = smoothing_2sharp_images(reduction_metadata, ref_fwhm_x, ref_fwhm_y, ref_sigma_x, ref_sigma_y,
-                                            row_index)
+def init_stamp_worker(shared_data):
+    """Function to initialize a process to solve for stamp kernels, storing
+    the data shared between work units.  Each process draws from its own
+    random number sequence.
 
+    Inputs:
+        :param dict shared_data: Read-only data required by every work unit
+    """
 
-        image_directory = reduction_metadata.data_architecture[1]['IMAGES_PATH'][0]
-        image_file_path = os.path.join(image_directory, new_image)
-        image_structure = image_handling.determine_image_struture(image_file_path, log=log)
-        theimage = fits.open(image_file_path)[image_structure['sci']].data.astype(float)
+    stamp_worker_data.clear()
+    stamp_worker_data.update(shared_data)
+    stamp_worker_data['data_image'] = [None, None, None]
+    np.random.seed()
 
-        stamps_directory = os.path.join(data_image_directory, new_image)
 
-        warp_matrix =  np.load(os.path.join(stamps_directory, 'warp_matrice_image.npy'))
-        warp_matrix = np.round(warp_matrix,10)
-        if warp_matrix.shape != (3,3):
-            warp_matrix = tf.PolynomialTransform(warp_matrix)
+def load_warp_transform(warp_file_path):
+    """Function to read a warp matrix computed in stage4 as the inverse
+    map of the resampling onto the reference pixel grid
 
-        resample_image = stage4.warp_image(theimage,warp_matrix)
-        ref_wcs = WCS(fits.open( ref_file_path)[ref_structure['sci']].header)
+    Inputs:
+        :param str warp_file_path: Path to the stored warp matrix
 
-        #resample_image = stage4.warp_image_drizzle(theimage,warp_matrix,ref_wcs)
-        try:
+    Output:
+        :param object transform: skimage transform
+    """
 
+    warp_matrix = np.load(warp_file_path)
+    warp_matrix = np.round(warp_matrix,10)
 
+    if warp_matrix.shape != (3,3):
+        return tf.PolynomialTransform(warp_matrix)
 
-            pscales = []
-            pscales_err = []
-            medians_sky = []
-            variances_per_pixel = []
-            ngoods = []
-            kurtosises_quality = []
-            skewes_quality = []
+    return tf.ProjectiveTransform(matrix=warp_matrix)
 
 
+def load_data_image(new_image):
+    """Function to read a data image and its resampling onto the reference
+    pixel grid, reusing the last image read by this process
 
-            for stamp in list_of_stamps:
+    Inputs:
+        :param str new_image: Image name
 
-                stamp_row = np.where(reduction_metadata.stamps[1]['PIXEL_INDEX'] == stamp)[0][0]
-                xmin = int(reduction_metadata.stamps[1][stamp_row]['X_MIN'])
-                xmax = int(reduction_metadata.stamps[1][stamp_row]['X_MAX'])
-                ymin = int(reduction_metadata.stamps[1][stamp_row]['Y_MIN'])
-                ymax = int(reduction_metadata.stamps[1][stamp_row]['Y_MAX'])
+    Output:
+        :param array theimage: Data image
+        :param object image_warp: Inverse map of the image resampling
+    """
 
+    (cached_image, theimage, image_warp) = stamp_worker_data['data_image']
+    if cached_image == new_image:
+        return theimage, image_warp
 
-                #ref_extended, bal_mask_extended, ref_unmasked, noise = open_reference(setup, reference_image_directory, reference_image_name, kernel_size_array[umatrix_index], max_adu,
-                 #              ref_extension=ref_structure['sci'], log=log, central_crop=maxshift, master_mask=master_mask,
-                 #              external_weight=None,subset=[ymin,ymax, xmin,xmax])
-#                ref = reference_image[kernel_size:-kernel_size, kernel_size:-kernel_size][ymin:ymax, xmin:xmax]
+    image_file_path = os.path.join(stamp_worker_data['image_directory'], new_image)
+    image_structure = image_handling.determine_image_struture(image_file_path, log=None)
+    theimage = fits.open(image_file_path)[image_structure['sci']].data.astype(float)
 
-#                ref_unmasked = reference_image_unmasked[ymin:ymax, xmin:xmax]
+    stamps_directory = os.path.join(stamp_worker_data['data_image_directory'], new_image)
+    image_warp = load_warp_transform(os.path.join(stamps_directory, 'warp_matrice_image.npy'))
 
-                #ref,ref_unmasked,ref_mask,bkg_ref,noise = reference_images[stamp_row]
-                ref,ref_unmasked,ref_mask,bkg_ref,noise =  mask_the_reference(reference_image[ymin:ymax, xmin:xmax],master_mask[ymin:ymax, xmin:xmax],kernel_size,max_adu)
+    stamp_worker_data['data_image'] = [new_image, theimage, image_warp]
 
-                img = resample_image[ymin:ymax, xmin:xmax]
+    return theimage, image_warp
 
 
-#                ref_extended = np.zeros((ref.shape[0]+2*kernel_size,ref.shape[1]+2*kernel_size))
-#                ref_extended[kernel_size:-kernel_size, kernel_size:-kernel_size] = ref
+def stamp_coordinate_map(image_warp, stamp_warp, stamp_slice):
+    """Function to compose the inverse maps of the image and stamp resampling,
+    giving the data image coordinates of each pixel of a resampled stamp.
+    This replaces resampling the full data image followed by resampling
+    the stamp a second time.
 
-#                ref_unmasked_extended = np.zeros((ref.shape[0] + 2 * kernel_size, ref.shape[1] + 2 * kernel_size))
-#                ref_unmasked_extended [kernel_size:-kernel_size, kernel_size:-kernel_size] = ref_unmasked
+    Inputs:
+        :param object image_warp: Inverse map of the image resampling
+        :param object stamp_warp: Inverse map of the stamp resampling
+        :param list stamp_slice: [ymin, ymax, xmin, xmax] of the stamp
 
-#                bal_mask_extended = np.ones((np.shape(ref)[0] + 2 * kernel_size, np.shape(ref)[1] + 2 * kernel_size)).astype(bool)
+    Output:
+        :param array coordinate_map: [rows, columns] in the data image
+    """
 
+    (ymin, ymax, xmin, xmax) = stamp_slice
+    (rows, cols) = np.mgrid[0:ymax-ymin, 0:xmax-xmin]
 
-#                bal_mask_extended[kernel_size:-kernel_size, kernel_size:-kernel_size] = \
-#                    master_mask[ymin:ymax, xmin:xmax]
-#                #img = data_image[ymin:ymax, xmin:xmax]
-#                #img = fits.open(os.path.join(stamps_directory, 'resample__stamp_' + str(stamp) + '.fits'))[0].data
-#                #img_unmasked = np.copy(img)
+    coords = np.column_stack([cols.ravel(), rows.ravel()]).astype(float)
+    coords = stamp_warp(coords) + np.array([xmin, ymin])
+    coords = image_warp(coords)
 
-#                #img, img_unmasked = open_data_image(setup,stamps_directory, 'resample_stamp_'+str(stamp)+'.fits',
-#                #                                              bal_mask_extended, kernel_size, max_adu,
-#                #                                              xshift=x_shift, yshift=y_shift, sigma_smooth=smoothing,
-#                #                                              central_crop=maxshift)
+    return np.array([coords[:,1].reshape(rows.shape), coords[:,0].reshape(rows.shape)])
 
 
+def resample_stamp(image, coordinate_map):
+    """Function to resample a stamp from the data image with a single
+    bilinear interpolation, filling pixels mapped outside the image with 0
 
-                warp_matrix2 =  np.load(os.path.join(stamps_directory, 'warp_matrice_stamp_'+str(stamp)+'.npy'))
-                warp_matrix2 = np.round(warp_matrix2,10)
-                if warp_matrix2.shape != (3,3):
-                    warp_matrix2 = tf.PolynomialTransform(warp_matrix2)
+    Inputs:
+        :param array image: Data image
+        :param array coordinate_map: Output of stamp_coordinate_map
 
-                img = stage4.warp_image(img,warp_matrix2)
+    Output:
+        :param array stamp_image: Resampled stamp
+    """
 
-                #tot_warp = np.dot(warp_matrix2,warp_matrix)
-                #resample_image = stage4.warp_image(data_image,tot_warp)
-                #img_new = resample_image[ymin:ymax, xmin:xmax]
-                umatrix = umatrix_grid[stamp_row]
-                kernels = []
-                for i in range(5):
-                    data_image, data_image_unmasked,bkg_image = mask_the_image(np.random.poisson(np.abs(img))*np.sign(img),max_adu,ref_mask,kernel_size)
+    return sn.map_coordinates(image, coordinate_map, order=1, mode='constant', cval=0.0)
 
 
+def stamp_kernel_solution_pool(work_unit):
+    """Function to compute the kernel solution and difference image for a
+    single stamp of a single image, writing the kernel and difference image
+    products to disk.
 
+    Inputs:
+        :param list work_unit: [image, stamp, stamp_row, stamp_slice, umatrix_index]
 
-                    b_vector = bvector_constant(ref,data_image, kernel_size, noise)
+    Output:
+        :param list result: [status, message, metrics] where metrics lists the
+                            pscale, pscale_err, median_sky, variance_per_pixel,
+                            ngood, kurtosis and skew of the stamp
+    """
 
-                    kernel_matrix, bkg_kernel, kernel_uncertainty = kernel_solution(umatrix, b_vector, kernel_size,circular=False)
+    (new_image, stamp, stamp_row, stamp_slice, umatrix_index) = work_unit
+    (ymin, ymax, xmin, xmax) = stamp_slice
 
+    try:
+        reference_image = stamp_worker_data['reference_image']
+        master_mask = stamp_worker_data['master_mask']
+        max_adu = stamp_worker_data['max_adu']
+        engine = stamp_worker_data['engine']
+        uncertainty_mode = stamp_worker_data['uncertainty_mode']
+        kernel_size = stamp_worker_data['kernel_size_array'][umatrix_index]
+        umatrix = stamp_worker_data['umatrices_grid'][umatrix_index][stamp_row]
+        u_factor = stamp_worker_data['factors_grid'][umatrix_index][stamp_row]
+        kernel_directory = os.path.join(stamp_worker_data['kernel_directory_path'], new_image)
+        diffim_directory = os.path.join(stamp_worker_data['diffim_directory_path'], new_image)
+        stamps_directory = os.path.join(stamp_worker_data['data_image_directory'], new_image)
 
-                    kernels.append(kernel_matrix)
+        (theimage, image_warp) = load_data_image(new_image)
 
+        ref,ref_unmasked,ref_mask,bkg_ref,noise =  mask_the_reference(reference_image[ymin:ymax, xmin:xmax],master_mask[ymin:ymax, xmin:xmax],kernel_size,max_adu)
 
-                data_image, data_image_unmasked,bkg_image = mask_the_image(img,max_adu,ref_mask,kernel_size)
+        stamp_warp = load_warp_transform(os.path.join(stamps_directory, 'warp_matrice_stamp_'+str(stamp)+'.npy'))
 
-                b_vector = bvector_constant(ref,data_image, kernel_size, noise)
+        img = resample_stamp(theimage, stamp_coordinate_map(image_warp, stamp_warp, stamp_slice))
 
-                kernel_matrix, bkg_kernel, kernel_uncertainty = kernel_solution(umatrix, b_vector, kernel_size,circular=False)
+        data_image, data_image_unmasked,bkg_image = mask_the_image(img,max_adu,ref_mask,kernel_size)
 
-                kernel_uncertainty = np.std(kernels,axis=0)
+        b_vector = bvector_constant(ref,data_image, kernel_size, noise, engine=engine)
 
+        kernel_matrix, bkg_kernel, kernel_uncertainty = kernel_solution(umatrix, b_vector, kernel_size,circular=False,
+                                                                        u_factor=u_factor)
 
+        if uncertainty_mode == 'bootstrap':
+            kernels = []
+            for i in range(5):
+                data_image_resampled, data_image_resampled_unmasked, bkg_image_resampled = mask_the_image(np.random.poisson(np.abs(img))*np.sign(img),max_adu,ref_mask,kernel_size)
 
-                pscale = np.sum(kernel_matrix)
-                pscale_err = np.sum(kernel_uncertainty ** 2) ** 0.5
-                np.save(os.path.join(kernel_directory, 'kernel_stamp_' + str(stamp) + '.npy'), [kernel_matrix, bkg_kernel])
-                kernel_header = fits.Header()
-                kernel_header['SCALEFAC'] = str(pscale)
-                kernel_header['KERBKG'] = bkg_kernel
-                hdu_kernel = fits.PrimaryHDU(kernel_matrix, header=kernel_header)
-                hdu_kernel.writeto(os.path.join(kernel_directory, 'kernel_stamp_' + str(stamp) + '.fits'), overwrite=True)
-                hdu_kernel_err = fits.PrimaryHDU(kernel_uncertainty)
-                hdu_kernel_err.writeto(os.path.join(kernel_directory, 'kernel_err_stamp_' + str(stamp) + '.fits'), overwrite=True)
-                # Particle data group formatting
-                pscale_formatted = round_unc(pscale, pscale_err)
+                b_vector = bvector_constant(ref,data_image_resampled, kernel_size, noise, engine=engine)
 
-                difference_image = subtract_images(data_image_unmasked, ref_unmasked, kernel_matrix,
-                                               kernel_size, bkg_kernel)
+                kernel_matrix_resampled, bkg_kernel_resampled, kernel_uncertainty_resampled = kernel_solution(umatrix, b_vector, kernel_size,circular=False,
+                                                                                                              u_factor=u_factor)
 
-                # unmasked subtraction (for quality stats)
-                mean_sky, median_sky, std_sky = sigma_clipped_stats(ref_unmasked, sigma=5.0)
-                difference_image_um = subtract_images(data_image, ref, kernel_matrix, kernel_size, bkg_kernel)
-                mask = ref != 0
-                ngood = len(difference_image_um[mask])
-                kurtosis_quality = kurtosis(difference_image_um[mask])
-                skew_quality = skew(difference_image_um[mask])
-                variance_per_pixel = np.var(difference_image_um[mask]) / float(ngood)
-
-
-
-                new_header = fits.Header()
-                new_header['SCALEFAC'] = pscale
-                new_header['SCALEERR'] = pscale_err
-                new_header['VARPP'] = variance_per_pixel
-                new_header['NGOOD'] = ngood
-                new_header['SKY'] = median_sky
-                new_header['KURTOSIS'] = kurtosis_quality
-                new_header['SKEW'] = skew_quality
-                difference_image_hdu = fits.PrimaryHDU(difference_image, header=new_header)
-                try:
-                    os.mkdir(diffim_directory)
-                except:
-                    pass
-                difference_image_hdu.writeto(os.path.join(diffim_directory, 'diff_stamp_' + str(stamp) + '.fits'), overwrite=True)
-
-                bkg_image_hdu = fits.PrimaryHDU(bkg_image)
-                bkg_image_hdu.writeto(os.path.join(diffim_directory, 'diff_back_stamp_' + str(stamp) + '.fits'), overwrite=True)
-
-
-                pscales.append(pscale)
-                pscales_err.append(pscale_err)
-                medians_sky.append(median_sky)
-                variances_per_pixel.append(variance_per_pixel)
-                ngoods.append(ngood)
-                kurtosises_quality.append(kurtosis_quality)
-                skewes_quality.append(skew_quality)
+                kernels.append(kernel_matrix_resampled)
 
-            if log is not None:
-                logs.ifverbose(log, setup,
-                               'b_vector calculated for:' + new_image + ' and scale factor ' + str(np.median(pscales))
-                               + ' +/- '+str(np.median(pscales_err)) +' variance per pixel ' + str(
-                                   np.round(np.median(variances_per_pixel), 4)) + ' in kernel bin ' + str(umatrix_index))
-            quality_metrics.append(
-                [new_image, np.median(pscales), np.median(pscales_err), np.median(medians_sky),
-                 np.median(variances_per_pixel), np.median(ngoods), np.median(kurtosises_quality),
-                 np.median(skewes_quality)])
+            kernel_uncertainty = np.std(kernels,axis=0)
 
+        elif uncertainty_mode == 'analytic':
+            fitted_pixels = ~ref_mask[kernel_size:-kernel_size, kernel_size:-kernel_size]
+            pixel_variance = np.mean(np.abs(img)[fitted_pixels])
+            kernel_uncertainty = kernel_uncertainty_analytic(umatrix, pixel_variance, kernel_size,
+                                                             u_factor=u_factor)
 
-        except Exception as e:
-            #import pdb; pdb.set_trace()
-            quality_metrics.append([new_image, -1.0, -1.0, -1.0, -1.0, 0, -1.0, -1.0])
+        else:
+            raise ValueError('Unknown kernel uncertainty method ' + str(uncertainty_mode) +
+                             ', expected one of ' + repr(KERNEL_UNCERTAINTY_MODES))
+
+        pscale = np.sum(kernel_matrix)
+        pscale_err = np.sum(kernel_uncertainty ** 2) ** 0.5
+        np.save(os.path.join(kernel_directory, 'kernel_stamp_' + str(stamp) + '.npy'),
+                np.array([kernel_matrix, bkg_kernel], dtype=object))
+        kernel_header = fits.Header()
+        kernel_header['SCALEFAC'] = str(pscale)
+        kernel_header['KERBKG'] = bkg_kernel
+        hdu_kernel = fits.PrimaryHDU(kernel_matrix, header=kernel_header)
+        hdu_kernel.writeto(os.path.join(kernel_directory, 'kernel_stamp_' + str(stamp) + '.fits'), overwrite=True)
+        hdu_kernel_err = fits.PrimaryHDU(kernel_uncertainty)
+        hdu_kernel_err.writeto(os.path.join(kernel_directory, 'kernel_err_stamp_' + str(stamp) + '.fits'), overwrite=True)
+
+        difference_image = subtract_images(data_image_unmasked, ref_unmasked, kernel_matrix,
+                                       kernel_size, bkg_kernel)
+
+        # unmasked subtraction (for quality stats)
+        mean_sky, median_sky, std_sky = sigma_clipped_stats(ref_unmasked, sigma=5.0)
+        difference_image_um = subtract_images(data_image, ref, kernel_matrix, kernel_size, bkg_kernel)
+        mask = ref != 0
+        ngood = len(difference_image_um[mask])
+        kurtosis_quality = kurtosis(difference_image_um[mask])
+        skew_quality = skew(difference_image_um[mask])
+        variance_per_pixel = np.var(difference_image_um[mask]) / float(ngood)
+
+        new_header = fits.Header()
+        new_header['SCALEFAC'] = pscale
+        new_header['SCALEERR'] = pscale_err
+        new_header['VARPP'] = variance_per_pixel
+        new_header['NGOOD'] = ngood
+        new_header['SKY'] = median_sky
+        new_header['KURTOSIS'] = kurtosis_quality
+        new_header['SKEW'] = skew_quality
+        difference_image_hdu = fits.PrimaryHDU(difference_image, header=new_header)
+        try:
+            os.mkdir(diffim_directory)
+        except:
+            pass
+        difference_image_hdu.writeto(os.path.join(diffim_directory, 'diff_stamp_' + str(stamp) + '.fits'), overwrite=True)
 
-            if log is not None:
-                logs.ifverbose(log, setup,
-                               'kernel matrix computation or shift failed:' + new_image + '. skipping! ' + str(e))
-            #else:
-                #print(str(e))
+        bkg_image_hdu = fits.PrimaryHDU(bkg_image)
+        bkg_image_hdu.writeto(os.path.join(diffim_directory, 'diff_back_stamp_' + str(stamp) + '.fits'), overwrite=True)
 
-        log.info(' -> ' + repr(quality_metrics[-1]))
+        metrics = [pscale, pscale_err, median_sky, variance_per_pixel, ngood, kurtosis_quality, skew_quality]
 
-    return quality_metrics
+        return ['OK', 'Completed successfully', metrics]
+
+    except Exception as e:
+
+        return ['KO', str(e), None]
 
 
 def open_reference_stamps(setup, reduction_metadata, reference_image_directory, reference_image_name, kernel_size,
@@ -993,7 +1126,7 @@ def subtract_large_format_image(new_images, reference_image_name, reference_imag
         kernel_stamps = []
         pool_stamps = []
         data_image1 = fits.open(os.path.join(data_image_directory, new_image), mmap=True)
-        row_index = np.where(reduction_metadata.images_stats[1]['IM_NAME'] == new_image)[0][0]
+        row_index = reduction_metadata.find_row('images_stats', new_image)
         x_shift, y_shift = -reduction_metadata.images_stats[1][row_index]['SHIFT_X'], - \
         reduction_metadata.images_stats[1][row_index]['SHIFT_Y']
         for substamp_idx in range(len(reduction_metadata.stamps[1])):
@@ -1080,8 +1213,40 @@ def mask_kernel(kernel_size_plus):
     return mask_kernel
 
 
+def load_umatrix_routines(engine='cython'):
+    '''
+    Returns the functions used to construct the u matrix and b vector.
+    The 'cython' engine uses the compiled umatrix_routine module, which
+    loops over every pixel for every pair of kernel pixels. The 'numpy'
+    and 'fft' engines of umatrix_numpy compute the same sums as products
+    and correlations of the shifted reference images respectively.
+
+    :param string engine: one of UMATRIX_ENGINES
+
+    :return: dictionary of construction functions
+    '''
+    routine_names = ['umatrix_construction', 'umatrix_bvector_construction', 'bvector_construction',
+                     'umatrix_construction_nobkg', 'bvector_construction_nobkg']
+
+    if engine == 'cython':
+        try:
+            import umatrix_routine
+        except ImportError:
+            raise ImportError('cannot import cython module umatrix_routine')
+        routines = {name: getattr(umatrix_routine, name) for name in routine_names}
+
+    elif engine in UMATRIX_ENGINES:
+        routines = {name: functools.partial(getattr(umatrix_numpy, name), method=engine)
+                    for name in routine_names}
+
+    else:
+        raise ValueError('Unknown u-matrix engine ' + str(engine) + ', expected one of ' + repr(UMATRIX_ENGINES))
+
+    return routines
+
+
 def umatrix_constant(reference_image, ker_size, noise_image, model_image=None, sigma_max=None, bright_mask=None,
-                     nobkg=None):
+                     nobkg=None, engine='cython'):
     '''
     The kernel solution is supposed to implement the approach outlined in
     the Bramich 2008 paper. It generates the u matrix which is required
@@ -1093,16 +1258,11 @@ def umatrix_constant(reference_image, ker_size, noise_image, model_image=None, s
 
     :param object image: reference image
     :param integer kernel size: edge length of the kernel in px
+    :param string engine: u-matrix construction engine, one of UMATRIX_ENGINES
 
     :return: u matrix
     '''
-    try:
-        from umatrix_routine import umatrix_construction, umatrix_bvector_construction, bvector_construction
-        from umatrix_routine import umatrix_construction_nobkg, bvector_construction_nobkg
-
-    except ImportError:
-        raise ImportError('cannot import cython module umatrix_routine')
-        return []
+    routines = load_umatrix_routines(engine)
 
     if ker_size:
         if ker_size % 2 == 0:
@@ -1121,9 +1281,9 @@ def umatrix_constant(reference_image, ker_size, noise_image, model_image=None, s
             pandq.append((lidx - half_kernel_size, midx - half_kernel_size))
 
     if nobkg == True:
-        u_matrix = umatrix_construction_nobkg(reference_image, weights, pandq, n_kernel, kernel_size)
+        u_matrix = routines['umatrix_construction_nobkg'](reference_image, weights, pandq, n_kernel, kernel_size)
     else:
-        u_matrix = umatrix_construction(reference_image, weights, pandq, n_kernel, kernel_size)
+        u_matrix = routines['umatrix_construction'](reference_image, weights, pandq, n_kernel, kernel_size)
     return u_matrix
 
 
@@ -1256,7 +1416,7 @@ def umatrix_pool(input_arg):
 
 
 def bvector_constant(reference_image, data_image, ker_size, noise_image, model_image=None, sigma_max=None,
-                     bright_mask=None, nobkg=None):
+                     bright_mask=None, nobkg=None, engine='cython'):
     '''
     The kernel solution is supposed to implement the approach outlined in
     the Bramich 2008 paper. It generates the b_vector which is required
@@ -1267,16 +1427,11 @@ def bvector_constant(reference_image, data_image, ker_size, noise_image, model_i
 
     :param object image: reference image
     :param integer kernel size: edge length of the kernel in px
+    :param string engine: b-vector construction engine, one of UMATRIX_ENGINES
 
     :return: b_vector
     '''
-    try:
-        from umatrix_routine import umatrix_construction, umatrix_bvector_construction, bvector_construction
-        from umatrix_routine import umatrix_construction_nobkg, bvector_construction_nobkg
-
-    except ImportError:
-        raise ImportError('cannot import cython module umatrix_routine')
-        return []
+    routines = load_umatrix_routines(engine)
 
     if ker_size:
         if ker_size % 2 == 0:
@@ -1295,9 +1450,11 @@ def bvector_constant(reference_image, data_image, ker_size, noise_image, model_i
             pandq.append((lidx - half_kernel_size, midx - half_kernel_size))
 
     if nobkg == True:
-        b_vector = bvector_construction_nobkg(reference_image, data_image, weights, pandq, n_kernel, kernel_size)
+        b_vector = routines['bvector_construction_nobkg'](reference_image, data_image, weights, pandq, n_kernel,
+                                                          kernel_size)
     else:
-        b_vector = bvector_construction(reference_image, data_image, weights, pandq, n_kernel, kernel_size)
+        b_vector = routines['bvector_construction'](reference_image, data_image, weights, pandq, n_kernel,
+                                                    kernel_size)
 
     return b_vector
 
@@ -1419,30 +1576,123 @@ def kernel_preparation_matrix(data_image, reference_image, ker_size, model_image
     return u_matrix, b_vector
 
 
-def kernel_solution(u_matrix, b_vector, kernel_size, circular=True):
+def factorise_umatrix(u_matrix):
+    '''
+    Cholesky factorisation of a u matrix, which only depends on the
+    reference stamp and kernel size and so can be reused for the
+    kernel solution of every image. The diagonal of the inverse u matrix
+    is kept for the kernel uncertainties.
+
+    :param object array: u_matrix
+    :return: [lower triangular factor, diagonal of the inverse u matrix],
+             or None if the u matrix is not positive definite
+    '''
+    try:
+        factor = cho_factor(np.array(u_matrix), lower=True)
+    except LinAlgError:
+        return None
+
+    inverse_diagonal = np.diag(cho_solve(factor, np.identity(len(u_matrix))))
+
+    return [factor[0], inverse_diagonal]
+
+
+def load_umatrix_grid(reference_image, master_mask, stamps, kernel_size_array, max_adu,
+                      kernel_directory_path, log, engine='cython'):
+    '''
+    Fetch the unweighted u matrices and their cholesky factorisations, one
+    per kernel size and stamp, from the u-matrix store in the kernel
+    directory. Only the entries whose reference and mask pixels, kernel
+    size or saturation level changed since the last run are recomputed.
+
+    :param object reference_image: reference image data
+    :param object master_mask: master mask of the reference image
+    :param object stamps: stamps table of the reduction metadata
+    :param list kernel_size_array: kernel sizes
+    :param float max_adu: saturation level
+    :param string kernel_directory_path: path to the kernel directory
+    :param logger log: open reduction log
+    :param string engine: u-matrix construction engine
+    :return: u matrices and factorisations per kernel size and stamp
+    '''
+    store = umatrix_store.UMatrixStore(os.path.join(kernel_directory_path, 'umatrix_store'), log=log)
+
+    umatrices_grid = []
+    factors_grid = []
+    for kernel_size in kernel_size_array:
+        umatrices = []
+        factors = []
+
+        for stamp_row in range(len(stamps)):
+            xmin = int(stamps[stamp_row]['X_MIN'])
+            xmax = int(stamps[stamp_row]['X_MAX'])
+            ymin = int(stamps[stamp_row]['Y_MIN'])
+            ymax = int(stamps[stamp_row]['Y_MAX'])
+
+            key, description = store.entry_key(reference_image[ymin:ymax, xmin:xmax],
+                                               master_mask[ymin:ymax, xmin:xmax], kernel_size, max_adu)
+
+            if store.has_entry(key):
+                umatrix, u_factor = store.fetch(key)
+            else:
+                ref, ref_unmasked, ref_mask, bkg_ref, noise = mask_the_reference(reference_image[ymin:ymax, xmin:xmax],
+                                                                                 master_mask[ymin:ymax, xmin:xmax],
+                                                                                 kernel_size, max_adu)
+                umatrix = umatrix_constant(ref, kernel_size, noise, engine=engine)
+                u_factor = factorise_umatrix(umatrix)
+                store.add_entry(key, description, umatrix, u_factor)
+
+                log.info(' -> Computed u-matrix for kernel size ' + str(kernel_size) + ' on stamp '
+                         + str(stamps[stamp_row]['PIXEL_INDEX']))
+
+            umatrices.append(umatrix)
+            factors.append(u_factor)
+
+        umatrices_grid.append(umatrices)
+        factors_grid.append(factors)
+
+    n_pruned = store.prune()
+    store.save_index()
+    umatrix_store.remove_legacy_files(kernel_directory_path, log=log)
+    log.info('Computed ' + str(store.n_added) + ' u-matrices, reused '
+             + str(len(store.entries) - store.n_added) + ' stored u-matrices, removed '
+             + str(n_pruned) + ' out of date entries')
+
+    return umatrices_grid, factors_grid
+
+
+def kernel_solution(u_matrix, b_vector, kernel_size, circular=True, u_factor=None):
     '''
     reshape kernel solution for convolution and obtain uncertainty
-    from lstsq solution
+    from lstsq solution. If a factorisation of the u_matrix from
+    factorise_umatrix is given, the solution only requires the triangular
+    solves and the uncertainty is that of unit variance data pixels.
 
     :param object array: u_matrix
      :param object array: b_vector
+    :param list u_factor: optional cholesky factor and inverse diagonal of u_matrix
     :return: kernel matrix
     '''
-    # For better stability: solve the least square problem via np.linalg.lstsq
-    # inv_umatrix = np.linalg.inv(u_matrix)
-    # a_vector = np.dot(inv_umatrix, b_vector)
-    # recalculate residuals to apply standard lstsq uncertainties
-    lstsq_result = np.linalg.lstsq(np.array(u_matrix), np.array(b_vector), rcond=None)
-    a_vector = lstsq_result[0]
-    lstsq_fit = np.dot(np.array(u_matrix), a_vector)
-    resid = np.array(b_vector) - lstsq_fit
-    reduced_chisqr = np.sum(resid ** 2) / (float(kernel_size * kernel_size))
-    lstsq_cov = np.dot(np.array(u_matrix).T, np.array(u_matrix)) * reduced_chisqr
-    resivar = np.var(resid, ddof=0) * float(len(a_vector))
-    # use pinv in order to stabilize calculation
-    a_var = np.diag(np.linalg.pinv(lstsq_cov) * resivar)
-
-    a_vector_err = np.sqrt(a_var)
+    if u_factor is not None:
+        a_vector = cho_solve((u_factor[0], True), np.array(b_vector))
+        a_vector_err = np.sqrt(np.abs(u_factor[1]))
+
+    else:
+        # For better stability: solve the least square problem via np.linalg.lstsq
+        # inv_umatrix = np.linalg.inv(u_matrix)
+        # a_vector = np.dot(inv_umatrix, b_vector)
+        # recalculate residuals to apply standard lstsq uncertainties
+        lstsq_result = np.linalg.lstsq(np.array(u_matrix), np.array(b_vector), rcond=None)
+        a_vector = lstsq_result[0]
+        lstsq_fit = np.dot(np.array(u_matrix), a_vector)
+        resid = np.array(b_vector) - lstsq_fit
+        reduced_chisqr = np.sum(resid ** 2) / (float(kernel_size * kernel_size))
+        lstsq_cov = np.dot(np.array(u_matrix).T, np.array(u_matrix)) * reduced_chisqr
+        resivar = np.var(resid, ddof=0) * float(len(a_vector))
+        # use pinv in order to stabilize calculation
+        a_var = np.diag(np.linalg.pinv(lstsq_cov) * resivar)
+
+        a_vector_err = np.sqrt(a_var)
     output_kernel = np.zeros(kernel_size * kernel_size, dtype=float)
     if len(a_vector) > kernel_size * kernel_size:
         output_kernel = a_vector[:-1]
@@ -1473,6 +1723,33 @@ def kernel_solution(u_matrix, b_vector, kernel_size, circular=True):
     return output_kernel_2, a_vector[-1], err_kernel_2
 
 
+def kernel_uncertainty_analytic(u_matrix, pixel_variance, kernel_size, u_factor=None):
+    '''
+    Obtain the kernel uncertainty from the covariance of the least squares
+    solution. The u matrix is built with unit weights, so for data pixels of
+    variance pixel_variance the covariance of the solution is
+    pixel_variance * U^-1. This replaces the spread of the kernels solved
+    for Poisson resamplings of the data.
+
+    :param object array: u_matrix
+    :param float pixel_variance: mean variance of the fitted data pixels
+    :param int kernel_size: edge length of the kernel in px
+    :param list u_factor: optional cholesky factor and inverse diagonal of u_matrix
+    :return: kernel uncertainty matrix
+    '''
+    if u_factor is not None:
+        a_var = u_factor[1] * pixel_variance
+    else:
+        # use pinv in order to stabilize calculation, as in kernel_solution
+        a_var = np.diag(np.linalg.pinv(np.array(u_matrix))) * pixel_variance
+    a_vector_err = np.sqrt(np.abs(a_var))
+
+    err_kernel = a_vector_err[:kernel_size * kernel_size].reshape((kernel_size, kernel_size))
+    err_kernel_2 = np.flip(np.flip(err_kernel, 0), 1)
+
+    return err_kernel_2
+
+
 def kernel_solution_pool(input_pars):
     umatrix_stamp = input_pars[0]
     reference_stamp = input_pars[1]
@@ -119,15 +119,7 @@ def run_stage6(setup, **kwargs):
                              control_stars['x'].data,
                              control_stars['y'].data]
 
-    for index, key in enumerate(starlist.columns.keys()):
-
-        if index != 0:
-
-            ref_star_catalog = np.c_[ref_star_catalog, starlist[key].data]
-
-        else:
-
-            ref_star_catalog = starlist[key].data
+    ref_star_catalog = build_ref_star_catalog(starlist)
     log.info('Established ref_star_catalog array')
 
     psf_model = fits.open(reduction_metadata.data_architecture[1]['REF_PATH'].data[0] + '/psf_model.fits')
@@ -166,7 +158,7 @@ def run_stage6(setup, **kwargs):
             reference_image, date = open_an_image(setup, reference_image_directory, reference_image_name, log, image_index=ref_structure['sci'])
 
             ref_image_name = reduction_metadata.data_architecture[1]['REF_IMAGE'].data[0]
-            index_reference = np.where(ref_image_name == reduction_metadata.headers_summary[1]['IMAGES'].data)[0][0]
+            index_reference = reduction_metadata.find_row('headers_summary', ref_image_name)
             ref_exposure_time = float(reduction_metadata.headers_summary[1]['EXPKEY'].data[index_reference])
 
             reference_header = reduction_metadata.headers_summary[1][index_reference]
@@ -207,9 +199,20 @@ def run_stage6(setup, **kwargs):
         n_images = len(new_images)
         list_of_stamps = reduction_metadata.stamps[1]['PIXEL_INDEX'].tolist()
 
+        stamp_star_catalogs = build_stamp_star_catalogs(ref_star_catalog, reduction_metadata.stamps[1])
+        log.info('Assigned stars to '+str(len(stamp_star_catalogs))+' stamps')
+
+        if kwargs['build_phot_db']:
+            key_cache = db_phot.PrimaryKeyCache(conn)
+            key_cache.preload('image', new_images)
+            key_cache.preload('stamp', list_of_stamps)
+            log.info('Loaded photometry DB pk indices of '+str(len(key_cache.keys['image']))+' images')
+        else:
+            key_cache = None
+
         for idx, new_image in enumerate(new_images[:]):
             log.info('Extracting parameters of image ' + new_image + ' for photometry ('+str(idx)+' of '+str(n_images)+')')
-            index_image = np.where(new_image == reduction_metadata.headers_summary[1]['IMAGES'].data)[0][0]
+            index_image = reduction_metadata.find_row('headers_summary', new_image)
             image_header = reduction_metadata.headers_summary[1][index_image]
 
             ddate = reduction_metadata.headers_summary[1]['DATEKEY'][index_image]
@@ -236,24 +239,16 @@ def run_stage6(setup, **kwargs):
 
             log.info('Starting difference photometry of ' + new_image)
 
+            # The sky model depends only on the image, so it is fitted once,
+            # for the first stamp with a kernel, and reused for all stamps
+            sky_model = None
+
 
             for stamp in list_of_stamps:
 
                 image_params['stamp'] = str(stamp)
 
-                stamp_row = np.where(reduction_metadata.stamps[1]['PIXEL_INDEX'] == stamp)[0][0]
-                xmin = int(reduction_metadata.stamps[1][stamp_row]['X_MIN'])
-                xmax = int(reduction_metadata.stamps[1][stamp_row]['X_MAX'])
-                ymin = int(reduction_metadata.stamps[1][stamp_row]['Y_MIN'])
-                ymax = int(reduction_metadata.stamps[1][stamp_row]['Y_MAX'])
-
-                stamp_mask = (ref_star_catalog[:,1].astype(float) < xmax) & (ref_star_catalog[:,1].astype(float) > xmin) & \
-                             (ref_star_catalog[:,2].astype(float) < ymax) & (ref_star_catalog[:,2].astype(float) > ymin)
-
-
-                stamp_star_catalog = np.copy(ref_star_catalog[stamp_mask])
-                stamp_star_catalog[:,1] =  (stamp_star_catalog[:,1].astype(float)-xmin).astype(str)
-                stamp_star_catalog[:,2] =  (stamp_star_catalog[:,2].astype(float)-ymin).astype(str)
+                stamp_star_catalog = stamp_star_catalogs[stamp]
 
 
                 kernel_image, kernel_error, kernel_bkg = find_the_associated_kernel_stamp(setup, kernels_directory, new_image,stamp, log)
@@ -262,13 +257,14 @@ def run_stage6(setup, **kwargs):
                     log.info('No kernel image available, so no photometry performed.')
 
                 else:
-                    sky_model = sky_background.model_sky_background(setup,
-                                                                    reduction_metadata,
-                                                                    log, ref_star_catalog,
-                                                                    image_path=os.path.join(setup.red_dir,'data',new_image),
-                                                                    bandpass=image_params['filter_name'],
-                                                                    diagnostics=False)
-                    log.info('Built sky model')
+                    if sky_model is None:
+                        sky_model = sky_background.model_sky_background(setup,
+                                                                        reduction_metadata,
+                                                                        log, ref_star_catalog,
+                                                                        image_path=os.path.join(setup.red_dir,'data',new_image),
+                                                                        bandpass=image_params['filter_name'],
+                                                                        diagnostics=False)
+                        log.info('Built sky model')
                     stamp_directory = os.path.join(diffim_directory,new_image)
                     difference_image = open_an_image(setup, stamp_directory,'diff_stamp_'+str(stamp)+'.fits' , log, 0)[0]
                     background_difference_image = open_an_image(setup, stamp_directory,'diff_back_stamp_'+str(stamp)+'.fits' , log, 0)[0]
@@ -285,7 +281,8 @@ def run_stage6(setup, **kwargs):
                         photometry_data = store_stamp_photometry_to_array(setup, conn, image_params, reduction_metadata,
                                                             photometry_data,
                                                             phot_table, matched_stars,
-                                                            new_image, log, kwargs)
+                                                            new_image, log, kwargs,
+                                                            key_cache=key_cache)
 
                     else:
                         log.info('No difference image available, so no photometry performed.')
@@ -316,7 +313,9 @@ def run_stage6(setup, **kwargs):
             reduction_metadata.data_architecture[1]['METADATA_NAME'][0],
             log=log)
 
-    hd5_utils.write_phot_hd5(setup,photometry_data,log=log)
+    # Only the photometry of the new images is written to the existing file
+    hd5_utils.update_phot_hd5(setup, photometry_data, exposures_id, log=log,
+                              compression=kwargs['phot_compression'])
 
     phot_statistics = plot_rms.calc_mean_rms_mag(photometry_data,log,'calibrated')
     plot_rms.plot_rms(phot_statistics, {'red_dir': setup.red_dir}, log)
@@ -330,9 +329,69 @@ def run_stage6(setup, **kwargs):
 
     return status, report
 
+# Typed columns of the reference star catalog used for the difference image
+# photometry, taken from columns 0, 1, 2, 5 and 6 of the star_catalog layer
+REF_STAR_CATALOG_DTYPE = [('star_id', 'int64'),
+                          ('x', 'float64'), ('y', 'float64'),
+                          ('ref_flux', 'float64'), ('ref_flux_err', 'float64')]
+
+def build_ref_star_catalog(starlist):
+    """Function to extract the reference star catalog used for the difference
+    image photometry from the star_catalog table of the metadata, as a
+    structured array so that no further type conversion is needed
+
+    :param Table starlist: star_catalog table from the reduction metadata
+
+    Returns:
+
+    :param structured array ref_star_catalog: catalog with fields REF_STAR_CATALOG_DTYPE
+    """
+
+    ref_star_catalog = np.zeros(len(starlist), dtype=REF_STAR_CATALOG_DTYPE)
+
+    for (field, dtype), column in zip(REF_STAR_CATALOG_DTYPE, [0, 1, 2, 5, 6]):
+        ref_star_catalog[field] = np.array(starlist.columns[column].data).astype(float)
+
+    return ref_star_catalog
+
+def build_stamp_star_catalogs(ref_star_catalog, stamps):
+    """Function to index the stars of the reference star catalog falling
+    within each stamp.  The catalogs of each stamp have their star
+    coordinates relative to the stamp origin, and are the same for every
+    image of the dataset.
+
+    :param structured array ref_star_catalog: output of build_ref_star_catalog
+    :param Table stamps: stamps table from the reduction metadata
+
+    Returns:
+
+    :param dict stamp_star_catalogs: catalog of the stars of each stamp, keyed
+                                    by the stamp PIXEL_INDEX
+    """
+
+    stamp_star_catalogs = {}
+
+    for stamp_row in range(len(stamps)):
+        xmin = int(stamps[stamp_row]['X_MIN'])
+        xmax = int(stamps[stamp_row]['X_MAX'])
+        ymin = int(stamps[stamp_row]['Y_MIN'])
+        ymax = int(stamps[stamp_row]['Y_MAX'])
+
+        stamp_mask = (ref_star_catalog['x'] < xmax) & (ref_star_catalog['x'] > xmin) & \
+                     (ref_star_catalog['y'] < ymax) & (ref_star_catalog['y'] > ymin)
+
+        stamp_star_catalog = ref_star_catalog[stamp_mask]
+        stamp_star_catalog['x'] -= xmin
+        stamp_star_catalog['y'] -= ymin
+
+        stamp_star_catalogs[stamps[stamp_row]['PIXEL_INDEX']] = stamp_star_catalog
+
+    return stamp_star_catalogs
+
 def get_default_config(kwargs,log):
 
-    default_config = {'per_star_logging': False, 'build_phot_db': True}
+    default_config = {'per_star_logging': False, 'build_phot_db': True,
+                      'phot_compression': None}
 
     kwargs = config_utils.set_default_config(default_config, kwargs, log)
 
@@ -495,7 +554,7 @@ def image_substraction(setup, reduction_metadata, reference_image_data, kernel_d
     '''
 
     image_data, date = open_an_image(setup, './data/', image_name, log, image_index=0)
-    row_index = np.where(reduction_metadata.images_stats[1]['IM_NAME'] == image_name)[0][0]
+    row_index = reduction_metadata.find_row('images_stats', image_name)
 
     kernel_size = kernel_data.shape[0]
 
@@ -596,32 +655,13 @@ def photometry_on_the_difference_image(setup, reduction_metadata, log, star_cata
     :rtype: array_like
     '''
 
-    # PSF photometry function returns a list of lists
+    # PSF photometry function returns a structured array
     (differential_photometry, control_zone) = photometry.run_psf_photometry_on_difference_image(setup, reduction_metadata, log,
                                                                                 star_catalog, sky_model,
                                                                                 difference_image, psf_model, kernel,
                                                                                 kernel_error, background_difference_image,ref_exposure_time,image_id)
 
-    table_data = [ Column(name='star_id', data=differential_photometry[0]),
-                   Column(name='diff_flux', data=differential_photometry[1]),
-                   Column(name='diff_flux_err', data=differential_photometry[2]),
-                   Column(name='magnitude', data=differential_photometry[3]),
-                   Column(name='magnitude_err', data=differential_photometry[4]),
-                   Column(name='cal_magnitude', data=differential_photometry[5]),
-                   Column(name='cal_magnitude_err', data=differential_photometry[6]),
-                   Column(name='flux', data=differential_photometry[7]),
-                   Column(name='flux_err', data=differential_photometry[8]),
-                   Column(name='cal_flux', data=differential_photometry[9]),
-                   Column(name='cal_flux_err', data=differential_photometry[10]),
-                   Column(name='phot_scale_factor', data=differential_photometry[11]),
-                   Column(name='phot_scale_factor_err', data=differential_photometry[12]),
-                   Column(name='local_background', data=differential_photometry[13]),
-                   Column(name='local_background_err', data=differential_photometry[14]),
-                   Column(name='residual_x', data=differential_photometry[15]),
-                   Column(name='residual_y', data=differential_photometry[16]),
-                   Column(name='radius', data=differential_photometry[17]) ]
-
-    photometric_table = Table(data=table_data)
+    photometric_table = Table(differential_photometry)
 
     # return table
     return differential_photometry, control_zone, photometric_table
@@ -640,7 +680,7 @@ def photometry_on_the_difference_image_stamp(setup, reduction_metadata, log, sta
     :rtype: array_like
     '''
 
-    # PSF photometry function returns a list of lists
+    # PSF photometry function returns a structured array
     (differential_photometry, control_zone) = photometry.run_psf_photometry_on_difference_image(setup,
                                                                                                 reduction_metadata, log,
                                                                                                 star_catalog, sky_model,
@@ -651,26 +691,7 @@ def photometry_on_the_difference_image_stamp(setup, reduction_metadata, log, sta
                                                                                                 image_id,
                                                                                                 per_star_logging=per_star_logging)
 
-    table_data = [Column(name='star_id', data=differential_photometry[0]),
-                  Column(name='diff_flux', data=differential_photometry[1]),
-                  Column(name='diff_flux_err', data=differential_photometry[2]),
-                  Column(name='magnitude', data=differential_photometry[3]),
-                  Column(name='magnitude_err', data=differential_photometry[4]),
-                  Column(name='cal_magnitude', data=differential_photometry[5]),
-                  Column(name='cal_magnitude_err', data=differential_photometry[6]),
-                  Column(name='flux', data=differential_photometry[7]),
-                  Column(name='flux_err', data=differential_photometry[8]),
-                  Column(name='cal_flux', data=differential_photometry[9]),
-                  Column(name='cal_flux_err', data=differential_photometry[10]),
-                  Column(name='phot_scale_factor', data=differential_photometry[11]),
-                  Column(name='phot_scale_factor_err', data=differential_photometry[12]),
-                  Column(name='local_background', data=differential_photometry[13]),
-                  Column(name='local_background_err', data=differential_photometry[14]),
-                  Column(name='residual_x', data=differential_photometry[15]),
-                  Column(name='residual_y', data=differential_photometry[16]),
-                  Column(name='radius', data=differential_photometry[17])]
-
-    photometric_table = Table(data=table_data)
+    photometric_table = Table(differential_photometry)
 
     # return table
     return differential_photometry, control_zone, photometric_table
@@ -983,7 +1004,7 @@ def build_photometry_array(setup,nimages,nstars,log):
 
     if len(existing_phot) > 0 and existing_phot.shape[2] != ncolumns:
         message = 'Existing matched photometry array has '+\
-                        str(matched_existing_phot.shape[2])+\
+                        str(existing_phot.shape[2])+\
                         ' which is incompatible with the expected '+\
                         str(ncolumns)+' columns'
         log.info('ERROR: '+message)
@@ -994,61 +1015,58 @@ def build_photometry_array(setup,nimages,nstars,log):
 
     # If available, transfer the existing photometry into the data arrays
     if len(existing_phot) > 0:
-        for i in range(0,existing_phot.shape[1],1):
-            photometry_data[:,int(i),:] = existing_phot[:,int(i),:]
+        existing_phot.read_direct(photometry_data,
+                                  dest_sel=np.s_[:,0:existing_phot.shape[1],:])
+        existing_phot.file.close()
 
     log.info('Completed build of the photometry array for '+str(nimages)+' images and '+str(nstars)+' stars')
 
     return photometry_data
 
-def get_entry_db_indices(conn, kwargs, params, new_image, log):
+def get_entry_db_indices(conn, kwargs, params, new_image, log, key_cache=None):
+    """Function to look up the photometry DB primary keys of the facility,
+    filter, software, reference image, image and stamp of a set of photometry.
+
+    :param connection conn: Open photometry DB connection
+    :param dict kwargs: stage6 configuration
+    :param dict params: image parameters including the stamp index
+    :param str new_image: Image name
+    :param logging log: Open reduction log object
+    :param PrimaryKeyCache key_cache: cache of DB primary keys shared by the
+                                      images of the reduction, optional
+    """
 
     db_pk = {}
 
     if kwargs['build_phot_db']:
         log.info('Extracting the photometry DB pk indices for '+new_image)
 
-        query = 'SELECT facility_id, facility_code FROM facilities WHERE facility_code="' + params['facility_code'] + '"'
-        result = db_phot.query_to_astropy_table(conn, query, args=())
-        if len(result) > 0:
-            db_pk['facility'] = result['facility_id'][0]
-        else:
+        if key_cache is None:
+            key_cache = db_phot.PrimaryKeyCache(conn)
+
+        db_pk['facility'] = key_cache.get('facility', params['facility_code'])
+        if db_pk['facility'] is None:
             raise IOError('Facility '+params['facility_code']+' unknown to phot_db')
 
-        query = 'SELECT filter_id, filter_name FROM filters WHERE filter_name="' + params['filter_name'] + '"'
-        result = db_phot.query_to_astropy_table(conn, query, args=())
-        if len(result) > 0:
-            db_pk['filter'] = result['filter_id'][0]
-        else:
+        db_pk['filter'] = key_cache.get('filter', params['filter_name'])
+        if db_pk['filter'] is None:
             raise IOError('Filter '+params['filter_name']+' unknown to phot_db')
 
-        query = 'SELECT code_id, version FROM software WHERE version="' + params['version'] + '"'
-        result = db_phot.query_to_astropy_table(conn, query, args=())
-        if len(result) > 0:
-            db_pk['code'] = result['code_id'][0]
-        else:
+        db_pk['code'] = key_cache.get('code', params['version'])
+        if db_pk['code'] is None:
             raise IOError('Software '+params['version']+' unknown to phot_db')
 
-        query = 'SELECT refimg_id, filename FROM reference_images WHERE filename ="' + params['ref_filename'] + '"'
-        result = db_phot.query_to_astropy_table(conn, query, args=())
-        if len(result) > 0:
-            db_pk['refimage'] = result['refimg_id'][0]
-        else:
+        db_pk['refimage'] = key_cache.get('refimage', params['ref_filename'])
+        if db_pk['refimage'] is None:
             raise ValueError(
                 'No Stage 3 results for this reference image available in photometry DB.  Stage3_db_ingest needs to be run for this dataset first.')
 
-        query = 'SELECT img_id, filename FROM images WHERE filename ="' + params['filename'] + '"'
-        result = db_phot.query_to_astropy_table(conn, query, args=())
-        if len(result) > 0:
-            db_pk['image'] = result['img_id'][0]
-        else:
+        db_pk['image'] = key_cache.get('image', params['filename'])
+        if db_pk['image'] is None:
             raise IOError('Image '+params['filename']+' unknown to phot_db')
 
-        query = 'SELECT stamp_id FROM stamps WHERE stamp_index ="' + params['stamp'] + '"'
-        result = db_phot.query_to_astropy_table(conn, query, args=())
-        if len(result) > 0:
-            db_pk['stamp'] = result['stamp_id'][0]
-        else:
+        db_pk['stamp'] = key_cache.get('stamp', params['stamp'])
+        if db_pk['stamp'] is None:
             raise IOError('Stamp '+params['stamp']+' unknown to phot_db')
 
         log.info('Extracted dataset identifiers from database')
@@ -1074,7 +1092,7 @@ def store_stamp_photometry_to_array_starloop(conn, params, reduction_metadata,
 
     # The index of the data from a given image corresponds to the index of that
     # image in the metadata
-    image_dataset_id = np.where(new_image == reduction_metadata.headers_summary[1]['IMAGES'].data)[0][0]
+    image_dataset_id = reduction_metadata.find_row('headers_summary', new_image)
 
     for j in range(0, len(phot_table), 1):
         star_dataset_id = int(float(phot_table[j]['star_id']))
@@ -1141,7 +1159,7 @@ def store_stamp_photometry_to_array(setup, conn, params, reduction_metadata,
                                     photometry_data,
                                     phot_table, matched_stars,
                                     new_image, log, kwargs,
-                                    verbose=False, debug=False):
+                                    verbose=False, debug=False, key_cache=None):
     """Function to store photometry data from a stamp to the main
     photometry array"""
 
@@ -1151,11 +1169,11 @@ def store_stamp_photometry_to_array(setup, conn, params, reduction_metadata,
         matched_stars.output_match_list(os.path.join(setup.red_dir,'matched_stars.txt'))
 
     # Returns default values if DB is not in use
-    db_pk = get_entry_db_indices(conn, kwargs, params, new_image, log)
+    db_pk = get_entry_db_indices(conn, kwargs, params, new_image, log, key_cache=key_cache)
 
     # The index of the data from a given image corresponds to the index of that
     # image in the metadata
-    image_dataset_index = np.where(new_image == reduction_metadata.headers_summary[1]['IMAGES'].data)[0][0]
+    image_dataset_index = reduction_metadata.find_row('headers_summary', new_image)
 
     star_dataset_ids = np.array(phot_table['star_id'].data)
     star_dataset_ids = star_dataset_ids.astype('float')
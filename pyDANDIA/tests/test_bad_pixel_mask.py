@@ -186,6 +186,40 @@ def test_find_clusters_saturated_pixels():
     
     logs.close_log(log)
 
+def test_find_clusters_in_vector():
+    """Function to test the identification of contiguous values in a vector"""
+
+    vector = np.array([3, 4, 5, 6, 10, 20, 21, 22])
+
+    clusters = bad_pixel_mask.find_clusters_in_vector(vector)
+
+    assert len(clusters) == 3
+    assert [ len(c.pixels) for c in clusters ] == [ 4, 1, 3 ]
+    assert [ c.xc for c in clusters ] == [ 4.5, 10.0, 21.0 ]
+    assert clusters[0].range == [ 3, 6, 0, 0 ]
+
+    assert bad_pixel_mask.find_clusters_in_vector(np.array([])) == []
+
+def test_build_pixel_clusters():
+    """Function to test the calculation of cluster properties from
+    labelled pixels"""
+
+    xp = np.array([12, 10, 11, 30, 31, 30])
+    yp = np.array([5, 5, 6, 20, 24, 22])
+    labels = np.array([1, 1, 1, 2, 2, 2])
+
+    clusters = bad_pixel_mask.build_pixel_clusters(xp, yp, labels, 2)
+
+    assert len(clusters) == 2
+    assert clusters[0].pixels == [ [10,5], [11,6], [12,5] ]
+    assert clusters[0].xc == 11.0
+    assert clusters[0].yc == 5.0
+    assert clusters[0].range == [ 10, 12, 5, 6 ]
+    assert clusters[0].xyratio == 2.0
+    assert clusters[1].xc == 30.0
+    assert clusters[1].yc == 22.0
+    assert clusters[1].range == [ 30, 31, 20, 24 ]
+
 def test_mask_ccd_blooming():
     """Function to test the blooming detection method of BPM"""
     
@@ -8,6 +8,7 @@ from pyDANDIA import logs
 import test_field_photometry
 from astropy.table import Table, Column
 from astropy import units as u
+from astropy.coordinates import SkyCoord
 import numpy as np
 
 def test_params():
@@ -358,6 +359,99 @@ def test_record_dataset_stamps():
         assert(column in xmatch.stamps.colnames)
     assert(len(xmatch.stamps) == len(meta.images_stats[1])*len(meta.stamps[1]))
 
+def build_field_crossmatch(nstars, dataset_codes=['primary_ref_dataset', 'dataset0']):
+    rng = np.random.default_rng(3)
+    xmatch = crossmatch.CrossMatchTable()
+    columns = [Column(name='field_id', data=np.arange(1,nstars+1,1), dtype='int'),
+               Column(name='ra', data=268.0 + rng.random(nstars)*0.2, dtype='float'),
+               Column(name='dec', data=-29.9 + rng.random(nstars)*0.2, dtype='float'),
+               Column(name='quadrant', data=np.zeros(nstars), dtype='int'),
+               Column(name='quadrant_id', data=np.zeros(nstars), dtype='int'),
+               Column(name='gaia_source_id', data=np.array(['0']*nstars), dtype='S19')]
+    for code in dataset_codes:
+        columns.append(Column(name=code+'_index', data=np.zeros(nstars), dtype='int'))
+    xmatch.field_index = Table(columns)
+
+    return xmatch
+
+def test_cone_search_on_positions():
+
+    xmatch = build_field_crossmatch(2000)
+    radius = 20.0/3600.0
+    ra_centres = [268.05, 268.1, 0.0]
+    dec_centres = [-29.85, -29.8, 0.0]
+
+    results = xmatch.cone_search_on_positions(ra_centres, dec_centres, radius)
+
+    field_stars = SkyCoord(xmatch.field_index['ra'], xmatch.field_index['dec'],
+                            frame='icrs', unit=(u.deg, u.deg))
+    for j in range(0,len(ra_centres),1):
+        target = SkyCoord(ra_centres[j], dec_centres[j], frame='icrs', unit=(u.deg, u.deg))
+        separations = target.separation(field_stars).deg
+        idx = np.where(separations <= radius)[0]
+
+        jdx = np.where(results['target_index'] == j)[0]
+        assert results['field_idx'][jdx].tolist() == idx.tolist()
+        assert results['field_id'][jdx].tolist() == xmatch.field_index['field_id'][idx].tolist()
+        np.testing.assert_allclose(results['separation'][jdx], separations[idx], atol=1e-9)
+
+    assert len(np.where(results['target_index'] == 2)[0]) == 0
+
+    params = {'ra_centre': ra_centres[0], 'dec_centre': dec_centres[0], 'radius': radius}
+    stars = xmatch.cone_search(params)
+    assert len(stars) == len(np.where(results['target_index'] == 0)[0])
+    assert 'separation' in stars.colnames
+
+    (field_idx, separations) = xmatch.nearest_field_stars(xmatch.field_index['ra'][[5,10]],
+                                                          xmatch.field_index['dec'][[5,10]])
+    assert field_idx.tolist() == [5, 10]
+    assert (separations.value < 1e-9).all()
+
+def test_update_field_index_in_bulk():
+
+    log = logs.start_stage_log( '.', 'test_crossmatch' )
+
+    nstars = 10
+    xmatch = build_field_crossmatch(nstars)
+    xmatch.field_index['field_id'] = np.arange(nstars,0,-1)
+
+    matched_stars = match_utils.StarMatchIndex()
+    orphans = match_utils.StarMatchIndex()
+    ndataset = 5
+    p = {'cat1_index': [3, 7, nstars+20], 'cat2_index': [1, 2, 3]}
+    o = {'cat1_index': [None, None], 'cat2_index': [4, 5]}
+    for key in ['cat1_ra', 'cat1_dec', 'cat1_x', 'cat1_y',
+                'cat2_ra', 'cat2_dec', 'cat2_x', 'cat2_y', 'separation']:
+        p[key] = np.zeros(3)
+        o[key] = np.zeros(2)
+    o['cat2_ra'] = np.array([250.0, 251.0])
+    matched_stars.add_matches(p)
+    orphans.add_matches(o, replace_worse_matches=False)
+
+    dataset_metadata = metadata.MetaData()
+    dataset_metadata.star_catalog = [None, Table([Column(name='index', data=np.arange(1,ndataset+1,1)),
+                                                Column(name='gaia_source_id', data=['g'+str(j) for j in range(1,ndataset+1,1)])])]
+
+    xmatch.update_field_index('dataset0', matched_stars, orphans, dataset_metadata, log)
+
+    assert xmatch.locate_stars_in_field_index([3, 7, nstars+20]) == [nstars-3, nstars-7, None]
+    assert xmatch.field_index['dataset0_index'][nstars-3] == 1
+    assert xmatch.field_index['dataset0_index'][nstars-7] == 2
+    assert len(xmatch.field_index) == nstars + 2
+    assert xmatch.field_index['field_id'][nstars:].tolist() == [nstars+1, nstars+2]
+    assert xmatch.field_index['ra'][nstars:].tolist() == [250.0, 251.0]
+    assert xmatch.field_index['dataset0_index'][nstars:].tolist() == [4, 5]
+    assert xmatch.field_index['gaia_source_id'][nstars+1] == 'g5'
+
+    xmatch.assign_stars_to_quadrants()
+
+    for q in range(1,5,1):
+        idx = np.where(xmatch.field_index['quadrant'] == q)[0]
+        assert xmatch.field_index['quadrant_id'][idx].tolist() == list(range(1,len(idx)+1,1))
+    assert (xmatch.field_index['quadrant'] > 0).all()
+
+    logs.close_log(log)
+
 if __name__ == '__main__':
     #test_create()
 #    test_add_dataset()
@@ -509,6 +509,125 @@ def test_populate_stamps_table():
 
     logs.close_log(log)
 
+def test_populate_field_photometry_files(tmp_path):
+
+    log = logs.start_stage_log( str(tmp_path), 'test_field_photometry' )
+
+    nfield = 40
+    ndataset_stars = 30
+    nimages = 12
+    rng = np.random.default_rng(7)
+
+    # Field stars 0-29 are matched with dataset stars in reverse order, and
+    # the images of the dataset follow those of another dataset
+    xmatch = crossmatch.CrossMatchTable()
+    dataset_index = np.zeros(nfield, dtype='int')
+    dataset_index[0:ndataset_stars] = np.arange(ndataset_stars,0,-1)
+    xmatch.field_index = Table([Column(name='field_id', data=np.arange(1,nfield+1,1)),
+                                Column(name='quadrant', data=(np.arange(0,nfield,1)%4)+1),
+                                Column(name='quadrant_id', data=(np.arange(0,nfield,1)//4)+1),
+                                Column(name='dataset0_index', data=dataset_index)])
+    xmatch.stars = Table([Column(name='field_id', data=np.arange(1,nfield+1,1))])
+    xmatch.images = Table([Column(name='dataset_code', data=['other']*5+['dataset0']*nimages),
+                           Column(name='hjd', data=np.zeros(5+nimages))])
+    dataset = {'dataset_code': 'dataset0'}
+
+    meta = metadata.MetaData()
+    meta.star_catalog = [None, Table([Column(name='index', data=np.arange(1,ndataset_stars+1,1)),
+                                      Column(name='x', data=rng.random(ndataset_stars)*200.0),
+                                      Column(name='y', data=rng.random(ndataset_stars)*200.0)])]
+    meta.stamps = [None, Table([Column(name='PIXEL_INDEX', data=[0, 1]),
+                                Column(name='X_MIN', data=[0, 100]),
+                                Column(name='X_MAX', data=[110, 200]),
+                                Column(name='Y_MIN', data=[0, 0]),
+                                Column(name='Y_MAX', data=[200, 200])])]
+
+    dataset_photometry = rng.random((ndataset_stars, nimages, 28))
+    dataset_photometry[:,:,9] = 2459000.0 + np.arange(0,nimages,1)
+    dataset_photometry[0,:,9] = 0.0
+
+    (field_star_index, dataset_star_index) = field_photometry.get_dataset_star_indices(dataset, xmatch)
+    dataset_image_index = field_photometry.get_dataset_image_index(dataset, xmatch)
+
+    # The in-memory photometry array provides the expected result
+    photometry = field_photometry.init_field_data_table(xmatch, log)
+    (xmatch, photometry) = field_photometry.populate_photometry_array(field_star_index, dataset_star_index,
+                                    dataset_image_index, photometry, dataset_photometry, xmatch, log, meta)
+    for j,jdataset in zip(field_star_index, dataset_star_index):
+        stamp_id = calc_star_stamp(meta.star_catalog[1]['x'][jdataset],
+                                   meta.star_catalog[1]['y'][jdataset], meta)
+        assert (photometry[j,dataset_image_index,11] == max(stamp_id,0)).all()
+        assert (photometry[j,dataset_image_index,3] == dataset_photometry[jdataset,:,13]).all()
+
+    params = {'crossmatch_file': str(tmp_path / 'crossmatch.fits'), 'field_name': 'TEST'}
+    xmatch.images['hjd'] = 0.0
+    quad_files = field_photometry.init_field_photometry_files(params, xmatch, log)
+
+    file_path = str(tmp_path / 'dataset_photometry.hdf5')
+    with h5py.File(file_path, "w") as f:
+        f.create_dataset('dataset_photometry', data=dataset_photometry)
+    with h5py.File(file_path, "r") as f:
+        xmatch = field_photometry.populate_field_photometry_files(field_star_index, dataset_star_index,
+                                    dataset_image_index, quad_files, f['dataset_photometry'],
+                                    xmatch, log, meta, block_stars=3)
+
+    assert (xmatch.images['hjd'][5:] == dataset_photometry[1,:,9]).all()
+    assert (xmatch.images['hjd'][0:5] == 0.0).all()
+
+    for q in range(1,5,1):
+        idx = np.where(xmatch.field_index['quadrant'] == q)[0]
+        with h5py.File(quad_files[q], "r") as f:
+            quad_phot = f['dataset_photometry'][:]
+        assert quad_phot.shape == (len(idx), len(xmatch.images), 17)
+        np.testing.assert_array_equal(quad_phot[xmatch.field_index['quadrant_id'][idx]-1], photometry[idx])
+
+    logs.close_log(log)
+
+def test_init_field_photometry_files_empty_quadrant(tmp_path):
+
+    log = logs.start_stage_log( str(tmp_path), 'test_field_photometry' )
+
+    # All stars lie in quadrants 1-3, leaving quadrant 4 empty
+    nfield = 9
+    nimages = 4
+    xmatch = crossmatch.CrossMatchTable()
+    xmatch.field_index = Table([Column(name='field_id', data=np.arange(1,nfield+1,1)),
+                                Column(name='quadrant', data=(np.arange(0,nfield,1)%3)+1),
+                                Column(name='quadrant_id', data=(np.arange(0,nfield,1)//3)+1),
+                                Column(name='dataset0_index', data=np.arange(1,nfield+1,1))])
+    xmatch.images = Table([Column(name='dataset_code', data=['dataset0']*nimages),
+                           Column(name='hjd', data=np.zeros(nimages))])
+    dataset = {'dataset_code': 'dataset0'}
+
+    meta = metadata.MetaData()
+    meta.star_catalog = [None, Table([Column(name='index', data=np.arange(1,nfield+1,1)),
+                                      Column(name='x', data=np.linspace(10.0,90.0,nfield)),
+                                      Column(name='y', data=np.linspace(10.0,90.0,nfield))])]
+    meta.stamps = [None, Table([Column(name='PIXEL_INDEX', data=[0]),
+                                Column(name='X_MIN', data=[0]),
+                                Column(name='X_MAX', data=[100]),
+                                Column(name='Y_MIN', data=[0]),
+                                Column(name='Y_MAX', data=[100])])]
+
+    dataset_photometry = np.ones((nfield, nimages, 28))
+    dataset_photometry[:,:,9] = 2459000.0 + np.arange(0,nimages,1)
+
+    params = {'crossmatch_file': str(tmp_path / 'crossmatch.fits'), 'field_name': 'TEST'}
+    quad_files = field_photometry.init_field_photometry_files(params, xmatch, log)
+
+    (field_star_index, dataset_star_index) = field_photometry.get_dataset_star_indices(dataset, xmatch)
+    dataset_image_index = field_photometry.get_dataset_image_index(dataset, xmatch)
+    xmatch = field_photometry.populate_field_photometry_files(field_star_index, dataset_star_index,
+                                dataset_image_index, quad_files, dataset_photometry,
+                                xmatch, log, meta)
+
+    with h5py.File(quad_files[4], "r") as f:
+        assert f['dataset_photometry'].shape == (0, nimages, 17)
+    with h5py.File(quad_files[1], "r") as f:
+        assert (f['dataset_photometry'][:,:,0] == dataset_photometry[0:3,:,9]).all()
+
+    logs.close_log(log)
+
 if __name__ == '__main__':
     test_init_field_data_table()
     test_populate_images_table()
@@ -1,6 +1,7 @@
 import numpy as np
 import os
 import sys
+import h5py
 cwd = os.getcwd()
 sys.path.append(os.path.join(cwd,'../'))
 import hd5_utils
@@ -47,6 +48,153 @@ def test_read_phot_hd5():
 
     logs.close_log(log)
 
+def test_update_phot_hd5(tmp_path):
+
+    setup = pipeline_setup.pipeline_setup({'red_dir': str(tmp_path)})
+
+    nstars = 100
+    phot_data = np.random.normal(size=(nstars,5,28))
+
+    hd5_utils.write_phot_hd5(setup,phot_data,compression='gzip')
+
+    with h5py.File(os.path.join(setup.red_dir,'photometry.hdf5'), 'r') as f:
+        dset = f['dataset_photometry']
+        assert dset.chunks == (64,64,28)
+        assert dset.maxshape == (nstars,None,28)
+        assert dset.compression == 'gzip'
+
+    new_phot_data = np.zeros((nstars,9,28))
+    new_phot_data[:,0:5,:] = phot_data
+    new_phot_data[:,6:9,:] = 2.0
+    new_phot_data[:,5,:] = 3.0
+
+    hd5_utils.update_phot_hd5(setup,new_phot_data,[6,7,8])
+
+    dataset = hd5_utils.read_phot_hd5(setup, return_type='array')
+
+    assert dataset.shape == (nstars,9,28)
+    assert (dataset[:,0:5,:] == phot_data).all()
+    assert (dataset[:,5,:] == 0.0).all()
+    assert (dataset[:,6:9,:] == 2.0).all()
+
+def test_write_empty_phot_hd5(tmp_path):
+
+    setup = pipeline_setup.pipeline_setup({'red_dir': str(tmp_path)})
+
+    hd5_utils.write_phot_hd5(setup,np.zeros((0,10,23)))
+
+    dataset = hd5_utils.read_phot_hd5(setup, return_type='array')
+
+    assert dataset.shape == (0,10,23)
+
+    with h5py.File(os.path.join(setup.red_dir,'empty.hdf5'), 'w') as f:
+        dset = hd5_utils.create_empty_phot_dataset(f, (0,10,17))
+        assert dset.shape == (0,10,17)
+
+        dset = hd5_utils.create_empty_phot_dataset(f.create_group('small'), (3,10,17))
+        assert dset.chunks == (3,64,17)
+        assert dset.maxshape == (3,None,17)
+
+def test_update_contiguous_phot_hd5(tmp_path):
+
+    setup = pipeline_setup.pipeline_setup({'red_dir': str(tmp_path)})
+
+    phot_data = np.ones((10,3,28))
+    with h5py.File(os.path.join(setup.red_dir,'photometry.hdf5'), 'w') as f:
+        f.create_dataset('dataset_photometry', phot_data.shape,
+                         dtype='float64', data=phot_data)
+
+    new_phot_data = np.ones((10,4,28))
+    new_phot_data[:,3,:] = 2.0
+
+    hd5_utils.update_phot_hd5(setup,new_phot_data,[3])
+
+    dataset = hd5_utils.read_phot_hd5(setup)
+
+    assert dataset.shape == (10,4,28)
+    assert dataset.maxshape == (10,None,28)
+    assert (dataset[:] == new_phot_data).all()
+
+def test_photometry_reader(tmp_path):
+
+    setup = pipeline_setup.pipeline_setup({'red_dir': str(tmp_path)})
+
+    phot_data = np.random.normal(size=(150,70,28))
+    hd5_utils.write_phot_hd5(setup,phot_data)
+
+    with hd5_utils.open_phot_hd5(setup, cache_chunks=2) as reader:
+
+        assert reader.shape == phot_data.shape
+        assert (reader.get_star(130) == phot_data[130,:,:]).all()
+        assert (reader.get_star(-1, columns=[9,13]) == phot_data[-1,:,[9,13]].T).all()
+        assert len(reader.blocks) == 2
+
+        stars = reader.get_stars([3,1], columns=[13])
+        assert stars.shape == (2,70,1)
+        assert (stars[:,:,0] == phot_data[[3,1],:,13]).all()
+        assert len(reader.blocks) == 2
+
+        assert (reader.get_image(65) == phot_data[:,65,:]).all()
+        assert (reader.get_images([7,2,7], columns=[0]) == phot_data[:,[7,2,7],:][:,:,[0]]).all()
+
+        try:
+            reader.get_star(150)
+            raise AssertionError('Expected IndexError')
+        except IndexError:
+            pass
+
+class CountingDataset(object):
+    """Wrapper around an h5py dataset counting the reads made from it"""
+
+    def __init__(self, dset):
+        self.dset = dset
+        self.nreads = 0
+
+    def __getitem__(self, key):
+        self.nreads += 1
+        return self.dset[key]
+
+def test_photometry_reader_cache(tmp_path):
+
+    setup = pipeline_setup.pipeline_setup({'red_dir': str(tmp_path)})
+
+    cache_chunks = 2
+    nimages = cache_chunks*hd5_utils.PHOT_CHUNK_IMAGES + 10
+    phot_data = np.random.normal(size=(130,nimages,5))
+    hd5_utils.write_phot_hd5(setup,phot_data)
+
+    with hd5_utils.open_phot_hd5(setup, cache_chunks=cache_chunks) as reader:
+
+        assert reader.cache_chunks == 3
+
+        reader.dset = CountingDataset(reader.dset)
+
+        assert (reader.get_star(10) == phot_data[10,:,:]).all()
+        assert reader.dset.nreads == 3
+
+        # Neighbouring stars are in the same chunks, which remain cached
+        assert (reader.get_star(11) == phot_data[11,:,:]).all()
+        assert (reader.get_star(63) == phot_data[63,:,:]).all()
+        assert reader.dset.nreads == 3
+
+        assert (reader.get_star(64) == phot_data[64,:,:]).all()
+        assert reader.dset.nreads == 6
+
+def test_photometry_reader_contiguous(tmp_path):
+
+    file_path = os.path.join(str(tmp_path),'photometry.hdf5')
+    phot_data = np.random.normal(size=(10,3,23))
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('dataset_photometry', phot_data.shape,
+                         dtype='float64', data=phot_data)
+
+    reader = hd5_utils.PhotometryReader(file_path)
+
+    assert reader.block_shape == (10,64)
+    assert (reader.get_star(4) == phot_data[4,:,:]).all()
+
+    reader.close()
+
 if __name__ == '__main__':
     test_write_phot_hd5()
     test_read_phot_hd5()
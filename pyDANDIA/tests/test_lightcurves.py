@@ -1,5 +1,11 @@
 from pyDANDIA import lightcurves
+from pyDANDIA import match_utils
+from pyDANDIA import metadata
+from pyDANDIA import hd5_utils
+from pyDANDIA import pipeline_setup
 from os import path
+import numpy as np
+import h5py
 
 def test_setname():
 
@@ -12,3 +18,51 @@ def test_setname():
         setname = lightcurves.get_setname(params)
         print(setname, test_setnames[i])
         assert setname == test_setnames[i]
+
+def test_extract_star_lightcurves_in_batch(tmp_path):
+
+    red_dir = tmp_path / 'ROME-FIELD-01_lsc-doma-1m0-05-fa15_ip'
+    red_dir.mkdir()
+    params = {'red_dir': str(red_dir), 'output_dir': str(tmp_path / 'lc')}
+
+    nstars = 20
+    nimages = 7
+    matched_stars = match_utils.StarMatchIndex()
+    star_ids = list(range(1,nstars+1,1))
+    matched_stars.cat1_index = star_ids
+    matched_stars.cat2_index = list(np.array(star_ids)[::-1])
+    for key in ['cat1_ra', 'cat1_dec', 'cat1_x', 'cat1_y',
+                'cat2_ra', 'cat2_dec', 'cat2_x', 'cat2_y', 'separation']:
+        setattr(matched_stars, key, [0.0]*nstars)
+    matched_stars.n_match = nstars
+
+    metad = metadata.MetaData()
+    metad.create_matched_stars_layer(matched_stars)
+    metad.create_metadata_file(str(red_dir), 'pyDANDIA_metadata.fits')
+    metad.save_a_layer_to_file(str(red_dir), 'pyDANDIA_metadata.fits',
+                                'matched_stars', log=None)
+
+    photometry = np.random.default_rng(5).random((nstars, nimages, 28))
+    setup = pipeline_setup.pipeline_setup({'red_dir': str(red_dir)})
+    hd5_utils.write_phot_hd5(setup, photometry)
+
+    params['star_ids'] = [3, 17, 5, nstars+10]
+    (message, lc_files) = lightcurves.extract_star_lightcurves_in_batch(params,
+                                                            format='dat,hdf5')
+
+    assert message == 'OK'
+    assert len(lc_files) == 4
+
+    with h5py.File(lc_files[0], 'r') as f:
+        assert f['star_field_id'][:].tolist() == [3, 5, 17]
+        bundle = f['photometry'][:]
+
+    for j,star_id in enumerate([3, 5, 17]):
+        expected = photometry[nstars-star_id,:,:][:,lightcurves.BATCH_LC_COLUMNS]
+        np.testing.assert_array_equal(bundle[j], expected)
+
+        lc_file = path.join(params['output_dir'], 'star_'+str(star_id)+'_lsc-doma-1m0-05-fa15_ip.dat')
+        assert lc_file in lc_files
+        lc = lightcurves.read_pydandia_lightcurve(lc_file, skip_zero_entries=False)
+        np.testing.assert_array_equal(lc['hjd'], expected[:,0])
+        np.testing.assert_array_equal(lc['calibrated_mag_err'], expected[:,4])
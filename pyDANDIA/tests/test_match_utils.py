@@ -263,6 +263,78 @@ def test_remove_worse_matches():
     
     logs.close_log(log)
 
+def test_add_matches():
+    log = logs.start_stage_log( cwd, 'test_match_utils' )
+
+    nstars = 10
+    matched_stars = build_test_matched_stars_index(nstars)
+
+    # Star 1 in catalog 1 is proposed twice, star 3 in catalog 2 is proposed
+    # with a worse separation than its existing match and star nstars+1
+    # is new to both catalogs
+    new_matches = {'cat1_index': np.array([1, 1, nstars+2, nstars+1]),
+                'cat1_ra': np.zeros(4), 'cat1_dec': np.zeros(4),
+                'cat1_x': np.zeros(4), 'cat1_y': np.zeros(4),
+                'cat2_index': np.array([nstars+5, nstars+6, 3, nstars+1]),
+                'cat2_ra': np.zeros(4), 'cat2_dec': np.zeros(4),
+                'cat2_x': np.zeros(4), 'cat2_y': np.zeros(4),
+                'separation': np.array([0.2, 0.1, 0.9, 0.1])}
+
+    accepted = matched_stars.add_matches(new_matches, log=log)
+
+    assert accepted.tolist() == [False, True, False, True]
+    assert matched_stars.n_match == nstars + 1
+    assert len(matched_stars.cat2_index) == matched_stars.n_match
+    idx = matched_stars.find_star_match_index('cat1_index', 1)
+    assert matched_stars.cat2_index[idx] == nstars+6
+    assert matched_stars.separation[idx] == 0.1
+    assert matched_stars.find_star_match_index('cat2_index', 3) == 1
+    assert matched_stars.find_star_match_index('cat1_index', nstars+2) == -1
+
+    orphans = match_utils.StarMatchIndex()
+    accepted = orphans.add_matches(new_matches, replace_worse_matches=False)
+
+    assert accepted.all()
+    assert orphans.n_match == 4
+    assert orphans.find_star_match_index('cat1_index', 1) == 0
+
+    logs.close_log(log)
+
+def test_select_closest_matches():
+
+    # Star 1 in catalog 2 is closest to star 1 in catalog 1, so the closer
+    # match of star 2 to it is rejected in favour of its match to star 2
+    cat1_index = np.array([1, 2, 2])
+    cat2_index = np.array([1, 1, 2])
+    separation = np.array([0.1, 0.2, 0.3])
+
+    accepted = match_utils.select_closest_matches(cat1_index, cat2_index, separation)
+
+    assert accepted.tolist() == [True, False, True]
+
+    # Bulk selection should retain the same matches as adding them one
+    # at a time in order of separation
+    nstars = 2000
+    rng = np.random.default_rng(42)
+    cat1_index = rng.integers(0, 500, nstars)
+    cat2_index = rng.integers(0, 500, nstars)
+    separation = rng.random(nstars)
+
+    accepted = match_utils.select_closest_matches(cat1_index, cat2_index, separation)
+
+    matched_stars = match_utils.StarMatchIndex()
+    for j in np.argsort(separation):
+        star = {'cat1_index': cat1_index[j],
+                'cat1_ra': 0.0, 'cat1_dec': 0.0, 'cat1_x': 0.0, 'cat1_y': 0.0,
+                'cat2_index': cat2_index[j],
+                'cat2_ra': 0.0, 'cat2_dec': 0.0, 'cat2_x': 0.0, 'cat2_y': 0.0,
+                'separation': separation[j]}
+        matched_stars.add_match(star)
+
+    assert matched_stars.n_match == accepted.sum()
+    assert set(matched_stars.cat1_index) == set(cat1_index[accepted])
+    assert set(matched_stars.cat2_index) == set(cat2_index[accepted])
+
 if __name__ == '__main__':
 
     #test_find_starlist_match_index()
@@ -105,6 +105,37 @@ def test_save_a_layer_to_file():
     assert metad2.dummy_layer[1].keys() == ['OHOHOH', 'IHIHIH']
 
 
+def test_save_only_updated_layers(tmp_path):
+    metad = metadata.MetaData()
+    metad.create_metadata_file(str(tmp_path), 'dummy_metadata.fits')
+    metad.create_a_new_layer('dummy_layer', [['OHOHOH', 'IHIHIH'], ['S150', 'S10'], ['km/s', 'h/(2pi)']],
+                             [['0', '1'], ['59',
+                                           '41']])
+    metad.save_updated_metadata(str(tmp_path), 'dummy_metadata.fits')
+
+    metad2 = metadata.MetaData()
+    metad2.load_all_metadata(str(tmp_path), 'dummy_metadata.fits')
+    log = mock.MagicMock()
+    metad2.save_updated_metadata(str(tmp_path), 'dummy_metadata.fits', log=log)
+
+    written = [call[0][0] for call in log.info.call_args_list if 'Writing' in call[0][0]]
+    assert written == []
+
+    metad2.dummy_layer[1]['IHIHIH'][0] = '60'
+    metad2.save_updated_metadata(str(tmp_path), 'dummy_metadata.fits', log=log)
+
+    written = [call[0][0] for call in log.info.call_args_list if 'Writing' in call[0][0]]
+    assert written == ['Writing meta data layer dummy_layer']
+    assert os.listdir(str(tmp_path)) == ['dummy_metadata.fits']
+
+    metad3 = metadata.MetaData()
+    metad3.load_all_metadata(str(tmp_path), 'dummy_metadata.fits')
+
+    assert metad3.dummy_layer[1]['IHIHIH'][0] == '60'
+    assert metad3.data_architecture[1]['METADATA_NAME'][0] == 'dummy_metadata.fits'
+    assert metad3.layer_names() == metad2.layer_names()
+
+
 def test_transform_2D_table_to_dictionary():
     metad = metadata.MetaData()
 
@@ -150,6 +181,42 @@ def test_add_row_to_layer():
     assert metad.dummy_layer[1]['IHIHIH'][0] == '59'
     assert metad.dummy_layer[1]['IHIHIH'][1] == 'orange'
 
+def test_find_rows():
+    metad = metadata.MetaData()
+
+    metad.create_a_new_layer('dummy_layer', [['OHOHOH', 'IHIHIH'], ['S150', 'S10'], ['km/s', 'h/(2pi)']],
+                             [['im1.fits', 'im2.fits'], ['59', '41']])
+
+    assert metad.find_row('dummy_layer', 'im2.fits') == 1
+    assert metad.find_row('dummy_layer', b'im1.fits') == 0
+    assert (metad.find_rows('dummy_layer', ['im2.fits', 'im3.fits', 'im1.fits']) == [1, -1, 0]).all()
+    with pytest.raises(IndexError):
+        metad.find_row('dummy_layer', 'im3.fits')
+
+    metad.add_row_to_layer('dummy_layer', ['im3.fits', '12'])
+    metad.add_row_to_layer('dummy_layer', ['im1.fits', '60'])
+
+    assert len(metad.dummy_layer[1]) == 3
+    assert metad.find_row('dummy_layer', 'im3.fits') == 2
+    assert metad.dummy_layer[1]['IHIHIH'][0] == '60'
+
+    metad.update_a_cell_to_layer('dummy_layer', 2, 'OHOHOH', 'im4.fits')
+
+    assert (metad.find_rows('dummy_layer', ['im3.fits', 'im4.fits']) == [-1, 2]).all()
+
+def test_add_rows_to_layer():
+    metad = metadata.MetaData()
+
+    metad.create_a_new_layer('dummy_layer', [['OHOHOH', 'IHIHIH'], ['S150', 'S10'], ['km/s', 'h/(2pi)']],
+                             [['im1.fits'], ['59']])
+
+    metad.add_rows_to_layer('dummy_layer', [['im2.fits', '41'], ['im1.fits', '60'], ['im3.fits', '12']])
+
+    assert list(metad.dummy_layer[1]['OHOHOH']) == ['im1.fits', 'im2.fits', 'im3.fits']
+    assert list(metad.dummy_layer[1]['IHIHIH']) == ['60', '41', '12']
+    assert metad.dummy_layer[1]['OHOHOH'].dtype == 'S150'
+    assert metad.find_row('dummy_layer', 'im3.fits') == 2
+
 def test_add_column_to_layer():
 
     metad = metadata.MetaData()
@@ -369,3 +436,41 @@ if __name__ == '__main__':
     #test_cone_search_on_position()
     #test_fetch_reduction_filter()
     test_expand_headers_summary()
+
+def test_update_reduction_status():
+    metad = metadata.MetaData()
+    metad.create_reduction_status_layer()
+
+    images = ['im'+str(i)+'.fits' for i in range(5)]
+    metad.update_reduction_metadata_reduction_status(images, stage_number=0, status='1')
+
+    assert len(metad.reduction_status[1]) == 5
+    assert metad.pending_images(0) == images
+
+    metad.update_reduction_metadata_reduction_status(images[:2]+['im5.fits'], stage_number=0, status='1')
+
+    assert metad.pending_images(0) == images[2:]+['im5.fits']
+
+    metad.update_reduction_metadata_reduction_status_list(images[2:4], [1, -1], stage_number=1)
+
+    assert metad.reduction_status[1]['STAGE_1'][2] == '1'
+    assert list(metad.reduction_status[1][3]) == ['im3.fits', '0'] + 7*['-1']
+    assert metad.pending_images(2) == ['im0.fits', 'im1.fits', 'im2.fits', 'im4.fits', 'im5.fits']
+
+    metad.update_reduction_metadata_reduction_status_dict({'im4.fits': '-1', 'im0.fits': '1'}, stage_number=2)
+
+    assert metad.pending_images(2) == ['im1.fits', 'im2.fits', 'im5.fits']
+    assert metad.pending_images(7) == ['im0.fits', 'im1.fits', 'im2.fits', 'im5.fits']
+
+    with pytest.raises(IOError):
+        metad.update_reduction_metadata_reduction_status_dict({'im6.fits': '1'}, stage_number=2)
+
+    setup = mock.MagicMock()
+    new_images = metad.find_images_need_to_be_process(setup, images+['im6.fits'], stage_number=2)
+
+    assert new_images == ['im1.fits', 'im2.fits', 'im6.fits']
+
+    new_images = metad.find_images_need_to_be_process(setup, images+['im6.fits'], stage_number=2,
+                                                      rerun_all=True, process_missing=False)
+
+    assert new_images == images
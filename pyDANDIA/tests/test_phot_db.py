@@ -119,6 +119,25 @@ def test_feed_to_table_many():
     assert len(t) == len(tuples)
     conn.close()
 
+def test_feed_to_table_many_returning_ids(tmp_path):
+
+    conn = phot_db.get_connection(dsn=str(tmp_path / 'phot.db'))
+
+    phot_db.feed_to_table_many(conn, 'Stars', ['ra', 'dec'], [(10.0, -20.0)])
+
+    tuples = [(10.0+i*0.01, -20.0) for i in range(5)]
+    star_ids = phot_db.feed_to_table_many_returning_ids(conn, 'stars', ['ra', 'dec'],
+                                                        tuples, 'star_id')
+
+    assert not conn.in_transaction
+    assert list(star_ids) == [2, 3, 4, 5, 6]
+
+    t = phot_db.query_to_astropy_table(conn, 'SELECT star_id,ra FROM stars WHERE star_id > 1', args=())
+    for i, star_id in enumerate(star_ids):
+        assert t['ra'][t['star_id'] == star_id][0] == tuples[i][0]
+
+    conn.close()
+
 def test_ingest_astropy_table():
 
     if os.path.isfile(db_file_path):
@@ -207,6 +226,58 @@ def test_box_search_on_position():
 
     conn.close()
 
+def test_spatial_index(tmp_path):
+
+    dsn = str(tmp_path / 'phot.db')
+    conn = phot_db.get_connection(dsn=dsn)
+
+    (names, tuples) = generate_test_catalog()
+    phot_db.feed_to_table_many(conn, 'Stars', names, tuples)
+
+    conn.execute('UPDATE stars SET ra=10.0, dec=10.0 WHERE star_id=2')
+    conn.execute('DELETE FROM stars WHERE star_id=3')
+
+    t = phot_db.query_to_astropy_table(conn, 'SELECT star_id, ra_min, dec_min FROM stars_spatial ORDER BY star_id', args=())
+    assert list(t['star_id']) == [1, 2, 4, 5]
+    assert abs(t['ra_min'][1] - 10.0) < 1e-4
+
+    results = phot_db.box_search_on_position(conn, 269.5, -28.0, 0.05, 0.1)
+    assert list(results['star_id']) == [1, 4, 5]
+
+    # Databases created without the index have it built on connection
+    conn.execute('DELETE FROM stars_spatial')
+    conn.close()
+    conn = phot_db.get_connection(dsn=dsn)
+
+    results = phot_db.box_search_on_position(conn, 269.5, -28.0, 0.05, 0.1)
+    assert list(results['star_id']) == [1, 4, 5]
+
+    conn.close()
+
+def test_cone_search_on_positions(tmp_path):
+
+    conn = phot_db.get_connection(dsn=str(tmp_path / 'phot.db'))
+
+    (names, tuples) = generate_test_catalog()
+    tuples += [ (6, 0.0003, 10.0), (7, 359.9995, 10.0), (8, 120.0, 89.9998) ]
+    phot_db.feed_to_table_many(conn, 'Stars', names, tuples)
+
+    radius = 2.0/3600.0
+    ra_centres = [ 269.5155763609925, 359.9999, 300.0, 0.0 ]
+    dec_centres = [ -27.996414691517113, 10.0, 89.9999, -50.0 ]
+
+    results = phot_db.cone_search_on_positions(conn, ra_centres, dec_centres, radius)
+
+    assert list(results['target_index']) == [0, 1, 1, 2]
+    assert list(results['star_id']) == [1, 6, 7, 8]
+    assert (results['separation'] <= radius).all()
+    assert results['separation'][0] < 1e-6
+
+    results = phot_db.cone_search_on_positions(conn, [0.0], [-50.0], radius)
+    assert len(results) == 0
+
+    conn.close()
+
 def test_update_table_entry():
 
     if os.path.isfile(db_file_path):
@@ -503,6 +574,38 @@ def test_add_table_to_existing_db():
 
     conn.close()
 
+def test_primary_key_cache(tmp_path):
+    """Function to test the lookup of the primary keys of DB entries by
+    the values of their identifying columns"""
+
+    conn = phot_db.get_connection(dsn=str(tmp_path / 'phot.db'))
+
+    phot_db.feed_to_table_many(conn, 'stamps', ['stamp_index', 'xmin', 'xmax', 'ymin', 'ymax'],
+                               [(str(i), 0, 100, i*100, (i+1)*100) for i in range(4)])
+    phot_db.feed_to_table_many(conn, 'images', ['filename'],
+                               [('image'+str(i)+'.fits',) for i in range(3)])
+
+    key_cache = phot_db.PrimaryKeyCache(conn)
+    key_cache.preload('stamp', [0, 1, 2, 3, 4])
+
+    assert len(key_cache.keys['stamp']) == 4
+
+    stamps = phot_db.query_to_astropy_table(conn, 'SELECT stamp_id, stamp_index FROM stamps', args=())
+    for row in stamps:
+        assert key_cache.get('stamp', row['stamp_index']) == row['stamp_id']
+    assert key_cache.get('stamp', 4) == None
+
+    ip_filter = phot_db.query_to_astropy_table(conn, 'SELECT filter_id FROM filters WHERE filter_name="ip"', args=())
+    assert key_cache.get('filter', 'ip') == ip_filter['filter_id'][0]
+    assert key_cache.get('image', 'image2.fits') != None
+    assert key_cache.get('image', 'image3.fits') == None
+
+    phot_db.feed_to_table_many(conn, 'images', ['filename'], [('image3.fits',)])
+
+    assert key_cache.get('image', 'image3.fits') != None
+
+    conn.close()
+
 if __name__ == '__main__':
 
     #test_get_connection()
@@ -417,6 +417,141 @@ def test_calc_calib_mags():
     np.testing.assert_almost_equal(cal_mag, test_cal_mag, 3)
     np.testing.assert_almost_equal(cal_mag_err, test_cal_mag_err, 3)
 
+def test_convert_flux_to_mag_array():
+
+    flux = np.array([1000.0, 2500.0, -10.0])
+    flux_err = np.sqrt(np.abs(flux))
+    expt = 30.0
+
+    (mags, mag_errs, f_scaled, ferr_scaled) = photometry.convert_flux_to_mag_array(flux, flux_err, exp_time=expt)
+
+    for i in range(len(flux)):
+        (m,merr,f,ferr) = photometry.convert_flux_to_mag(flux[i],flux_err[i],exp_time=expt)
+        np.testing.assert_almost_equal(mags[i], m, 10)
+        np.testing.assert_almost_equal(mag_errs[i], merr, 10)
+        np.testing.assert_almost_equal(f_scaled[i], f, 10)
+
+def test_calc_calib_mags_array():
+
+    fit_params = np.array([1.047361046162702, -3.695617826430103])
+    covar_fit = np.array([ [0.00030368, -0.00560597], [-0.00560597, 0.10369162] ])
+    mags = np.array([19.016, 15.2, 6.5])
+    mag_errs = np.array([0.00592, 0.002, 0.001])
+
+    (cal_mags, cal_mag_errs) = photometry.calc_calib_mags_array(fit_params, covar_fit, mags, mag_errs)
+
+    for i in range(len(mags)):
+        (cal_mag, cal_mag_err) = photometry.calc_calib_mags(fit_params, covar_fit, mags[i], mag_errs[i])
+        np.testing.assert_almost_equal(cal_mags[i], cal_mag, 10)
+        np.testing.assert_almost_equal(cal_mag_errs[i], cal_mag_err, 10)
+
+def simulate_star_field(nstars=60, shape=(120,150), sky_value=300.0):
+    """Function to simulate an image of stars with a Moffat2D PSF"""
+
+    np.random.seed(12)
+    psf_params = [ 1.0, 0.0, 0.0, 2.5, 2.2 ]
+    xstars = np.random.uniform(0.0, shape[1], nstars)
+    ystars = np.random.uniform(0.0, shape[0], nstars)
+
+    image = np.random.normal(sky_value, 5.0, shape)
+    Y_data, X_data = np.indices(shape)
+    for j in range(0,nstars,1):
+        star = psf.get_psf_object('Moffat2D')
+        pars = list(psf_params)
+        pars[0] = np.random.uniform(100.0, 5000.0)
+        pars[1] = ystars[j]
+        pars[2] = xstars[j]
+        image += star.psf_model(Y_data, X_data, pars)
+
+    psf_model = psf.get_psf_object('Moffat2D')
+    psf_model.update_psf_parameters(psf_params)
+
+    return image, np.zeros(shape) + sky_value, psf_model, xstars, ystars
+
+def test_fit_star_intensities():
+
+    setup = pipeline_setup.pipeline_setup({'red_dir': TEST_DIR})
+    (image, sky_bkgd, psf_model, xstars, ystars) = simulate_star_field()
+    psf_diameter = 15.0
+
+    (intensity, good_fit) = photometry.fit_star_intensities(image, sky_bkgd, psf_model,
+                                                            xstars, ystars, psf_diameter)
+
+    for j in range(0,len(xstars),1):
+        corners = psf.calc_stamp_corners(xstars[j], ystars[j], psf_diameter, psf_diameter,
+                                         image.shape[1], image.shape[0], over_edge=True)
+        (data_section, sec_xstar, sec_ystar) = psf.extract_image_section(image,
+                                                            xstars[j],ystars[j],corners)
+        (sky_section, sky_x, sky_y) = psf.extract_image_section(sky_bkgd,
+                                                            xstars[j],ystars[j],corners)
+
+        (fitted_model,fitted_cov,fit_ok) = psf.fit_star_existing_model(setup, data_section,
+                                               sec_xstar, sec_ystar, psf_diameter,
+                                               psf_model, sky_section, centroiding=False)
+
+        np.testing.assert_allclose(intensity[j], fitted_model.get_parameters()[0], rtol=1e-6)
+        assert(good_fit[j] == fit_ok)
+
+def test_fit_star_group_intensities():
+
+    (image, sky_bkgd, psf_model, xstars, ystars) = simulate_star_field(nstars=150)
+
+    (groups, group_size) = psf.group_blended_stars(xstars, ystars, 15.0)
+    assert((group_size > 1).any())
+
+    (intensity, good_fit) = photometry.fit_star_group_intensities(image, sky_bkgd, psf_model,
+                                                        xstars, ystars, 15.0,
+                                                        groups, False)
+
+    # Isolated stars are fitted as before
+    isolated = group_size[groups] == 1
+    (single_intensity, single_fit) = photometry.fit_star_intensities(image, sky_bkgd, psf_model,
+                                                        xstars[isolated], ystars[isolated], 15.0)
+    np.testing.assert_allclose(intensity[isolated], single_intensity)
+
+    # Groups of blended stars stay within a single work unit
+    work_units = photometry.build_photometry_tiles(xstars, ystars, 50, groups=groups)
+    for unit in work_units:
+        for g in np.unique(groups[unit[1]]):
+            assert((groups[unit[1]] == g).sum() == group_size[g])
+
+def test_run_photometry_work_units():
+
+    setup = pipeline_setup.pipeline_setup({'red_dir': TEST_DIR})
+    log = logs.start_stage_log( cwd, 'test_photometry' )
+    (image, sky_bkgd, psf_model, xstars, ystars) = simulate_star_field()
+
+    work_units = photometry.build_photometry_tiles(xstars, ystars, 50)
+
+    assert(len(work_units) == 9)
+    star_index = np.concatenate([unit[1] for unit in work_units])
+    assert((np.sort(star_index) == np.arange(0,len(xstars),1)).all())
+
+    shared_data = {'image': image, 'sky_bkgd': sky_bkgd,
+                   'xstars': xstars, 'ystars': ystars,
+                   'psf_type': psf_model.psf_type(),
+                   'psf_parameters': psf_model.get_parameters(),
+                   'psf_diameter': 15.0, 'centroiding': False,
+                   'groups': None, 'setup': setup}
+
+    serial_fit = photometry.run_photometry_work_units(work_units, shared_data, 1,
+                                                      len(xstars), log)
+    pool_fit = photometry.run_photometry_work_units(work_units, shared_data, 2,
+                                                    len(xstars), log)
+
+    for key in serial_fit.keys():
+        np.testing.assert_array_equal(serial_fit[key], pool_fit[key])
+    assert(serial_fit['good_fit'].all())
+    np.testing.assert_allclose(serial_fit['median_sky'], 300.0)
+
+    # Subtracting the fitted models should remove most of the star flux
+    residuals = photometry.subtract_psf_models(image, psf_model, xstars, ystars,
+                                               serial_fit['intensity'], 15.0,
+                                               serial_fit['good_fit'], work_units)
+    assert((residuals - sky_bkgd).std() < 0.5*(image - sky_bkgd).std())
+
+    logs.close_log(log)
+
 if __name__ == '__main__':
 
     #test_run_psf_photometry()
@@ -492,6 +492,69 @@ def test_mask_datapoints_by_image_stamp():
 
     logs.close_log(log)
 
+def test_calc_qc_statistics():
+
+    params = test_params()
+    log = logs.start_stage_log( params['log_dir'], 'test_postproc_phot' )
+
+    (photometry, phot_stats) = test_photometry(log)
+
+    (qc_stats, image_residuals) = postproc_qc.calc_qc_statistics(photometry, log, 'calibrated')
+
+    assert(qc_stats.shape == phot_stats.shape)
+    np.testing.assert_allclose(qc_stats[:,0], phot_stats[:,0])
+    np.testing.assert_allclose(qc_stats[:,1], phot_stats[:,1])
+    np.testing.assert_allclose(qc_stats[:,3], phot_stats[:,3])
+
+    phot_residuals = postproc_qc.calc_phot_residuals(photometry, qc_stats, log, 'calibrated')
+    err_squared_inv = 1.0 / (phot_residuals[:,:,1]*phot_residuals[:,:,1])
+    mean_residuals = (phot_residuals[:,:,0] * err_squared_inv).sum(axis=0) / (err_squared_inv.sum(axis=0))
+    assert(image_residuals.shape == (photometry.shape[1],3))
+    np.testing.assert_allclose(image_residuals[:,0], mean_residuals)
+
+    # Processing the array in chunks of stars should give the same results,
+    # and invalid or masked datapoints should be excluded
+    photometry[0,:,13] = 0.0
+    photometry = postproc_qc.mask_photometry_array(photometry, 1, log)
+    (full_stats, full_residuals) = postproc_qc.calc_qc_statistics(photometry, log, 'calibrated')
+    (chunk_stats, chunk_residuals) = postproc_qc.calc_qc_statistics(photometry, log, 'calibrated',
+                                                                    star_chunk=7)
+
+    assert((full_stats[0,:] == 0.0).all())
+    np.testing.assert_allclose(chunk_stats, full_stats)
+    np.testing.assert_allclose(chunk_residuals, full_residuals)
+
+    logs.close_log(log)
+
+def test_apply_qc_flags():
+
+    params = test_params()
+    log = logs.start_stage_log( params['log_dir'], 'test_postproc_phot' )
+
+    (photometry, phot_stats) = test_photometry(log)
+
+    bad_images = np.zeros(photometry.shape[1], dtype='bool')
+    bad_images[2] = True
+    bad_data = np.zeros(photometry.shape[0:2], dtype='bool')
+    bad_data[5,2] = True
+    bad_data[6,3] = True
+
+    photometry = postproc_qc.apply_qc_flags(photometry, [(2, bad_images), (4, bad_data)],
+                                            log, star_chunk=4)
+
+    mask = np.ma.getmask(photometry)
+    data = np.ma.getdata(photometry)
+
+    assert( (mask[:,2,:] == True).all() )
+    assert( (mask[6,3,:] == True).all() )
+    assert( (mask[7,3,:] == False).all() )
+    assert( data[5,2,25] == 6 )
+    assert( data[6,3,25] == 4 )
+    assert( data[0,2,25] == 2 )
+    assert( data[0,0,25] == 0 )
+
+    logs.close_log(log)
+
 if __name__ == '__main__':
     #test_grow_photometry_array()
     #test_calc_phot_residuals()
@@ -740,6 +740,80 @@ def test_calc_stamp_corners():
     assert(corners[2] == 193)
     assert(corners[3] == 201)
 
+def test_calc_stamp_pixels():
+
+    xcen = np.array([184.0, 2.3, 98.6])
+    ycen = np.array([197.0, 50.2, 1.4])
+    psf_diameter = 15.0
+    (maxx, maxy) = (100, 210)
+
+    (Y_stamps, X_stamps, inside) = psf.calc_stamp_pixels(xcen, ycen, psf_diameter, psf_diameter,
+                                                         maxx, maxy)
+
+    assert(Y_stamps.shape == (3,15,15))
+    for j in range(0,len(xcen),1):
+        corners = psf.calc_stamp_corners(xcen[j], ycen[j], psf_diameter, psf_diameter,
+                                         maxx, maxy, over_edge=True)
+        if corners[1] > corners[0]:
+            assert(X_stamps[j][inside[j]].min() == corners[0])
+            assert(X_stamps[j][inside[j]].max() == corners[1]-1)
+            assert(Y_stamps[j][inside[j]].min() == corners[2])
+            assert(Y_stamps[j][inside[j]].max() == corners[3]-1)
+        else:
+            assert(inside[j].any() == False)
+
+def test_group_blended_stars():
+
+    xstars = np.array([10.0, 50.0, 55.0, 200.0, 210.0, 220.0, 400.0])
+    ystars = np.array([10.0, 50.0, 52.0, 200.0, 200.0, 206.0, 10.0])
+
+    (groups, group_size) = psf.group_blended_stars(xstars, ystars, 15.0)
+
+    assert(len(group_size) == 4)
+    assert(groups[1] == groups[2])
+    assert(groups[3] == groups[4] == groups[5])
+    assert(len(np.unique(groups[[0,1,3,6]])) == 4)
+    assert(group_size[groups[3]] == 3)
+
+    # Large groups are split by reducing the critical separation
+    (groups, group_size) = psf.group_blended_stars(xstars, ystars, 15.0,
+                                                   max_group_size=2)
+    assert(group_size.max() <= 2)
+    assert(groups[1] == groups[2])
+
+def test_fit_star_group_existing_model():
+
+    np.random.seed(21)
+    psf_params = [1.0, 0.0, 0.0, 2.5, 2.2]
+    sky_value = 300.0
+    xstars = np.array([40.0, 44.5, 37.2])
+    ystars = np.array([40.0, 41.2, 45.3])
+    intensities = np.array([2000.0, 800.0, 1500.0])
+
+    (Y_stamps, X_stamps, inside) = psf.calc_stamp_pixels(xstars, ystars, 15.0, 15.0, 80, 80)
+    image = np.zeros((80,80)) + sky_value + np.random.normal(0.0, 1.0, (80,80))
+    psf_model = psf.get_psf_object('Moffat2D')
+    psf_model.update_psf_parameters(psf_params)
+    models = psf.model_unit_psfs(psf_model, Y_stamps, X_stamps, xstars, ystars) * \
+                intensities[:,np.newaxis,np.newaxis]
+    np.add.at(image, (Y_stamps[inside], X_stamps[inside]), models[inside])
+    sky_bkgd = np.zeros(image.shape) + sky_value
+
+    (intensity, x_fit, y_fit, good_fit) = psf.fit_star_group_existing_model(image, sky_bkgd,
+                                                        psf_model, xstars, ystars, 15.0)
+
+    assert(good_fit.all())
+    np.testing.assert_allclose(intensity, intensities, rtol=0.01)
+
+    (intensity, x_fit, y_fit, good_fit) = psf.fit_star_group_existing_model(image, sky_bkgd,
+                                                        psf_model, xstars+0.3, ystars-0.3,
+                                                        15.0, centroiding=True)
+
+    assert(good_fit.all())
+    np.testing.assert_allclose(intensity, intensities, rtol=0.01)
+    np.testing.assert_allclose(x_fit, xstars, atol=0.02)
+    np.testing.assert_allclose(y_fit, ystars, atol=0.02)
+
 def test_calc_optimized_flux():
     """Function to test the calculation of the optimized flux, given a PSF
     model"""
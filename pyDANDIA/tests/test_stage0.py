@@ -421,6 +421,69 @@ def test_update_reduction_metadata_headers_summary_with_new_images():
     os.remove('Leia.fits')
 
 
+def test_prepare_new_images():
+    setup = mock.MagicMock()
+    setup.verbosity = 0
+    log = mock.MagicMock()
+
+    reduction_metadata = metadata.MetaData()
+
+    config_dir = path.join(path.dirname(path.abspath(__file__)), '../../config/')
+    pipeline_config = stage0.read_the_config_file(config_dir, log=None)
+
+    stage0.update_reduction_metadata_with_config_file(reduction_metadata, pipeline_config, log=None)
+    inst_config_dictionnary = stage0.read_the_inst_config_file(config_dir, 'inst_config_fl15.json', log=None)
+    inst_config_dictionnary['OBSTYPE'] = {"comment": "tres bon",
+                                          "value": "OBJECT",
+                                          "format": "S200",
+                                          "unit": ""}
+
+    stage0.update_reduction_metadata_with_inst_config_file(reduction_metadata, inst_config_dictionnary, log=None)
+    reduction_metadata.data_architecture[1] = {'IMAGES_PATH': ['./']}
+
+    new_images = []
+    for i, target in enumerate(['NDG', 'LMC']):
+        header = fits.Header()
+        header['OBJECT'] = target
+        image_data = np.zeros((20, 20)) + 100.0
+        image_data[5, 5] = 1e6
+        bpm_data = np.zeros((20, 20), dtype=int)
+        bpm_data[10, 10] = 1
+
+        hdulist = fits.HDUList([fits.PrimaryHDU(image_data, header=header),
+                                fits.ImageHDU(bpm_data, name='BPM')])
+        hdulist.writeto('Leia'+str(i)+'.fits', overwrite=True)
+        new_images.append('Leia'+str(i)+'.fits')
+
+    instrument_bpm = stage0.bad_pixel_mask.BadPixelMask()
+    instrument_bpm.create_empty_masks((20, 20))
+
+    for n_workers in [1, 2]:
+        header_infos = stage0.prepare_new_images(setup, reduction_metadata, new_images,
+                                                 instrument_bpm, n_workers, log)
+
+        assert len(header_infos) == 2
+        assert header_infos[1][0][1] == 'LMC'
+
+        for image_name in new_images:
+            test_image = fits.open(image_name)
+            pixel_mask = test_image['pyDANDIA_PIXEL_MASK'].data
+            assert len(test_image) == 3
+            assert pixel_mask[5, 5] > 0
+            assert pixel_mask[10, 10] > 0
+            assert pixel_mask[15, 15] == 0
+            test_image.close()
+
+    stage0.add_new_images_to_headers_summary(reduction_metadata, new_images,
+                                             header_infos, log=None)
+
+    assert list(reduction_metadata.headers_summary[1]['IMAGES']) == new_images
+    assert list(reduction_metadata.headers_summary[1]['OBSTYPE']) == ['NDG', 'LMC']
+
+    for image_name in new_images:
+        os.remove(image_name)
+
+
 def test_construct_the_stamps():
     image = np.zeros((300, 300))
     image = fits.PrimaryHDU(image)
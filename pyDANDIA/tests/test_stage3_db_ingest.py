@@ -12,6 +12,7 @@ from astropy.io import fits
 from astropy import table
 import numpy as np
 import sqlite3
+import mock
 from skimage.transform import AffineTransform
 from pyDANDIA import  logs
 from pyDANDIA import  metadata
@@ -290,6 +291,67 @@ def test_commit_stars():
 
     logs.close_log(log)
 
+def test_match_stars_on_position():
+
+    stars = table.Table([table.Column(name='star_id', data=[1, 2, 3, 4]),
+                         table.Column(name='ra', data=[270.0, 270.0002, 270.1, 269.9]),
+                         table.Column(name='dec', data=[-28.0, -28.0001, -28.1, -27.9])])
+    tol = 1.0/3600.0
+
+    ra = np.array([270.0001, 270.1, 271.0, 269.9])
+    dec = np.array([-28.0001, -28.1002, -28.0, -27.9])
+
+    star_ids = stage3_db_ingest.match_stars_on_position(stars, ra, dec, tol)
+
+    assert list(star_ids) == [1, 3, 0, 4]
+
+    star_ids = stage3_db_ingest.match_stars_on_position(stars[0:0], ra, dec, tol)
+
+    assert (star_ids == 0).all()
+
+def test_match_duplicate_positions():
+
+    tol = 1.0/3600.0
+    ra = np.array([270.0, 270.0002, 270.1, 270.0004, 270.0001])
+    dec = np.array([-28.0, -28.0, -28.1, -28.0, -28.0001])
+
+    duplicate_of = stage3_db_ingest.match_duplicate_positions(ra, dec, tol)
+
+    # The fourth entry is within tol of the second, but that is a duplicate
+    # of the first, which is out of range
+    assert list(duplicate_of) == [-1, 0, -1, -1, 0]
+
+def test_commit_stars_search_for_match(tmp_path):
+
+    log = mock.MagicMock()
+    conn = phot_db.get_connection(dsn=str(tmp_path / 'phot.db'))
+    conn.execute('PRAGMA foreign_keys=OFF')
+    conn.execute("INSERT INTO reference_images (filename) VALUES ('ref.fits')")
+    phot_db.feed_to_table_many(conn, 'stars', ['ra', 'dec'], [(269.9, -27.9)])
+
+    columns = ['index', 'ra', 'dec', 'gaia_source_id', 'gaia_ra', 'gaia_ra_error',
+               'gaia_dec', 'gaia_dec_error', 'phot_g_mean_flux', 'phot_g_mean_flux_error',
+               'phot_bp_mean_flux', 'phot_bp_mean_flux_error',
+               'phot_rp_mean_flux', 'phot_rp_mean_flux_error',
+               'vphas_source_id', 'vphas_ra', 'vphas_dec',
+               'gmag', 'gmag_error', 'rmag', 'rmag_error', 'imag', 'imag_error', 'clean']
+    ra = [270.0, 270.0002, 269.9, 270.1]
+    dec = [-28.0, -28.0, -27.9, -28.1]
+    data = [np.arange(1,5,1), ra, dec] + [np.zeros(4)]*(len(columns)-4) + [np.ones(4, dtype=int)]
+    reduction_metadata = mock.MagicMock()
+    reduction_metadata.star_catalog = [None, table.Table(data, names=columns)]
+
+    star_ids = stage3_db_ingest.commit_stars(conn, {'ref_filename': 'ref.fits'},
+                                             reduction_metadata, log,
+                                             search_for_match=True)
+
+    assert list(star_ids) == [2, 2, 1, 3]
+
+    t = phot_db.query_to_astropy_table(conn, 'SELECT star_id, star_index FROM stars', args=())
+    assert len(t) == 3
+
+    conn.close()
+
 def test_commit_photometry():
 
     if os.path.isfile(db_file_path):
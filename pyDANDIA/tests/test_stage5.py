@@ -6,10 +6,13 @@ from os import getcwd, path
 from sys import path as systempath
 import collections
 from astropy.io import fits
+from astropy.table import Table, Column
+from skimage import transform as tf
 
 cwd = getcwd()
 systempath.append(path.join(cwd, '../'))
 from umatrix_routine import umatrix_construction
+import stage4
 import stage5
 import metadata
 import numpy as np
@@ -121,6 +124,52 @@ def test_bvector_constant():
 
     assert np.allclose(bvector,expected)
 
+def brute_force_umatrix(reference_image, data_image, weights, kernel_size):
+    half = int(kernel_size / 2)
+    pandq = [(l - half, m - half) for l in range(kernel_size) for m in range(kernel_size)]
+    n_kernel = len(pandq)
+    (ni, nj) = reference_image.shape
+
+    u_matrix = np.zeros((n_kernel + 1, n_kernel + 1))
+    b_vector = np.zeros(n_kernel + 1)
+    for p, (l, m) in enumerate(pandq):
+        for q, (lp, mp) in enumerate(pandq):
+            for i in range(half, ni - half):
+                for j in range(half, nj - half):
+                    u_matrix[p, q] += reference_image[i + l, j + m] * reference_image[i + lp, j + mp] * weights[i, j]
+        for i in range(half, ni - half):
+            for j in range(half, nj - half):
+                u_matrix[p, n_kernel] += reference_image[i + l, j + m] * weights[i, j]
+                b_vector[p] += data_image[i, j] * reference_image[i + l, j + m] * weights[i, j]
+        u_matrix[n_kernel, p] = u_matrix[p, n_kernel]
+    u_matrix[n_kernel, n_kernel] = weights.sum()
+    b_vector[n_kernel] = (data_image * weights).sum()
+
+    return u_matrix, b_vector
+
+def test_umatrix_engines():
+
+    rng = np.random.default_rng(42)
+    reference_image = rng.normal(loc=1000.0, scale=50.0, size=(17, 14))
+    data_image = rng.normal(loc=1000.0, scale=50.0, size=(17, 14))
+    noise_image = np.zeros((17, 14))
+    noise_image[3, 5] = 1
+    noise_image[10, 9] = 1
+
+    weights = stage5.noise_model(noise_image)
+    (expected_u, expected_b) = brute_force_umatrix(reference_image, data_image, weights, 5)
+
+    for engine in ['numpy', 'fft']:
+        u_matrix = stage5.umatrix_constant(reference_image, 5, noise_image, engine=engine)
+        b_vector = stage5.bvector_constant(reference_image, data_image, 5, noise_image, engine=engine)
+
+        assert u_matrix.shape == expected_u.shape
+        assert np.allclose(u_matrix, expected_u, rtol=1e-12)
+        assert np.allclose(b_vector, expected_b, rtol=1e-12)
+
+    with pytest.raises(ValueError):
+        stage5.umatrix_constant(reference_image, 5, noise_image, engine='unknown')
+
 def test_noise_model():
     model = np.ones((5,5))*0.123
     gain = 1
@@ -264,6 +313,153 @@ def test_quality_control_matrix_sort():
     assert(type(sorted_data) == type(quality_metrics))
     assert(np.array_equal(sorted_data, full_quality_metrics))
 
+def test_kernel_uncertainty_analytic():
+
+    kernel_size = 3
+    diagonal = np.arange(1, kernel_size * kernel_size + 2, dtype=float)
+    u_matrix = np.diag(diagonal)
+
+    err_kernel = stage5.kernel_uncertainty_analytic(u_matrix, 4.0, kernel_size)
+
+    expected = np.sqrt(4.0 / diagonal[:-1]).reshape((kernel_size, kernel_size))
+    expected = np.flip(np.flip(expected, 0), 1)
+
+    assert err_kernel.shape == (kernel_size, kernel_size)
+    assert np.allclose(err_kernel, expected)
+
+def test_kernel_solution_factorised():
+
+    rng = np.random.default_rng(7)
+    kernel_size = 3
+    design = rng.normal(size=(200, kernel_size * kernel_size + 1))
+    u_matrix = np.dot(design.T, design)
+    b_vector = rng.normal(size=kernel_size * kernel_size + 1)
+
+    u_factor = stage5.factorise_umatrix(u_matrix)
+
+    assert np.allclose(u_factor[1], np.diag(np.linalg.inv(u_matrix)))
+
+    (kernel, bkg, err) = stage5.kernel_solution(u_matrix, b_vector, kernel_size, circular=False)
+    (kernel_fac, bkg_fac, err_fac) = stage5.kernel_solution(u_matrix, b_vector, kernel_size, circular=False,
+                                                            u_factor=u_factor)
+
+    assert np.allclose(kernel_fac, kernel)
+    assert np.isclose(bkg_fac, bkg)
+    assert np.allclose(stage5.kernel_uncertainty_analytic(u_matrix, 2.0, kernel_size, u_factor=u_factor),
+                       stage5.kernel_uncertainty_analytic(u_matrix, 2.0, kernel_size))
+
+    assert stage5.factorise_umatrix(np.zeros((4, 4))) is None
+
+def test_load_umatrix_grid(tmp_path):
+
+    log = mock.MagicMock()
+    rng = np.random.default_rng(8)
+    reference_image = rng.normal(1000.0, 30.0, size=(40, 40))
+    master_mask = np.zeros((40, 40), dtype=bool)
+    stamps = Table([Column(name='PIXEL_INDEX', data=[0, 1]),
+                    Column(name='Y_MIN', data=[0, 20]),
+                    Column(name='Y_MAX', data=[20, 40]),
+                    Column(name='X_MIN', data=[0, 0]),
+                    Column(name='X_MAX', data=[40, 40])])
+
+    (umatrices_grid, factors_grid) = stage5.load_umatrix_grid(reference_image, master_mask, stamps, [3, 5],
+                                                              65000.0, str(tmp_path), log, engine='numpy')
+
+    assert len(umatrices_grid) == 2
+    assert len(factors_grid[1]) == 2
+    assert umatrices_grid[1][0].shape == (26, 26)
+
+    # Changing one stamp of the reference only recomputes the entries of that stamp
+    reference_image[25, 10] += 500.0
+    (updated_grid, updated_factors) = stage5.load_umatrix_grid(reference_image, master_mask, stamps, [3, 5],
+                                                               65000.0, str(tmp_path), log, engine='numpy')
+
+    assert np.allclose(updated_grid[0][0], umatrices_grid[0][0])
+    assert not np.allclose(updated_grid[0][1], umatrices_grid[0][1])
+    assert np.allclose(updated_factors[1][0][0], factors_grid[1][0][0])
+    assert len(os.listdir(path.join(str(tmp_path), 'umatrix_store'))) == 13
+
+def test_stamp_coordinate_map():
+
+    rng = np.random.default_rng(4)
+    image = rng.normal(100.0, 20.0, size=(60, 80))
+    stamp_slice = [10, 40, 20, 60]
+    image_matrix = np.array([[1.0, 0.0, 3.0], [0.0, 1.0, -2.0], [0.0, 0.0, 1.0]])
+    stamp_matrix = np.array([[1.0, 0.0, -1.0], [0.0, 1.0, 2.0], [0.0, 0.0, 1.0]])
+
+    resampled_image = stage4.warp_image(image, image_matrix)
+    expected = stage4.warp_image(resampled_image[10:40, 20:60], stamp_matrix)
+
+    coordinate_map = stage5.stamp_coordinate_map(tf.ProjectiveTransform(matrix=image_matrix),
+                                                 tf.ProjectiveTransform(matrix=stamp_matrix), stamp_slice)
+    stamp_image = stage5.resample_stamp(image, coordinate_map)
+
+    assert stamp_image.shape == (30, 40)
+    assert np.allclose(coordinate_map[:, 0, 0], [10.0, 22.0])
+    assert np.allclose(stamp_image[2:-2, 2:-2], expected[2:-2, 2:-2])
+
+def test_gather_stamp_quality_metrics():
+    """Function to test the combination of per-stamp results into per-image
+    quality metrics"""
+
+    setup = mock.MagicMock()
+    setup.verbosity = 1
+    log = mock.MagicMock()
+
+    new_images = ['image2.fits', 'image1.fits']
+    work_units = [['image1.fits', 0, 0, [0, 10, 0, 10], 0],
+                  ['image2.fits', 0, 0, [0, 10, 0, 10], 1],
+                  ['image1.fits', 1, 1, [10, 20, 0, 10], 0],
+                  ['image2.fits', 1, 1, [10, 20, 0, 10], 1],
+                  ['image1.fits', 2, 2, [20, 30, 0, 10], 0],
+                  ['image2.fits', 2, 2, [20, 30, 0, 10], 1]]
+    stamp_results = [['OK', 'Completed successfully', [1.0, 0.1, 10.0, 0.5, 100, 0.0, 0.0]],
+                     ['OK', 'Completed successfully', [2.0, 0.2, 20.0, 1.0, 200, 1.0, 1.0]],
+                     ['OK', 'Completed successfully', [1.2, 0.3, 12.0, 0.7, 120, 0.2, 0.2]],
+                     ['KO', 'Singular matrix', None],
+                     ['OK', 'Completed successfully', [1.4, 0.2, 14.0, 0.6, 110, 0.4, 0.4]],
+                     ['OK', 'Completed successfully', [2.2, 0.2, 22.0, 1.2, 220, 1.2, 1.2]]]
+    image_bins = {'image1.fits': 0, 'image2.fits': 1}
+
+    quality_metrics = stage5.gather_stamp_quality_metrics(new_images, work_units, stamp_results,
+                                                          image_bins, setup, log)
+
+    assert len(quality_metrics) == 2
+    assert quality_metrics[0] == ['image2.fits', -1.0, -1.0, -1.0, -1.0, 0, -1.0, -1.0]
+    assert quality_metrics[1][0] == 'image1.fits'
+    assert np.allclose(quality_metrics[1][1:], [1.2, 0.2, 12.0, 0.6, 110, 0.2, 0.2])
+
+def fake_stamp_kernel_solution(unit):
+    """Stand-in for stage5.stamp_kernel_solution_pool, returning the work
+    unit with data set by the worker initializer and the worker process ID"""
+
+    return [unit[0], unit[1], stage5.stamp_worker_data['kernel_size'] * unit[1],
+            stage5.stamp_worker_data['data_image'], os.getpid()]
+
+def test_run_stamp_work_units():
+
+    log = mock.MagicMock()
+    shared_data = {'kernel_size': 3}
+
+    for n_stamps in [2, 6]:
+        work_units = [['image'+str(i // n_stamps)+'.fits', i % n_stamps, i % n_stamps, None, 0]
+                      for i in range(0,6,1)]
+
+        with mock.patch.object(stage5, 'stamp_kernel_solution_pool', fake_stamp_kernel_solution):
+            serial_results = stage5.run_stamp_work_units(work_units, shared_data, 1, n_stamps, log)
+            pool_results = stage5.run_stamp_work_units(work_units, shared_data, 2, n_stamps, log)
+
+        assert [r[0:4] for r in pool_results] == [r[0:4] for r in serial_results]
+        assert [r[0:2] for r in pool_results] == [u[0:2] for u in work_units]
+        assert [r[3] for r in pool_results] == [[None, None, None]]*6
+        assert set([r[4] for r in pool_results]) != set([os.getpid()])
+
+        # With enough images to occupy the pool, the stamps of each image
+        # are solved by the same worker
+        if n_stamps == 2:
+            for i in range(0,6,2):
+                assert pool_results[i][4] == pool_results[i+1][4]
+
 if __name__ == '__main__':
 
     test_quality_control_matrix_sort()
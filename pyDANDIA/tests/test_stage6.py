@@ -143,6 +143,36 @@ def test_store_stamp_photometry_to_array():
 
     logs.close_log(log)
 
+def test_build_stamp_star_catalogs():
+
+    starlist = Table([Column(name='index', data=np.arange(1,6,1)),
+                      Column(name='x', data=[10.0, 60.0, 110.0, 160.0, 100.0]),
+                      Column(name='y', data=[10.0, 10.0, 60.0, 160.0, 40.0]),
+                      Column(name='ra', data=np.zeros(5)),
+                      Column(name='dec', data=np.zeros(5)),
+                      Column(name='ref_flux', data=np.linspace(1000.0,5000.0,5)),
+                      Column(name='ref_flux_error', data=np.linspace(10.0,50.0,5)),
+                      Column(name='gaia_source_id', data=['1','2','3','4','5'])])
+
+    stamps = Table([Column(name='PIXEL_INDEX', data=[0, 1]),
+                    Column(name='Y_MIN', data=[0, 0]),
+                    Column(name='Y_MAX', data=[100, 100]),
+                    Column(name='X_MIN', data=[0, 50]),
+                    Column(name='X_MAX', data=[100, 150])])
+
+    ref_star_catalog = stage6.build_ref_star_catalog(starlist)
+
+    assert ref_star_catalog['star_id'].tolist() == [1, 2, 3, 4, 5]
+    assert ref_star_catalog['ref_flux_err'][2] == 30.0
+
+    stamp_star_catalogs = stage6.build_stamp_star_catalogs(ref_star_catalog, stamps)
+
+    assert stamp_star_catalogs[0]['star_id'].tolist() == [1, 2]
+    assert stamp_star_catalogs[1]['star_id'].tolist() == [2, 3, 5]
+    assert stamp_star_catalogs[1]['x'].tolist() == [10.0, 60.0, 50.0]
+    assert stamp_star_catalogs[1]['y'].tolist() == [10.0, 60.0, 40.0]
+    assert ref_star_catalog['x'][1] == 60.0
+
 if __name__ == '__main__':
 
     #test_build_photometry_array()
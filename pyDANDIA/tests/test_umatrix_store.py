@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import mock
+import numpy as np
+cwd = os.getcwd()
+sys.path.append(os.path.join(cwd,'../'))
+import umatrix_store
+
+def test_array_checksum():
+
+    data = np.arange(12.0).reshape(3,4)
+
+    assert umatrix_store.array_checksum(data) == umatrix_store.array_checksum(np.asfortranarray(data))
+    assert umatrix_store.array_checksum(data) != umatrix_store.array_checksum(data.reshape(4,3))
+    assert umatrix_store.array_checksum(data) != umatrix_store.array_checksum(data.astype('float32'))
+
+def test_store_entries(tmp_path):
+
+    log = mock.MagicMock()
+    store_directory = os.path.join(str(tmp_path), 'umatrix_store')
+    reference_stamp = np.ones((10,10))
+    mask_stamp = np.zeros((10,10), dtype=bool)
+    u_matrix = np.identity(10) * 2.0
+    u_factor = [np.identity(10) * np.sqrt(2.0), np.ones(10) * 0.5]
+
+    store = umatrix_store.UMatrixStore(store_directory, log=log)
+    (key, description) = store.entry_key(reference_stamp, mask_stamp, 3, 65000.0)
+
+    assert not store.has_entry(key)
+    assert key != store.entry_key(reference_stamp, mask_stamp, 5, 65000.0)[0]
+    assert key != store.entry_key(reference_stamp, mask_stamp, 3, 60000.0)[0]
+    assert key != store.entry_key(reference_stamp, ~mask_stamp, 3, 65000.0)[0]
+
+    store.add_entry(key, description, u_matrix, u_factor)
+    (key_singular, description_singular) = store.entry_key(reference_stamp * 2.0, mask_stamp, 3, 65000.0)
+    store.add_entry(key_singular, description_singular, np.zeros((10,10)), None)
+    store.save_index()
+
+    store = umatrix_store.UMatrixStore(store_directory, log=log)
+
+    assert store.has_entry(key)
+    (stored_umatrix, stored_factor) = store.fetch(key)
+    assert isinstance(stored_umatrix, np.memmap)
+    assert np.allclose(stored_umatrix, u_matrix)
+    assert np.allclose(stored_factor[0], u_factor[0])
+    assert np.allclose(stored_factor[1], u_factor[1])
+
+    # Entries not used since the store was opened are out of date
+    assert store.prune() == 1
+    assert not store.has_entry(key_singular)
+    assert store.has_entry(key)
+
+def test_store_version(tmp_path):
+
+    store_directory = str(tmp_path)
+    store = umatrix_store.UMatrixStore(store_directory)
+    (key, description) = store.entry_key(np.ones((5,5)), np.zeros((5,5)), 3, 100.0)
+    store.add_entry(key, description, np.identity(10), None)
+    store.save_index()
+
+    index_path = os.path.join(store_directory, umatrix_store.INDEX_FILE)
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    index['version'] = umatrix_store.STORE_VERSION - 1
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+
+    store = umatrix_store.UMatrixStore(store_directory)
+
+    assert not store.has_entry(key)
+
+    # The files of the out of date entries are removed by the next prune
+    (new_key, new_description) = store.entry_key(np.ones((5,5)), np.zeros((5,5)), 5, 100.0)
+    store.add_entry(new_key, new_description, np.identity(10), None)
+
+    assert store.prune() == 1
+    assert not os.path.isfile(store.entry_path(key, 'umatrix'))
+    assert os.path.isfile(store.entry_path(new_key, 'umatrix'))
+
+def test_remove_legacy_files(tmp_path):
+
+    kernel_directory = str(tmp_path)
+    for file_name in umatrix_store.LEGACY_FILES:
+        np.save(os.path.join(kernel_directory, file_name), np.zeros(3))
+
+    assert umatrix_store.remove_legacy_files(kernel_directory) == 2
+    assert os.listdir(kernel_directory) == []
+    assert umatrix_store.remove_legacy_files(kernel_directory) == 0
@@ -0,0 +1,348 @@
+######################################################################
+#
+# umatrix_numpy.py - Vectorised counterpart of the cython module
+# umatrix_routine, building the u-matrix and b-vector of the Bramich
+# (2008) kernel solution from correlations of the reference image.
+#
+# Every element of the u-matrix is a weighted cross-product of two
+# shifted copies of the reference image. Rather than looping over each
+# (p, q) pair and each stamp pixel, the products are computed either as
+# a single matrix product of the stack of shifted images ('numpy'), or
+# as the correlation of each weighted shifted image with the reference,
+# which yields a full row of the matrix per FFT ('fft').
+#
+# dependencies:
+#      numpy 1.8+
+#      scipy 1.4+
+######################################################################
+import numpy as np
+from scipy import fft as sp_fft
+
+# Maximum number of elements held in memory at once by the stack of
+# shifted reference images used in the 'numpy' method
+MAX_STACK_SIZE = 2**23
+
+def kernel_offsets(pandq, kernel_size):
+    '''
+    Converts the list of kernel pixel offsets into arrays of indices
+    relative to the corner of the kernel footprint
+
+    :param list pandq: list of (l, m) kernel pixel offsets
+    :param int kernel_size: edge length of the kernel in px
+
+    :return: l and m offsets, each shifted by half the kernel size
+    '''
+    half_kernel_size = int(kernel_size) // 2
+    offsets = np.array(pandq, dtype=int).reshape(-1, 2)
+
+    return offsets[:, 0] + half_kernel_size, offsets[:, 1] + half_kernel_size
+
+def shifted_images(reference_image, pandq, kernel_size, i_range, j_range):
+    '''
+    Returns the stack of reference image sections shifted by each of the
+    kernel pixel offsets, as seen from the pixels of the fitted region
+
+    :param array reference_image: reference image
+    :param list pandq: list of (l, m) kernel pixel offsets
+    :param int kernel_size: edge length of the kernel in px
+    :param tuple i_range: first and last+1 row of the fitted region
+    :param tuple j_range: first and last+1 column of the fitted region
+
+    :return: array of shape (n_offsets, n_rows, n_columns)
+    '''
+    half_kernel_size = int(kernel_size) // 2
+    l_idx, m_idx = kernel_offsets(pandq, kernel_size)
+    ni = i_range[1] - i_range[0]
+    nj = j_range[1] - j_range[0]
+
+    stack = np.empty((len(l_idx), ni, nj))
+    for idx, (l, m) in enumerate(zip(l_idx, m_idx)):
+        i0 = i_range[0] - half_kernel_size + l
+        j0 = j_range[0] - half_kernel_size + m
+        stack[idx] = reference_image[i0:i0 + ni, j0:j0 + nj]
+
+    return stack
+
+def correlation_rows(reference_image, templates, pandq, kernel_size, i_range, j_range):
+    '''
+    Computes, for each template image defined over the fitted region, the
+    sum over that region of template * reference shifted by each kernel
+    offset, using one FFT of the reference and one per template.
+
+    :param array reference_image: reference image
+    :param array templates: array of shape (n_templates, n_rows, n_columns)
+    :param list pandq: list of (l, m) kernel pixel offsets
+    :param int kernel_size: edge length of the kernel in px
+    :param tuple i_range: first and last+1 row of the fitted region
+    :param tuple j_range: first and last+1 column of the fitted region
+
+    :return: array of shape (n_templates, n_offsets)
+    '''
+    half_kernel_size = int(kernel_size) // 2
+    l_idx, m_idx = kernel_offsets(pandq, kernel_size)
+    ni = i_range[1] - i_range[0]
+    nj = j_range[1] - j_range[0]
+
+    # Only the part of the reference reachable from the fitted region
+    # through the kernel footprint contributes
+    section = reference_image[i_range[0] - half_kernel_size:i_range[1] + half_kernel_size,
+                              j_range[0] - half_kernel_size:j_range[1] + half_kernel_size]
+
+    fft_shape = (sp_fft.next_fast_len(section.shape[0] + ni - 1, real=True),
+                 sp_fft.next_fast_len(section.shape[1] + nj - 1, real=True))
+    section_fft = sp_fft.rfft2(section, s=fft_shape)
+
+    rows = np.zeros((len(templates), len(l_idx)))
+    for idx, template in enumerate(templates):
+        template_fft = sp_fft.rfft2(template[::-1, ::-1], s=fft_shape)
+        correlation = sp_fft.irfft2(section_fft * template_fft, s=fft_shape)
+        rows[idx] = correlation[ni - 1 + l_idx, nj - 1 + m_idx]
+
+    return rows
+
+def cross_products(reference_image, weights, pandq, kernel_size, i_range, j_range, method='fft'):
+    '''
+    Computes the weighted cross-products of every pair of shifted reference
+    images, together with the weighted sum of each shifted image, over
+    the fitted region
+
+    :param array reference_image: reference image
+    :param array weights: pixel weights
+    :param list pandq: list of (l, m) kernel pixel offsets
+    :param int kernel_size: edge length of the kernel in px
+    :param tuple i_range: first and last+1 row of the fitted region
+    :param tuple j_range: first and last+1 column of the fitted region
+    :param string method: 'numpy' or 'fft'
+
+    :return: matrix of cross-products and vector of weighted sums
+    '''
+    n_kernel = len(pandq)
+    region_weights = weights[i_range[0]:i_range[1], j_range[0]:j_range[1]]
+
+    if method == 'fft':
+        l_idx, m_idx = kernel_offsets(pandq, kernel_size)
+        half_kernel_size = int(kernel_size) // 2
+        u_block = np.zeros((n_kernel, n_kernel))
+        for p in range(n_kernel):
+            i0 = i_range[0] - half_kernel_size + l_idx[p]
+            j0 = j_range[0] - half_kernel_size + m_idx[p]
+            template = reference_image[i0:i0 + region_weights.shape[0],
+                                       j0:j0 + region_weights.shape[1]] * region_weights
+            u_block[p] = correlation_rows(reference_image, template[np.newaxis], pandq, kernel_size,
+                                          i_range, j_range)[0]
+        # Symmetrize to suppress the FFT rounding noise between (p,q) and (q,p)
+        u_block = 0.5 * (u_block + u_block.T)
+        w_sums = correlation_rows(reference_image, region_weights[np.newaxis], pandq, kernel_size,
+                                  i_range, j_range)[0]
+
+    elif method == 'numpy':
+        n_cols = region_weights.shape[1]
+        rows_per_chunk = max(1, int(MAX_STACK_SIZE / max(1, n_kernel * n_cols)))
+        u_block = np.zeros((n_kernel, n_kernel))
+        w_sums = np.zeros(n_kernel)
+        for i_start in range(i_range[0], i_range[1], rows_per_chunk):
+            i_end = min(i_start + rows_per_chunk, i_range[1])
+            stack = shifted_images(reference_image, pandq, kernel_size, (i_start, i_end), j_range)
+            stack = stack.reshape(n_kernel, -1)
+            chunk_weights = weights[i_start:i_end, j_range[0]:j_range[1]].ravel()
+            weighted_stack = stack * chunk_weights
+            u_block += np.dot(weighted_stack, stack.T)
+            w_sums += weighted_stack.sum(axis=1)
+
+    else:
+        raise ValueError('Unknown u-matrix construction method ' + str(method))
+
+    return u_block, w_sums
+
+def data_products(reference_image, data_image, weights, pandq, kernel_size, i_range, j_range, method='fft'):
+    '''
+    Computes the weighted products of the data image with every shifted
+    reference image over the fitted region
+
+    :param array reference_image: reference image
+    :param array data_image: data image
+    :param array weights: pixel weights
+    :param list pandq: list of (l, m) kernel pixel offsets
+    :param int kernel_size: edge length of the kernel in px
+    :param tuple i_range: first and last+1 row of the fitted region
+    :param tuple j_range: first and last+1 column of the fitted region
+    :param string method: 'numpy' or 'fft'
+
+    :return: vector of weighted products
+    '''
+    weighted_data = data_image[i_range[0]:i_range[1], j_range[0]:j_range[1]] * \
+                    weights[i_range[0]:i_range[1], j_range[0]:j_range[1]]
+
+    if method == 'fft':
+        return correlation_rows(reference_image, weighted_data[np.newaxis], pandq, kernel_size,
+                                i_range, j_range)[0]
+
+    elif method == 'numpy':
+        n_kernel = len(pandq)
+        rows_per_chunk = max(1, int(MAX_STACK_SIZE / max(1, n_kernel * weighted_data.shape[1])))
+        b_block = np.zeros(n_kernel)
+        for i_start in range(i_range[0], i_range[1], rows_per_chunk):
+            i_end = min(i_start + rows_per_chunk, i_range[1])
+            stack = shifted_images(reference_image, pandq, kernel_size, (i_start, i_end), j_range)
+            chunk = weighted_data[i_start - i_range[0]:i_end - i_range[0]].ravel()
+            b_block += np.dot(stack.reshape(n_kernel, -1), chunk)
+        return b_block
+
+    else:
+        raise ValueError('Unknown b-vector construction method ' + str(method))
+
+def fitted_region(image_shape, kernel_size, nobkg=False):
+    '''
+    Returns the row and column ranges summed over by the corresponding
+    routines of umatrix_routine
+
+    :param tuple image_shape: shape of the image
+    :param int kernel_size: edge length of the kernel in px
+    :param boolean nobkg: use the bounds of the routines without background
+
+    :return: row range, column range
+    '''
+    half_kernel_size = int(kernel_size) // 2
+    if nobkg:
+        upper = int(kernel_size) - half_kernel_size
+    else:
+        upper = half_kernel_size
+
+    return (half_kernel_size, image_shape[0] - upper), (half_kernel_size, image_shape[1] - upper)
+
+def umatrix_construction(reference_image, weights, pandq, n_kernel, kernel_size, method='fft'):
+    '''
+    Vectorised equivalent of umatrix_routine.umatrix_construction
+
+    :param array reference_image: reference image
+    :param array weights: pixel weights
+    :param list pandq: list of (l, m) kernel pixel offsets
+    :param int n_kernel: number of kernel pixels
+    :param int kernel_size: edge length of the kernel in px
+    :param string method: 'numpy' or 'fft'
+
+    :return: u matrix
+    '''
+    reference_image = np.asarray(reference_image, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    n_kernel = int(n_kernel)
+    (i_range, j_range) = fitted_region(reference_image.shape, kernel_size)
+
+    u_matrix = np.zeros([n_kernel + 1, n_kernel + 1])
+    u_block, w_sums = cross_products(reference_image, weights, pandq[:n_kernel], kernel_size,
+                                     i_range, j_range, method=method)
+    u_matrix[:n_kernel, :n_kernel] = u_block
+    u_matrix[n_kernel, :n_kernel] = w_sums
+    u_matrix[:n_kernel, n_kernel] = w_sums
+    u_matrix[n_kernel, n_kernel] = weights.sum()
+
+    return u_matrix
+
+def bvector_construction(reference_image, data_image, weights, pandq, n_kernel, kernel_size, method='fft'):
+    '''
+    Vectorised equivalent of umatrix_routine.bvector_construction
+
+    :param array reference_image: reference image
+    :param array data_image: data image
+    :param array weights: pixel weights
+    :param list pandq: list of (l, m) kernel pixel offsets
+    :param int n_kernel: number of kernel pixels
+    :param int kernel_size: edge length of the kernel in px
+    :param string method: 'numpy' or 'fft'
+
+    :return: b vector
+    '''
+    reference_image = np.asarray(reference_image, dtype=np.float64)
+    data_image = np.asarray(data_image, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    n_kernel = int(n_kernel)
+    (i_range, j_range) = fitted_region(data_image.shape, kernel_size)
+
+    b_vector = np.zeros([n_kernel + 1])
+    b_vector[:n_kernel] = data_products(reference_image, data_image, weights, pandq[:n_kernel],
+                                        kernel_size, i_range, j_range, method=method)
+    b_vector[n_kernel] = (data_image * weights).sum()
+
+    return b_vector
+
+def umatrix_bvector_construction(reference_image, data_image, weights, pandq, n_kernel, kernel_size,
+                                 method='fft'):
+    '''
+    Vectorised equivalent of umatrix_routine.umatrix_bvector_construction
+
+    :param array reference_image: reference image
+    :param array data_image: data image
+    :param array weights: pixel weights
+    :param list pandq: list of (l, m) kernel pixel offsets
+    :param int n_kernel: number of kernel pixels
+    :param int kernel_size: edge length of the kernel in px
+    :param string method: 'numpy' or 'fft'
+
+    :return: u matrix, b vector
+    '''
+    reference_image = np.asarray(reference_image, dtype=np.float64)
+    data_image = np.asarray(data_image, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    n_kernel = int(n_kernel)
+    (i_range, j_range) = fitted_region(data_image.shape, kernel_size, nobkg=True)
+
+    u_matrix = np.zeros([n_kernel + 1, n_kernel + 1])
+    u_block, w_sums = cross_products(reference_image, weights, pandq[:n_kernel], kernel_size,
+                                     i_range, j_range, method=method)
+    u_matrix[:n_kernel, :n_kernel] = u_block
+    u_matrix[n_kernel, :n_kernel] = w_sums
+    u_matrix[:n_kernel, n_kernel] = w_sums
+    u_matrix[n_kernel, n_kernel] = weights.sum()
+
+    b_vector = np.zeros([n_kernel + 1])
+    b_vector[:n_kernel] = data_products(reference_image, data_image, weights, pandq[:n_kernel],
+                                        kernel_size, i_range, j_range, method=method)
+    b_vector[n_kernel] = (data_image * weights).sum()
+
+    return u_matrix, b_vector
+
+def umatrix_construction_nobkg(reference_image, weights, pandq, n_kernel, kernel_size, method='fft'):
+    '''
+    Vectorised equivalent of umatrix_routine.umatrix_construction_nobkg
+
+    :param array reference_image: reference image
+    :param array weights: pixel weights
+    :param list pandq: list of (l, m) kernel pixel offsets
+    :param int n_kernel: number of kernel pixels
+    :param int kernel_size: edge length of the kernel in px
+    :param string method: 'numpy' or 'fft'
+
+    :return: u matrix
+    '''
+    reference_image = np.asarray(reference_image, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    n_kernel = int(n_kernel)
+    (i_range, j_range) = fitted_region(reference_image.shape, kernel_size, nobkg=True)
+
+    u_matrix, w_sums = cross_products(reference_image, weights, pandq[:n_kernel], kernel_size,
+                                      i_range, j_range, method=method)
+
+    return u_matrix
+
+def bvector_construction_nobkg(reference_image, data_image, weights, pandq, n_kernel, kernel_size, method='fft'):
+    '''
+    Vectorised equivalent of umatrix_routine.bvector_construction_nobkg
+
+    :param array reference_image: reference image
+    :param array data_image: data image
+    :param array weights: pixel weights
+    :param list pandq: list of (l, m) kernel pixel offsets
+    :param int n_kernel: number of kernel pixels
+    :param int kernel_size: edge length of the kernel in px
+    :param string method: 'numpy' or 'fft'
+
+    :return: b vector
+    '''
+    reference_image = np.asarray(reference_image, dtype=np.float64)
+    data_image = np.asarray(data_image, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    n_kernel = int(n_kernel)
+    (i_range, j_range) = fitted_region(data_image.shape, kernel_size, nobkg=True)
+
+    return data_products(reference_image, data_image, weights, pandq[:n_kernel], kernel_size,
+                         i_range, j_range, method=method)
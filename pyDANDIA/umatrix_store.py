@@ -0,0 +1,235 @@
+######################################################################
+#
+# umatrix_store.py - On-disk store of the unweighted stage5 u-matrices.
+#
+# The u-matrix of a stamp only depends on the reference image and master
+# mask within the stamp, the kernel size and the saturation level, so
+# it is computed once and reused by every run of stage5. Each entry of
+# the store is a plain .npy file, loaded memory-mapped, and the store is
+# described by a JSON index. Entries are keyed by checksums of their
+# inputs, so that a change to one stamp of the reference image or mask
+# only invalidates the entries of that stamp.
+#
+######################################################################
+
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+
+STORE_VERSION = 1
+INDEX_FILE = 'index.json'
+PRODUCTS = ['umatrix', 'ufactor', 'uinvdiag']
+
+# Pickled u-matrix caches of the kernel directory replaced by the store
+LEGACY_FILES = ['unweighted_u_matrix.npy', 'unweighted_u_matrix_factors.npy']
+
+
+def array_checksum(data):
+    '''
+    SHA1 checksum of the values of an array, independent of its memory layout
+
+    :param object data: array or array-like
+    :return: hex digest
+    '''
+    data = np.ascontiguousarray(np.asarray(data))
+    checksum = hashlib.sha1(str(data.dtype).encode())
+    checksum.update(str(data.shape).encode())
+    checksum.update(data.tobytes())
+
+    return checksum.hexdigest()
+
+
+class UMatrixStore:
+    '''
+    Versioned store of u-matrices and their Cholesky factorisations,
+    one entry per kernel size and stamp.
+
+    :param string store_directory: directory holding the store
+    :param logger log: open reduction log, optional
+    '''
+
+    def __init__(self, store_directory, log=None):
+
+        self.store_directory = store_directory
+        self.log = log
+        self.entries = {}
+        self.used_keys = set()
+        self.n_added = 0
+
+        self.read_index()
+
+    def read_index(self):
+        '''Load the index of the store, discarding it if it is unreadable
+        or was written by a different version of the store'''
+
+        index_path = os.path.join(self.store_directory, INDEX_FILE)
+
+        if not os.path.isfile(index_path):
+            return
+
+        try:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+        except (IOError, ValueError) as e:
+            self.log_info('Could not read the u-matrix store index, rebuilding it: ' + str(e))
+            return
+
+        if index.get('version') != STORE_VERSION:
+            self.log_info('U-matrix store version ' + repr(index.get('version'))
+                          + ' is out of date, rebuilding it')
+            return
+
+        self.entries = index.get('entries', {})
+
+    def log_info(self, message):
+        if self.log is not None:
+            self.log.info(message)
+
+    def entry_key(self, reference_stamp, mask_stamp, kernel_size, max_adu):
+        '''
+        Key of the u-matrix entry for a stamp
+
+        :param object reference_stamp: reference image pixels of the stamp
+        :param object mask_stamp: master mask pixels of the stamp
+        :param int kernel_size: kernel size
+        :param float max_adu: saturation level
+        :return: (key, entry description)
+        '''
+
+        description = {'reference_checksum': array_checksum(np.asarray(reference_stamp, dtype=float)),
+                       'mask_checksum': array_checksum(mask_stamp),
+                       'kernel_size': int(kernel_size),
+                       'max_adu': float(max_adu)}
+
+        key = hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+        return key, description
+
+    def entry_path(self, key, product):
+
+        return os.path.join(self.store_directory, product + '_' + key + '.npy')
+
+    def has_entry(self, key):
+        '''Whether the entry is in the store with all of its files'''
+
+        if key not in self.entries:
+            return False
+
+        products = ['umatrix']
+        if self.entries[key]['factorised']:
+            products += ['ufactor', 'uinvdiag']
+
+        return all([os.path.isfile(self.entry_path(key, product)) for product in products])
+
+    def fetch(self, key, mmap_mode='r'):
+        '''
+        Load an entry of the store
+
+        :param string key: entry key
+        :param string mmap_mode: numpy memory-map mode, None to read into memory
+        :return: u_matrix, u_factor (None if the u-matrix is not positive definite)
+        '''
+
+        u_matrix = np.load(self.entry_path(key, 'umatrix'), mmap_mode=mmap_mode)
+
+        if self.entries[key]['factorised']:
+            u_factor = [np.load(self.entry_path(key, 'ufactor'), mmap_mode=mmap_mode),
+                        np.load(self.entry_path(key, 'uinvdiag'), mmap_mode=mmap_mode)]
+        else:
+            u_factor = None
+
+        self.used_keys.add(key)
+
+        return u_matrix, u_factor
+
+    def add_entry(self, key, description, u_matrix, u_factor):
+        '''
+        Write an entry to the store. The index is only updated on disk by
+        save_index.
+
+        :param string key: entry key, from entry_key
+        :param dict description: entry description, from entry_key
+        :param object u_matrix: u-matrix
+        :param list u_factor: factorisation of the u-matrix or None
+        '''
+
+        if not os.path.isdir(self.store_directory):
+            os.makedirs(self.store_directory)
+
+        np.save(self.entry_path(key, 'umatrix'), np.asarray(u_matrix, dtype=float))
+
+        if u_factor is not None:
+            np.save(self.entry_path(key, 'ufactor'), np.asarray(u_factor[0], dtype=float))
+            np.save(self.entry_path(key, 'uinvdiag'), np.asarray(u_factor[1], dtype=float))
+
+        entry = dict(description)
+        entry['factorised'] = u_factor is not None
+        self.entries[key] = entry
+        self.used_keys.add(key)
+        self.n_added += 1
+
+    def prune(self):
+        '''Remove the entries that were neither fetched nor added since the
+        store was opened, i.e. those superseded by a change of the reference
+        image, master mask, kernel sizes or saturation level'''
+
+        stale_keys = [key for key in self.entries.keys() if key not in self.used_keys]
+
+        for key in stale_keys:
+            for product in PRODUCTS:
+                if os.path.isfile(self.entry_path(key, product)):
+                    os.remove(self.entry_path(key, product))
+            del self.entries[key]
+
+        # Entry files missing from the index, e.g. those of an index that was
+        # unreadable or written by a different version of the store
+        orphan_keys = set()
+        for product in PRODUCTS:
+            for file_path in glob.glob(os.path.join(self.store_directory, product + '_*.npy')):
+                key = os.path.basename(file_path)[len(product)+1:-len('.npy')]
+                if key not in self.entries:
+                    os.remove(file_path)
+                    orphan_keys.add(key)
+
+        return len(stale_keys) + len(orphan_keys)
+
+    def save_index(self):
+        '''Write the index of the store, replacing the previous one atomically'''
+
+        if not os.path.isdir(self.store_directory):
+            os.makedirs(self.store_directory)
+
+        index_path = os.path.join(self.store_directory, INDEX_FILE)
+
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({'version': STORE_VERSION, 'entries': self.entries}, f, indent=1, sort_keys=True)
+
+        os.replace(index_path + '.tmp', index_path)
+
+
+def remove_legacy_files(kernel_directory, log=None):
+    '''
+    Remove the pickled u-matrix caches that predate the store from a kernel
+    directory. They hold the u-matrices of the whole stamp grid without the
+    checksums of the stamps, so they cannot be migrated into the store.
+
+    :param string kernel_directory: path to the kernel directory
+    :param logger log: open reduction log, optional
+    :return: number of files removed
+    '''
+
+    n_removed = 0
+
+    for file_name in LEGACY_FILES:
+        file_path = os.path.join(kernel_directory, file_name)
+
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+            n_removed += 1
+
+            if log is not None:
+                log.info('Removed the legacy u-matrix cache ' + file_path)
+
+    return n_removed